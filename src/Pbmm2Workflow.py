@@ -16,12 +16,54 @@
 
 import subprocess
 import os
-from pathlib import Path
+import time as time_module
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from typing import Dict, List, Optional, Tuple
+from pydantic import BaseModel
 from src.constants import SAMTOOLS_STATS
-from src.logging_utils import add_to_log
-from src.config_utils import load_config, print_config, Config
+from src.logging_utils import add_to_log, keep_log_open
+from src.config_utils import load_config, print_config, use_config, Config, QC_ENGINE_NATIVE
+from src.bam_stats_utils import quickcheck, get_record_count
 from src.file_utils import get_file_without_extension, remove_files
-from src.qc_utils import parse_and_store_qc_outputs, QC_locations, QC_location
+from src.qc_utils import (
+    parse_and_store_qc_outputs,
+    parse_samtools_stats,
+    read_qc_file,
+    store_qc_metrics,
+    merge_samtools_stats,
+    QC_locations,
+    QC_location,
+)
+from src.sample_utils import SampleAssignment
+from src.slurm_utils import (
+    JobSubmission,
+    JobMarker,
+    read_job_marker,
+    write_job_marker,
+    get_job_states,
+    parse_memory,
+    format_memory,
+    parse_time,
+    format_time,
+    FAILURE_STATES,
+    TOOL_FAILURE_STATES,
+)
+from src.executor_utils import get_executor, is_local_job_id, get_local_job_state
+from src.slurm_utils import get_active_job_ids
+from src.lock_utils import SampleLock, create_file_exclusively
+from src.profiling_utils import profiled
+from src.snapshot_utils import FolderSnapshot
+from src.traversal_utils import iter_files
+from src.cache_utils import get_cache_key, has_cache_entry, restore_from_cache, add_to_cache
+from src.scheduling_utils import (
+    ScheduledJob,
+    estimate_runtime,
+    order_largest_first,
+    hold_back_jobs,
+    estimate_completion,
+    print_schedule,
+)
 
 EXT_ALIGNMENT_RUNNING = "alignment_running"
 EXT_ALIGNMENT_SLURM_OUT = "align_slurm_out"
@@ -31,6 +73,86 @@ EXT_CHECKS_COMPLETE = "aligned_sorted.checks_complete"
 EXT_QC_RUNNING = "aligned_sorted.qc_running"
 EXT_QC_SLURM_OUT = "aligned_sorted.qc_slurm_out"
 EXT_SAMTOOLS_STATS = "aligned_sorted.stats.txt"
+EXT_QC = "aligned_sorted.qc"
+EXT_CRAM = "aligned_sorted.cram"
+EXT_CRAM_INDEXED = "aligned_sorted.cram.crai"
+EXT_CRAM_RUNNING = "aligned_sorted.cram_running"
+EXT_CRAM_SLURM_OUT = "aligned_sorted.cram_slurm_out"
+# Number of primary records in the CRAM, written at the end of the conversion job
+EXT_CRAM_RECORD_COUNT = "aligned_sorted.cram_record_count"
+# Files of a sample whose movies are merged, see get_sample_file_name
+EXT_MERGED = "merged.aligned_sorted.bam"
+EXT_MERGED_INDEXED = "merged.aligned_sorted.bam.bai"
+EXT_MERGE_RUNNING = "merge_running"
+EXT_MERGE_SLURM_OUT = "merge_slurm_out"
+# Number of records in the merged BAM (from its index), written at the end of the merge job
+EXT_MERGE_RECORD_COUNT = "merged.record_count"
+EXT_MERGED_QC = "merged.aligned_sorted.qc"
+EXT_LOCK = "o2p_lock"
+# Number of locks (each holding a file descriptor) after which the queued jobs of a batch run
+# are submitted and the locks are released, see resume_workflow_batch
+MAX_HELD_LOCKS = 256
+
+PBMM2_PRESET = "CCS"
+
+STATE_PENDING = "pending"
+STATE_ALIGNMENT_RUNNING = "alignment_running"
+STATE_ALIGNMENT_FAILED = "alignment_failed"
+STATE_ALIGNMENT_COMPLETE = "alignment_complete"
+STATE_CHECKS_COMPLETE = "checks_complete"
+STATE_QC_RUNNING = "qc_running"
+STATE_QC_FAILED = "qc_failed"
+STATE_QC_COMPLETE = "qc_complete"
+STATE_QC_PARSED = "qc_parsed"
+STATE_CRAM_RUNNING = "cram_running"
+STATE_CRAM_FAILED = "cram_failed"
+STATE_CRAM_COMPLETE = "cram_complete"
+STATE_MERGE_RUNNING = "merge_running"
+STATE_MERGE_FAILED = "merge_failed"
+STATE_MERGE_COMPLETE = "merge_complete"
+STATE_WORKFLOW_COMPLETE = "complete"
+
+# Actions taken by a run of the workflow for a file, see StepResult
+ACTION_NONE = "none"
+ACTION_WAIT = "wait"
+ACTION_SKIP_LOCKED = "skip_locked"
+ACTION_HOLD_BACK = "hold_back"
+ACTION_SUBMIT_ALIGNMENT = "submit_alignment"
+ACTION_RESTORE_FROM_CACHE = "restore_from_cache"
+ACTION_RUN_CHECKS = "run_checks"
+ACTION_SUBMIT_QC = "submit_qc"
+ACTION_PARSE_QC = "parse_qc"
+ACTION_SUBMIT_CRAM = "submit_cram"
+ACTION_VERIFY_CRAM = "verify_cram"
+ACTION_SUBMIT_MERGE = "submit_merge"
+ACTION_VERIFY_MERGE = "verify_merge"
+ACTION_RETRY = "retry"
+ACTION_NOT_RETRIED = "not_retried"
+
+STEP_ALIGNMENT = "alignment"
+STEP_QC = "qc"
+STEP_CRAM = "cram"
+STEP_MERGE = "merge"
+# Running marker and Slurm output of the job of each step
+STEP_JOB_EXTENSIONS = {
+    STEP_ALIGNMENT: (EXT_ALIGNMENT_RUNNING, EXT_ALIGNMENT_SLURM_OUT),
+    STEP_QC: (EXT_QC_RUNNING, EXT_QC_SLURM_OUT),
+    STEP_CRAM: (EXT_CRAM_RUNNING, EXT_CRAM_SLURM_OUT),
+    STEP_MERGE: (EXT_MERGE_RUNNING, EXT_MERGE_SLURM_OUT),
+}
+
+# samtools stats metric with the number of primary records of the aligned BAM
+QC_METRIC_PRIMARY_RECORDS = f"{SAMTOOLS_STATS}: raw total sequences"
+# samtools stats metrics that, together with the primary records, add up to all records of a BAM
+QC_METRICS_NON_PRIMARY_RECORDS = [
+    f"{SAMTOOLS_STATS}: non-primary alignments",
+    f"{SAMTOOLS_STATS}: supplementary alignments",
+]
+
+# Resources of the samtools stats jobs. Should not need to allocate more resources than what's set
+QC_ALLOCATED_TIME = "00-04:00:00"
+QC_ALLOCATED_MEMORY = "4G"
+QC_ALLOCATED_THREADS = 2
 
 REQ_PACKAGES = [
     ("pbmm2", "1.13"),
@@ -38,155 +160,1271 @@ REQ_PACKAGES = [
     ]
 
 
+def get_required_packages(config: Config) -> list:
+    """samtools is not required if the native QC engine is used and the steps that need samtools
+    (CRAM conversion, merging) are disabled
+    """
+
+    if (
+        config.qc_config.engine == QC_ENGINE_NATIVE
+        and not config.cram_config.enabled
+        and not config.merge_config.enabled
+    ):
+        return [package for package in REQ_PACKAGES if package[0] != "samtools"]
+    return REQ_PACKAGES
+
+
+class StepResult(BaseModel):
+    """Outcome of advancing the workflow for one file, see Pbmm2Workflow.advance"""
+
+    # Path of the unaligned BAM
+    file: str
+    previous_state: Optional[str] = None
+    new_state: Optional[str] = None
+    # One of the ACTION_* constants
+    action: Optional[str] = None
+    job_id: Optional[str] = None
+    # Seconds it took to run the step (without the batched job submission)
+    duration: float = 0.0
+    error: Optional[str] = None
+
+
+class JobRetry(BaseModel):
+    """Resubmission of a failed job, see Pbmm2Workflow.get_job_retry"""
+
+    job_id: Optional[str] = None
+    job_state: Optional[str] = None
+    # Attempt of the failed job
+    attempt: int = 1
+    # Resources of the next attempt
+    time: str
+    memory: str
+    # Reason the job is not resubmitted, None if it is
+    not_retried: Optional[str] = None
+
+
 class Pbmm2Workflow:
-    def __init__(self, working_directory):
-        self.check_packages(REQ_PACKAGES)
+    def __init__(
+        self,
+        working_directory,
+        executor_name: str = None,
+        read_only: bool = False,
+        check_requirements: bool = True,
+        executor=None,
+    ):
+        """
+        Args:
+            working_directory (str): folder with the unaligned BAMs
+            executor_name (str): executor to run the jobs with. Defaults to the executor in the config
+            read_only (bool): only inspect the states of the files (e.g. for status reports and
+                metrics). No packages are required and no step can be run
+            check_requirements (bool): check the required packages and print the setup. Batch runs
+                do this once for all folders, see advance
+            executor: executor that is shared with other workflows, so that they share its
+                submission limits and CPUs (see advance). Overrides executor_name
+        """
+
+        self.read_only = read_only
         self.config : Config = load_config()
+        if not read_only and check_requirements:
+            self.check_packages(get_required_packages(self.config))
         self.dir = working_directory
-
+        self.executor = executor or get_executor(self.config, executor_name)
+        # When set, jobs are collected and submitted together by submit_pending_jobs
+        self.batch_submissions = False
+        self.pending_submissions: List[JobSubmission] = []
+        # Slurm job states by job ID, see prefetch_job_states
+        self.job_states = {}
+        # Locks of the files that are currently advanced by this process, by file name
+        self.held_locks = {}
+        # Snapshot of the files in the working directory, see take_snapshot
+        self.snapshot: Optional[FolderSnapshot] = None
+        # Sample of each movie, if the movies of a sample are merged
+        self.sample_assignment: Optional[SampleAssignment] = None
+        if self.config.merge_config.enabled:
+            # Not combined with the CRAM conversion, see Config.check_cram_and_merge
+            self.sample_assignment = SampleAssignment(self.config.merge_config)
+        # Movies of each sample, see get_sample_movies
+        self.sample_movies: Optional[Dict[str, List[str]]] = None
+        # Size and modification time of each unaligned BAM with its cache key, see get_alignment_cache_key
+        self.alignment_cache_keys: Dict[str, Tuple[Tuple[int, int], str]] = {}
+
+        if read_only or not check_requirements:
+            return
         print(f"Working directory: {self.dir}")
+        print(f"Executor: {self.executor.name}")
         print(f"Used configuration:")
         print_config()
 
-    def resume_workflow_single(self, file_name):
+    def get_state(self, file_name: str) -> str:
+        """Returns the current workflow state of a file, i.e. the last step that has been completed
+        or is running
+
+        Args:
+            file_name (str): file name of the unaligned BAM
+        """
+
         if self.is_workflow_complete(file_name):
+            return STATE_WORKFLOW_COMPLETE
+        elif self.is_qc_parsed(file_name):
+            # Only reached if the CRAM conversion or merging is enabled
+            sample = self.get_sample(file_name)
+            if sample:
+                sample_file_name = self.get_sample_file_name(sample)
+                if not self.is_merge_running(sample):
+                    return STATE_QC_PARSED
+                elif self.is_merge_complete(sample):
+                    return STATE_MERGE_COMPLETE
+                elif self.get_failed_job_state(sample_file_name, EXT_MERGE_RUNNING):
+                    return STATE_MERGE_FAILED
+                return STATE_MERGE_RUNNING
+            if not self.is_cram_running(file_name):
+                return STATE_QC_PARSED
+            elif self.is_cram_complete(file_name):
+                return STATE_CRAM_COMPLETE
+            elif self.get_failed_job_state(file_name, EXT_CRAM_RUNNING):
+                return STATE_CRAM_FAILED
+            return STATE_CRAM_RUNNING
+        elif self.is_qc_complete(file_name):
+            return STATE_QC_COMPLETE
+        elif self.is_qc_running(file_name):
+            if self.get_failed_job_state(file_name, EXT_QC_RUNNING):
+                return STATE_QC_FAILED
+            return STATE_QC_RUNNING
+        elif self.are_checks_complete(file_name):
+            return STATE_CHECKS_COMPLETE
+        elif self.is_alignment_running(file_name) and self.get_failed_job_state(
+            file_name, EXT_ALIGNMENT_RUNNING
+        ):
+            return STATE_ALIGNMENT_FAILED
+        elif self.is_alignment_complete(file_name):
+            return STATE_ALIGNMENT_COMPLETE
+        elif self.is_alignment_running(file_name):
+            return STATE_ALIGNMENT_RUNNING
+        return STATE_PENDING
+
+    def resume_workflow_single(self, file_name):
+        """Runs the next workflow step for a single file. The file is locked while the step is run
+        and, if submissions are batched and the step queued a job, until its job is submitted.
+        Files that are locked by another run of the workflow are skipped.
+
+        Args:
+            file_name (str): file name of the unaligned BAM
+
+        Returns:
+            str: the action taken, one of the ACTION_* constants
+        """
+
+        held_locks = set(self.held_locks)
+        num_pending_submissions = len(self.pending_submissions)
+        if not self.acquire_lock(file_name):
+            return ACTION_SKIP_LOCKED
+        try:
+            return self.run_next_step(file_name)
+        finally:
+            if not self.batch_submissions:
+                self.release_locks()
+            elif len(self.pending_submissions) == num_pending_submissions:
+                # Nothing to submit: the locks of this step (of the file and, for sample steps, of
+                # the sample) are released right away, so that only files with queued jobs hold
+                # a lock (and its file descriptor) until the batch is submitted
+                for locked_file_name in set(self.held_locks) - held_locks:
+                    self.release_lock(locked_file_name)
+
+    def run_next_step(self, file_name) -> str:
+        state = self.get_state(file_name)
+        if state == STATE_WORKFLOW_COMPLETE:
             print(
                 f"The workflow is complete for file {file_name}. Nothing else is done for this file."
             )
-            return
-        elif self.is_qc_complete(file_name):
+            return ACTION_NONE
+        elif state == STATE_CRAM_COMPLETE:
+            print(f"Verifying the CRAM of file {file_name}.")
+            self.verify_cram(file_name)
+            self.add_alignment_to_cache(file_name)
+            return ACTION_VERIFY_CRAM
+        elif state == STATE_CRAM_FAILED:
+            return self.handle_failed_job(file_name, STEP_CRAM)
+        elif state == STATE_CRAM_RUNNING:
+            print(
+                f"CRAM conversion for file {file_name} is currently running. Please rerun command when it is done."
+            )
+            return ACTION_WAIT
+        elif state in [STATE_QC_PARSED, STATE_MERGE_RUNNING, STATE_MERGE_FAILED, STATE_MERGE_COMPLETE] and self.get_sample(file_name):
+            return self.run_next_sample_step(file_name, state)
+        elif state == STATE_QC_PARSED:
+            print(f"Converting the aligned BAM of file {file_name} to CRAM.")
+            self.run_cram(file_name)
+            return ACTION_SUBMIT_CRAM
+        elif state == STATE_QC_COMPLETE:
             print(f"Parsing QCs and cleaning up for file {file_name}.")
 
             # TODO: Improve error handling
-            file_name_without_ext = get_file_without_extension(file_name)
             path_to_stats = self.get_file_with_extension(file_name, EXT_SAMTOOLS_STATS)
             qc_location = QC_location(qc_tool=SAMTOOLS_STATS, output_path=path_to_stats)
             qc_locations = QC_locations([qc_location])
-            qc_output_path = f"{self.dir}/qc/{file_name_without_ext}.aligned_sorted.qc"
+            qc_output_path = self.get_qc_file(file_name)
+            if self.config.qc_config.reconcile_read_counts:
+                self.reconcile_read_counts(file_name)
             # Run QC parser which produces the .qc file
-            add_to_log(f"Parsing QC outputs for {file_name} and storing .qc file")
+            add_to_log(
+                f"Parsing QC outputs for {self.get_file_with_extension(file_name, 'bam')} and storing .qc file"
+            )
             parse_and_store_qc_outputs(qc_locations, qc_output_path)
 
             self.cleanup(file_name)
             print(f"Finished parsing qc outputs and cleaning up intermediate files for {file_name}.")
-            return
-        elif self.is_qc_running(file_name):
+            if not self.config.cram_config.enabled:
+                self.add_alignment_to_cache(file_name)
+            return ACTION_PARSE_QC
+        elif state == STATE_QC_FAILED:
+            return self.handle_failed_job(file_name, STEP_QC)
+        elif state == STATE_QC_RUNNING:
             print(
                 f"QC for file {file_name} is currently running. Please rerun command when it is done."
             )
-            return
-        elif self.are_checks_complete(file_name):
+            return ACTION_WAIT
+        elif state == STATE_CHECKS_COMPLETE:
             print(f"Running QC for file {file_name}")
             self.run_qc(file_name)
-        elif self.is_alignment_complete(file_name):
+            return ACTION_SUBMIT_QC
+        elif state == STATE_ALIGNMENT_FAILED:
+            return self.handle_failed_job(file_name, STEP_ALIGNMENT)
+        elif state == STATE_ALIGNMENT_COMPLETE:
             print(f"Running basic checks for file {file_name}")
             self.run_alignment_checks(file_name)
-        elif self.is_alignment_running(file_name):
+            return ACTION_RUN_CHECKS
+        elif state == STATE_ALIGNMENT_RUNNING:
             print(
                 f"Alignment for file {file_name} is currently running. Please rerun command when it is done."
             )
-            return
+            return ACTION_WAIT
+        elif self.restore_alignment_from_cache(file_name):
+            print(
+                f"Found the alignment of file {file_name} in the cache. The workflow is complete for this file."
+            )
+            return ACTION_RESTORE_FROM_CACHE
+        self.run_pbmm2(file_name)
+        return ACTION_SUBMIT_ALIGNMENT
+
+    def run_next_sample_step(self, file_name: str, state: str) -> str:
+        """Runs the next step of the sample of a movie whose QC has been parsed: the aligned
+        movie BAMs are merged once the QC of all movies of the sample has been parsed, and the
+        merged BAM is verified once the merge is complete. Sample steps are run under the lock
+        of the sample.
+
+        Args:
+            file_name (str): file name of the unaligned movie BAM
+            state (str): state of the movie
+
+        Returns:
+            str: the action taken, one of the ACTION_* constants
+        """
+
+        sample = self.get_sample(file_name)
+        sample_file_name = self.get_sample_file_name(sample)
+        if state == STATE_MERGE_RUNNING:
+            print(
+                f"Merging of sample {sample} is currently running. Please rerun command when it is done."
+            )
+            return ACTION_WAIT
+        if not self.acquire_lock(sample_file_name):
+            return ACTION_SKIP_LOCKED
+        if state == STATE_MERGE_COMPLETE:
+            print(f"Verifying the merged BAM of sample {sample}.")
+            self.verify_merge(sample)
+            return ACTION_VERIFY_MERGE
+        if state == STATE_MERGE_FAILED:
+            return self.handle_failed_job(sample_file_name, STEP_MERGE)
+
+        # The merge is submitted once, by the first movie that finds all movies ready
+        merge_marker = self.get_file_with_extension(sample_file_name, EXT_MERGE_RUNNING)
+        if self.is_merge_running(sample) or any(
+            submission.marker_path == merge_marker for submission in self.pending_submissions
+        ):
+            print(f"Merging of sample {sample} has been started.")
+            return ACTION_WAIT
+        waiting_for = [
+            movie for movie in self.get_sample_movies(sample)
+            if not self.is_file(self.get_file_with_extension(movie, "bam")) or not self.is_qc_parsed(movie)
+        ]
+        if waiting_for:
+            print(f"Waiting for the QC of {', '.join(waiting_for)} before merging sample {sample}.")
+            return ACTION_WAIT
+        print(f"Merging the aligned movie BAMs of sample {sample}.")
+        self.run_merge(sample)
+        return ACTION_SUBMIT_MERGE
+
+    def resume_workflow_all(self, dry_run: bool = False) -> List[StepResult]:
+        """Runs the next workflow step for all unaligned BAMs in the working directory.
+        Alignment and QC jobs are submitted largest input first and only as long as the
+        step has fewer in-flight jobs than configured; the remaining jobs are held back
+        until a later run.
+
+        Args:
+            dry_run (bool): only print the planned submissions and the estimated completion time
+        """
+
+        return self.resume_workflow_batch(dry_run=dry_run)
+
+    def resume_workflow_batch(
+        self,
+        file_names: Optional[List[str]] = None,
+        dry_run: bool = False,
+        stop_on_error: bool = True,
+    ) -> List[StepResult]:
+        """Runs the next workflow step for the given files like resume_workflow_all. The
+        submissions are planned from one snapshot of the working directory; each step checks
+        the state of its file on disk again once the file is locked. Files stay locked until
+        their queued job is submitted, and the queued jobs are submitted whenever MAX_HELD_LOCKS
+        files are locked, so that the open lock files stay bounded.
+
+        Args:
+            file_names (List[str]): file names of the unaligned BAMs. Defaults to all unaligned
+                BAMs in the working directory
+            dry_run (bool): only print the planned submissions and the estimated completion time
+            stop_on_error (bool): raise the first error. Otherwise, errors are stored in the
+                results and the remaining files are advanced
+
+        Returns:
+            List[StepResult]: one result per file, empty for dry runs
+        """
+
+        # Not assigned with take_snapshot, since steps must not be run on the snapshot
+        self.snapshot = FolderSnapshot(self.dir)
+        self.sample_movies = None
+        try:
+            if file_names is None:
+                file_names = self.get_unaligned_bams()
+            self.prefetch_job_states(file_names)
+            states = {file_name: self.get_state(file_name) for file_name in file_names}
+            scheduled_jobs = self.plan_submissions(states, print_report=dry_run)
+        finally:
+            self.snapshot = None
+        if dry_run:
+            return []
+
+        results = {
+            file_name: StepResult(
+                file=self.get_file_with_extension(file_name, "bam"), previous_state=states[file_name]
+            )
+            for file_name in file_names
+        }
+        # Job submission of each file, if any
+        submissions: Dict[str, JobSubmission] = {}
+
+        def advance_file(file_name: str):
+            result = results[file_name]
+            num_pending_submissions = len(self.pending_submissions)
+            start = time_module.time()
+            try:
+                result.action = self.resume_workflow_single(file_name)
+            except Exception as e:
+                if stop_on_error:
+                    raise
+                result.error = str(e)
+            finally:
+                result.duration = time_module.time() - start
+            if len(self.pending_submissions) > num_pending_submissions:
+                submissions[file_name] = self.pending_submissions[-1]
+            if len(self.held_locks) >= MAX_HELD_LOCKS:
+                submit_and_release()
+
+        def submit_and_release():
+            try:
+                self.submit_pending_jobs()
+            except Exception:
+                # Errors of the single submissions are stored in the results below
+                if stop_on_error:
+                    raise
+            finally:
+                self.release_locks()
+
+        scheduled_file_names = {job.file_name for job in scheduled_jobs}
+        self.batch_submissions = True
+        try:
+            # Steps without job submissions first, then the submissions in the planned order
+            for file_name in file_names:
+                if file_name not in scheduled_file_names:
+                    advance_file(file_name)
+            for job in scheduled_jobs:
+                if job.held_back:
+                    print(
+                        f"Holding back {job.step} job for file {job.file_name}: too many {job.step} jobs in flight."
+                    )
+                    results[job.file_name].action = ACTION_HOLD_BACK
+                else:
+                    advance_file(job.file_name)
+            self.batch_submissions = False
+            submit_and_release()
+        finally:
+            self.batch_submissions = False
+            self.release_locks()
+
+        for file_name, submission in submissions.items():
+            results[file_name].job_id = submission.job_id
+            if submission.error:
+                results[file_name].error = submission.error
+        # One sacct call for the jobs of all files, e.g. the ones that were just submitted
+        self.prefetch_job_states(file_names)
+        for file_name in file_names:
+            try:
+                results[file_name].new_state = self.get_state(file_name)
+            except Exception as e:
+                results[file_name].error = results[file_name].error or str(e)
+        return [results[file_name] for file_name in file_names]
+
+    @classmethod
+    def advance(
+        cls, paths: List[str], workers: int = 1, executor_name: str = None
+    ) -> List[StepResult]:
+        """Runs the next workflow step for the given unaligned BAMs and all unaligned BAMs in the
+        given folders, and returns what was done for each file instead of raising errors.
+        Folders are advanced in parallel by `workers` threads, the files of a folder one after
+        another like resume_workflow_all. The config is loaded, the packages are checked, the
+        executor is created and the log file is opened once for all folders.
+
+        Args:
+            paths (List[str]): unaligned BAMs and folders with unaligned BAMs
+            workers (int): number of folders that are advanced at the same time
+            executor_name (str): executor to run the jobs with. Defaults to the executor in the config
+
+        Returns:
+            List[StepResult]: one result per file, in the order of the given paths
+        """
+
+        # File names by folder. None: all unaligned BAMs of the folder
+        folders: Dict[str, Optional[List[str]]] = {}
+        for path in paths:
+            path = os.path.abspath(path.rstrip("/"))
+            if os.path.isdir(path):
+                folders[path] = None
+            elif os.path.isfile(path) and path.endswith(".bam") and EXT_ALIGNED_SORTED not in path:
+                folder = os.path.dirname(path)
+                if folder not in folders:
+                    folders[folder] = []
+                if folders[folder] is not None and os.path.basename(path) not in folders[folder]:
+                    folders[folder].append(os.path.basename(path))
+            else:
+                raise ValueError(f"Please provide unaligned BAMs or folders with unaligned BAMs: {path}")
+
+        config = load_config()
+        # Fails the whole batch right away, like the constructor does for a single folder
+        cls.check_packages(get_required_packages(config))
+        # One executor for all folders, so that the sbatch rate limit and the local CPUs are
+        # shared by the folders that are advanced at the same time
+        executor = get_executor(config, executor_name)
+
+        def advance_folder(folder: str) -> List[StepResult]:
+            try:
+                workflow = cls(folder, check_requirements=False, executor=executor)
+                return workflow.resume_workflow_batch(folders[folder], stop_on_error=False)
+            except Exception as e:
+                # The folder could not be planned, e.g. because a marker is unreadable
+                return [
+                    StepResult(file=f"{folder}/{file_name}", error=str(e))
+                    for file_name in folders[folder] or []
+                ] or [StepResult(file=folder, error=str(e))]
+
+        with use_config(config), keep_log_open():
+            with ThreadPoolExecutor(max_workers=max(workers, 1)) as pool:
+                return [
+                    result
+                    for folder_results in pool.map(advance_folder, folders)
+                    for result in folder_results
+                ]
+
+    def get_unaligned_bams(self) -> List[str]:
+        """Returns the file names of the unaligned BAMs in the working directory"""
+
+        if self.snapshot:
+            file_names = self.snapshot.get_file_names(suffix=".bam")
         else:
-            self.run_pbmm2(file_name)
-
-    def resume_workflow_all(self):
-        pathlist = Path(self.dir).rglob("*.bam")
-        for path_obj in pathlist:
-            file_name = str(path_obj.name)
-            # Do not run the workflow on aligned BAM files
-            if EXT_ALIGNED_SORTED in file_name:
+            # The workflow only runs on the BAMs directly in the working directory
+            file_names = [os.path.basename(path) for path in iter_files(self.dir, include=["*.bam"], max_depth=0)]
+        # Do not run the workflow on aligned BAM files
+        return [file_name for file_name in file_names if EXT_ALIGNED_SORTED not in file_name]
+
+    def take_snapshot(self):
+        """Lists the files of the working directory once. Afterwards, the states of the files
+        are determined from the snapshot instead of checking each file on disk. Only allowed
+        for read-only workflows, since the snapshot does not reflect files created later on.
+        """
+
+        if not self.read_only:
+            raise Exception("Snapshots can only be used by read-only workflows.")
+        self.snapshot = FolderSnapshot(self.dir)
+
+    def plan_submissions(self, states: dict, print_report: bool = False) -> List[ScheduledJob]:
+        """Plans the alignment and QC submissions for the given files: largest input first,
+        and jobs that would exceed the in-flight limit of a step are held back. Failed jobs that
+        are resubmitted are planned like new submissions, so that a wave of failures can't
+        exceed the limit. Pending files whose alignment is in the cache are not planned, they
+        are restored instead.
+
+        Args:
+            states (dict): workflow state of each file, keyed by file name
+            print_report (bool): print the planned order and the estimated completion time
+        """
+
+        scheduling_config = self.config.scheduling_config
+        # Failed jobs that are not retried are only reported, they don't take a slot
+        retried_states = {STATE_ALIGNMENT_FAILED: STEP_ALIGNMENT, STATE_QC_FAILED: STEP_QC}
+        states = {
+            file_name: state
+            for file_name, state in states.items()
+            if state not in retried_states or not self.get_job_retry(file_name, retried_states[state]).not_retried
+        }
+        # Alignments that are restored from the cache are not submitted and don't take a slot
+        alignment_states = {
+            file_name: state
+            for file_name, state in states.items()
+            if state != STATE_PENDING or not self.is_alignment_cached(file_name)
+        }
+        alignment_jobs, num_alignments_in_flight, alignment_completion = self.plan_step(
+            alignment_states,
+            step=STEP_ALIGNMENT,
+            ready_states=[STATE_PENDING, STATE_ALIGNMENT_FAILED],
+            running_state=STATE_ALIGNMENT_RUNNING,
+            input_extension="bam",
+            marker_extension=EXT_ALIGNMENT_RUNNING,
+            max_in_flight=scheduling_config.max_in_flight_alignment,
+            gb_per_hour=scheduling_config.alignment_gb_per_hour,
+        )
+        qc_jobs, num_qc_in_flight, qc_completion = self.plan_step(
+            states,
+            step=STEP_QC,
+            ready_states=[STATE_CHECKS_COMPLETE, STATE_QC_FAILED],
+            running_state=STATE_QC_RUNNING,
+            input_extension=EXT_ALIGNED_SORTED,
+            marker_extension=EXT_QC_RUNNING,
+            max_in_flight=scheduling_config.max_in_flight_qc,
+            gb_per_hour=scheduling_config.qc_gb_per_hour,
+        )
+
+        if print_report:
+            print_schedule(
+                alignment_jobs + qc_jobs,
+                max(alignment_completion, qc_completion),
+                {STEP_ALIGNMENT: num_alignments_in_flight, STEP_QC: num_qc_in_flight},
+            )
+        return alignment_jobs + qc_jobs
+
+    def plan_step(
+        self,
+        states: dict,
+        step: str,
+        ready_states: List[str],
+        running_state: str,
+        input_extension: str,
+        marker_extension: str,
+        max_in_flight: Optional[int],
+        gb_per_hour: float,
+    ):
+        """Plans the submissions of a single step. Returns the ordered jobs, the number of
+        jobs of the step that are in flight and the estimated time until all are complete.
+        """
+
+        def get_input_size(file_name):
+            return self.get_file_size(self.get_file_with_extension(file_name, input_extension))
+
+        jobs = []
+        for file_name, state in states.items():
+            if state not in ready_states:
                 continue
-            self.resume_workflow_single(file_name)
+            input_size = get_input_size(file_name)
+            jobs.append(
+                ScheduledJob(
+                    file_name=file_name,
+                    step=step,
+                    input_size=input_size,
+                    estimated_runtime=estimate_runtime(input_size, gb_per_hour),
+                )
+            )
+        jobs = order_largest_first(jobs)
+
+        running_files = [file_name for file_name, state in states.items() if state == running_state]
+        in_flight_files = self.get_in_flight_files(running_files, marker_extension)
+        in_flight_remaining = []
+        for file_name in in_flight_files:
+            marker = self.get_file_with_extension(file_name, marker_extension)
+            elapsed = datetime.now().timestamp() - self.get_file_mtime(marker)
+            runtime = estimate_runtime(get_input_size(file_name), gb_per_hour)
+            in_flight_remaining.append(max(runtime - elapsed, 0.0))
+
+        hold_back_jobs(jobs, len(in_flight_files), max_in_flight)
+        completion = estimate_completion(jobs, in_flight_remaining, max_in_flight)
+        return jobs, len(in_flight_files), completion
+
+    def get_in_flight_files(self, file_names: List[str], marker_extension: str) -> List[str]:
+        """Returns the files whose job (given by the job ID in the running marker) is still
+        pending or running in Slurm. If the live job state can't be retrieved, all files with
+        a running marker are considered in flight.
 
-    def run_pbmm2(self, file_name):
+        Args:
+            file_names (List[str]): file names of the unaligned BAMs with a running marker
+            marker_extension (str): extension of the running marker
+        """
+
+        job_ids = {
+            file_name: self.get_job_id(file_name, marker_extension) for file_name in file_names
+        }
+        slurm_job_ids = [
+            job_id for job_id in job_ids.values() if job_id and not is_local_job_id(job_id)
+        ]
+        active_job_ids = get_active_job_ids(slurm_job_ids)
+        if active_job_ids is None:
+            print("Could not retrieve the job states from Slurm. Treating all running jobs as in flight.")
+            return file_names
+        return [file_name for file_name, job_id in job_ids.items() if job_id in active_job_ids]
+
+    def get_job_id(self, file_name: str, marker_extension: str) -> Optional[str]:
+        """Returns the job ID stored in the running marker of a step, None if it's unknown
+
+        Args:
+            file_name (str): file name of the unaligned BAM
+            marker_extension (str): extension of the running marker
+        """
+
+        return self.get_job_marker(file_name, marker_extension).job_id
+
+    def get_job_marker(self, file_name: str, marker_extension: str) -> JobMarker:
+        return read_job_marker(self.get_file_with_extension(file_name, marker_extension))
+
+    def prefetch_job_states(self, file_names: List[str]):
+        """Retrieves the Slurm job states of all running markers of the given files with a
+        single sacct call, so that get_state doesn't have to query them one by one.
+
+        Args:
+            file_names (List[str]): file names of the unaligned BAMs
+        """
+
+        markers = [
+            (file_name, marker_extension)
+            for file_name in file_names
+            for marker_extension in [EXT_ALIGNMENT_RUNNING, EXT_QC_RUNNING, EXT_CRAM_RUNNING]
+        ]
+        samples = {self.get_sample(file_name) for file_name in file_names} - {None}
+        markers += [(self.get_sample_file_name(sample), EXT_MERGE_RUNNING) for sample in sorted(samples)]
+
+        job_ids = []
+        for file_name, marker_extension in markers:
+            if self.does_file_with_extension_exist(file_name, marker_extension):
+                job_id = self.get_job_id(file_name, marker_extension)
+                if job_id and not is_local_job_id(job_id):
+                    job_ids.append(job_id)
+        job_states = get_job_states(job_ids)
+        for job_id in job_ids:
+            self.job_states[job_id] = job_states.get(job_id)
+
+    def get_failed_job_state(self, file_name: str, marker_extension: str) -> Optional[str]:
+        """Returns the Slurm state of the job of a step if the job ended unsuccessfully
+        (e.g. "OUT_OF_MEMORY"), otherwise None. Jobs that were run locally are failed if their
+        exit code is non-zero, see get_local_job_state
+
+        Args:
+            file_name (str): file name of the unaligned BAM
+            marker_extension (str): extension of the running marker
+        """
+
+        marker = self.get_job_marker(file_name, marker_extension)
+        job_id = marker.job_id
+        if not job_id:
+            return None
+        if is_local_job_id(job_id):
+            return get_local_job_state(marker.exit_code)
+        if job_id not in self.job_states:
+            self.job_states[job_id] = get_job_states([job_id]).get(job_id)
+        job_state = self.job_states[job_id]
+        return job_state if job_state in FAILURE_STATES else None
+
+    def get_job_retry(self, file_name: str, step: str) -> JobRetry:
+        """Determines if and how a failed alignment, QC, CRAM conversion or merge job is
+        resubmitted. Jobs that ran out of memory or time are resubmitted with scaled memory/time
+        up to the configured ceilings, jobs that failed because of the cluster with the same
+        resources. Tool errors and jobs that reached the maximum number of attempts are not
+        retried.
+
+        Args:
+            file_name (str): file name of the unaligned BAM (of the sample for 'merge', see
+                get_sample_file_name)
+            step (str): 'alignment', 'qc', 'cram' or 'merge'
+        """
+
+        retry_config = self.config.slurm_config.retry_config
+        if step == STEP_ALIGNMENT:
+            default_time = self.config.slurm_config.allocated_time
+            default_mem = self.config.slurm_config.allocated_memory
+        elif step == STEP_CRAM:
+            default_time = self.config.cram_config.allocated_time
+            default_mem = self.config.cram_config.allocated_memory
+        elif step == STEP_MERGE:
+            default_time = self.config.merge_config.allocated_time
+            default_mem = self.config.merge_config.allocated_memory
+        else:
+            default_time, default_mem = QC_ALLOCATED_TIME, QC_ALLOCATED_MEMORY
+
+        marker_extension = STEP_JOB_EXTENSIONS[step][0]
+        marker = self.get_job_marker(file_name, marker_extension)
+        job_state = self.get_failed_job_state(file_name, marker_extension)
+        time = marker.time or default_time
+        mem = marker.memory or default_mem
+
+        not_retried = None
+        if job_state in TOOL_FAILURE_STATES:
+            not_retried = "Tool errors are not retried"
+        elif marker.attempt >= retry_config.max_attempts:
+            not_retried = f"Maximum number of attempts ({retry_config.max_attempts}) reached"
+        elif job_state == "OUT_OF_MEMORY":
+            new_mem = min(
+                int(parse_memory(mem) * retry_config.memory_scale),
+                parse_memory(retry_config.max_memory),
+            )
+            if new_mem <= parse_memory(mem):
+                not_retried = f"Memory is already at the ceiling of {retry_config.max_memory}"
+            mem = format_memory(new_mem)
+        elif job_state == "TIMEOUT":
+            new_time = min(
+                int(parse_time(time) * retry_config.time_scale),
+                parse_time(retry_config.max_time),
+            )
+            if new_time <= parse_time(time):
+                not_retried = f"Time is already at the ceiling of {retry_config.max_time}"
+            time = format_time(new_time)
+        return JobRetry(
+            job_id=marker.job_id,
+            job_state=job_state,
+            attempt=marker.attempt,
+            time=time,
+            memory=mem,
+            not_retried=not_retried,
+        )
+
+    def handle_failed_job(self, file_name: str, step: str) -> str:
+        """Resubmits a failed alignment, QC, CRAM conversion or merge job, see get_job_retry.
+        Jobs that are not retried are reported. The running marker of the failed job is kept
+        until the resubmission is confirmed, so that the attempt and the escalated resources are
+        not lost if the resubmission fails.
+
+        Args:
+            file_name (str): file name of the unaligned BAM (of the sample for 'merge', see
+                get_sample_file_name)
+            step (str): 'alignment', 'qc', 'cram' or 'merge'
+
+        Returns:
+            str: ACTION_RETRY or ACTION_NOT_RETRIED
+        """
+
+        marker_extension, slurm_out_extension = STEP_JOB_EXTENSIONS[step]
+        retry = self.get_job_retry(file_name, step)
+        slurm_out = self.get_file_with_extension(file_name, slurm_out_extension)
+        if retry.not_retried:
+            message = (
+                f"The {step} job {retry.job_id} for file {file_name} failed with state {retry.job_state} "
+                f"(attempt {retry.attempt}). {retry.not_retried}. Please check {slurm_out} and reset the "
+                f"step with o2p-reset-pbmm2-workflow once the problem is fixed."
+            )
+            add_to_log(message)
+            print(message)
+            return ACTION_NOT_RETRIED
+
+        time, mem, attempt = retry.time, retry.memory, retry.attempt + 1
+        add_to_log(
+            f"The {step} job {retry.job_id} for file {file_name} failed with state {retry.job_state}. "
+            f"Resubmitting with time={time}, mem={mem} (attempt {attempt})."
+        )
+        marker = self.get_file_with_extension(file_name, marker_extension)
+        if step == STEP_ALIGNMENT:
+            reset_files = self.get_alignment_reset_files(file_name)
+        elif step == STEP_CRAM:
+            reset_files = self.get_cram_reset_files(file_name)
+        elif step == STEP_MERGE:
+            reset_files = self.get_merge_reset_files(get_file_without_extension(file_name))
+        else:
+            reset_files = self.get_qc_reset_files(file_name)
+        remove_files([path for path in reset_files if path != marker])
+
+        if step == STEP_ALIGNMENT:
+            self.run_pbmm2(file_name, time=time, mem=mem, attempt=attempt)
+        elif step == STEP_CRAM:
+            self.run_cram(file_name, time=time, mem=mem, attempt=attempt)
+        elif step == STEP_MERGE:
+            self.run_merge(get_file_without_extension(file_name), time=time, mem=mem, attempt=attempt)
+        else:
+            self.run_qc(file_name, time=time, mem=mem, attempt=attempt)
+        return ACTION_RETRY
+
+    def run_pbmm2(self, file_name, time: str = None, mem: str = None, attempt: int = 1):
         """
         Run pbmm2 on a single unaligned PacBio HiFi/Fiber-seq BAM through Slurm.
+        Time and memory default to the allocated resources in the config.
         """
-        time = self.config.slurm_config.allocated_time
-        mem = self.config.slurm_config.allocated_memory
+        time = time or self.config.slurm_config.allocated_time
+        mem = mem or self.config.slurm_config.allocated_memory
         threads = self.config.slurm_config.allocated_threads
         mail_user = self.config.slurm_config.mail_user
 
         path_to_file = self.get_file_with_extension(file_name, "bam")
 
-        log_stmt = f"Submitting sbatch job to run pbmm2 on {path_to_file}. time={time}, mem={mem}, threads={threads}"
+        log_stmt = f"Submitting job to run pbmm2 on {path_to_file}. time={time}, mem={mem}, threads={threads}"
         add_to_log(log_stmt)
         print(log_stmt)
 
-        PRESET = "CCS"
         aligned_bam = self.get_file_with_extension(file_name, EXT_ALIGNED_SORTED)
         slurm_out = self.get_file_with_extension(file_name, EXT_ALIGNMENT_SLURM_OUT)
 
-        pbmm2_command = f'pbmm2 align --num-threads {threads} --preset {PRESET} --strip --unmapped --log-level INFO --sort --sort-memory 1G --sort-threads 4 {self.config.reference_sequence_path} {path_to_file} {aligned_bam}'
-        sbatch_command = f'sbatch -J "o2p_align_pbmm2" -p park -A park_contrib -o {slurm_out} -t {time} --mem={mem} -c {threads} --mail-type=ALL --mail-user={mail_user} --wrap="{pbmm2_command}"'
-
-        try:
-            result = subprocess.run(sbatch_command, shell = True, capture_output = True, text = True)
-        except Exception as e:
-            raise Exception(
-                f"Error submitting sbatch job to run pbmm2 on file {path_to_file}"
-            )
-
-        # Create the signal for the workflow that pbmm2 is running
-        self.create_file_with_extension(file_name, EXT_ALIGNMENT_RUNNING)
+        pbmm2_command = f'pbmm2 align --num-threads {threads} --preset {PBMM2_PRESET} --strip --unmapped --log-level INFO --sort --sort-memory 1G --sort-threads 4 {self.config.reference_sequence_path} {path_to_file} {aligned_bam}'
+        submission = JobSubmission(
+            job_name="o2p_align_pbmm2",
+            input_path=path_to_file,
+            command=pbmm2_command,
+            slurm_out=slurm_out,
+            time=time,
+            memory=mem,
+            threads=threads,
+            mail_user=mail_user,
+            attempt=attempt,
+            # Retries replace the marker of the failed attempt
+            replaces_marker=attempt > 1,
+            # Signal for the workflow that pbmm2 is running
+            marker_path=self.get_file_with_extension(file_name, EXT_ALIGNMENT_RUNNING),
+        )
+        self.submit_job(submission)
 
     def run_alignment_checks(self, file_name):
         """
         Perform basic checks to confirm aligned BAM was properly generated
         """
 
-        add_to_log(f"Running checks on {file_name}.")
         path_to_aligned_bam = self.get_file_with_extension(
             file_name, EXT_ALIGNED_SORTED
         )
+        add_to_log(f"Running checks on {self.get_file_with_extension(file_name, 'bam')}.")
 
         # Perform header and EOF checks; raise Exception if failed
-        try:
-            subprocess.run(
-                f"samtools quickcheck {path_to_aligned_bam}",
-                shell=True,
-                text=True,
-                capture_output=True,
-                check=True,
-            )
-        except subprocess.CalledProcessError as e:
-            raise Exception(f"samtools quickcheck failed for file {path_to_aligned_bam}") from e
+        if self.config.qc_config.engine == QC_ENGINE_NATIVE:
+            # Same checks without samtools
+            try:
+                quickcheck(path_to_aligned_bam)
+            except Exception as e:
+                raise Exception(f"quickcheck failed for file {path_to_aligned_bam}: {str(e)}") from e
+        else:
+            try:
+                subprocess.run(
+                    f"samtools quickcheck {path_to_aligned_bam}",
+                    shell=True,
+                    text=True,
+                    capture_output=True,
+                    check=True,
+                )
+            except subprocess.CalledProcessError as e:
+                raise Exception(f"samtools quickcheck failed for file {path_to_aligned_bam}") from e
 
         self.create_file_with_extension(file_name, EXT_CHECKS_COMPLETE)
-        print("samtools quickcheck passed for file {path_to_aligned_bam}")
-
-    def run_qc(self, file_name):
-        # Hard-coding in sbatch allocated resources here
-        # Should not need to allocate more resources than what's set
-        time = "00-04:00:00"
-        mem = "4G"
-        threads = 2
+        print(f"quickcheck passed for file {path_to_aligned_bam}")
+
+    def run_qc(self, file_name, time: str = None, mem: str = None, attempt: int = 1):
+        time = time or QC_ALLOCATED_TIME
+        mem = mem or QC_ALLOCATED_MEMORY
+        threads = QC_ALLOCATED_THREADS
         mail_user = self.config.slurm_config.mail_user
 
         aligned_bam = self.get_file_with_extension(file_name, EXT_ALIGNED_SORTED)
         slurm_out = self.get_file_with_extension(file_name, EXT_QC_SLURM_OUT)
         stats_txt = self.get_file_with_extension(file_name, EXT_SAMTOOLS_STATS)
 
+        if self.config.qc_config.engine == QC_ENGINE_NATIVE:
+            # Built-in metrics engine, writes the core metrics in the samtools stats format
+            tool = "o2p-bam-stats"
+            job_name = "o2p_qc_bam_stats"
+            qc_command = f'o2p-bam-stats -b {aligned_bam} -t {threads} > {stats_txt}'
+        else:
+            tool = "samtools stats"
+            job_name = "o2p_qc_samtools_stats"
+            qc_command = f'samtools stats -@ {threads} {aligned_bam} > {stats_txt}'
+        unaligned_bam = self.get_file_with_extension(file_name, "bam")
+        if self.config.qc_config.reconcile_read_counts and not get_record_count(unaligned_bam, compute=False):
+            # No .pbi: the records of the unaligned BAM are counted once, in the QC job, and cached
+            # in a sidecar. They are counted first, so that the QC is only complete afterwards
+            qc_command = f'o2p-count-records -b {unaligned_bam} -t {threads} > /dev/null && {qc_command}'
+
         add_to_log(
-            f"Submitting sbatch job to run samtools stats on {aligned_bam}. time={time}, mem={mem}, threads={threads}"
+            f"Submitting job to run {tool} on {aligned_bam}. time={time}, mem={mem}, threads={threads}"
         )
 
-        samtools_stats_command = f'samtools stats -@ {threads} {aligned_bam} > {stats_txt}'        
-        sbatch_command = f'sbatch -J "o2p_qc_samtools_stats" -p park -A park_contrib -o {slurm_out} -t {time} --mem={mem} -c {threads} --mail-type=ALL --mail-user={mail_user} --wrap="{samtools_stats_command}"'
+        submission = JobSubmission(
+            job_name=job_name,
+            input_path=aligned_bam,
+            command=qc_command,
+            slurm_out=slurm_out,
+            time=time,
+            memory=mem,
+            threads=threads,
+            mail_user=mail_user,
+            attempt=attempt,
+            # Retries replace the marker of the failed attempt
+            replaces_marker=attempt > 1,
+            # Signal for the workflow that QC is running
+            marker_path=self.get_file_with_extension(file_name, EXT_QC_RUNNING),
+        )
+        self.submit_job(submission)
 
-        try:
-            result = subprocess.run(
-                sbatch_command,
-                shell = True,
-                capture_output = True,
-                text = True)
-        except Exception as e:
+    def reconcile_read_counts(self, file_name):
+        """
+        Compares the number of primary records in the samtools stats of the aligned BAM with the
+        number of records of the unaligned BAM (from its .pbi or its record count sidecar, see
+        get_record_count). pbmm2 runs with --unmapped, so every read of the unaligned BAM has
+        to be in the aligned BAM. Raises an exception if they differ, e.g. because the aligned
+        BAM is truncated, so that the QC is not parsed. The records are never counted here; if
+        no count is available (e.g. the QC job was submitted before the check was enabled), the
+        check is skipped.
+        """
+
+        unaligned_bam = self.get_file_with_extension(file_name, "bam")
+        aligned_bam = self.get_file_with_extension(file_name, EXT_ALIGNED_SORTED)
+        path_to_stats = self.get_file_with_extension(file_name, EXT_SAMTOOLS_STATS)
+        metrics = parse_samtools_stats(path_to_stats)
+        if QC_METRIC_PRIMARY_RECORDS not in metrics:
+            raise Exception(
+                f"Can't reconcile the read counts of {aligned_bam}: '{QC_METRIC_PRIMARY_RECORDS}' is missing in {path_to_stats}."
+            )
+        aligned_records = int(metrics[QC_METRIC_PRIMARY_RECORDS])
+        # Counting the records would decompress the whole unaligned BAM on the login node
+        record_count = get_record_count(unaligned_bam, compute=False)
+        if not record_count:
+            add_to_log(
+                f"Skipping the read count reconciliation of {aligned_bam}: no record count of {unaligned_bam} "
+                f"(no .pbi and no up-to-date sidecar)."
+            )
+            return
+        input_records, source = record_count
+        if aligned_records != input_records:
+            add_to_log(
+                f"Read count mismatch for {unaligned_bam}: {input_records} reads in the unaligned BAM ({source}), "
+                f"but {aligned_records} primary records in {aligned_bam}."
+            )
+            raise Exception(
+                f"Read count reconciliation failed for {aligned_bam}: {aligned_records} primary records, but "
+                f"{input_records} reads in {unaligned_bam} ({source}). The QC is not parsed. Please check the "
+                f"alignment and reset it with o2p-reset-pbmm2-workflow -s alignment."
+            )
+        add_to_log(f"Reconciled read counts of {unaligned_bam}: {input_records} reads ({source}).")
+
+    def run_cram(self, file_name, time: str = None, mem: str = None, attempt: int = 1):
+        """
+        Convert the aligned BAM to a reference-based CRAM through Slurm. All tags, incl. the
+        PacBio kinetics and methylation tags, are kept. The job indexes the CRAM and counts its
+        primary records, which are verified against the QC before the aligned BAM is removed.
+        """
+        cram_config = self.config.cram_config
+        time = time or cram_config.allocated_time
+        mem = mem or cram_config.allocated_memory
+        threads = cram_config.allocated_threads
+        mail_user = self.config.slurm_config.mail_user
+        reference = self.config.reference_sequence_path
+
+        aligned_bam = self.get_file_with_extension(file_name, EXT_ALIGNED_SORTED)
+        if not self.is_file(aligned_bam):
+            raise Exception(f"Can't convert {aligned_bam} to CRAM. The file does not exist.")
+        cram = self.get_file_with_extension(file_name, EXT_CRAM)
+        record_count = self.get_file_with_extension(file_name, EXT_CRAM_RECORD_COUNT)
+        slurm_out = self.get_file_with_extension(file_name, EXT_CRAM_SLURM_OUT)
+
+        add_to_log(
+            f"Submitting job to run samtools view on {aligned_bam}. time={time}, mem={mem}, threads={threads}"
+        )
+
+        cram_command = (
+            f"samtools view -C -T {reference} -@ {threads} -o {cram} {aligned_bam}"
+            f" && samtools index -@ {threads} {cram}"
+            # Primary records only, i.e. without secondary and supplementary alignments
+            f" && samtools view -c -F 0x900 -T {reference} -@ {threads} {cram} > {record_count}"
+        )
+        submission = JobSubmission(
+            job_name="o2p_cram_samtools",
+            input_path=aligned_bam,
+            command=cram_command,
+            slurm_out=slurm_out,
+            time=time,
+            memory=mem,
+            threads=threads,
+            mail_user=mail_user,
+            attempt=attempt,
+            # Retries replace the marker of the failed attempt
+            replaces_marker=attempt > 1,
+            # Signal for the workflow that the CRAM conversion is running
+            marker_path=self.get_file_with_extension(file_name, EXT_CRAM_RUNNING),
+        )
+        self.submit_job(submission)
+
+    def verify_cram(self, file_name):
+        """
+        Compares the number of primary records in the CRAM with the number of primary records
+        in the samtools stats of the aligned BAM. Only if they match, the aligned BAM is removed.
+        """
+
+        cram = self.get_file_with_extension(file_name, EXT_CRAM)
+        with open(self.get_file_with_extension(file_name, EXT_CRAM_RECORD_COUNT)) as f:
+            cram_records = int(f.read().strip())
+        metrics = read_qc_file(self.get_qc_file(file_name))
+        if QC_METRIC_PRIMARY_RECORDS not in metrics:
             raise Exception(
-                f"Error submitting samtools stats sbatch job for file {aligned_bam}."
+                f"Can't verify {cram}: '{QC_METRIC_PRIMARY_RECORDS}' is missing in {self.get_qc_file(file_name)}."
             )
+        expected_records = int(metrics[QC_METRIC_PRIMARY_RECORDS])
+        if cram_records != expected_records:
+            raise Exception(
+                f"CRAM verification failed for {cram}: {cram_records} primary records, but {expected_records} "
+                f"according to samtools stats. The aligned BAM is kept."
+            )
+        if not self.does_file_with_extension_exist(file_name, EXT_CRAM_INDEXED):
+            raise Exception(f"CRAM verification failed for {cram}: the index is missing. The aligned BAM is kept.")
+
+        add_to_log(
+            f"Verified CRAM {cram} against the QC of {self.get_file_with_extension(file_name, 'bam')}: "
+            f"{cram_records} primary records. Removing the aligned BAM."
+        )
+        # The running marker is removed last, so that an interrupted cleanup is verified again
+        files_to_remove = [
+            self.get_file_with_extension(file_name, EXT_ALIGNED_SORTED),
+            self.get_file_with_extension(file_name, EXT_ALIGNED_SORTED_INDEXED),
+            self.get_file_with_extension(file_name, EXT_CRAM_RECORD_COUNT),
+            self.get_file_with_extension(file_name, EXT_CRAM_SLURM_OUT),
+            self.get_file_with_extension(file_name, EXT_CRAM_RUNNING),
+        ]
+        remove_files(files_to_remove)
+        print(f"CRAM {cram} verified. Removed the aligned BAM of file {file_name}.")
+
+    def run_merge(self, sample: str, time: str = None, mem: str = None, attempt: int = 1):
+        """
+        Merge the coordinate-sorted aligned BAMs of the movies of a sample through Slurm. The
+        job indexes the merged BAM and counts its records from the index, which are verified
+        against the QC of the movies before the movie BAMs are removed.
+        """
+        merge_config = self.config.merge_config
+        time = time or merge_config.allocated_time
+        mem = mem or merge_config.allocated_memory
+        threads = merge_config.allocated_threads
+        mail_user = self.config.slurm_config.mail_user
 
-        # Create the signal for the workflow that QC is running
-        self.create_file_with_extension(file_name, EXT_QC_RUNNING)
+        sample_file_name = self.get_sample_file_name(sample)
+        movie_bams = [
+            self.get_file_with_extension(movie, EXT_ALIGNED_SORTED) for movie in self.get_sample_movies(sample)
+        ]
+        missing_bams = [bam for bam in movie_bams if not self.is_file(bam)]
+        if missing_bams:
+            raise Exception(f"Can't merge sample {sample}. The aligned BAMs are missing: {', '.join(missing_bams)}")
+        merged_bam = self.get_file_with_extension(sample_file_name, EXT_MERGED)
+        record_count = self.get_file_with_extension(sample_file_name, EXT_MERGE_RECORD_COUNT)
+        slurm_out = self.get_file_with_extension(sample_file_name, EXT_MERGE_SLURM_OUT)
+
+        add_to_log(
+            f"Submitting job to run samtools merge on {self.get_file_with_extension(sample_file_name, 'bam')}. "
+            f"time={time}, mem={mem}, threads={threads}"
+        )
+
+        merge_command = (
+            # Identical @PG lines (pbmm2) of the movies are combined
+            f"samtools merge -@ {threads} -p -f -o {merged_bam} {' '.join(movie_bams)}"
+            f" && samtools index -@ {threads} {merged_bam}"
+            # All records, incl. unmapped ones, from the index
+            f" && samtools idxstats {merged_bam} | awk '{{n += $3 + $4}} END {{print n}}' > {record_count}"
+        )
+        submission = JobSubmission(
+            job_name="o2p_merge_samtools",
+            # The executor is chosen by the size of the largest movie
+            input_path=max(movie_bams, key=self.get_file_size),
+            command=merge_command,
+            slurm_out=slurm_out,
+            time=time,
+            memory=mem,
+            threads=threads,
+            mail_user=mail_user,
+            attempt=attempt,
+            # Retries replace the marker of the failed attempt
+            replaces_marker=attempt > 1,
+            # Signal for the workflow that the merge is running
+            marker_path=self.get_file_with_extension(sample_file_name, EXT_MERGE_RUNNING),
+        )
+        self.submit_job(submission)
+
+    def verify_merge(self, sample: str):
+        """
+        Compares the number of records in the merged BAM with the sum of the records of the
+        movies according to their samtools stats. Only if they match, the QC of the sample is
+        created by merging the QC of the movies and the aligned movie BAMs are removed.
+        """
+
+        sample_file_name = self.get_sample_file_name(sample)
+        merged_bam = self.get_file_with_extension(sample_file_name, EXT_MERGED)
+        with open(self.get_file_with_extension(sample_file_name, EXT_MERGE_RECORD_COUNT)) as f:
+            merged_records = int(f.read().strip())
+
+        movies = self.get_sample_movies(sample)
+        movie_metrics = [read_qc_file(self.get_qc_file(movie)) for movie in movies]
+        expected_records = 0
+        for movie, metrics in zip(movies, movie_metrics):
+            record_metrics = [QC_METRIC_PRIMARY_RECORDS] + QC_METRICS_NON_PRIMARY_RECORDS
+            missing_metrics = [metric for metric in record_metrics if metric not in metrics]
+            if missing_metrics:
+                raise Exception(
+                    f"Can't verify {merged_bam}: {', '.join(missing_metrics)} missing in {self.get_qc_file(movie)}."
+                )
+            expected_records += sum(int(metrics[metric]) for metric in record_metrics)
+        if merged_records != expected_records:
+            raise Exception(
+                f"Verification of the merged BAM {merged_bam} failed: {merged_records} records, but "
+                f"{expected_records} in the movies according to samtools stats. The aligned movie BAMs are kept."
+            )
+        if not self.does_file_with_extension_exist(sample_file_name, EXT_MERGED_INDEXED):
+            raise Exception(
+                f"Verification of the merged BAM {merged_bam} failed: the index is missing. The aligned movie BAMs are kept."
+            )
+
+        store_qc_metrics(merge_samtools_stats(movie_metrics), self.get_sample_qc_file(sample))
+        add_to_log(
+            f"Verified merged BAM {merged_bam} against the QC of {self.get_file_with_extension(sample_file_name, 'bam')}: "
+            f"{merged_records} records from {len(movies)} movies. Removing the aligned movie BAMs."
+        )
+        # The running marker is removed last, so that an interrupted cleanup is verified again
+        files_to_remove = []
+        for movie in movies:
+            files_to_remove += [
+                self.get_file_with_extension(movie, EXT_ALIGNED_SORTED),
+                self.get_file_with_extension(movie, EXT_ALIGNED_SORTED_INDEXED),
+            ]
+        files_to_remove += [
+            self.get_file_with_extension(sample_file_name, EXT_MERGE_RECORD_COUNT),
+            self.get_file_with_extension(sample_file_name, EXT_MERGE_SLURM_OUT),
+            self.get_file_with_extension(sample_file_name, EXT_MERGE_RUNNING),
+        ]
+        remove_files(files_to_remove)
+        print(f"Merged BAM {merged_bam} verified. Removed the aligned BAMs of the movies of sample {sample}.")
+
+    def submit_job(self, submission: JobSubmission):
+        """Submits the job to the executor right away or, if submissions are batched, queues it
+        until submit_pending_jobs is called.
+
+        Args:
+            submission (JobSubmission): job to submit
+        """
+
+        self.pending_submissions.append(submission)
+        if not self.batch_submissions:
+            self.submit_pending_jobs()
+
+    def submit_pending_jobs(self):
+        """Submits all queued jobs to the executor. The running marker of a job is only
+        created (with the job ID, attempt and resources as content), or for retries replaced,
+        once the submission is confirmed by the executor.
+        """
+
+        submissions, self.pending_submissions = self.pending_submissions, []
+        failed_submissions = []
+        for submission in self.executor.submit(submissions):
+            if submission.job_id:
+                write_job_marker(
+                    submission.marker_path, JobMarker.from_submission(submission), replace=submission.replaces_marker
+                )
+                add_to_log(
+                    f"Submitted {self.executor.name} job {submission.job_id} ({submission.job_name}). Signal file: {submission.marker_path}"
+                )
+            else:
+                add_to_log(
+                    f"Error submitting {self.executor.name} job ({submission.job_name}). Signal file: {submission.marker_path}. {submission.error}"
+                )
+                failed_submissions.append(submission)
+
+        if failed_submissions:
+            errors = "\n".join(
+                f"{s.marker_path}: {s.error}" for s in failed_submissions
+            )
+            raise Exception(f"Error submitting {len(failed_submissions)} job(s):\n{errors}")
+
+    def get_alignment_cache_files(self, file_name: str) -> dict:
+        """Returns the path of each file of the alignment that is cached, keyed by its name in
+        the cache
+
+        Args:
+            file_name (str): file name of the unaligned BAM
+        """
+
+        if self.config.cram_config.enabled:
+            # The aligned BAM is removed once the CRAM is verified. Caching it would keep it
+            return {
+                EXT_CRAM: self.get_file_with_extension(file_name, EXT_CRAM),
+                EXT_CRAM_INDEXED: self.get_file_with_extension(file_name, EXT_CRAM_INDEXED),
+                EXT_QC: self.get_qc_file(file_name),
+            }
+        return {
+            EXT_ALIGNED_SORTED: self.get_file_with_extension(file_name, EXT_ALIGNED_SORTED),
+            EXT_ALIGNED_SORTED_INDEXED: self.get_file_with_extension(file_name, EXT_ALIGNED_SORTED_INDEXED),
+            EXT_QC: self.get_qc_file(file_name),
+        }
+
+    def get_alignment_cache_key(self, file_name: str) -> str:
+        # The unaligned BAM is only fingerprinted again if it changed, e.g. the cache is checked
+        # both when the submissions are planned and when the file is advanced
+        unaligned_bam = self.get_file_with_extension(file_name, "bam")
+        bam_stat = os.stat(unaligned_bam)
+        version = (bam_stat.st_size, bam_stat.st_mtime_ns)
+        if self.alignment_cache_keys.get(file_name, (None, None))[0] != version:
+            cache_key = get_cache_key(
+                unaligned_bam,
+                self.config.reference_sequence_path,
+                PBMM2_PRESET,
+                output_format="cram" if self.config.cram_config.enabled else "bam",
+            )
+            self.alignment_cache_keys[file_name] = (version, cache_key)
+        return self.alignment_cache_keys[file_name][1]
+
+    def is_alignment_cached(self, file_name: str) -> bool:
+        """Checks if the alignment of a file can be restored from the cache, see
+        restore_alignment_from_cache
+
+        Args:
+            file_name (str): file name of the unaligned BAM
+        """
+
+        cache_config = self.config.cache_config
+        return bool(cache_config) and has_cache_entry(cache_config, self.get_alignment_cache_key(file_name))
+
+    def restore_alignment_from_cache(self, file_name: str) -> bool:
+        """Links the aligned BAM (or, if the CRAM conversion is enabled, the CRAM), its index and
+        the .qc file from the cache if the same BAM has been aligned with the same reference,
+        preset and pbmm2 version before. Returns False if there is no cache or no cache entry
+        for the file.
+
+        Args:
+            file_name (str): file name of the unaligned BAM
+        """
+
+        cache_config = self.config.cache_config
+        if not cache_config:
+            return False
+        cache_key = self.get_alignment_cache_key(file_name)
+        if not restore_from_cache(cache_config, cache_key, self.get_alignment_cache_files(file_name)):
+            return False
+        add_to_log(
+            f"Restored alignment and QC of {self.get_file_with_extension(file_name, 'bam')} from cache entry {cache_key}."
+        )
+        return True
+
+    def add_alignment_to_cache(self, file_name: str):
+        cache_config = self.config.cache_config
+        if not cache_config:
+            return
+        if self.get_sample(file_name):
+            # The aligned BAM of a movie is removed once the merged BAM of its sample is
+            # verified. Caching it would keep it
+            return
+        cache_key = self.get_alignment_cache_key(file_name)
+        cache_files = {
+            name: path for name, path in self.get_alignment_cache_files(file_name).items()
+            if os.path.isfile(path)
+        }
+        add_to_cache(cache_config, cache_key, cache_files, self.get_file_with_extension(file_name, "bam"))
+        add_to_log(f"Added alignment and QC of {file_name} to cache entry {cache_key}.")
 
     def cleanup(self, file_name: str):
         add_to_log(f"Cleaning up temporary files for file {file_name}.")
@@ -209,43 +1447,159 @@ class Pbmm2Workflow:
             )
             return
         
-        path_to_file = self.get_file_with_extension(file_name, "bam")
-        if workflow_step == "qc":
-            self.reset_qc(file_name)
-        elif workflow_step == "checks":
-            self.reset_checks(file_name)
-        elif workflow_step == "alignment":
-            self.reset_alignment(file_name)
-        else:
-            raise ValueError("workflow_step must be on of 'qc', 'checks', 'alignment'.")
+        if not self.acquire_reset_locks(file_name):
+            return
+        try:
+            path_to_file = self.get_file_with_extension(file_name, "bam")
+            remove_files(self.get_reset_files(file_name, workflow_step))
+        finally:
+            self.release_locks()
         
         add_to_log(f"Resetting workflow step '{workflow_step}' for {path_to_file}.")
 
+    def acquire_lock(self, file_name: str) -> bool:
+        """Acquires the per-sample lock of a file. Returns False, if the file is locked by
+        another run of the workflow.
+
+        Args:
+            file_name (str): file name of the unaligned BAM
+        """
+
+        if self.read_only:
+            raise Exception(f"The workflow for {self.dir} is read-only. No step can be run.")
+        if file_name in self.held_locks:
+            return True
+        lock = SampleLock(
+            self.get_file_with_extension(file_name, EXT_LOCK), self.config.stale_lock_seconds
+        )
+        if not lock.acquire():
+            owner = lock.get_owner()
+            print(
+                f"File {file_name} is currently processed by another run of the workflow "
+                f"(host {owner.get('host')}, PID {owner.get('pid')}). Skipping it."
+            )
+            return False
+        self.held_locks[file_name] = lock
+        return True
+
+    def acquire_reset_locks(self, file_name: str) -> bool:
+        """Acquires the lock of a file and, if the file belongs to a sample that is merged, the
+        lock of the sample, since resetting a movie removes the merge files of its sample as well.
+        Returns False (without holding either lock), if one of them is locked by another run of
+        the workflow.
+
+        Args:
+            file_name (str): file name of the unaligned BAM
+        """
+
+        if not self.acquire_lock(file_name):
+            return False
+        sample = self.get_sample(file_name)
+        if sample and not self.acquire_lock(self.get_sample_file_name(sample)):
+            self.release_lock(file_name)
+            return False
+        return True
+
+    def release_lock(self, file_name: str):
+        lock = self.held_locks.pop(file_name, None)
+        if lock:
+            lock.release()
+
+    def release_locks(self):
+        for lock in self.held_locks.values():
+            lock.release()
+        self.held_locks = {}
+
+    def get_reset_files(self, file_name: str, workflow_step: str) -> List[str]:
+        """Returns the files that are removed to reset a workflow step (and the steps after it).
+        Files that don't exist are included as well.
+
+        Args:
+            file_name (str): file name of the unaligned BAM
+            workflow_step (str): 'merge', 'cram', 'qc', 'checks' or 'alignment'
+        """
+
+        if workflow_step == "merge":
+            if not self.get_sample(file_name):
+                raise ValueError(f"File {file_name} does not belong to a sample that is merged.")
+            return self.get_merge_reset_files(self.get_sample(file_name))
+        elif workflow_step == "cram":
+            return self.get_cram_reset_files(file_name)
+        elif workflow_step == "qc":
+            return self.get_qc_reset_files(file_name)
+        elif workflow_step == "checks":
+            return self.get_checks_reset_files(file_name)
+        elif workflow_step == "alignment":
+            return self.get_alignment_reset_files(file_name)
+        raise ValueError("workflow_step must be on of 'merge', 'cram', 'qc', 'checks', 'alignment'.")
+
+    def reset_cram(self, file_name: str):
+        remove_files(self.get_cram_reset_files(file_name))
+
+    def reset_merge(self, sample: str):
+        remove_files(self.get_merge_reset_files(sample))
+
     def reset_qc(self, file_name: str):
+        remove_files(self.get_qc_reset_files(file_name))
+
+    def reset_checks(self, file_name: str):
+        remove_files(self.get_checks_reset_files(file_name))
+
+    def reset_alignment(self, file_name: str):
+        remove_files(self.get_alignment_reset_files(file_name))
+
+    def get_cram_reset_files(self, file_name: str) -> List[str]:
+        files_to_remove = [
+            self.get_file_with_extension(file_name, EXT_CRAM_RUNNING),
+            self.get_file_with_extension(file_name, EXT_CRAM_RECORD_COUNT),
+            self.get_file_with_extension(file_name, EXT_CRAM_SLURM_OUT),
+        ]
+        # The CRAM is only removed as long as the aligned BAM exists, i.e. before verification
+        if self.does_file_with_extension_exist(file_name, EXT_ALIGNED_SORTED):
+            files_to_remove += [
+                self.get_file_with_extension(file_name, EXT_CRAM),
+                self.get_file_with_extension(file_name, EXT_CRAM_INDEXED),
+            ]
+        return files_to_remove
+
+    def get_merge_reset_files(self, sample: str) -> List[str]:
+        sample_file_name = self.get_sample_file_name(sample)
         files_to_remove = [
+            self.get_file_with_extension(sample_file_name, EXT_MERGE_RUNNING),
+            self.get_file_with_extension(sample_file_name, EXT_MERGE_RECORD_COUNT),
+            self.get_file_with_extension(sample_file_name, EXT_MERGE_SLURM_OUT),
+        ]
+        # The merged BAM is only removed as long as the movie BAMs exist, i.e. before verification
+        if not self.is_file(self.get_sample_qc_file(sample)):
+            files_to_remove += [
+                self.get_file_with_extension(sample_file_name, EXT_MERGED),
+                self.get_file_with_extension(sample_file_name, EXT_MERGED_INDEXED),
+            ]
+        return files_to_remove
+
+    def get_qc_reset_files(self, file_name: str) -> List[str]:
+        files_to_remove = self.get_cram_reset_files(file_name)
+        if self.get_sample(file_name):
+            files_to_remove += self.get_merge_reset_files(self.get_sample(file_name))
+        return files_to_remove + [
             self.get_file_with_extension(file_name, EXT_QC_RUNNING),
-            f"{self.dir}/qc/{get_file_without_extension(file_name)}.qc",
+            self.get_qc_file(file_name),
             self.get_file_with_extension(file_name, EXT_SAMTOOLS_STATS),
             self.get_file_with_extension(file_name, EXT_QC_SLURM_OUT),
         ]
-        remove_files(files_to_remove)
 
-    def reset_checks(self, file_name: str):
-        self.reset_qc(file_name)
-        files_to_remove = [
+    def get_checks_reset_files(self, file_name: str) -> List[str]:
+        return self.get_qc_reset_files(file_name) + [
             self.get_file_with_extension(file_name, EXT_CHECKS_COMPLETE),
         ]
-        remove_files(files_to_remove)
 
-    def reset_alignment(self, file_name: str):
-        self.reset_checks(file_name)
-        files_to_remove = [
+    def get_alignment_reset_files(self, file_name: str) -> List[str]:
+        return self.get_checks_reset_files(file_name) + [
             self.get_file_with_extension(file_name, EXT_ALIGNMENT_RUNNING),
             self.get_file_with_extension(file_name, EXT_ALIGNED_SORTED),
             self.get_file_with_extension(file_name, EXT_ALIGNED_SORTED_INDEXED),
             self.get_file_with_extension(file_name, EXT_ALIGNMENT_SLURM_OUT),
         ]
-        remove_files(files_to_remove)
 
     def are_checks_complete(self, file_name: str):
         """Checks if checks have been run on the aligned BAMs
@@ -309,25 +1663,159 @@ class Pbmm2Workflow:
         qc_slurm_out = self.get_file_with_extension(file_name, EXT_QC_SLURM_OUT)
 
         if self.does_file_with_extension_exist(file_name, EXT_SAMTOOLS_STATS):
-            if os.path.getsize(samtools_stats) and not os.path.getsize(qc_slurm_out):
+            if self.get_file_size(samtools_stats) and not self.get_file_size(qc_slurm_out):
                 return True
             else:
                 return False
         else:
             return False
 
-    def is_workflow_complete(self, file_name: str):
+    def is_cram_running(self, file_name: str):
+        """Checks if the CRAM conversion is currently running (or complete, but not verified yet)
+
+        Args:
+            file_name (str): file name of the unaligned BAM
+        """
+
+        return self.does_file_with_extension_exist(file_name, EXT_CRAM_RUNNING)
+
+    def is_cram_complete(self, file_name: str):
+        """Checks if the CRAM conversion job is complete, i.e. if it has written the record count
+
+        Args:
+            file_name (str): file name of the unaligned BAM
+        """
+
+        if not self.does_file_with_extension_exist(file_name, EXT_CRAM_RECORD_COUNT):
+            return False
+        return self.get_file_size(self.get_file_with_extension(file_name, EXT_CRAM_RECORD_COUNT)) > 0
+
+    def is_cram_verified(self, file_name: str):
+        """Checks if the CRAM has been verified, i.e. if the CRAM exists and the aligned BAM
+        has been removed
+
+        Args:
+            file_name (str): file name of the unaligned BAM
+        """
+
+        return (
+            self.does_file_with_extension_exist(file_name, EXT_CRAM)
+            and not self.does_file_with_extension_exist(file_name, EXT_ALIGNED_SORTED)
+            and not self.is_cram_running(file_name)
+        )
+
+    def is_merge_running(self, sample: str):
+        """Checks if the merge of a sample is currently running (or complete, but not verified yet)
+
+        Args:
+            sample (str): sample name
+        """
+
+        return self.does_file_with_extension_exist(self.get_sample_file_name(sample), EXT_MERGE_RUNNING)
+
+    def is_merge_complete(self, sample: str):
+        """Checks if the merge job of a sample is complete, i.e. if it has written the record count
+
+        Args:
+            sample (str): sample name
+        """
+
+        sample_file_name = self.get_sample_file_name(sample)
+        if not self.does_file_with_extension_exist(sample_file_name, EXT_MERGE_RECORD_COUNT):
+            return False
+        return self.get_file_size(self.get_file_with_extension(sample_file_name, EXT_MERGE_RECORD_COUNT)) > 0
+
+    def is_merge_verified(self, sample: str):
+        """Checks if the merged BAM of a sample has been verified, i.e. if the QC of the sample
+        exists and the merge is not running
+
+        Args:
+            sample (str): sample name
+        """
+
+        return self.is_file(self.get_sample_qc_file(sample)) and not self.is_merge_running(sample)
+
+    def is_qc_parsed(self, file_name: str):
         """Checks for the existence of the ./qc/{file_name}.qc file
 
         Args:
             file_name (str): file name of the unaligned BAM
         """
 
+        return self.is_file(self.get_qc_file(file_name))
+
+    def is_workflow_complete(self, file_name: str):
+        """Checks for the existence of the ./qc/{file_name}.qc file and, if the CRAM conversion
+        is enabled, for a verified CRAM. Movies of a sample that is merged are complete once the
+        merged BAM of the sample has been verified.
+
+        Args:
+            file_name (str): file name of the unaligned BAM
+        """
+
+        if not self.is_qc_parsed(file_name):
+            return False
+        if self.get_sample(file_name):
+            return self.is_merge_verified(self.get_sample(file_name))
+        if self.config.cram_config.enabled:
+            return self.is_cram_verified(file_name)
+        return True
+
+    def get_qc_file(self, file_name: str):
+        """Returns the path of the parsed QC file, ./qc/{file_name}.aligned_sorted.qc
+
+        Args:
+            file_name (str): file name of the unaligned BAM
+        """
+
         file_name_without_ext = get_file_without_extension(file_name)
-        if os.path.isfile(f"{self.dir}/qc/{file_name_without_ext}.aligned_sorted.qc"):
-            return True
-        return False
+        return f"{self.dir}/qc/{file_name_without_ext}.{EXT_QC}"
+
+    def get_sample(self, file_name: str) -> Optional[str]:
+        """Returns the sample of a movie if its sample is merged, otherwise None
+
+        Args:
+            file_name (str): file name of the unaligned movie BAM
+        """
+
+        if not self.sample_assignment:
+            return None
+        return self.sample_assignment.get_sample(file_name)
+
+    def get_sample_file_name(self, sample: str) -> str:
+        """Files of a sample are named like the files of an unaligned BAM {sample}.bam, so that
+        the file helpers, locks and job markers of the movies can be used for samples as well.
+
+        Args:
+            sample (str): sample name
+        """
+
+        return f"{sample}.bam"
+
+    def get_sample_qc_file(self, sample: str) -> str:
+        """Returns the path of the merged QC file of a sample, ./qc_merged/{sample}.merged.aligned_sorted.qc.
+        It's kept apart from the QC files of the movies in ./qc, so that a summary QC file has
+        either one row per movie or one row per sample.
 
+        Args:
+            sample (str): sample name
+        """
+
+        return f"{self.dir}/qc_merged/{sample}.{EXT_MERGED_QC}"
+
+    def get_sample_movies(self, sample: str) -> List[str]:
+        """Returns the file names of the movies of a sample. The assignment is determined once
+        for all samples of the working directory.
+
+        Args:
+            sample (str): sample name
+        """
+
+        if self.sample_movies is None or sample not in self.sample_movies:
+            self.sample_movies = self.sample_assignment.get_movies_by_sample(self.get_unaligned_bams())
+        return self.sample_movies.get(sample, [])
+
+    @profiled("does_file_with_extension_exist")
     def does_file_with_extension_exist(self, file_name: str, extension: str):
         """Checks if the file with a given extension exists. E.g. if the original file is
             unaligned_file.bam, then this function checks for the existence of unaligned_file.{extension}
@@ -337,18 +1825,34 @@ class Pbmm2Workflow:
             extension (str): extension to check for
         """
 
-        return os.path.isfile(self.get_file_with_extension(file_name, extension))
+        return self.is_file(self.get_file_with_extension(file_name, extension))
+
+    def is_file(self, path: str) -> bool:
+        if self.snapshot:
+            return self.snapshot.is_file(path)
+        return os.path.isfile(path)
+
+    def get_file_size(self, path: str) -> int:
+        if self.snapshot:
+            return self.snapshot.get_size(path)
+        return os.path.getsize(path)
+
+    def get_file_mtime(self, path: str) -> float:
+        if self.snapshot:
+            return self.snapshot.get_mtime(path)
+        return os.path.getmtime(path)
 
     def create_file_with_extension(self, file_name: str, extension: str):
-        """Creates an empty file for a given extension. E.g. if the original file is
-            unaligned_file.bam, then this function creates unaligned_file.{extension}
+        """Atomically creates an empty file for a given extension. E.g. if the original file is
+            unaligned_file.bam, then this function creates unaligned_file.{extension}.
+            Raises FileExistsError if the file exists already.
 
         Args:
             file_name (str): file name of the unaligned BAM
             extension (str): extension the file is created with
         """
 
-        open(self.get_file_with_extension(file_name, extension), "w").close()
+        create_file_exclusively(self.get_file_with_extension(file_name, extension))
 
     def get_file_with_extension(self, file_name: str, extension: str):
         """Given the name of a file, returns the full file path with the specified
@@ -363,11 +1867,13 @@ class Pbmm2Workflow:
         file_name_without_ext = get_file_without_extension(file_name)
         return f"{self.dir}/{file_name_without_ext}.{extension}"
 
-    def check_packages(self, packages: list):
+    @staticmethod
+    def check_packages(packages: list):
         for package in packages:
-            self.check_package(package)
+            Pbmm2Workflow.check_package(package)
 
-    def check_package(self, package):
+    @staticmethod
+    def check_package(package):
         req_package = f"{package[0]} {package[1]}"
         try:
             instl_package = subprocess.check_output(
@@ -0,0 +1,663 @@
+########################################################################
+#
+#   Authors:
+#       William Feng
+#       Harvard Medical School
+#       william_feng@gmail.com
+#
+#       Alexander Veit
+#       Harvard Medical School
+#       alexander_veit@hms.harvard.edu
+#
+#   Native BAM metrics engine: the core samtools stats (SN) metrics,
+#       computed without samtools by decompressing the BGZF blocks of
+#       a BAM in a pool of processes.
+#
+########################################################################
+
+import json
+import math
+import multiprocessing
+import os
+import re
+import struct
+import zlib
+from typing import Dict, Iterator, List, Optional, Tuple
+
+from src.constants import SAMTOOLS_STATS
+from src.file_utils import get_file_without_extension, write_atomically
+
+# BGZF block header: gzip header with a single extra subfield "BC" that holds the block size - 1
+BGZF_HEADER = struct.Struct("<4sIBBHBBHH")
+BGZF_MAGIC = b"\x1f\x8b\x08\x04"
+BGZF_HEADER_SIZE = BGZF_HEADER.size
+# Empty block every BGZF file ends with
+BGZF_EOF = bytes.fromhex("1f8b08040000000000ff0600424302001b0003000000000000000000")
+BAM_MAGIC = b"BAM\x01"
+
+# Fixed part of a BAM record: block_size, refID, pos, l_read_name, mapq, bin, n_cigar_op, flag,
+# l_seq, next_refID, next_pos, tlen
+BAM_RECORD = struct.Struct("<iiiBBHHHiiii")
+BAM_RECORD_SIZE = BAM_RECORD.size
+INT32 = struct.Struct("<i")
+UINT32 = struct.Struct("<I")
+UINT16 = struct.Struct("<H")
+# Offset of the flag in a BAM record
+FLAG_OFFSET = 18
+
+# PacBio BAM index (.pbi): BGZF compressed, starts with magic, version, flags and number of reads
+PBI_MAGIC = b"PBI\x01"
+PBI_HEADER = struct.Struct("<4sIHI")
+# Extension of the sidecar file the record count of a BAM is cached in, see get_record_count
+RECORD_COUNT_EXTENSION = "record_count"
+
+FLAG_UNMAPPED = 0x4
+FLAG_SECONDARY = 0x100
+FLAG_QC_FAILED = 0x200
+FLAG_SUPPLEMENTARY = 0x800
+FLAGS_NON_PRIMARY = FLAG_SECONDARY | FLAG_SUPPLEMENTARY
+
+CIGAR_SOFT_CLIP = 4
+CIGAR_HARD_CLIP = 5
+CIGAR_REF_SKIP = 3
+
+# Sizes of the fixed-size values of optional fields (also the element types of B arrays)
+AUX_SIZES = {ord(t): size for t, size in [("A", 1), ("c", 1), ("C", 1), ("s", 2), ("S", 2), ("i", 4), ("I", 4), ("f", 4)]}
+AUX_INTEGER_FORMATS = {ord(t): f for t, f in [("c", "<b"), ("C", "<B"), ("s", "<h"), ("S", "<H"), ("i", "<i"), ("I", "<I")]}
+# Read names as allowed by the SAM specification, NUL-terminated
+READ_NAME_PATTERN = re.compile(rb"[!-?A-~][!-~]*\x00")
+
+# Bytes per range of a BAM that is processed as one task. With sampling, only some of the ranges
+# are processed
+RANGE_SIZE = 4 * 1024 * 1024
+# Number of tasks per worker without sampling, to balance the load
+TASKS_PER_WORKER = 4
+# Records claiming to be larger are considered invalid when the first record of a range is searched
+MAX_RECORD_SIZE = 64 * 1024 * 1024
+
+# Counts and totals of the computed metrics, which are summed over the ranges of a BAM
+COUNTERS = [
+    "raw total sequences",
+    "reads mapped",
+    "reads unmapped",
+    "reads MQ0",
+    "reads QC failed",
+    "non-primary alignments",
+    "supplementary alignments",
+    "total length",
+    "bases mapped",
+    "bases mapped (cigar)",
+    "mismatches",
+]
+MAXIMUM_LENGTH = "maximum length"
+
+
+def read_block(bam_file, offset: int) -> Optional[Tuple[bytes, int]]:
+    """Reads and decompresses the BGZF block at offset. Returns its data and the offset of the
+    next block, or None at the end of the file
+    """
+
+    bam_file.seek(offset)
+    header = bam_file.read(BGZF_HEADER_SIZE)
+    if not header:
+        return None
+    magic, _, _, _, extra_length, si1, si2, _, block_size = BGZF_HEADER.unpack(header)
+    if magic != BGZF_MAGIC or extra_length != 6 or (si1, si2) != (66, 67):
+        raise Exception(f"Invalid BGZF block at offset {offset} of {bam_file.name}.")
+    compressed = bam_file.read(block_size + 1 - BGZF_HEADER_SIZE)
+    return zlib.decompress(compressed[:-8], -15), offset + block_size + 1
+
+
+def find_block(bam_file, offset: int, end: int) -> Optional[int]:
+    """Offset of the first BGZF block that starts in [offset, end). A candidate is only accepted
+    if the following block header is valid as well (or it ends the file)
+    """
+
+    file_size = os.fstat(bam_file.fileno()).st_size
+    while offset < end:
+        bam_file.seek(offset)
+        chunk = bam_file.read(min(end - offset, RANGE_SIZE) + BGZF_HEADER_SIZE)
+        position = chunk.find(BGZF_MAGIC)
+        while 0 <= position and offset + position < end:
+            candidate = offset + position
+            header = chunk[position:position + BGZF_HEADER_SIZE]
+            if len(header) < BGZF_HEADER_SIZE:
+                bam_file.seek(candidate)
+                header = bam_file.read(BGZF_HEADER_SIZE)
+            if len(header) == BGZF_HEADER_SIZE:
+                _, _, _, _, extra_length, si1, si2, _, block_size = BGZF_HEADER.unpack(header)
+                next_block = candidate + block_size + 1
+                if extra_length == 6 and (si1, si2) == (66, 67):
+                    bam_file.seek(next_block)
+                    if next_block == file_size or bam_file.read(4) == BGZF_MAGIC:
+                        return candidate
+            position = chunk.find(BGZF_MAGIC, position + 1)
+        offset += RANGE_SIZE
+    return None
+
+
+def get_header_size(data: bytes) -> Optional[Tuple[int, int]]:
+    """Number of reference sequences and size of the BAM header at the start of data, None if
+    data doesn't contain the whole header yet
+    """
+
+    if len(data) < 8:
+        return None
+    position = 8 + INT32.unpack_from(data, 4)[0]
+    if len(data) < position + 4:
+        return None
+    n_ref = INT32.unpack_from(data, position)[0]
+    position += 4
+    # The references: name length, name and sequence length each
+    for _ in range(n_ref):
+        if len(data) < position + 4:
+            return None
+        position += 8 + INT32.unpack_from(data, position)[0]
+    return (n_ref, position) if len(data) >= position else None
+
+
+def read_header(bam_file) -> Tuple[int, int, int]:
+    """Parses the BAM header.
+
+    Returns:
+        Tuple[int, int, int]: number of reference sequences, and offset of the BGZF block and
+            position in its data of the first record
+    """
+
+    data = b""
+    # Offset of the last block that was read and position of its data in data
+    block_offset, block_start = 0, 0
+    offset = 0
+    header = None
+    while header is None:
+        block = read_block(bam_file, offset)
+        if block is None:
+            raise Exception(f"{bam_file.name} ends within the BAM header.")
+        block_offset, block_start = offset, len(data)
+        data += block[0]
+        offset = block[1]
+        if data[:4] != BAM_MAGIC[:len(data)]:
+            raise Exception(f"{bam_file.name} is not a BAM file.")
+        header = get_header_size(data)
+    n_ref, header_size = header
+    if header_size == len(data):
+        # The header ends with the block, the first record starts in the next one
+        return n_ref, offset, 0
+    return n_ref, block_offset, header_size - block_start
+
+
+def read_aux_integer(data: bytes, start: int, end: int, tag: bytes) -> Optional[int]:
+    """Value of an integer optional field of a record, None if it doesn't have the tag"""
+
+    position = start
+    while position + 3 <= end:
+        value_type = data[position + 2]
+        if data[position:position + 2] == tag and value_type in AUX_INTEGER_FORMATS:
+            return struct.unpack_from(AUX_INTEGER_FORMATS[value_type], data, position + 3)[0]
+        position += 3
+        if value_type in AUX_SIZES:
+            position += AUX_SIZES[value_type]
+        elif value_type in (ord("Z"), ord("H")):
+            position = data.index(b"\x00", position, end) + 1
+        elif value_type == ord("B"):
+            position += 5 + INT32.unpack_from(data, position + 1)[0] * AUX_SIZES[data[position]]
+        else:
+            return None
+    return None
+
+
+def find_aux_array(data: bytes, start: int, end: int, tag: bytes) -> Optional[Tuple[int, int]]:
+    """Offset of the values and length of an array (B) optional field, None if it's missing"""
+
+    position = start
+    while position + 3 <= end:
+        value_type = data[position + 2]
+        position += 3
+        if value_type in AUX_SIZES:
+            position += AUX_SIZES[value_type]
+        elif value_type in (ord("Z"), ord("H")):
+            position = data.index(b"\x00", position, end) + 1
+        elif value_type == ord("B"):
+            length = INT32.unpack_from(data, position + 1)[0]
+            if data[position - 3:position - 1] == tag:
+                return position + 5, length
+            position += 5 + length * AUX_SIZES[data[position]]
+        else:
+            return None
+    return None
+
+
+def get_soft_clipped_bases(data: bytes, cigar_offset: int, n_cigar_op: int) -> int:
+    """Number of soft clipped bases. Clips are the first or last operations, or next to a hard
+    clip, so that only up to two operations at each end are read
+    """
+
+    clipped = 0
+    first_unclipped = 0
+    for i in range(min(2, n_cigar_op)):
+        op = UINT32.unpack_from(data, cigar_offset + 4 * i)[0]
+        first_unclipped = i + 1
+        if op & 0xF == CIGAR_SOFT_CLIP:
+            clipped += op >> 4
+        elif op & 0xF != CIGAR_HARD_CLIP:
+            first_unclipped = i
+            break
+    for i in range(n_cigar_op - 1, max(n_cigar_op - 3, first_unclipped - 1), -1):
+        op = UINT32.unpack_from(data, cigar_offset + 4 * i)[0]
+        if op & 0xF == CIGAR_SOFT_CLIP:
+            clipped += op >> 4
+        elif op & 0xF != CIGAR_HARD_CLIP:
+            break
+    return clipped
+
+
+class BlockBuffer:
+    """Decompressed data of consecutive BGZF blocks of a BAM, which are read on demand. Keeps
+    track of where the blocks that start before the end of a range end in the data.
+
+    Args:
+        bam_file: BAM opened in binary mode
+        offset (int): offset of the first block
+        end (int): end of the range (file offset)
+    """
+
+    def __init__(self, bam_file, offset: int, end: int):
+        self.bam_file = bam_file
+        self.offset = offset
+        self.end = end
+        self.data = bytearray()
+        # Position in data where the first block that starts at or after end starts
+        self.range_end: Optional[int] = None
+        # Compressed size of the blocks of the range
+        self.compressed_bytes = 0
+        self.end_of_file = False
+
+    def read_block(self) -> bool:
+        if self.end_of_file:
+            return False
+        if self.range_end is None and self.offset >= self.end:
+            self.range_end = len(self.data)
+        block = read_block(self.bam_file, self.offset)
+        if block is None:
+            self.end_of_file = True
+            return False
+        if self.range_end is None:
+            self.compressed_bytes += block[1] - self.offset
+        self.data += block[0]
+        self.offset = block[1]
+        return True
+
+    def ensure(self, size: int) -> bool:
+        """Reads blocks until data has at least size bytes. False if the file ends before"""
+
+        while len(self.data) < size:
+            if not self.read_block():
+                return False
+        return True
+
+    def is_in_range(self, position: int) -> bool:
+        """Whether position is in the data of a block of the range"""
+
+        while self.range_end is None and position >= len(self.data):
+            if not self.read_block():
+                break
+        return position < (len(self.data) if self.range_end is None else self.range_end)
+
+    def discard(self, position: int):
+        """Drops the data before position. Positions shift accordingly"""
+
+        del self.data[:position]
+        if self.range_end is not None:
+            self.range_end -= position
+
+
+def is_record_start(buffer: BlockBuffer, position: int, n_ref: int) -> bool:
+    """Whether a valid BAM record starts at position"""
+
+    if not buffer.ensure(position + BAM_RECORD_SIZE):
+        return False
+    block_size, ref_id, pos, l_read_name, _, _, n_cigar_op, flag, l_seq, next_ref_id, next_pos, _ = (
+        BAM_RECORD.unpack_from(buffer.data, position)
+    )
+    if (
+        not -1 <= ref_id < n_ref
+        or not -1 <= next_ref_id < n_ref
+        or pos < -1
+        or next_pos < -1
+        or l_read_name < 2
+        or flag >= 0x1000
+        or l_seq < 0
+        or block_size > MAX_RECORD_SIZE
+        or block_size < BAM_RECORD_SIZE - 4 + l_read_name + 4 * n_cigar_op + (l_seq + 1) // 2 + l_seq
+    ):
+        return False
+    name_offset = position + BAM_RECORD_SIZE
+    if not buffer.ensure(name_offset + l_read_name):
+        return False
+    return bool(READ_NAME_PATTERN.fullmatch(buffer.data, name_offset, name_offset + l_read_name))
+
+
+def find_first_record(buffer: BlockBuffer, n_ref: int) -> Optional[int]:
+    """Position of the first record that starts in the blocks of the range. Records can span
+    several blocks, so each position is checked for a valid record that is followed by another
+    valid record (or the end of the file).
+    """
+
+    position = 0
+    while buffer.is_in_range(position):
+        if is_record_start(buffer, position, n_ref):
+            next_record = position + 4 + INT32.unpack_from(buffer.data, position)[0]
+            if is_record_start(buffer, next_record, n_ref) or (
+                not buffer.ensure(next_record + 1) and next_record == len(buffer.data)
+            ):
+                return position
+        position += 1
+        if position >= RANGE_SIZE:
+            buffer.discard(position)
+            position = 0
+    return None
+
+
+def new_stats() -> Dict[str, int]:
+    stats = {counter: 0 for counter in COUNTERS}
+    stats[MAXIMUM_LENGTH] = 0
+    # Compressed bytes of the blocks the counted records start in
+    stats["compressed bytes"] = 0
+    return stats
+
+
+def add_record(stats: Dict[str, int], data: bytes, position: int):
+    """Adds the record at position to the stats, see get_bam_stats for the definitions"""
+
+    block_size, _, _, l_read_name, mapq, _, n_cigar_op, flag, l_seq, _, _, _ = BAM_RECORD.unpack_from(data, position)
+    if flag & FLAG_SECONDARY:
+        stats["non-primary alignments"] += 1
+        return
+    if flag & FLAG_SUPPLEMENTARY:
+        stats["supplementary alignments"] += 1
+        return
+    stats["raw total sequences"] += 1
+    stats["total length"] += l_seq
+    if l_seq > stats[MAXIMUM_LENGTH]:
+        stats[MAXIMUM_LENGTH] = l_seq
+    if flag & FLAG_QC_FAILED:
+        stats["reads QC failed"] += 1
+    if flag & FLAG_UNMAPPED:
+        stats["reads unmapped"] += 1
+        return
+    stats["reads mapped"] += 1
+    stats["bases mapped"] += l_seq
+    if mapq == 0:
+        stats["reads MQ0"] += 1
+
+    cigar_offset = position + BAM_RECORD_SIZE + l_read_name
+    aux_offset = cigar_offset + 4 * n_cigar_op + (l_seq + 1) // 2 + l_seq
+    end = position + 4 + block_size
+    if (
+        n_cigar_op == 2
+        and UINT32.unpack_from(data, cigar_offset)[0] == (l_seq << 4 | CIGAR_SOFT_CLIP)
+        and UINT32.unpack_from(data, cigar_offset + 4)[0] & 0xF == CIGAR_REF_SKIP
+    ):
+        # Placeholder CIGAR of records with more than 65535 operations. The CIGAR is in the CG tag
+        cigar = find_aux_array(data, aux_offset, end, b"CG")
+        if cigar:
+            cigar_offset, n_cigar_op = cigar
+    stats["bases mapped (cigar)"] += l_seq - get_soft_clipped_bases(data, cigar_offset, n_cigar_op)
+    stats["mismatches"] += read_aux_integer(data, aux_offset, end, b"NM") or 0
+
+
+def get_range_stats(
+    path: str,
+    start: int,
+    end: int,
+    n_ref: int,
+    first_record: Optional[int] = None,
+    count_only: bool = False,
+) -> Dict[str, int]:
+    """Stats of the records that start in the BGZF blocks that start in [start, end).
+
+    Args:
+        path (str): path of the BAM
+        start (int): start of the range (file offset)
+        end (int): end of the range (file offset)
+        n_ref (int): number of reference sequences, used to validate records
+        first_record (int): position of the first record in the data of the block at start.
+            By default, the first record is searched, see find_first_record
+        count_only (bool): only count the primary records ("raw total sequences"), without
+            parsing them
+    """
+
+    stats = new_stats()
+    with open(path, "rb") as bam_file:
+        offset = start if first_record is not None else find_block(bam_file, start, end)
+        if offset is None:
+            return stats
+        buffer = BlockBuffer(bam_file, offset, end)
+        position = first_record if first_record is not None else find_first_record(buffer, n_ref)
+        while position is not None and buffer.is_in_range(position):
+            if not buffer.ensure(position + 4):
+                break
+            record_end = position + 4 + INT32.unpack_from(buffer.data, position)[0]
+            if not buffer.ensure(record_end):
+                raise Exception(f"{path} is truncated: its last record is incomplete.")
+            if not count_only:
+                add_record(stats, buffer.data, position)
+            elif not UINT16.unpack_from(buffer.data, position + FLAG_OFFSET)[0] & FLAGS_NON_PRIMARY:
+                stats["raw total sequences"] += 1
+            position = record_end
+            if position >= RANGE_SIZE:
+                buffer.discard(position)
+                position = 0
+        # Also reads the remaining blocks of the range, if no record starts in them
+        buffer.is_in_range(len(buffer.data) + RANGE_SIZE)
+        stats["compressed bytes"] = buffer.compressed_bytes
+    return stats
+
+
+def _get_range_stats(task: tuple) -> Dict[str, int]:
+    return get_range_stats(*task)
+
+
+def get_range_tasks(path: str, fraction: float, workers: int, count_only: bool = False) -> Tuple[List[tuple], int, int]:
+    """Splits a BAM into ranges of BGZF blocks, see get_bam_stats.
+
+    Returns:
+        Tuple[List[tuple], int, int]: arguments of get_range_stats for each range that is read,
+            size of the BAM and offset of the block the header ends in
+    """
+
+    with open(path, "rb") as bam_file:
+        n_ref, header_block, first_record = read_header(bam_file)
+    file_size = os.path.getsize(path)
+
+    # Ranges start after the block the header ends in. That block belongs to the first range
+    records_start = header_block + 1
+    size = max(file_size - records_start, 1)
+    if fraction < 1:
+        num_ranges = max(1, math.ceil(size / RANGE_SIZE))
+        num_sampled = max(1, round(num_ranges * fraction))
+        indices = sorted({int((i + 0.5) * num_ranges / num_sampled) for i in range(num_sampled)})
+    else:
+        num_ranges = workers * TASKS_PER_WORKER
+        indices = range(num_ranges)
+    range_size = math.ceil(size / num_ranges)
+    tasks = [
+        (path, header_block, records_start + range_size, n_ref, first_record, count_only) if i == 0
+        else (path, records_start + i * range_size, records_start + (i + 1) * range_size, n_ref, None, count_only)
+        for i in indices
+    ]
+    return tasks, file_size, header_block
+
+
+def sum_range_stats(tasks: List[tuple], workers: int) -> Dict[str, int]:
+    """Runs get_range_stats for the ranges in a pool of processes and sums up their stats"""
+
+    stats = new_stats()
+    if workers == 1 or len(tasks) == 1:
+        results: Iterator[Dict[str, int]] = map(_get_range_stats, tasks)
+        pool = None
+    else:
+        pool = multiprocessing.Pool(min(workers, len(tasks)))
+        results = pool.imap_unordered(_get_range_stats, tasks)
+    try:
+        for range_stats in results:
+            for counter in COUNTERS + ["compressed bytes"]:
+                stats[counter] += range_stats[counter]
+            stats[MAXIMUM_LENGTH] = max(stats[MAXIMUM_LENGTH], range_stats[MAXIMUM_LENGTH])
+    finally:
+        if pool:
+            pool.close()
+            pool.join()
+    return stats
+
+
+def get_bam_stats(path: str, fraction: float = 1.0, workers: Optional[int] = None) -> Dict[str, str]:
+    """Computes the core samtools stats (SN) metrics of a BAM without samtools. The BAM is split
+    into ranges of BGZF blocks that are decompressed and parsed in a pool of processes. The
+    metrics are named like those of parse_samtools_stats and follow the samtools definitions:
+    secondary and supplementary records are only counted as non-primary and supplementary
+    alignments, all other metrics are computed from the primary records.
+
+    Args:
+        path (str): path of the BAM
+        fraction (float): fraction of the BAM to read. Below 1, only evenly spread ranges of
+            blocks are read and counts and totals are extrapolated to the whole BAM (maximum
+            length is the maximum of the sampled records)
+        workers (int): number of processes. Defaults to the number of available CPUs
+
+    Returns:
+        Dict[str, str]: values by metric name ("samtools stats: ...")
+    """
+
+    if not 0 < fraction <= 1:
+        raise ValueError("The sampling fraction must be greater than 0 and at most 1.")
+    workers = workers or len(os.sched_getaffinity(0))
+    tasks, file_size, header_block = get_range_tasks(path, fraction, workers)
+    stats = sum_range_stats(tasks, workers)
+
+    # Extrapolation to the whole BAM, by the compressed size of the blocks that were read
+    scale = 1.0
+    if fraction < 1 and stats["compressed bytes"]:
+        scale = max(1.0, (file_size - header_block) / stats["compressed bytes"])
+    values = {counter: round(stats[counter] * scale) for counter in COUNTERS}
+    values[MAXIMUM_LENGTH] = stats[MAXIMUM_LENGTH]
+    values["sequences"] = values["raw total sequences"]
+    values["filtered sequences"] = 0
+    values["average length"] = round(values["total length"] / values["sequences"]) if values["sequences"] else 0
+    values["error rate"] = values["mismatches"] / values["bases mapped (cigar)"] if values["bases mapped (cigar)"] else 0.0
+    return {f"{SAMTOOLS_STATS}: {name}": format_value(value) for name, value in values.items()}
+
+
+def count_primary_records(path: str, workers: Optional[int] = None) -> int:
+    """Counts the primary records of a BAM (like "raw total sequences" of samtools stats). The
+    BGZF blocks are decompressed in a pool of processes, like for get_bam_stats, but only the
+    flags of the records are read.
+
+    Args:
+        path (str): path of the BAM
+        workers (int): number of processes. Defaults to the number of available CPUs
+    """
+
+    workers = workers or len(os.sched_getaffinity(0))
+    tasks, _, _ = get_range_tasks(path, 1.0, workers, count_only=True)
+    return sum_range_stats(tasks, workers)["raw total sequences"]
+
+
+def read_pbi_record_count(path: str) -> int:
+    """Number of records of a PacBio BAM according to its .pbi index. Only the header of the
+    index is read.
+
+    Args:
+        path (str): path of the .pbi file
+    """
+
+    with open(path, "rb") as pbi_file:
+        block = read_block(pbi_file, 0)
+    if block is None or len(block[0]) < PBI_HEADER.size or block[0][:4] != PBI_MAGIC:
+        raise Exception(f"{path} is not a PacBio BAM index.")
+    return PBI_HEADER.unpack_from(block[0])[3]
+
+
+def get_record_count_sidecar(path: str) -> str:
+    """Path of the sidecar file the record count of a BAM is cached in, e.g. movie.record_count
+    for movie.bam
+    """
+
+    return f"{get_file_without_extension(path)}.{RECORD_COUNT_EXTENSION}"
+
+
+def get_record_count(path: str, workers: Optional[int] = None, compute: bool = True) -> Optional[Tuple[int, str]]:
+    """Number of primary records of a BAM, from the first of these sources:
+    - its PacBio index (path.pbi), if it's not older than the BAM
+    - its sidecar file (see get_record_count_sidecar), if the BAM has not changed since the
+      records were counted
+    - counting the records, see count_primary_records. The count is then stored in the sidecar,
+      so that the records of a BAM are only counted once
+
+    Args:
+        path (str): path of the BAM
+        workers (int): number of processes that count the records. Defaults to the number of
+            available CPUs
+        compute (bool): count the records if neither the index nor the sidecar has the count
+
+    Returns:
+        Optional[Tuple[int, str]]: number of records and its source ("pbi", "sidecar" or
+            "bgzf"). None if the records would have to be counted, but compute is False
+    """
+
+    bam_stat = os.stat(path)
+    pbi_path = f"{path}.pbi"
+    try:
+        if os.stat(pbi_path).st_mtime >= bam_stat.st_mtime:
+            return read_pbi_record_count(pbi_path), "pbi"
+    except FileNotFoundError:
+        pass
+
+    sidecar_path = get_record_count_sidecar(path)
+    try:
+        with open(sidecar_path) as sidecar_file:
+            sidecar = json.load(sidecar_file)
+        if sidecar["size"] == bam_stat.st_size and sidecar["mtime"] == bam_stat.st_mtime:
+            return int(sidecar["records"]), "sidecar"
+    except (OSError, ValueError, KeyError):
+        pass
+
+    if not compute:
+        return None
+    records = count_primary_records(path, workers)
+    write_atomically(
+        sidecar_path, json.dumps({"size": bam_stat.st_size, "mtime": bam_stat.st_mtime, "records": records})
+    )
+    return records, "bgzf"
+
+
+def format_value(value) -> str:
+    # Like samtools stats, which prints the error rate in scientific notation
+    return f"{value:e}" if isinstance(value, float) else str(value)
+
+
+def quickcheck(path: str):
+    """Checks that a file is a BAM with a valid header and the BGZF end-of-file marker, like
+    samtools quickcheck. Raises an exception otherwise.
+
+    Args:
+        path (str): path of the BAM
+    """
+
+    with open(path, "rb") as bam_file:
+        read_header(bam_file)
+        bam_file.seek(0, os.SEEK_END)
+        if bam_file.tell() < len(BGZF_EOF):
+            raise Exception(f"{path} is missing the BGZF end-of-file marker.")
+        bam_file.seek(-len(BGZF_EOF), os.SEEK_END)
+        if bam_file.read() != BGZF_EOF:
+            raise Exception(f"{path} is missing the BGZF end-of-file marker.")
+
+
+def format_samtools_stats(metrics: Dict[str, str], comments: Optional[List[str]] = None) -> str:
+    """Metrics as the SN section of samtools stats output, which parse_samtools_stats reads"""
+
+    prefix = f"{SAMTOOLS_STATS}: "
+    lines = [f"# {comment}" for comment in comments or []]
+    lines += [f"SN\t{name[len(prefix):]}:\t{value}" for name, value in metrics.items()]
+    return "\n".join(lines) + "\n"
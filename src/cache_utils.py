@@ -0,0 +1,209 @@
+########################################################################
+#
+#   Authors:
+#       William Feng
+#       Harvard Medical School
+#       william_feng@gmail.com
+#
+#       Alexander Veit
+#       Harvard Medical School
+#       alexander_veit@hms.harvard.edu
+#
+#   Content-addressed cache of alignment results, so that the same
+#       unaligned BAM is only aligned once.
+#
+########################################################################
+
+import hashlib
+import json
+import os
+import shutil
+import subprocess
+import uuid
+from datetime import datetime, timezone
+from functools import lru_cache
+from pathlib import Path
+from typing import Dict, List, Optional
+from src.config_utils import CacheConfig
+
+# Number and size of the blocks that are hashed to fingerprint a file
+FINGERPRINT_NUM_BLOCKS = 16
+FINGERPRINT_BLOCK_SIZE = 64 * 1024
+
+CACHE_ENTRY_METADATA = "entry.json"
+
+
+def get_file_fingerprint(path: str) -> str:
+    """Fast fingerprint of a (large) file: the file size together with a hash of
+    FINGERPRINT_NUM_BLOCKS blocks that are evenly spaced over the file, incl. the first
+    and the last block.
+
+    Args:
+        path (str): path of the file
+    """
+
+    size = os.path.getsize(path)
+    sha = hashlib.sha256()
+    sha.update(str(size).encode())
+    with open(path, "rb") as f:
+        if size <= FINGERPRINT_NUM_BLOCKS * FINGERPRINT_BLOCK_SIZE:
+            sha.update(f.read())
+        else:
+            step = (size - FINGERPRINT_BLOCK_SIZE) // (FINGERPRINT_NUM_BLOCKS - 1)
+            for i in range(FINGERPRINT_NUM_BLOCKS):
+                f.seek(i * step)
+                sha.update(f.read(FINGERPRINT_BLOCK_SIZE))
+    return f"{size}-{sha.hexdigest()}"
+
+
+@lru_cache(maxsize=None)
+def get_reference_checksum(reference_path: str) -> str:
+    return get_file_fingerprint(reference_path)
+
+
+@lru_cache(maxsize=None)
+def get_pbmm2_version() -> str:
+    output = subprocess.check_output(["pbmm2", "--version"], text=True, stderr=subprocess.STDOUT)
+    return output.splitlines()[0].strip() if output else ""
+
+
+def get_cache_key(input_bam: str, reference_path: str, preset: str, output_format: str = "bam") -> str:
+    """Cache key of an alignment: input fingerprint, reference checksum, pbmm2 preset and version,
+    and the format of the cached alignment
+
+    Args:
+        input_bam (str): path of the unaligned BAM
+        reference_path (str): path of the reference the BAM is aligned to
+        preset (str): pbmm2 preset
+        output_format (str): "bam" or "cram". BAM entries keep the keys they had before CRAMs
+            were cached
+    """
+
+    parts = [
+        get_file_fingerprint(input_bam),
+        get_reference_checksum(reference_path),
+        preset,
+        get_pbmm2_version(),
+    ]
+    if output_format != "bam":
+        parts.append(output_format)
+    return hashlib.sha256("|".join(parts).encode()).hexdigest()
+
+
+def get_cache_entry_dir(cache_config: CacheConfig, cache_key: str) -> str:
+    return f"{cache_config.cache_dir}/{cache_key[:2]}/{cache_key}"
+
+
+def link_file(source: str, target: str):
+    """Hardlinks source to target. If that's not possible (e.g. different file systems), the file
+    is reflinked, which falls back to a copy if the file system does not support reflinks.
+    """
+
+    Path(target).unlink(missing_ok=True)
+    try:
+        os.link(source, target)
+    except OSError:
+        subprocess.run(["cp", "--reflink=auto", source, target], check=True)
+
+
+def has_cache_entry(cache_config: CacheConfig, cache_key: str) -> bool:
+    return os.path.isfile(f"{get_cache_entry_dir(cache_config, cache_key)}/{CACHE_ENTRY_METADATA}")
+
+
+def restore_from_cache(cache_config: CacheConfig, cache_key: str, targets: Dict[str, str]) -> bool:
+    """Links the cached files of an entry to their targets. Returns False if there is no
+    complete entry for the key.
+
+    Args:
+        cache_config (CacheConfig): cache configuration
+        cache_key (str): key of the entry
+        targets (Dict[str, str]): target path for each cached file name
+    """
+
+    entry_dir = get_cache_entry_dir(cache_config, cache_key)
+    if not has_cache_entry(cache_config, cache_key):
+        return False
+    for file_name, target in targets.items():
+        # Optional files (e.g. the BAM index) might not be part of the entry
+        if os.path.isfile(f"{entry_dir}/{file_name}"):
+            Path(target).parent.mkdir(parents=True, exist_ok=True)
+            link_file(f"{entry_dir}/{file_name}", target)
+    # Entries are evicted least recently used first
+    os.utime(f"{entry_dir}/{CACHE_ENTRY_METADATA}")
+    return True
+
+
+def add_to_cache(cache_config: CacheConfig, cache_key: str, sources: Dict[str, str], source_bam: str):
+    """Adds an entry to the cache. The entry is assembled in a temporary folder and moved into
+    place at the end, so that concurrent readers never see partial entries.
+
+    Args:
+        cache_config (CacheConfig): cache configuration
+        cache_key (str): key of the entry
+        sources (Dict[str, str]): path of the file to cache for each cached file name
+        source_bam (str): path of the unaligned BAM the entry was created from
+    """
+
+    entry_dir = get_cache_entry_dir(cache_config, cache_key)
+    if os.path.isdir(entry_dir):
+        return
+    tmp_dir = f"{cache_config.cache_dir}/tmp/{uuid.uuid4().hex}"
+    Path(tmp_dir).mkdir(parents=True)
+    for file_name, source in sources.items():
+        link_file(source, f"{tmp_dir}/{file_name}")
+    with open(f"{tmp_dir}/{CACHE_ENTRY_METADATA}", "w") as f:
+        json.dump(
+            {
+                "source_bam": source_bam,
+                "created": datetime.now(timezone.utc).isoformat(),
+            },
+            f,
+        )
+    Path(entry_dir).parent.mkdir(parents=True, exist_ok=True)
+    try:
+        os.rename(tmp_dir, entry_dir)
+    except OSError:
+        # Another process added the same entry in the meantime
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+
+def get_cache_entries(cache_config: CacheConfig) -> List[dict]:
+    """Returns all cache entries with their size in bytes and last use, least recently used first"""
+
+    entries = []
+    for metadata in Path(cache_config.cache_dir).glob(f"??/*/{CACHE_ENTRY_METADATA}"):
+        entry_dir = metadata.parent
+        size = sum(f.stat().st_size for f in entry_dir.iterdir() if f.is_file())
+        entries.append(
+            {"path": str(entry_dir), "size": size, "last_used": metadata.stat().st_mtime}
+        )
+    return sorted(entries, key=lambda entry: entry["last_used"])
+
+
+def prune_cache(cache_config: CacheConfig, max_size_gb: Optional[float] = None, dry_run: bool = False):
+    """Evicts the least recently used entries until the cache is smaller than max_size_gb.
+    Note that files that are still hardlinked from a project folder only free up space once
+    they are removed there as well.
+
+    Args:
+        cache_config (CacheConfig): cache configuration
+        max_size_gb (float): maximum size of the cache. Defaults to the size in the config
+        dry_run (bool): only print which entries would be evicted
+    """
+
+    max_size = (max_size_gb if max_size_gb is not None else cache_config.max_size_gb) * 1024**3
+    entries = get_cache_entries(cache_config)
+    cache_size = sum(entry["size"] for entry in entries)
+    print(
+        f"Cache {cache_config.cache_dir}: {len(entries)} entries, {cache_size / 1024**3:.2f} GB "
+        f"(limit {max_size / 1024**3:.2f} GB)."
+    )
+
+    for entry in entries:
+        if cache_size <= max_size:
+            break
+        print(f"{'Would evict' if dry_run else 'Evicting'} {entry['path']} ({entry['size'] / 1024**3:.2f} GB)")
+        if not dry_run:
+            shutil.rmtree(entry["path"])
+        cache_size -= entry["size"]
+    print(f"Cache size after eviction: {cache_size / 1024**3:.2f} GB.")
@@ -1,11 +1,23 @@
 import click, os
 from src.logging_utils import search_log
 from src.env_utils import check_env_variable, check_all_env_variables
-from src.qc_utils import create_summary_qc_file, print_human_readable_qc
+from src.qc_utils import create_summary_qc_file, store_qc_metrics
+from src.qc_viewer_utils import print_human_readable_qc
+from src.qc_gate_utils import run_qc_gate
+from src.bam_stats_utils import get_bam_stats, format_samtools_stats, get_record_count
 # from src.run_pbmm2 import run_pbmm2_single, run_pbmm2_all
 # from src.run_qc import run_qc_single, run_qc_all
-from src.config_utils import print_config
-from src.Pbmm2Workflow import Pbmm2Workflow
+from src.config_utils import print_config, load_config, EXECUTORS
+from src.executor_utils import get_executor
+from src.cache_utils import prune_cache
+from src.timeline_utils import print_timeline_report
+from src.metrics_utils import MetricsExporter, get_metrics_state_path
+from src.status_utils import print_status, STATES
+from src.reset_utils import get_reset_plan, run_reset, WORKFLOW_STEPS
+from src.Pbmm2Workflow import Pbmm2Workflow, EXT_ALIGNED_SORTED, STATE_PENDING
+from src.watch_utils import FolderWatcher
+from src.logging_utils import add_to_log
+from src.profiling_utils import init_profiling
 
 
 @click.command()
@@ -31,7 +43,35 @@ def cmd_print_config():
     type=str,
     help="Path to folder with unaligned BAM files to run the respective next steps in the workflow",
 )
-def cmd_run_pbmm2_workflow(input_bam, input_folder):
+@click.option(
+    "-e",
+    "--executor",
+    required=False,
+    type=click.Choice(EXECUTORS),
+    help="Where to run the jobs. 'slurm' submits them with sbatch, 'local' runs them on this machine, "
+    "'auto' runs jobs with small inputs locally. Defaults to the executor in the config file.",
+)
+@click.option(
+    "--dry-run",
+    is_flag=True,
+    help="Only print the planned job submissions for the folder and the estimated completion time. "
+    "Only valid with -f/--input-folder.",
+)
+@click.option(
+    "--profile",
+    is_flag=True,
+    help="Time file checks, subprocesses, config loads and log writes and print a summary at exit. "
+    "Can also be enabled with the environment variable O2P_PROFILE=1.",
+)
+@click.option(
+    "--profile-output",
+    required=False,
+    type=str,
+    help="Path to additionally write a profile of the whole run to (implies --profile). Paths ending "
+    "with .json get a Chrome trace of the timed calls, all other paths a cProfile dump (pstats). "
+    "Defaults to the environment variable O2P_PROFILE_OUTPUT.",
+)
+def cmd_run_pbmm2_workflow(input_bam, input_folder, executor, dry_run, profile, profile_output):
     """
     This script runs the full pbmm2 workflow on a given unaligned BAM file or all of the unaligned BAM files in
     a given folder. The script aligns the BAM files, runs some basic checks, runs samtools stats, and gathers
@@ -46,6 +86,9 @@ def cmd_run_pbmm2_workflow(input_bam, input_folder):
         raise ValueError(
             "argument -b/--input-bam not allowed with argument -f/--input-folder."
             )
+    if dry_run and not input_folder:
+        raise ValueError("argument --dry-run is only allowed with argument -f/--input-folder.")
+    init_profiling(profile or bool(profile_output), profile_output)
     check_all_env_variables()
 
     if input_bam:
@@ -54,7 +97,7 @@ def cmd_run_pbmm2_workflow(input_bam, input_folder):
         working_dir = (
             "." if os.path.dirname(input_bam) == "" else os.path.dirname(input_bam)
         )
-        pbmm2_workflow = Pbmm2Workflow(working_dir)
+        pbmm2_workflow = Pbmm2Workflow(working_dir, executor_name=executor)
         file_name = os.path.basename(input_bam)
         pbmm2_workflow.resume_workflow_single(file_name)
     elif input_folder:
@@ -62,8 +105,8 @@ def cmd_run_pbmm2_workflow(input_bam, input_folder):
             raise IOError("Please provide the path to a valid directory.")
         # strip trailing backslashes for folders
         input_folder = input_folder.rstrip("/")
-        pbmm2_workflow = Pbmm2Workflow(input_folder)
-        pbmm2_workflow.resume_workflow_all()
+        pbmm2_workflow = Pbmm2Workflow(input_folder, executor_name=executor)
+        pbmm2_workflow.resume_workflow_all(dry_run=dry_run)
 
 
 @click.command()
@@ -71,24 +114,77 @@ def cmd_run_pbmm2_workflow(input_bam, input_folder):
 @click.option(
     "-b",
     "--input-bam",
-    required=True,
+    required=False,
     type=str,
     help="Path to an unaligned BAM file to reset a step in the workflow.",
 )
+@click.option(
+    "-f",
+    "--input-folder",
+    required=False,
+    type=str,
+    help="Path to a folder to reset a step in the workflow for all unaligned BAM files that match "
+    "the --state and -g/--glob filters.",
+)
 @click.option(
     "-s",
     "--workflow-step",
     required=True,
+    type=click.Choice(WORKFLOW_STEPS),
+    help="Workflow step to reset. Valid options are 'merge', 'cram', 'qc', 'checks', and 'alignment'.",
+)
+@click.option(
+    "--state",
+    required=False,
+    multiple=True,
+    type=click.Choice(STATES),
+    help="Only reset the files in this state. Can be given multiple times. Only valid with -f/--input-folder.",
+)
+@click.option(
+    "-g",
+    "--glob",
+    required=False,
+    multiple=True,
     type=str,
-    help="Workflow step to reset. Valid options are 'qc', 'checks', and 'alignment'.",
+    help="Only reset the files whose name matches this glob, e.g. 'm84*.bam'. Can be given multiple "
+    "times. Only valid with -f/--input-folder.",
+)
+@click.option(
+    "--dry-run",
+    is_flag=True,
+    help="Only print the files that would be reset, the jobs that would be cancelled and the files "
+    "that would be removed with the space they take up. Only valid with -f/--input-folder.",
 )
-def cmd_reset_pbmm2_workflow(input_bam, workflow_step):
+def cmd_reset_pbmm2_workflow(input_bam, input_folder, workflow_step, state, glob, dry_run):
     """
     This script resets a specific workflow step for a given input BAM file. This can be helpful in the
-    event that a step is interrupted or if another error occurs.
+    event that a step is interrupted or if another error occurs. With -f, the step is reset for all
+    matching BAM files of a folder: their jobs that are still pending or running are cancelled with
+    one scancel call and the files of the step are removed in parallel.
     """
 
+    if not input_bam and not input_folder:
+        raise ValueError(
+            "Either a path to an unaligned BAM file or a path to a folder containing those must be provided."
+            )
+    if input_bam and input_folder:
+        raise ValueError(
+            "argument -b/--input-bam not allowed with argument -f/--input-folder."
+            )
+    if (state or glob or dry_run) and not input_folder:
+        raise ValueError("arguments --state, -g/--glob and --dry-run are only allowed with argument -f/--input-folder.")
     check_all_env_variables()
+
+    if input_folder:
+        if not os.path.isdir(input_folder):
+            raise IOError("Please provide the path to a valid directory.")
+        plan = get_reset_plan(input_folder.rstrip("/"), workflow_step, state_filter=list(state), globs=list(glob))
+        if dry_run:
+            plan.print()
+        else:
+            run_reset(plan)
+        return
+
     working_dir = (
         "." if os.path.dirname(input_bam) == "" else os.path.dirname(input_bam)
     )
@@ -97,6 +193,103 @@ def cmd_reset_pbmm2_workflow(input_bam, workflow_step):
     pbmm2_workflow.reset(file_name=file_name, workflow_step=workflow_step)
 
 
+@click.command()
+@click.help_option("--help", "-h")
+@click.option(
+    "-f",
+    "--input-folder",
+    required=False,
+    multiple=True,
+    type=str,
+    help="Folder to watch for new unaligned BAM files. Can be given multiple times. Defaults to the "
+    "folders in the watch config.",
+)
+@click.option(
+    "-e",
+    "--executor",
+    required=False,
+    type=click.Choice(EXECUTORS),
+    help="Where to run the jobs. Defaults to the executor in the config file.",
+)
+@click.option(
+    "--polling",
+    is_flag=True,
+    help="List the folders periodically instead of using inotify.",
+)
+def cmd_watch_folders(input_folder, executor, polling):
+    """
+    This script watches folders for new unaligned BAM files and starts the pbmm2 workflow for a file
+    as soon as its size and modification time have been stable for the configured window, i.e. once
+    its transfer is complete. Unaligned BAM files that are already in the folders and have not been
+    started yet are processed as well.
+    """
+
+    check_all_env_variables()
+    watch_config = load_config().watch_config
+    folders = [folder.rstrip("/") for folder in (input_folder or watch_config.folders)]
+    if not folders:
+        raise ValueError("Please provide a folder to watch (-f) or set folders in the watch config.")
+    for folder in folders:
+        if not os.path.isdir(folder):
+            raise IOError(f"Please provide the path to a valid directory: {folder}")
+
+    # The folders share one executor and with it the submission limits and the local CPUs
+    shared_executor = get_executor(load_config(), executor)
+    workflows = {folder: Pbmm2Workflow(folder, executor=shared_executor) for folder in folders}
+
+    def is_new(folder, file_name):
+        try:
+            return workflows[folder].get_state(file_name) == STATE_PENDING
+        except Exception:
+            return False
+
+    def on_stable_file(folder, file_name):
+        add_to_log(f"Transfer of {folder}/{file_name} is complete. Starting the workflow.")
+        try:
+            workflows[folder].resume_workflow_single(file_name)
+        except Exception as e:
+            add_to_log(f"Error starting the workflow for {folder}/{file_name}: {str(e)}")
+            print(f"Error starting the workflow for {folder}/{file_name}: {str(e)}")
+
+    watcher = FolderWatcher(
+        folders,
+        aligned_extension=EXT_ALIGNED_SORTED,
+        on_stable_file=on_stable_file,
+        stability_window=watch_config.stability_window_seconds,
+        poll_interval=watch_config.poll_interval_seconds,
+        use_inotify=False if polling else watch_config.use_inotify,
+    )
+    watcher.add_existing_files(is_new)
+    watcher.watch()
+
+
+@click.command()
+@click.help_option("--help", "-h")
+@click.option(
+    "-m",
+    "--max-size-gb",
+    required=False,
+    type=float,
+    help="Maximum size of the cache in GB. Defaults to max_size_gb in the cache config.",
+)
+@click.option(
+    "--dry-run",
+    is_flag=True,
+    help="Only print the cache size and the entries that would be evicted.",
+)
+def cmd_prune_alignment_cache(max_size_gb, dry_run):
+    """
+    Prints the size of the alignment cache and evicts the least recently used entries until the
+    cache is smaller than the maximum size.
+    """
+
+    check_all_env_variables()
+    config = load_config()
+    if not config.cache_config:
+        raise ValueError("No alignment cache is configured (cache_config).")
+    prune_cache(config.cache_config, max_size_gb=max_size_gb, dry_run=dry_run)
+
+
 @click.command()
 @click.help_option("--help", "-h")
 @click.option(
@@ -114,6 +307,131 @@ def cmd_search_log(search_term):
     search_log(search_term)
 
 
+@click.command()
+@click.help_option("--help", "-h")
+@click.option(
+    "-p",
+    "--path-filter",
+    required=False,
+    type=str,
+    help="Only include samples whose path contains this string, e.g. a project folder.",
+)
+@click.option(
+    "-c",
+    "--csv",
+    "csv_path",
+    required=False,
+    type=str,
+    help="Path of a CSV file to write the per-sample timelines to.",
+)
+def cmd_timeline(path_filter, csv_path):
+    """
+    Reconstructs the per-sample timelines of the workflow from the master log and reports
+    p50/p90/p99 of the queue wait, run time, human gap (time until the workflow was run again
+    after a step ended) and turnaround of each step, overall and by input size. Job start and
+    end times are retrieved from sacct.
+    """
+
+    check_all_env_variables()
+    print_timeline_report(load_config(), path_filter=path_filter, csv_path=csv_path)
+
+
+@click.command()
+@click.help_option("--help", "-h")
+@click.option(
+    "-f",
+    "--input-folder",
+    required=False,
+    multiple=True,
+    type=str,
+    help="Folder to export the metrics of. Can be given multiple times. Defaults to the folders in the "
+    "metrics config.",
+)
+@click.option(
+    "-o",
+    "--output",
+    required=False,
+    type=str,
+    help="Path of the Prometheus text file (*.prom). Defaults to textfile_path in the metrics config.",
+)
+@click.option(
+    "--daemon",
+    is_flag=True,
+    help="Keep running and export the metrics every export_interval_seconds (metrics config). "
+    "The log is then only read incrementally.",
+)
+def cmd_export_metrics(input_folder, output, daemon):
+    """
+    Exports the number of samples per workflow state, the number of submitted and failed jobs and
+    histograms of the step turnaround of the given folders in the Prometheus text format, e.g. for
+    the textfile collector of node_exporter. The file is replaced atomically. Nothing is submitted
+    or changed in the folders.
+    """
+
+    check_all_env_variables()
+    config = load_config()
+    metrics_config = config.metrics_config
+    folders = list(input_folder or metrics_config.folders)
+    textfile_path = output or metrics_config.textfile_path
+    if not folders:
+        raise ValueError("Please provide a folder (-f) or set folders in the metrics config.")
+    if not textfile_path:
+        raise ValueError("Please provide the output path (-o) or set textfile_path in the metrics config.")
+    for folder in folders:
+        if not os.path.isdir(folder):
+            raise IOError(f"Please provide the path to a valid directory: {folder}")
+
+    if daemon:
+        MetricsExporter(config, folders).run(textfile_path, metrics_config.export_interval_seconds)
+    else:
+        # Continues reading the log where the previous run stopped
+        MetricsExporter(config, folders, state_path=get_metrics_state_path(config)).export(textfile_path)
+
+
+@click.command()
+@click.help_option("--help", "-h")
+@click.option(
+    "-f",
+    "--input-folder",
+    required=True,
+    multiple=True,
+    type=str,
+    help="Folder to show the status of. Can be given multiple times.",
+)
+@click.option(
+    "-s",
+    "--state",
+    required=False,
+    multiple=True,
+    type=click.Choice(STATES),
+    help="Only list the samples in this state. Can be given multiple times.",
+)
+@click.option("--json", "as_json", is_flag=True, help="Print the status as JSON.")
+@click.option(
+    "--live",
+    is_flag=True,
+    help="Keep refreshing the tables every refresh_seconds (status config) until interrupted.",
+)
+@click.option("--refresh", is_flag=True, help="Ignore cached state snapshots.")
+def cmd_status(input_folder, state, as_json, live, refresh):
+    """
+    Shows the workflow state of each sample and the number of samples per state of the given
+    folders. Nothing is submitted or changed in the folders. States are cached for ttl_seconds
+    (status config), unless files were added or removed in the folder.
+    """
+
+    check_all_env_variables()
+    for folder in input_folder:
+        if not os.path.isdir(folder):
+            raise IOError(f"Please provide the path to a valid directory: {folder}")
+    if as_json and live:
+        raise ValueError("--json and --live can't be combined.")
+
+    print_status(
+        load_config(), list(input_folder), state_filter=list(state), as_json=as_json, live=live, refresh=refresh
+    )
+
+
 @click.command()
 @click.help_option("--help", "-h")
 @click.option(
@@ -130,7 +448,22 @@ def cmd_search_log(search_term):
     type=str,
     help="Absolute path of the output summary QC file",
 )
-def cmd_create_summary_qc_file(qc_folder, summary_qc_path): 
+@click.option(
+    "-d",
+    "--max-depth",
+    required=False,
+    type=int,
+    help="Depth of the deepest subfolders of the qc folder that are searched (0: only the qc folder). Defaults to no limit.",
+)
+@click.option(
+    "-x",
+    "--exclude",
+    required=False,
+    multiple=True,
+    type=str,
+    help="Skip files and folders that match this glob, e.g. 'old_runs'. Can be given multiple times.",
+)
+def cmd_create_summary_qc_file(qc_folder, summary_qc_path, max_depth, exclude): 
     """ This scripts generates a summary QC file using the provided folder containing
         individual .qc files."""
 
@@ -140,7 +473,111 @@ def cmd_create_summary_qc_file(qc_folder, summary_qc_path):
         raise ValueError("Please provide the absolute path to the summary QC file.")
     
     qc_folder = qc_folder.rstrip("/")
-    create_summary_qc_file(qc_folder, summary_qc_path)
+    create_summary_qc_file(qc_folder, summary_qc_path, max_depth=max_depth, exclude=list(exclude))
+
+
+@click.command()
+@click.help_option("--help", "-h")
+@click.option(
+    "-b",
+    "--input-bam",
+    required=True,
+    type=str,
+    help="Path of the BAM to compute the metrics of",
+)
+@click.option(
+    "-f",
+    "--fraction",
+    required=False,
+    type=float,
+    default=1.0,
+    show_default=True,
+    help="Fraction of the BAM to read. Below 1, counts and totals are estimated from evenly spread parts of the BAM.",
+)
+@click.option(
+    "-t",
+    "--threads",
+    required=False,
+    type=int,
+    help="Number of processes that decompress and parse the BAM. Defaults to the number of available CPUs.",
+)
+@click.option(
+    "-o",
+    "--output",
+    required=False,
+    type=str,
+    help="Path of a parsed .qc file to write the metrics to. By default, they are printed in the samtools stats format.",
+)
+def cmd_bam_stats(input_bam, fraction, threads, output):
+    """ Computes the core samtools stats metrics of a BAM without samtools (built-in BAM metrics
+        engine)."""
+
+    if not os.path.isfile(input_bam):
+        raise IOError("Please provide the path to a valid BAM file.")
+    metrics = get_bam_stats(input_bam, fraction=fraction, workers=threads)
+    if output:
+        store_qc_metrics(metrics, output)
+        return
+    comments = [f"Computed by o2p-bam-stats from {input_bam}"]
+    if fraction < 1:
+        comments.append(f"Estimated from {fraction:.1%} of the BAM")
+    print(format_samtools_stats(metrics, comments), end="")
+
+
+@click.command()
+@click.help_option("--help", "-h")
+@click.option(
+    "-b",
+    "--input-bam",
+    required=True,
+    type=str,
+    help="Path of the BAM to count the records of",
+)
+@click.option(
+    "-t",
+    "--threads",
+    required=False,
+    type=int,
+    help="Number of processes that decompress the BAM. Defaults to the number of available CPUs.",
+)
+def cmd_count_records(input_bam, threads):
+    """ Prints the number of primary records of a BAM. The count is taken from the PacBio index
+        (.pbi) or from the record count sidecar of the BAM. Otherwise the records are counted
+        and the count is cached in the sidecar (<BAM without .bam>.record_count)."""
+
+    if not os.path.isfile(input_bam):
+        raise IOError("Please provide the path to a valid BAM file.")
+    records, _ = get_record_count(input_bam, workers=threads)
+    print(records)
+
+
+@click.command()
+@click.help_option("--help", "-h")
+@click.option(
+    "-s",
+    "--summary-qc-path",
+    required=True,
+    type=str,
+    help="Path of the summary QC file",
+)
+@click.option(
+    "-o",
+    "--output",
+    required=False,
+    type=str,
+    help="Path of a TSV file to write the result (PASS/FAIL/FLAGGED) and the reasons of every sample to",
+)
+@click.option("--json", "as_json", is_flag=True, help="Print the result of every sample as JSON.")
+def cmd_qc_gate(summary_qc_path, output, as_json):
+    """ Checks the samples of a summary QC file against the thresholds of the QC gate config and
+        flags outliers (robust z-score). Exits with status 1 if a sample failed. Flagged samples
+        only fail if fail_on_outliers is set."""
+
+    if not os.path.isfile(summary_qc_path):
+        raise IOError("Please provide the path to a valid file.")
+    result = run_qc_gate(summary_qc_path, load_config().qc_gate_config, output_path=output, as_json=as_json)
+    if result.failed.any():
+        raise SystemExit(1)
 
 
 @click.command()
@@ -152,13 +589,58 @@ def cmd_create_summary_qc_file(qc_folder, summary_qc_path):
     type=str,
     help="Path of the parsed QC file",
 )
-def cmd_print_qc_file(input_qc):
-    """ This scripts prints out a QC file in a human readable format using the "less" function.
-    Use your left and right arrow keys to view the entire file (since line wrapping has been removed).
-    This function works for both individual parsed QC files generated from a single aligned BAM and
-    for summary QC files."""
+@click.option(
+    "-m",
+    "--metric",
+    required=False,
+    multiple=True,
+    type=str,
+    help="Metric to show, e.g. 'samtools stats: reads mapped'. Can be given multiple times.",
+)
+@click.option(
+    "-M",
+    "--metric-regex",
+    required=False,
+    type=str,
+    help="Only show the metrics that match this regular expression.",
+)
+@click.option(
+    "-s",
+    "--sample",
+    required=False,
+    multiple=True,
+    type=str,
+    help="Sample (file name) to show. Can be given multiple times.",
+)
+@click.option(
+    "-S",
+    "--sample-regex",
+    required=False,
+    type=str,
+    help="Only show the samples whose file name matches this regular expression.",
+)
+@click.option(
+    "-n",
+    "--samples-per-page",
+    required=False,
+    type=int,
+    help="Maximum number of samples per page. Defaults to as many as fit into the terminal.",
+)
+def cmd_print_qc_file(input_qc, metric, metric_regex, sample, sample_regex, samples_per_page):
+    """ This scripts prints out a QC file in a human readable format: one row per metric and one
+    column per sample, one page of samples at a time. Only the samples of the shown pages are read,
+    so large summary files open right away. In a terminal, each page is shown in the pager and
+    you are asked whether to show the next or previous page. This function works for both
+    individual parsed QC files generated from a single aligned BAM and for summary QC files."""
 
-    print_human_readable_qc(input_qc)
+    print_human_readable_qc(
+        input_qc,
+        metrics=list(metric),
+        metric_regex=metric_regex,
+        samples=list(sample),
+        sample_regex=sample_regex,
+        samples_per_page=samples_per_page,
+    )
 
 
 # @click.command()
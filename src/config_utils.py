@@ -1,18 +1,52 @@
 
 import os
 import json
+from contextlib import contextmanager
+from typing import List, Optional
 from src.constants import O2_PROCESSING_CONFIG
-from pydantic import (BaseModel, RootModel, field_validator, ValidationInfo,)
+from src.profiling_utils import profiled
+from pydantic import (BaseModel, RootModel, field_validator, model_validator, ValidationInfo,)
 from rich import print
 
+EXECUTOR_SLURM = "slurm"
+EXECUTOR_LOCAL = "local"
+EXECUTOR_AUTO = "auto"
+EXECUTORS = [EXECUTOR_SLURM, EXECUTOR_LOCAL, EXECUTOR_AUTO]
+
+QC_ENGINE_SAMTOOLS = "samtools"
+QC_ENGINE_NATIVE = "native"
+QC_ENGINES = [QC_ENGINE_SAMTOOLS, QC_ENGINE_NATIVE]
+
 # TODO: Add validators for these models
+class SubmissionConfig(BaseModel):
+    max_concurrent_submissions: int = 4
+    submissions_per_second: float = 2.0
+    max_submission_retries: int = 5
+    retry_backoff_seconds: float = 2.0
+
+
+class RetryConfig(BaseModel):
+    # Total number of attempts per step, incl. the first submission
+    max_attempts: int = 3
+    # Factors the memory/time are multiplied with after OUT_OF_MEMORY/TIMEOUT
+    memory_scale: float = 2.0
+    time_scale: float = 2.0
+    # Ceilings for the scaled resources
+    max_memory: str = "256G"
+    max_time: str = "5-00:00:00"
+
+
 class SlurmConfig(BaseModel):
     allocated_time: str
     allocated_memory: str
     allocated_threads: int
     mail_user: str
+    partition: str = "park"
+    account: str = "park_contrib"
+    submission_config: SubmissionConfig = SubmissionConfig()
+    retry_config: RetryConfig = RetryConfig()
 
-    @field_validator('allocated_time', 'allocated_memory', 'mail_user')
+    @field_validator('allocated_time', 'allocated_memory', 'mail_user', 'partition', 'account')
     @classmethod
     def check_for_spaces(cls, v: str, info: ValidationInfo) -> str:
         if ' ' in v:
@@ -21,14 +55,176 @@ class SlurmConfig(BaseModel):
         return v
 
 
+class LocalConfig(BaseModel):
+    max_parallel_jobs: int = 2
+    cpus_per_job: int = 4
+    # Jobs with smaller inputs run locally if the 'auto' executor is used
+    auto_max_input_size_gb: float = 1.0
+
+
+class SchedulingConfig(BaseModel):
+    # Maximum number of pending or running jobs per step. None means no limit
+    max_in_flight_alignment: Optional[int] = None
+    max_in_flight_qc: Optional[int] = None
+    # Throughput of the steps, used to estimate runtimes
+    alignment_gb_per_hour: float = 10.0
+    qc_gb_per_hour: float = 50.0
+
+
+class CacheConfig(BaseModel):
+    cache_dir: str
+    max_size_gb: float = 1000.0
+
+
+class WatchConfig(BaseModel):
+    folders: List[str] = []
+    # New files are processed once size and mtime are unchanged for this long
+    stability_window_seconds: int = 300
+    poll_interval_seconds: int = 30
+    # Use inotify or periodic listing of the folders. None: inotify, unless on a network file system
+    use_inotify: Optional[bool] = None
+
+
+class QCConfig(BaseModel):
+    # Computes the QC metrics with samtools stats, or with the built-in BAM metrics engine
+    # ("native"), which only computes the core metrics but doesn't need samtools
+    engine: str = QC_ENGINE_SAMTOOLS
+    # Compare the primary records of the aligned BAM with the reads of the unaligned BAM before
+    # the QC is parsed. A mismatch (e.g. a truncated alignment) blocks the QC. Off by default,
+    # since it adds a pass over unaligned BAMs without .pbi to the QC jobs
+    reconcile_read_counts: bool = False
+
+    @field_validator('engine')
+    @classmethod
+    def check_engine(cls, v: str) -> str:
+        if v not in QC_ENGINES:
+            raise ValueError(f"engine must be one of {', '.join(QC_ENGINES)}.")
+        return v
+
+
+class CramConfig(BaseModel):
+    # Convert the aligned BAMs to CRAM after QC and remove the BAMs once the CRAMs are verified.
+    # Can't be combined with merge_config, whose merged BAMs are not converted
+    enabled: bool = False
+    allocated_time: str = "0-12:00:00"
+    allocated_memory: str = "8G"
+    allocated_threads: int = 8
+
+
+class MergeConfig(BaseModel):
+    # Merge the aligned movie BAMs of each sample into one BAM, with QC merged from the movies
+    enabled: bool = False
+    # Tab-separated file with the file name of each unaligned BAM and the name of its sample
+    sample_sheet: Optional[str] = None
+    # Alternatively, regular expression that extracts the sample name from the file name of an
+    # unaligned BAM (group "sample" or the first group), e.g. "^(.+?)_m\d+"
+    sample_pattern: Optional[str] = None
+    allocated_time: str = "0-12:00:00"
+    allocated_memory: str = "8G"
+    allocated_threads: int = 8
+
+
+class QCThreshold(BaseModel):
+    # Metric of the summary QC file, e.g. "samtools stats: error rate"
+    metric: str
+    min: Optional[float] = None
+    max: Optional[float] = None
+
+
+class QCGateConfig(BaseModel):
+    thresholds: List[QCThreshold] = []
+    # Metrics checked for outliers. None means all numeric metrics
+    outlier_metrics: Optional[List[str]] = None
+    # Samples with a robust z-score (median/MAD) above this in any of the outlier metrics are
+    # flagged. None disables the outlier detection
+    outlier_z_threshold: Optional[float] = 5.0
+    # Outliers fail the sample instead of flagging it
+    fail_on_outliers: bool = False
+    # Outliers are only detected if the summary QC file has at least this many samples
+    min_samples_for_outliers: int = 20
+
+
+class StatusConfig(BaseModel):
+    # Folder the state snapshots are cached in. Defaults to ~/.cache/o2-processing-utils/status
+    cache_dir: Optional[str] = None
+    # Cached snapshots are used while younger than this and no file was added or removed
+    ttl_seconds: int = 60
+    # Refresh interval of o2p-status --live
+    refresh_seconds: int = 5
+
+
+class MetricsConfig(BaseModel):
+    folders: List[str] = []
+    # Prometheus text file, e.g. in the node_exporter textfile collector directory
+    textfile_path: Optional[str] = None
+    export_interval_seconds: int = 60
+    # Upper bounds of the step duration histogram buckets
+    duration_buckets_seconds: List[float] = [600, 1800, 3600, 2 * 3600, 4 * 3600, 8 * 3600, 24 * 3600, 3 * 24 * 3600]
+
+
 class Config(BaseModel):
     reference_sequence_path: str
     log_path: str
     slurm_config: SlurmConfig
+    executor: str = EXECUTOR_SLURM
+    local_config: LocalConfig = LocalConfig()
+    scheduling_config: SchedulingConfig = SchedulingConfig()
+    # Alignment results are only cached if a cache is configured
+    cache_config: Optional[CacheConfig] = None
+    # Locks of other hosts that are older than this are considered stale
+    stale_lock_seconds: int = 6 * 3600
+    watch_config: WatchConfig = WatchConfig()
+    metrics_config: MetricsConfig = MetricsConfig()
+    qc_config: QCConfig = QCConfig()
+    cram_config: CramConfig = CramConfig()
+    merge_config: MergeConfig = MergeConfig()
+    status_config: StatusConfig = StatusConfig()
+    qc_gate_config: QCGateConfig = QCGateConfig()
+
+    @field_validator('executor')
+    @classmethod
+    def check_executor(cls, v: str) -> str:
+        if v not in EXECUTORS:
+            raise ValueError(f"executor must be one of {', '.join(EXECUTORS)}.")
+        return v
+
+    @model_validator(mode="after")
+    def check_cram_and_merge(self) -> "Config":
+        # The CRAM conversion runs on the aligned movie BAMs, which merging needs and removes
+        if self.cram_config.enabled and self.merge_config.enabled:
+            raise ValueError(
+                "The CRAM conversion (cram_config) can't be combined with merging movies (merge_config). "
+                "Please disable one of them."
+            )
+        return self
+
+
+# Config that load_config returns instead of reading the config file, see use_config
+_shared_config: Optional[Config] = None
+
+
+@contextmanager
+def use_config(config: Config):
+    """Makes load_config return the given config (in all threads) while active, instead of
+    reading the config file on every call. Meant for batch runs, see Pbmm2Workflow.advance
+
+    Args:
+        config (Config): configuration to use
+    """
+
+    global _shared_config
+    previous_config, _shared_config = _shared_config, config
+    try:
+        yield config
+    finally:
+        _shared_config = previous_config
 
 
+@profiled("load_config")
 def load_config():
 
+    if _shared_config is not None:
+        return _shared_config
     if os.getenv(O2_PROCESSING_CONFIG):
         with open(os.getenv(O2_PROCESSING_CONFIG)) as f:
             c = json.load(f)
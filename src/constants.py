@@ -1,5 +1,8 @@
 
 O2_PROCESSING_CONFIG = "O2_PROCESSING_CONFIG"
+# Optional: enables the profiling of the workflow commands and sets the path of the profile
+O2P_PROFILE = "O2P_PROFILE"
+O2P_PROFILE_OUTPUT = "O2P_PROFILE_OUTPUT"
 
 REQUIRED_ENV_VARIABLES = {
     O2_PROCESSING_CONFIG: "Absolute path on O2 where the configuration file is stored."
@@ -0,0 +1,171 @@
+########################################################################
+#
+#   Authors:
+#       William Feng
+#       Harvard Medical School
+#       william_feng@gmail.com
+#
+#       Alexander Veit
+#       Harvard Medical School
+#       alexander_veit@hms.harvard.edu
+#
+#   Executors that run the workflow jobs, either through Slurm or
+#       locally in a bounded pool of processes.
+#
+########################################################################
+
+import os
+import queue
+import shutil
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Optional
+from src.config_utils import Config, LocalConfig, EXECUTORS, EXECUTOR_SLURM, EXECUTOR_LOCAL, EXECUTOR_AUTO
+from src.slurm_utils import JobSubmission, SubmissionLimiter, submit_sbatch_jobs
+
+LOCAL_JOB_ID_PREFIX = "local-"
+# Slurm state of local jobs with a non-zero exit code. Tool errors are not retried
+LOCAL_FAILURE_STATE = "FAILED"
+
+
+class SlurmExecutor:
+    """Submits jobs with sbatch. Returns as soon as Slurm has accepted the jobs."""
+
+    name = EXECUTOR_SLURM
+
+    def __init__(self, config: Config):
+        self.slurm_config = config.slurm_config
+        # Shared by all submissions of the executor, also from several threads
+        self.limiter = SubmissionLimiter(self.slurm_config)
+
+    def submit(self, submissions: List[JobSubmission]) -> List[JobSubmission]:
+        return submit_sbatch_jobs(submissions, self.slurm_config, self.limiter)
+
+
+class LocalExecutor:
+    """Runs jobs on the current machine, at most `max_parallel_jobs` at a time. Each job is
+    pinned to its own set of `cpus_per_job` CPUs. Output is written to the same file Slurm
+    would write to, so the workflow can evaluate local and Slurm jobs the same way.
+    Returns once all jobs have finished.
+    """
+
+    name = EXECUTOR_LOCAL
+
+    def __init__(self, config: Config):
+        self.local_config: LocalConfig = config.local_config
+        self.cpu_slots = queue.Queue()
+        for cpus in self.get_cpu_slots():
+            self.cpu_slots.put(cpus)
+
+    def get_cpu_slots(self) -> List[List[int]]:
+        """Splits the CPUs available to this process into one disjoint set per parallel job.
+        If there are not enough CPUs, the sets are reused round robin.
+        """
+
+        available_cpus = sorted(os.sched_getaffinity(0))
+        cpus_per_job = min(self.local_config.cpus_per_job, len(available_cpus))
+        slots = []
+        for i in range(self.local_config.max_parallel_jobs):
+            start = (i * cpus_per_job) % len(available_cpus)
+            slots.append(
+                [available_cpus[(start + j) % len(available_cpus)] for j in range(cpus_per_job)]
+            )
+        return slots
+
+    def run(self, submission: JobSubmission) -> JobSubmission:
+        cpus = self.cpu_slots.get()
+        try:
+            print(f"Running {submission.job_name} locally on CPUs {cpus}: {submission.command}")
+            env = {**os.environ, "OMP_NUM_THREADS": str(len(cpus))}
+            args = ["bash", "-c", submission.command]
+            # preexec_fn is not safe with threads. taskset pins the job before it starts,
+            # otherwise the job is pinned right after it was spawned
+            taskset = shutil.which("taskset")
+            if taskset:
+                args = [taskset, "-c", ",".join(str(cpu) for cpu in cpus)] + args
+            with open(submission.slurm_out, "w") as slurm_out:
+                process = subprocess.Popen(args, stdout=slurm_out, stderr=subprocess.STDOUT, env=env)
+                if not taskset:
+                    try:
+                        os.sched_setaffinity(process.pid, cpus)
+                    except OSError:
+                        # The job has finished already
+                        pass
+                # The job ID has to be known for a job that ran, also if it failed.
+                # The exit code is stored in the running marker, see get_failed_job_state
+                submission.job_id = f"{LOCAL_JOB_ID_PREFIX}{process.pid}"
+                submission.exit_code = process.wait()
+        except OSError as e:
+            submission.error = f"Could not run job locally: {str(e)}"
+        finally:
+            self.cpu_slots.put(cpus)
+        return submission
+
+    def submit(self, submissions: List[JobSubmission]) -> List[JobSubmission]:
+        if not submissions:
+            return []
+        with ThreadPoolExecutor(max_workers=self.local_config.max_parallel_jobs) as pool:
+            return list(pool.map(self.run, submissions))
+
+
+class AutoExecutor:
+    """Runs jobs whose input is smaller than `auto_max_input_size_gb` locally, all other
+    jobs are submitted to Slurm.
+    """
+
+    name = EXECUTOR_AUTO
+
+    def __init__(self, config: Config):
+        self.slurm_executor = SlurmExecutor(config)
+        self.local_executor = LocalExecutor(config)
+        self.max_local_size = int(config.local_config.auto_max_input_size_gb * 1024**3)
+
+    def is_local(self, submission: JobSubmission) -> bool:
+        try:
+            return os.path.getsize(submission.input_path) < self.max_local_size
+        except OSError:
+            return False
+
+    def submit(self, submissions: List[JobSubmission]) -> List[JobSubmission]:
+        local_submissions = [s for s in submissions if self.is_local(s)]
+        slurm_submissions = [s for s in submissions if not self.is_local(s)]
+        # Submit to Slurm first, so that the cluster jobs are queued while the local ones run
+        return self.slurm_executor.submit(slurm_submissions) + self.local_executor.submit(
+            local_submissions
+        )
+
+
+EXECUTOR_CLASSES = {
+    EXECUTOR_SLURM: SlurmExecutor,
+    EXECUTOR_LOCAL: LocalExecutor,
+    EXECUTOR_AUTO: AutoExecutor,
+}
+
+
+def get_executor(config: Config, executor_name: str = None):
+    """Returns the executor with the given name. Defaults to the executor set in the config.
+
+    Args:
+        config (Config): workflow configuration
+        executor_name (str): one of 'slurm', 'local', 'auto'
+    """
+
+    executor_name = executor_name or config.executor
+    if executor_name not in EXECUTORS:
+        raise ValueError(f"executor must be one of {', '.join(EXECUTORS)}.")
+    return EXECUTOR_CLASSES[executor_name](config)
+
+
+def is_local_job_id(job_id: str) -> bool:
+    return job_id.startswith(LOCAL_JOB_ID_PREFIX)
+
+
+def get_local_job_state(exit_code: Optional[int]) -> Optional[str]:
+    """Slurm state that corresponds to the exit code of a job that was run locally. None if the
+    job succeeded or its exit code is unknown (markers written before exit codes were stored).
+    """
+
+    if not exit_code:
+        return None
+    # Killed by a signal (negative exit code) or failed, like Slurm reports such jobs
+    return LOCAL_FAILURE_STATE
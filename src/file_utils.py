@@ -1,11 +1,38 @@
 
+import os
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 
 def get_file_without_extension(file:str):
     return file.rsplit('.', 1)[0]
 
-def remove_files(files_to_remove):
-    for path in files_to_remove:
+def remove_files(files_to_remove, workers: int = 1):
+    """Removes the files, ignoring files that don't exist. With several workers, the files are
+    removed in a pool of threads, which mostly wait for the (network) file system.
+    """
+
+    def remove_file(path):
         p = Path(path)
         p.unlink(missing_ok=True)
+
+    if workers <= 1:
+        for path in files_to_remove:
+            remove_file(path)
+        return
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        # Consume the results, so that errors are raised
+        list(executor.map(remove_file, files_to_remove))
+
+
+def write_atomically(path: str, content: str):
+    """Writes the file under a temporary name and renames it, so that readers never see a
+    partially written file
+    """
+
+    tmp_path = f"{os.path.dirname(path) or '.'}/.{os.path.basename(path)}.{os.getpid()}.tmp"
+    with open(tmp_path, "w") as f:
+        f.write(content)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
         
\ No newline at end of file
@@ -0,0 +1,134 @@
+########################################################################
+#
+#   Authors:
+#       William Feng
+#       Harvard Medical School
+#       william_feng@gmail.com
+#
+#       Alexander Veit
+#       Harvard Medical School
+#       alexander_veit@hms.harvard.edu
+#
+#   Advisory per-sample locks, so that several workflow runs on the
+#       same folder don't advance the same sample twice.
+#
+########################################################################
+
+import fcntl
+import json
+import os
+import socket
+import time
+from typing import Optional
+
+
+class SampleLock:
+    """Advisory lock backed by a lock file. The lock file is created with O_EXCL, which is atomic
+    also on NFS, and contains the host and PID of the owner. While the lock is held, the owner
+    additionally keeps an flock on the file, so that a lock whose owner died can be detected.
+
+    A lock is considered stale and is broken if
+    - the owner ran on this host and no process holds the flock anymore, or
+    - the owner ran on another host and the lock is older than `stale_after_seconds`
+      (flock is not reliable across hosts on network file systems).
+    """
+
+    def __init__(self, path: str, stale_after_seconds: int):
+        self.path = path
+        self.stale_after_seconds = stale_after_seconds
+        self.fd: Optional[int] = None
+
+    def acquire(self) -> bool:
+        """Tries to acquire the lock without blocking. Returns False if it's held by someone else."""
+
+        for _ in range(2):
+            try:
+                fd = os.open(self.path, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o644)
+            except FileExistsError:
+                if self.break_if_stale():
+                    continue
+                return False
+            # Blocking, since another process checking for a stale lock might hold the flock briefly
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            os.write(
+                fd,
+                json.dumps(
+                    {"host": socket.gethostname(), "pid": os.getpid(), "created": time.time()}
+                ).encode(),
+            )
+            self.fd = fd
+            return True
+        return False
+
+    def release(self):
+        if self.fd is None:
+            return
+        try:
+            os.unlink(self.path)
+        except FileNotFoundError:
+            pass
+        os.close(self.fd)
+        self.fd = None
+
+    def get_owner(self) -> dict:
+        """Returns the content of the lock file, i.e. host, PID and creation time of the owner"""
+
+        try:
+            with open(self.path) as f:
+                return json.loads(f.read() or "{}")
+        except (OSError, ValueError):
+            return {}
+
+    def break_if_stale(self) -> bool:
+        """Removes the lock file if the lock is stale. Returns True if the lock was broken."""
+
+        try:
+            # Opened for writing, since NFS emulates flock with write locks
+            fd = os.open(self.path, os.O_RDWR)
+        except FileNotFoundError:
+            # Released in the meantime
+            return True
+        try:
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                # The owner is alive
+                return False
+
+            owner = self.get_owner()
+            # The owner might still be writing its details
+            if not owner:
+                if time.time() - os.fstat(fd).st_mtime < self.stale_after_seconds:
+                    return False
+                return self.remove(fd)
+            is_local = owner.get("host") == socket.gethostname()
+            age = time.time() - owner.get("created", time.time())
+            if not is_local and age < self.stale_after_seconds:
+                return False
+
+            return self.remove(fd)
+        finally:
+            os.close(fd)
+
+    def remove(self, fd: int) -> bool:
+        """Removes the lock file, but only if it's still the file that is open as fd"""
+
+        try:
+            if os.stat(self.path).st_ino == os.fstat(fd).st_ino:
+                os.unlink(self.path)
+        except FileNotFoundError:
+            pass
+        return True
+
+
+def create_file_exclusively(path: str, content: str = ""):
+    """Atomically creates a file that must not exist yet. Raises FileExistsError if it does.
+
+    Args:
+        path (str): path of the file
+        content (str): content of the file
+    """
+
+    fd = os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o644)
+    with os.fdopen(fd, "w") as f:
+        f.write(content)
@@ -1,7 +1,35 @@
 
+import threading
+from contextlib import contextmanager
 from datetime import datetime, timezone
 from src.config_utils import load_config, print_config, Config
+from src.profiling_utils import profiled
 
+# Log file that is kept open while keep_log_open is active
+_shared_log_file = None
+_shared_log_lock = threading.Lock()
+
+
+@contextmanager
+def keep_log_open():
+    """Keeps the log file open while active, instead of opening it for every message. Messages
+    of all threads are written through this one file handle. Meant for batch runs, see
+    Pbmm2Workflow.advance
+    """
+
+    global _shared_log_file
+    config : Config = load_config()
+    with open(config.log_path, "a") as log_file:
+        with _shared_log_lock:
+            previous_log_file, _shared_log_file = _shared_log_file, log_file
+        try:
+            yield
+        finally:
+            with _shared_log_lock:
+                _shared_log_file = previous_log_file
+
+
+@profiled("add_to_log")
 def add_to_log(message: str):
     """
     Adds one line to the log file. UTC timestamp + the supplied message
@@ -9,11 +37,17 @@ def add_to_log(message: str):
     Args:
         message (str): text to add to the log
     """
+    current_datetime = datetime.now(timezone.utc)
+    current_date_time = current_datetime.strftime("%Y-%m-%d, %H:%M:%S %Z")
+    line = f'{current_date_time}\t{message}\n'
+    with _shared_log_lock:
+        if _shared_log_file is not None:
+            _shared_log_file.write(line)
+            _shared_log_file.flush()
+            return
     config : Config = load_config()
     with open(config.log_path, "a") as log_file:
-        current_datetime = datetime.now(timezone.utc)
-        current_date_time = current_datetime.strftime("%Y-%m-%d, %H:%M:%S %Z")
-        log_file.write(f'{current_date_time}\t{message}\n')
+        log_file.write(line)
 
 
 def search_log(search_term: str):
@@ -0,0 +1,293 @@
+########################################################################
+#
+#   Authors:
+#       William Feng
+#       Harvard Medical School
+#       william_feng@gmail.com
+#
+#       Alexander Veit
+#       Harvard Medical School
+#       alexander_veit@hms.harvard.edu
+#
+#   Export of workflow states and throughput as Prometheus metrics
+#       for the node_exporter textfile collector.
+#
+########################################################################
+
+import hashlib
+import json
+import os
+import re
+import time
+from typing import Dict, List, Optional, Tuple
+from src.config_utils import Config
+from src.file_utils import write_atomically
+from src.status_utils import get_status, count_states, DEFAULT_CACHE_DIR
+from src.timeline_utils import (
+    TimelineBuilder,
+    StepTiming,
+    parse_log_line,
+    get_sample_path,
+    JOB_NAME_STEPS,
+    SUBMITTED_PATTERN,
+    STEP_ALIGNMENT,
+    STEP_QC,
+    STEP_CRAM,
+    STEP_MERGE,
+)
+
+SUBMISSION_ERROR_PATTERN = re.compile(r"^Error submitting \w+ job \((\S+)\)\. Signal file: (.+?)\. ")
+JOB_FAILED_PATTERN = re.compile(r"^The (\w+) job (\S+) for file .+? failed with state ([A-Z_]+)")
+
+
+def escape_label_value(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def format_labels(labels: Dict[str, str]) -> str:
+    return ",".join(f'{name}="{escape_label_value(str(value))}"' for name, value in labels.items())
+
+
+def format_value(value: float) -> str:
+    return str(int(value)) if float(value).is_integer() else repr(float(value))
+
+
+def get_metrics_state_path(config: Config) -> str:
+    """Path of the saved log state of the exporter, next to the cached state snapshots"""
+
+    cache_dir = os.path.expanduser(config.status_config.cache_dir or DEFAULT_CACHE_DIR)
+    log_path = os.path.abspath(config.log_path)
+    return f"{cache_dir}/metrics_{hashlib.sha1(log_path.encode()).hexdigest()}.json"
+
+
+class MetricsExporter:
+    """Computes the metrics of the given folders:
+    - number of samples per state, from the (cached) state snapshot of each folder, see get_status
+    - jobs submitted, submission errors and failed jobs, from the master log
+    - histograms of the step turnaround (submission of a step until the workflow picked up its
+      result), from the master log
+
+    The log is read incrementally: each export only reads the log entries that were added since
+    the previous one. When the exporter is kept running (see run), the state of the log is kept
+    in memory. Otherwise it's saved to state_path after each export and loaded by the next run.
+
+    Args:
+        config (Config): workflow configuration
+        folders (List[str]): folders to export the metrics of
+        state_path (str): file the log offset and the counters are saved to between runs, see
+            get_metrics_state_path. None keeps them in memory only
+    """
+
+    def __init__(self, config: Config, folders: List[str], state_path: Optional[str] = None):
+        self.config = config
+        self.folders = [os.path.abspath(folder.rstrip("/")) for folder in folders]
+        self.state_path = state_path
+        self.reset_log_metrics()
+        if state_path:
+            self.load_state()
+
+    def reset_log_metrics(self):
+        self.log_offset = 0
+        # Inode of the log at log_offset, to notice a rotated log that already grew past it
+        self.log_inode: Optional[int] = None
+        self.timelines = TimelineBuilder()
+        # Folder of each submitted job, by job ID
+        self.job_folders: Dict[str, str] = {}
+        self.jobs_submitted: Dict[Tuple[str, str], int] = {}
+        self.submission_errors: Dict[Tuple[str, str], int] = {}
+        # (step, state) of each failed job, by job ID. Failures are logged on every run
+        self.failed_jobs: Dict[str, Tuple[str, str]] = {}
+
+    def load_state(self):
+        """Continues from the log state saved by a previous run, if there is one for this log"""
+
+        try:
+            with open(self.state_path) as state_file:
+                state = json.load(state_file)
+            if state["log_path"] != os.path.abspath(self.config.log_path):
+                return
+            log_offset, log_inode = state["log_offset"], state["log_inode"]
+            timings = [StepTiming.model_validate(timing) for timing in state["timings"]]
+            samples_by_name = state["samples_by_name"]
+            job_folders = state["job_folders"]
+            jobs_submitted = {(folder, step): count for folder, step, count in state["jobs_submitted"]}
+            submission_errors = {(folder, step): count for folder, step, count in state["submission_errors"]}
+            failed_jobs = {job_id: (step, job_state) for job_id, step, job_state in state["failed_jobs"]}
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            print(f"Ignoring the saved metrics state {self.state_path}, the log is read from the start: {str(e)}")
+            return
+
+        self.log_offset, self.log_inode = log_offset, log_inode
+        self.timelines.timings = {(timing.sample, timing.step): timing for timing in timings}
+        self.timelines.samples_by_name = samples_by_name
+        self.job_folders = job_folders
+        self.jobs_submitted = jobs_submitted
+        self.submission_errors = submission_errors
+        self.failed_jobs = failed_jobs
+
+    def save_state(self):
+        state = {
+            "log_path": os.path.abspath(self.config.log_path),
+            "log_offset": self.log_offset,
+            "log_inode": self.log_inode,
+            "timings": [timing.model_dump(mode="json") for timing in self.timelines.timings.values()],
+            "samples_by_name": self.timelines.samples_by_name,
+            "job_folders": self.job_folders,
+            "jobs_submitted": [[folder, step, count] for (folder, step), count in self.jobs_submitted.items()],
+            "submission_errors": [[folder, step, count] for (folder, step), count in self.submission_errors.items()],
+            "failed_jobs": [[job_id, step, job_state] for job_id, (step, job_state) in self.failed_jobs.items()],
+        }
+        try:
+            os.makedirs(os.path.dirname(self.state_path), exist_ok=True)
+            write_atomically(self.state_path, json.dumps(state))
+        except OSError as e:
+            # The next run reads the log from the start
+            print(f"Could not save the metrics state to {self.state_path}: {str(e)}")
+
+    def get_folder(self, path: str) -> str:
+        return os.path.dirname(os.path.abspath(get_sample_path(path)))
+
+    def read_log(self):
+        """Processes the entries that were added to the master log since the last call"""
+
+        try:
+            log_stat = os.stat(self.config.log_path)
+        except FileNotFoundError:
+            return
+        if log_stat.st_size < self.log_offset or self.log_inode not in (None, log_stat.st_ino):
+            # The log was truncated or rotated
+            self.reset_log_metrics()
+        self.log_inode = log_stat.st_ino
+        with open(self.config.log_path, "rb") as log_file:
+            log_file.seek(self.log_offset)
+            for line in log_file:
+                # The last line might still be written
+                if not line.endswith(b"\n"):
+                    break
+                self.log_offset += len(line)
+                entry = parse_log_line(line.decode(errors="replace"))
+                if entry:
+                    self.add_log_entry(*entry)
+
+    def add_log_entry(self, time, message: str):
+        self.timelines.add_entry(time, message)
+        match = SUBMITTED_PATTERN.match(message)
+        if match and match.group(2) in JOB_NAME_STEPS:
+            folder = self.get_folder(match.group(3))
+            self.job_folders[match.group(1)] = folder
+            key = (folder, JOB_NAME_STEPS[match.group(2)])
+            self.jobs_submitted[key] = self.jobs_submitted.get(key, 0) + 1
+            return
+        match = SUBMISSION_ERROR_PATTERN.match(message)
+        if match and match.group(1) in JOB_NAME_STEPS:
+            key = (self.get_folder(match.group(2)), JOB_NAME_STEPS[match.group(1)])
+            self.submission_errors[key] = self.submission_errors.get(key, 0) + 1
+            return
+        match = JOB_FAILED_PATTERN.match(message)
+        if match:
+            self.failed_jobs[match.group(2)] = (match.group(1), match.group(3))
+
+    def get_metrics(self) -> str:
+        """Returns all metrics in the Prometheus text format"""
+
+        start = time.time()
+        self.read_log()
+        lines = []
+
+        def add_metric(name: str, metric_type: str, help_text: str, samples: List[Tuple[Dict[str, str], float]]):
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {metric_type}")
+            for labels, value in samples:
+                labels_text = f"{{{format_labels(labels)}}}" if labels else ""
+                lines.append(f"{name}{labels_text} {format_value(value)}")
+
+        state_samples = []
+        for folder in self.folders:
+            for state, count in count_states(get_status(self.config, folder)["states"]).items():
+                state_samples.append(({"folder": folder, "state": state}, count))
+        add_metric("o2p_samples", "gauge", "Number of unaligned BAMs per workflow state.", state_samples)
+
+        steps = [STEP_ALIGNMENT, STEP_QC, STEP_CRAM, STEP_MERGE]
+        add_metric(
+            "o2p_jobs_submitted_total",
+            "counter",
+            "Number of jobs submitted, according to the master log.",
+            [
+                ({"folder": folder, "step": step}, self.jobs_submitted.get((folder, step), 0))
+                for folder in self.folders for step in steps
+            ],
+        )
+        add_metric(
+            "o2p_job_submission_errors_total",
+            "counter",
+            "Number of job submissions that failed, according to the master log.",
+            [
+                ({"folder": folder, "step": step}, self.submission_errors.get((folder, step), 0))
+                for folder in self.folders for step in steps
+            ],
+        )
+        failed_counts: Dict[Tuple[str, str, str], int] = {}
+        for job_id, (step, state) in self.failed_jobs.items():
+            key = (self.job_folders.get(job_id, ""), step, state)
+            if key[0] in self.folders:
+                failed_counts[key] = failed_counts.get(key, 0) + 1
+        add_metric(
+            "o2p_jobs_failed_total",
+            "counter",
+            "Number of jobs that ended unsuccessfully (e.g. OUT_OF_MEMORY), according to the master log.",
+            [
+                ({"folder": folder, "step": step, "state": state}, count)
+                for (folder, step, state), count in sorted(failed_counts.items())
+            ],
+        )
+
+        buckets = sorted(self.config.metrics_config.duration_buckets_seconds)
+        durations: Dict[Tuple[str, str], List[float]] = {}
+        for (sample, step), timing in self.timelines.timings.items():
+            if step in steps and timing.turnaround is not None:
+                durations.setdefault((self.get_folder(sample), step), []).append(timing.turnaround)
+        lines.append(
+            "# HELP o2p_step_turnaround_seconds Time from the submission of a step until the workflow "
+            "picked up its result, according to the master log."
+        )
+        lines.append("# TYPE o2p_step_turnaround_seconds histogram")
+        for folder in self.folders:
+            for step in steps:
+                step_durations = durations.get((folder, step), [])
+                for bucket in buckets:
+                    labels = format_labels({"folder": folder, "step": step, "le": format_value(bucket)})
+                    count = sum(1 for duration in step_durations if duration <= bucket)
+                    lines.append(f"o2p_step_turnaround_seconds_bucket{{{labels}}} {count}")
+                labels = format_labels({"folder": folder, "step": step, "le": "+Inf"})
+                lines.append(f"o2p_step_turnaround_seconds_bucket{{{labels}}} {len(step_durations)}")
+                labels = format_labels({"folder": folder, "step": step})
+                lines.append(f"o2p_step_turnaround_seconds_sum{{{labels}}} {format_value(sum(step_durations))}")
+                lines.append(f"o2p_step_turnaround_seconds_count{{{labels}}} {len(step_durations)}")
+
+        add_metric(
+            "o2p_metrics_export_duration_seconds", "gauge", "Time it took to compute the metrics.",
+            [({}, time.time() - start)],
+        )
+        add_metric(
+            "o2p_metrics_export_timestamp_seconds", "gauge", "Time of the last export.",
+            [({}, time.time())],
+        )
+        return "\n".join(lines) + "\n"
+
+    def export(self, textfile_path: str):
+        write_atomically(textfile_path, self.get_metrics())
+        if self.state_path:
+            self.save_state()
+
+    def run(self, textfile_path: str, interval_seconds: float):
+        """Exports the metrics every interval_seconds until interrupted"""
+
+        print(f"Exporting metrics of {', '.join(self.folders)} to {textfile_path} every {interval_seconds}s.")
+        while True:
+            try:
+                self.export(textfile_path)
+            except Exception as e:
+                print(f"Error exporting metrics: {str(e)}")
+            time.sleep(interval_seconds)
@@ -0,0 +1,191 @@
+########################################################################
+#
+#   Authors:
+#       William Feng
+#       Harvard Medical School
+#       william_feng@gmail.com
+#
+#       Alexander Veit
+#       Harvard Medical School
+#       alexander_veit@hms.harvard.edu
+#
+#   Lightweight instrumentation of the hot paths of the workflow
+#       (file checks, subprocesses, config loads, log writes).
+#
+########################################################################
+
+import atexit
+import cProfile
+import functools
+import json
+import os
+import subprocess
+import threading
+import time
+from typing import Callable, Dict, List, Optional
+from rich.console import Console
+from rich.table import Table
+from src.constants import O2P_PROFILE, O2P_PROFILE_OUTPUT
+
+SUBPROCESS_RUN = "subprocess.run"
+
+
+class _Profiler:
+    """Collects number of calls and total/max duration per instrumented operation and,
+    if a Chrome trace is requested, the individual calls as trace events
+    """
+
+    def __init__(self, output_path: Optional[str] = None):
+        self.output_path = output_path
+        self.keep_events = bool(output_path) and output_path.endswith(".json")
+        self.start = time.perf_counter()
+        self.lock = threading.Lock()
+        # Number of calls, total and max duration in seconds, by operation
+        self.stats: Dict[str, List[float]] = {}
+        self.events: List[dict] = []
+        self.cprofile = None
+        if output_path and not self.keep_events:
+            self.cprofile = cProfile.Profile()
+            self.cprofile.enable()
+
+    def record(self, name: str, start: float, duration: float):
+        with self.lock:
+            stats = self.stats.setdefault(name, [0, 0.0, 0.0])
+            stats[0] += 1
+            stats[1] += duration
+            stats[2] = max(stats[2], duration)
+            if self.keep_events:
+                self.events.append(
+                    {
+                        "name": name,
+                        "ph": "X",
+                        "ts": (start - self.start) * 1e6,
+                        "dur": duration * 1e6,
+                        "pid": os.getpid(),
+                        "tid": threading.get_ident(),
+                    }
+                )
+
+    def print_summary(self):
+        wall_time = time.perf_counter() - self.start
+        table = Table(title=f"Profile (wall time {wall_time:.2f}s)")
+        table.add_column("Operation", no_wrap=True)
+        for column in ["Calls", "Total (s)", "Mean (ms)", "Max (ms)", "% of wall time"]:
+            table.add_column(column, justify="right")
+        for name, (calls, total, maximum) in sorted(
+            self.stats.items(), key=lambda item: item[1][1], reverse=True
+        ):
+            table.add_row(
+                name,
+                str(int(calls)),
+                f"{total:.3f}",
+                f"{total / calls * 1000:.3f}",
+                f"{maximum * 1000:.3f}",
+                f"{total / wall_time * 100:.1f}",
+            )
+        Console(stderr=True).print(table)
+
+    def write_output(self):
+        if self.cprofile:
+            self.cprofile.disable()
+            self.cprofile.dump_stats(self.output_path)
+        elif self.keep_events:
+            with open(self.output_path, "w") as f:
+                json.dump({"traceEvents": self.events, "displayTimeUnit": "ms"}, f)
+        else:
+            return
+        Console(stderr=True).print(f"Profile written to {self.output_path}")
+
+    def finish(self):
+        self.print_summary()
+        self.write_output()
+
+
+_profiler: Optional[_Profiler] = None
+
+
+def is_profiling_enabled() -> bool:
+    return _profiler is not None
+
+
+def profiled(name: str) -> Callable:
+    """Decorator that records the number of calls and the duration of the decorated function
+    under `name` while profiling is enabled. When it's disabled, the overhead is a single check.
+    """
+
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            profiler = _profiler
+            if profiler is None:
+                return func(*args, **kwargs)
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                profiler.record(name, start, time.perf_counter() - start)
+
+        return wrapper
+
+    return decorator
+
+
+def _get_program_name(args) -> str:
+    if isinstance(args, (list, tuple)):
+        program = str(args[0]) if args else ""
+    else:
+        program = str(args).split(maxsplit=1)[0] if str(args).strip() else ""
+    return os.path.basename(program)
+
+
+def _instrument_subprocess_run():
+    """Wraps subprocess.run, so that the spawned programs are recorded individually,
+    e.g. "subprocess.run: samtools". subprocess.check_output uses subprocess.run as well.
+    """
+
+    run = subprocess.run
+
+    @functools.wraps(run)
+    def wrapper(*args, **kwargs):
+        profiler = _profiler
+        if profiler is None:
+            return run(*args, **kwargs)
+        program = _get_program_name(args[0] if args else kwargs.get("args", ""))
+        start = time.perf_counter()
+        try:
+            return run(*args, **kwargs)
+        finally:
+            profiler.record(f"{SUBPROCESS_RUN}: {program}", start, time.perf_counter() - start)
+
+    subprocess.run = wrapper
+
+
+def enable_profiling(output_path: Optional[str] = None):
+    """Enables the instrumentation for the rest of the invocation. A summary is printed to
+    stderr at exit.
+
+    Args:
+        output_path (str): optional path the whole invocation is additionally profiled to.
+            Paths ending with .json get a Chrome trace of the instrumented calls (open in
+            chrome://tracing or Perfetto), all other paths a cProfile dump (open with pstats)
+    """
+
+    global _profiler
+    if _profiler is not None:
+        return
+    _profiler = _Profiler(output_path)
+    _instrument_subprocess_run()
+    atexit.register(_profiler.finish)
+
+
+def init_profiling(profile: bool = False, output_path: Optional[str] = None):
+    """Enables profiling if requested on the command line or with the O2P_PROFILE environment
+    variable. The output path defaults to the O2P_PROFILE_OUTPUT environment variable.
+
+    Args:
+        profile (bool): whether profiling was requested on the command line
+        output_path (str): optional path of a cProfile dump or Chrome trace (.json)
+    """
+
+    if profile or os.getenv(O2P_PROFILE, "").lower() in ["1", "true", "yes"]:
+        enable_profiling(output_path or os.getenv(O2P_PROFILE_OUTPUT))
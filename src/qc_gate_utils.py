@@ -0,0 +1,299 @@
+########################################################################
+#
+#   Authors:
+#       William Feng
+#       Harvard Medical School
+#       william_feng@gmail.com
+#
+#       Alexander Veit
+#       Harvard Medical School
+#       alexander_veit@hms.harvard.edu
+#
+#   QC gate: threshold rules and robust outlier detection on the
+#       numeric metrics of a summary QC file.
+#
+########################################################################
+
+import csv
+import json
+from typing import List, Optional, Tuple
+
+import numpy as np
+from rich.console import Console
+from rich.table import Table
+
+from src.config_utils import QCGateConfig
+from src.qc_viewer_utils import SAMPLE_COLUMN
+
+QC_GATE_PASS = "PASS"
+QC_GATE_FAIL = "FAIL"
+# Outliers that don't fail the sample, see QCGateConfig.fail_on_outliers
+QC_GATE_FLAGGED = "FLAGGED"
+# Scales the MAD to the standard deviation of a normal distribution
+MAD_SCALE = 1.4826
+# Scales the mean absolute deviation to the standard deviation of a normal distribution. Used
+# for metrics whose MAD is 0, i.e. more than half of the samples have the median value
+MEAN_ABSOLUTE_DEVIATION_SCALE = 1.253314
+
+
+def to_float(value: str) -> float:
+    try:
+        return float(value)
+    except ValueError:
+        return np.nan
+
+
+def load_summary_matrix(path: str) -> Tuple[List[str], List[str], np.ndarray]:
+    """Reads a summary QC file (see create_summary_qc_file) in one pass. Metrics that are numeric
+    in the first sample that has a value for them are loaded into a matrix; values that are
+    missing or not numeric in other samples are NaN. Other metrics are ignored.
+
+    Args:
+        path (str): path of the summary QC file
+
+    Returns:
+        Tuple[List[str], List[str], np.ndarray]: samples, metrics and the samples x metrics
+            matrix (column-major, i.e. the values of a metric are contiguous)
+    """
+
+    with open(path) as summary_file:
+        header = summary_file.readline().rstrip("\n").split("\t")
+        lines = summary_file.read().splitlines()
+    if header[0] != SAMPLE_COLUMN:
+        raise Exception(f"{path} is not a summary QC file. Its first column should be '{SAMPLE_COLUMN}'.")
+    lines = [line for line in lines if line]
+    if not lines:
+        return [], [], np.empty((0, 0))
+
+    first_values = lines[0].split("\t")[: len(header)]
+    first_values += [""] * (len(header) - len(first_values))
+    # Metrics without a value in the first sample, e.g. metrics that only one of the QC engines
+    # computes. Their first value is searched in the other samples
+    empty_columns = {i for i in range(1, len(header)) if not first_values[i]}
+    for line in lines[1:]:
+        if not empty_columns:
+            break
+        row = line.split("\t")
+        for i in [i for i in empty_columns if i < len(row) and row[i]]:
+            first_values[i] = row[i]
+            empty_columns.remove(i)
+    columns = [i for i in range(1, len(header)) if not np.isnan(to_float(first_values[i]))]
+    metrics = [header[i] for i in columns]
+    samples = [line.split("\t", 1)[0] for line in lines]
+    try:
+        matrix = np.loadtxt(lines, delimiter="\t", usecols=columns, dtype=float, ndmin=2, comments=None)
+    except ValueError:
+        # Missing or non-numeric values. Slow path, value by value
+        rows = [line.split("\t") for line in lines]
+        matrix = np.array(
+            [[to_float(row[i]) if i < len(row) else np.nan for i in columns] for row in rows], dtype=float
+        ).reshape(len(rows), len(columns))
+    return samples, metrics, np.asfortranarray(matrix)
+
+
+def format_number(value: float) -> str:
+    return f"{value:.6g}"
+
+
+class QCGateResult:
+    """Outcome of the QC gate for each sample of a summary QC file
+
+    Args:
+        samples (List[str]): samples (file names of the .qc files)
+        failed (np.ndarray): whether each sample failed the QC gate
+        flagged (np.ndarray): whether each sample has outliers that didn't fail it
+        reasons (List[List[str]]): reasons each sample failed or was flagged
+    """
+
+    def __init__(self, samples: List[str], failed: np.ndarray, flagged: np.ndarray, reasons: List[List[str]]):
+        self.samples = samples
+        self.failed = failed
+        self.flagged = flagged
+        self.reasons = reasons
+
+    def get_result(self, index: int) -> str:
+        if self.failed[index]:
+            return QC_GATE_FAIL
+        return QC_GATE_FLAGGED if self.flagged[index] else QC_GATE_PASS
+
+    def get_failed_indices(self) -> List[int]:
+        return np.flatnonzero(self.failed).tolist()
+
+    def get_reported_indices(self) -> List[int]:
+        """Samples that failed or were flagged"""
+
+        return np.flatnonzero(self.failed | self.flagged).tolist()
+
+    def write_tsv(self, path: str):
+        with open(path, "w", newline="") as outfile:
+            csvwriter = csv.writer(outfile, delimiter="\t")
+            csvwriter.writerow([SAMPLE_COLUMN, "QC gate", "Reasons"])
+            for i, sample in enumerate(self.samples):
+                csvwriter.writerow([sample, self.get_result(i), "; ".join(self.reasons[i])])
+
+    def to_json(self) -> str:
+        return json.dumps(
+            [
+                {"file_name": sample, "result": self.get_result(i), "reasons": self.reasons[i]}
+                for i, sample in enumerate(self.samples)
+            ],
+            indent=2,
+        )
+
+
+def get_row_medians(values: np.ndarray) -> np.ndarray:
+    """Median of each row. Without NaN values, a copy of the rows is partitioned in place, which
+    is faster than np.median
+    """
+
+    if np.isnan(values).any():
+        return np.nanmedian(values, axis=1)
+    values = values.copy()
+    middle = values.shape[1] // 2
+    values.partition(middle, axis=1)
+    medians = values[:, middle]
+    if values.shape[1] % 2 == 0:
+        # The other middle value is the largest value of the lower half
+        medians = (medians + values[:, :middle].max(axis=1)) / 2
+    return medians
+
+
+def get_robust_z_scores(matrix: np.ndarray) -> np.ndarray:
+    """Robust z-scores of the values of each metric (column): distance from the median of the
+    metric in units of its MAD (scaled to the standard deviation). If the MAD of a metric is 0,
+    the mean absolute deviation from the median is used instead. Metrics without any deviation
+    and NaN values get a z-score of 0.
+    """
+
+    # Rows of the transposed matrix are contiguous, which makes the medians much faster
+    values = np.ascontiguousarray(matrix.T)
+    differences = values - get_row_medians(values)[:, None]
+    deviations = np.abs(differences)
+    scales = get_row_medians(deviations) * MAD_SCALE
+    no_mad = scales == 0
+    if no_mad.any():
+        scales[no_mad] = np.nanmean(deviations[no_mad], axis=1) * MEAN_ABSOLUTE_DEVIATION_SCALE
+    with np.errstate(divide="ignore", invalid="ignore"):
+        z_scores = np.divide(differences, scales[:, None], out=differences)
+    z_scores[~np.isfinite(z_scores)] = 0
+    return z_scores.T
+
+
+def apply_qc_gate(samples: List[str], metrics: List[str], matrix: np.ndarray, gate_config: QCGateConfig) -> QCGateResult:
+    """Applies the threshold rules and the outlier detection of the QC gate config to the
+    metrics of all samples at once. A sample fails if a metric with a threshold is missing or
+    outside of its bounds. A sample whose metrics include a robust z-score outlier is flagged,
+    or fails if the config says so (fail_on_outliers).
+
+    Args:
+        samples (List[str]): samples, i.e. the rows of the matrix
+        metrics (List[str]): metrics, i.e. the columns of the matrix
+        matrix (np.ndarray): samples x metrics matrix, see load_summary_matrix
+        gate_config (QCGateConfig): threshold rules and outlier detection settings
+
+    Returns:
+        QCGateResult: pass/fail/flagged and reasons of each sample
+    """
+
+    metric_indices = {metric: i for i, metric in enumerate(metrics)}
+    unknown_metrics = [
+        metric
+        for metric in [threshold.metric for threshold in gate_config.thresholds] + (gate_config.outlier_metrics or [])
+        if metric not in metric_indices
+    ]
+    if unknown_metrics:
+        raise Exception(f"Metrics of the QC gate not found in the summary QC file: {', '.join(unknown_metrics)}")
+
+    # (sample indices, reason of each) of the failed checks and of the outliers
+    failures: List[Tuple[np.ndarray, List[str]]] = []
+    outliers: List[Tuple[np.ndarray, List[str]]] = []
+    for threshold in gate_config.thresholds:
+        values = matrix[:, metric_indices[threshold.metric]]
+        missing = np.flatnonzero(np.isnan(values))
+        failures.append((missing, [f"{threshold.metric} is missing"] * len(missing)))
+        if threshold.min is not None:
+            too_low = np.flatnonzero(values < threshold.min)
+            failures.append((
+                too_low,
+                [f"{threshold.metric} = {format_number(values[i])} < {format_number(threshold.min)}" for i in too_low],
+            ))
+        if threshold.max is not None:
+            too_high = np.flatnonzero(values > threshold.max)
+            failures.append((
+                too_high,
+                [f"{threshold.metric} = {format_number(values[i])} > {format_number(threshold.max)}" for i in too_high],
+            ))
+
+    if gate_config.outlier_z_threshold is not None and len(samples) >= gate_config.min_samples_for_outliers:
+        if gate_config.outlier_metrics is None:
+            outlier_columns = np.arange(len(metrics))
+        else:
+            outlier_columns = np.array([metric_indices[metric] for metric in gate_config.outlier_metrics], dtype=int)
+        if len(outlier_columns):
+            z_scores = get_robust_z_scores(matrix[:, outlier_columns])
+            rows, columns = np.nonzero(np.abs(z_scores) > gate_config.outlier_z_threshold)
+            outliers.append((
+                rows,
+                [
+                    f"{metrics[outlier_columns[column]]} = {format_number(matrix[row, outlier_columns[column]])} "
+                    f"is an outlier (robust z-score {z_scores[row, column]:.1f})"
+                    for row, column in zip(rows, columns)
+                ],
+            ))
+
+    if gate_config.fail_on_outliers:
+        failures, outliers = failures + outliers, []
+    failed = np.zeros(len(samples), dtype=bool)
+    flagged = np.zeros(len(samples), dtype=bool)
+    reasons: List[List[str]] = [[] for _ in samples]
+    for result, checks in [(failed, failures), (flagged, outliers)]:
+        for indices, check_reasons in checks:
+            result[indices] = True
+            for i, reason in zip(indices, check_reasons):
+                reasons[i].append(reason)
+    return QCGateResult(samples, failed, flagged & ~failed, reasons)
+
+
+def run_qc_gate(
+    summary_qc_path: str,
+    gate_config: QCGateConfig,
+    output_path: Optional[str] = None,
+    as_json: bool = False,
+) -> QCGateResult:
+    """Applies the QC gate to a summary QC file and prints the failed and flagged samples with
+    their reasons.
+
+    Args:
+        summary_qc_path (str): path of the summary QC file, see create_summary_qc_file
+        gate_config (QCGateConfig): threshold rules and outlier detection settings
+        output_path (str): TSV file the result of every sample is written to
+        as_json (bool): print the result of every sample as JSON instead of a table of the
+            failed and flagged samples
+
+    Returns:
+        QCGateResult: pass/fail/flagged and reasons of each sample
+    """
+
+    samples, metrics, matrix = load_summary_matrix(summary_qc_path)
+    result = apply_qc_gate(samples, metrics, matrix, gate_config)
+    if output_path:
+        result.write_tsv(output_path)
+    if as_json:
+        print(result.to_json())
+        return result
+
+    reported_indices = result.get_reported_indices()
+    if reported_indices:
+        table = Table(title=f"Samples that failed or were flagged by the QC gate ({summary_qc_path})", title_justify="left")
+        table.add_column(SAMPLE_COLUMN)
+        table.add_column("QC gate")
+        table.add_column("Reasons")
+        for i in reported_indices:
+            table.add_row(samples[i], result.get_result(i), "\n".join(result.reasons[i]))
+        Console().print(table)
+    num_failed = len(result.get_failed_indices())
+    print(
+        f"{len(samples) - num_failed} of {len(samples)} samples passed the QC gate, "
+        f"{len(reported_indices) - num_failed} of them flagged as outliers."
+    )
+    return result
@@ -1,8 +1,9 @@
 import os
 from src.constants import SUPPORTED_QC_TOOLS, SAMTOOLS_STATS
 from pydantic import BaseModel, RootModel
-from typing import List, Dict
+from typing import List, Dict, Optional
 from pathlib import Path
+from src.traversal_utils import iter_files
 import csv
 
 
@@ -31,11 +32,23 @@ def parse_and_store_qc_outputs(qcs: QC_locations, tsv_path: str):
     """
 
     all_metrics = parse_qc_outputs(qcs)
-    sorted_keys = sorted(list(all_metrics.keys()))
+    store_qc_metrics(all_metrics, tsv_path)
+
+
+def store_qc_metrics(metrics: Dict[str, str], tsv_path: str):
+    """Stores metrics as a parsed .qc file: sorted metric names in the first line, their values
+    in the second line
+
+    Args:
+        metrics (Dict[str, str]): values by metric name
+        tsv_path (str): location of the resulting TSV file
+    """
+
+    sorted_keys = sorted(list(metrics.keys()))
     sorted_metrics = []
 
     for key in sorted_keys:
-        sorted_metrics.append(all_metrics[key])
+        sorted_metrics.append(metrics[key])
    
     tsv_dir = os.path.dirname(tsv_path)
     Path(tsv_dir).mkdir(parents=True, exist_ok=True)
@@ -71,46 +84,73 @@ def parse_qc_outputs(qcs: QC_locations) -> Dict:
     
     return metrics_combined
 
-def create_summary_qc_file(qc_folder: str, summary_qc_path):
+def create_summary_qc_file(
+    qc_folder: str,
+    summary_qc_path,
+    max_depth: Optional[int] = None,
+    exclude: Optional[List[str]] = None,
+):
     """This function searches for all .qc files in the given folder
     and combines the metrics into a single summary qc file.
-    We assume that all qc files contain the same metrics (same header)!
+    If the .qc files have different metrics, e.g. because they were created by different QC
+    engines (see qc_config.engine), the summary has the union of the metrics in sorted order,
+    like in the .qc files, and the values that a file doesn't have are left empty.
+    The folder is searched in parallel and the .qc files are read while the search is still
+    running, see iter_files. The samples are sorted by file name.
 
     Args:
         qc_folder (str): Folder with .qc files in it
         summary_qc_path (str): File path to the summary qc file
+        max_depth (int): depth of the deepest subfolders that are searched. None means no limit
+        exclude (List[str]): skip files and folders that match one of these globs
     """
 
     print(f"Creating summary QC file from .qc files in folder {qc_folder}.")
 
-    current_keys = None
+    # Distinct headers of the .qc files. Files with the same header share it
+    headers = {}
     all_values = []
-    pathlist = Path(qc_folder).rglob("*.qc")
-    for path_obj in pathlist:
-        file_name = path_obj.name
-        # because path is an object not string
-        path = str(path_obj)
+    for path in iter_files(qc_folder, include=["*.qc"], exclude=exclude, max_depth=max_depth):
+        file_name = os.path.basename(path)
 
         with open(path) as qc_file:
             tsv_file = csv.reader(qc_file, delimiter="\t")
-            keys = next(tsv_file)  # First line
-            keys.insert(0, "File name")
-            # Make sure that TSV headers are the same
-            if current_keys and ",".join(keys) != ",".join(current_keys):
-                raise Exception(
-                    "Can't merge QC files. The TSV files have different headers."
-                )
-            current_keys = keys
-
-            values = next(tsv_file)
-            values.insert(0, file_name)
-            all_values.append(values)  # Second line
+            keys = tuple(next(tsv_file))  # First line
+            keys = headers.setdefault(keys, keys)
+            values = next(tsv_file)  # Second line
+            all_values.append((file_name, keys, values))
+
+    if len(headers) > 1:
+        current_keys = tuple(sorted({key for keys in headers for key in keys}))
+        print(
+            f"The .qc files have {len(headers)} different sets of metrics. The summary has all "
+            f"{len(current_keys)} metrics, missing values are left empty."
+        )
+    else:
+        current_keys = next(iter(headers), ())
 
     with open(summary_qc_path, "w") as outfile:
         csvwriter = csv.writer(outfile, delimiter="\t")
-        csvwriter.writerow(current_keys)
-        for metrics in all_values:
-            csvwriter.writerow(metrics)
+        csvwriter.writerow(["File name", *current_keys])
+        for file_name, keys, values in sorted(all_values, key=lambda row: row[0]):
+            if keys is not current_keys:
+                metrics = dict(zip(keys, values))
+                values = [metrics.get(key, "") for key in current_keys]
+            csvwriter.writerow([file_name, *values])
+
+
+def read_qc_file(path: str) -> Dict[str, str]:
+    """Returns the metrics of a parsed .qc file (header line and value line)
+
+    Args:
+        path (str): path of the .qc file
+    """
+
+    with open(path) as qc_file:
+        tsv_file = csv.reader(qc_file, delimiter="\t")
+        keys = next(tsv_file)
+        values = next(tsv_file)
+    return dict(zip(keys, values))
 
 
 def parse_samtools_stats(path):
@@ -124,10 +164,85 @@ def parse_samtools_stats(path):
                 metrics[f"{SAMTOOLS_STATS}: {field}"] = value
     return metrics
 
-def print_human_readable_qc(input_qc):
 
-    if not os.path.isfile(input_qc):
-        raise IOError("Please provide the path to a valid file.")
-    
-    cmd = f"column -t -s $'\t' {input_qc} | tr '\t' '\n' | less -S"
-    os.system(cmd)
\ No newline at end of file
+# samtools stats (SN) metrics that can't be summed when the stats of several BAMs are merged
+SAMTOOLS_STATS_MAX_FIELDS = ["maximum length", "maximum first fragment length", "maximum last fragment length"]
+SAMTOOLS_STATS_MIN_FIELDS = ["is sorted"]
+# Averages: (metric, total, count), i.e. the average is total / count
+SAMTOOLS_STATS_AVERAGE_FIELDS = [
+    ("average length", "total length", "sequences"),
+    ("average first fragment length", "total first fragment length", "1st fragments"),
+    ("average last fragment length", "total last fragment length", "last fragments"),
+]
+# Averages that are weighted by a count, since their totals are not reported
+SAMTOOLS_STATS_WEIGHTED_FIELDS = [
+    ("average quality", "total length"),
+    ("insert size average", "reads properly paired"),
+]
+
+
+def merge_samtools_stats(metrics_list: List[Dict[str, str]]) -> Dict[str, str]:
+    """Combines the parsed samtools stats of several BAMs (e.g. the movies of a sample) into the
+    stats of the merged BAM, without reading the merged BAM again. Counts and totals are summed,
+    maxima and averages are computed from the stats of the single BAMs.
+
+    Args:
+        metrics_list (List[Dict[str, str]]): parsed metrics of each BAM, see read_qc_file
+
+    Returns:
+        Dict[str, str]: merged metrics
+    """
+
+    prefix = f"{SAMTOOLS_STATS}: "
+    keys = [key for key in metrics_list[0] if all(key in metrics for metrics in metrics_list)]
+
+    def get_values(field: str) -> List[float]:
+        return [float(metrics.get(prefix + field, 0) or 0) for metrics in metrics_list]
+
+    def format_number(value: float) -> str:
+        return str(int(value)) if float(value).is_integer() else f"{value:.6g}"
+
+    merged = {}
+    for key in keys:
+        field = key[len(prefix):]
+        if not key.startswith(prefix):
+            # Other tools: only kept if all BAMs agree
+            if all(metrics[key] == metrics_list[0][key] for metrics in metrics_list):
+                merged[key] = metrics_list[0][key]
+        elif field in SAMTOOLS_STATS_MAX_FIELDS:
+            merged[key] = format_number(max(get_values(field)))
+        elif field in SAMTOOLS_STATS_MIN_FIELDS:
+            merged[key] = format_number(min(get_values(field)))
+        else:
+            merged[key] = format_number(sum(get_values(field)))
+
+    def set_metric(field: str, value: float):
+        if prefix + field in merged:
+            merged[prefix + field] = format_number(value)
+
+    for field, total_field, count_field in SAMTOOLS_STATS_AVERAGE_FIELDS:
+        count = sum(get_values(count_field))
+        set_metric(field, round(sum(get_values(total_field)) / count) if count else 0)
+    for field, weight_field in SAMTOOLS_STATS_WEIGHTED_FIELDS:
+        weights, values = get_values(weight_field), get_values(field)
+        set_metric(field, round(sum(w * v for w, v in zip(weights, values)) / sum(weights), 1) if sum(weights) else 0)
+
+    # Pooled standard deviation of the insert sizes
+    weights = get_values("reads properly paired")
+    if sum(weights):
+        averages, deviations = get_values("insert size average"), get_values("insert size standard deviation")
+        average = sum(w * a for w, a in zip(weights, averages)) / sum(weights)
+        variance = sum(w * (d**2 + (a - average) ** 2) for w, a, d in zip(weights, averages, deviations)) / sum(weights)
+        set_metric("insert size standard deviation", round(variance**0.5, 1))
+    else:
+        set_metric("insert size standard deviation", 0)
+
+    bases_mapped = sum(get_values("bases mapped (cigar)"))
+    if prefix + "error rate" in merged:
+        merged[prefix + "error rate"] = f"{sum(get_values('mismatches')) / bases_mapped:e}" if bases_mapped else "0.000000e+00"
+    sequences = sum(get_values("sequences"))
+    set_metric(
+        "percentage of properly paired reads (%)",
+        round(100 * sum(get_values("reads properly paired")) / sequences, 1) if sequences else 0,
+    )
+    return merged
@@ -0,0 +1,216 @@
+########################################################################
+#
+#   Authors:
+#       William Feng
+#       Harvard Medical School
+#       william_feng@gmail.com
+#
+#       Alexander Veit
+#       Harvard Medical School
+#       alexander_veit@hms.harvard.edu
+#
+#   Transposed viewer for parsed and summary QC files that only reads
+#       the samples that are shown.
+#
+########################################################################
+
+import csv
+import os
+import re
+from typing import Iterator, List, Optional, Tuple
+from rich.console import Console
+from rich.prompt import Prompt
+from rich.table import Table
+
+# First column of summary QC files, see create_summary_qc_file
+SAMPLE_COLUMN = "File name"
+# Space a table column takes in addition to its content (padding and border)
+COLUMN_PADDING = 3
+
+
+class QCFileReader:
+    """Reads the samples of a parsed .qc file or a summary QC file lazily: the header right
+    away, the sample rows only once they are requested. Only the values of the selected metrics
+    are kept.
+
+    Args:
+        path (str): path of the QC file
+        metrics (List[str]): metrics to show. Defaults to all metrics
+        metric_regex (str): only show the metrics that match this regular expression
+        samples (List[str]): samples (file names) to show. Defaults to all samples
+        sample_regex (str): only show the samples that match this regular expression
+    """
+
+    def __init__(
+        self,
+        path: str,
+        metrics: Optional[List[str]] = None,
+        metric_regex: Optional[str] = None,
+        samples: Optional[List[str]] = None,
+        sample_regex: Optional[str] = None,
+    ):
+        self.qc_file = open(path, newline="")
+        self.rows = csv.reader(self.qc_file, delimiter="\t")
+        header = next(self.rows, [])
+        # Parsed .qc files of a single sample have no sample column
+        self.has_sample_column = bool(header) and header[0] == SAMPLE_COLUMN
+        self.default_sample = os.path.basename(path)
+
+        first_metric = 1 if self.has_sample_column else 0
+        pattern = re.compile(metric_regex) if metric_regex else None
+        if metrics:
+            unknown_metrics = [metric for metric in metrics if metric not in header[first_metric:]]
+            if unknown_metrics:
+                raise Exception(f"Metrics not found in {path}: {', '.join(unknown_metrics)}")
+            indices = [header.index(metric, first_metric) for metric in metrics]
+        else:
+            indices = range(first_metric, len(header))
+        self.metric_indices = [i for i in indices if not pattern or pattern.search(header[i])]
+        self.metrics = [header[i] for i in self.metric_indices]
+
+        self.samples = set(samples) if samples else None
+        self.sample_pattern = re.compile(sample_regex) if sample_regex else None
+        # (sample, values of the selected metrics) of the samples read so far
+        self.loaded: List[Tuple[str, List[str]]] = []
+        self.exhausted = False
+
+    def is_selected(self, sample: str) -> bool:
+        if self.samples is not None and sample not in self.samples:
+            return False
+        return not self.sample_pattern or bool(self.sample_pattern.search(sample))
+
+    def load_next(self) -> bool:
+        """Reads up to the next selected sample. Returns False at the end of the file"""
+
+        for row in self.rows:
+            if not row:
+                continue
+            sample = row[0] if self.has_sample_column else self.default_sample
+            if not self.is_selected(sample):
+                continue
+            self.loaded.append((sample, [row[i] if i < len(row) else "" for i in self.metric_indices]))
+            return True
+        self.exhausted = True
+        self.qc_file.close()
+        return False
+
+    def get_sample(self, index: int) -> Optional[Tuple[str, List[str]]]:
+        while len(self.loaded) <= index and not self.exhausted:
+            self.load_next()
+        return self.loaded[index] if index < len(self.loaded) else None
+
+    def close(self):
+        self.qc_file.close()
+
+
+def get_page(reader: QCFileReader, start: int, width: int, max_samples: Optional[int] = None) -> int:
+    """Returns the end index of the page of samples that starts at start: as many samples as fit
+    into width next to the metric names (at least one), at most max_samples
+    """
+
+    available = width - max([len(metric) for metric in reader.metrics] + [len("Metric")]) - COLUMN_PADDING
+    end = start
+    while max_samples is None or end - start < max_samples:
+        sample = reader.get_sample(end)
+        if not sample:
+            break
+        name, values = sample
+        column_width = max([len(name)] + [len(value) for value in values]) + COLUMN_PADDING
+        if end > start and column_width > available:
+            break
+        available -= column_width
+        end += 1
+    return end
+
+
+def get_page_table(reader: QCFileReader, start: int, end: int) -> Table:
+    """Transposed window of the QC file: one row per metric, one column per sample"""
+
+    table = Table(title=f"Samples {start + 1}-{end}", title_justify="left")
+    table.add_column("Metric", style="bold", no_wrap=True)
+    samples = reader.loaded[start:end]
+    for name, _ in samples:
+        table.add_column(name, justify="right", no_wrap=True)
+    for i, metric in enumerate(reader.metrics):
+        table.add_row(metric, *[values[i] for _, values in samples])
+    return table
+
+
+def iter_pages(reader: QCFileReader, width: int, max_samples: Optional[int] = None) -> Iterator[Tuple[int, int]]:
+    start = 0
+    while True:
+        end = get_page(reader, start, width, max_samples)
+        if end == start:
+            return
+        yield start, end
+        start = end
+
+
+def print_human_readable_qc(
+    input_qc: str,
+    metrics: Optional[List[str]] = None,
+    metric_regex: Optional[str] = None,
+    samples: Optional[List[str]] = None,
+    sample_regex: Optional[str] = None,
+    samples_per_page: Optional[int] = None,
+):
+    """Prints a parsed .qc file or a summary QC file transposed, i.e. one row per metric and one
+    column per sample, one page of samples at a time. Samples are only read from the file when
+    their page is shown. In a terminal, each page is shown in the pager and the next page is
+    shown on request; otherwise, all pages are printed.
+
+    Args:
+        input_qc (str): path of the QC file
+        metrics (List[str]): metrics to show. Defaults to all metrics
+        metric_regex (str): only show the metrics that match this regular expression
+        samples (List[str]): samples (file names) to show. Defaults to all samples
+        sample_regex (str): only show the samples that match this regular expression
+        samples_per_page (int): maximum number of samples per page. Defaults to as many as fit
+            into the terminal
+    """
+
+    if not os.path.isfile(input_qc):
+        raise IOError("Please provide the path to a valid file.")
+
+    console = Console()
+    reader = QCFileReader(input_qc, metrics, metric_regex, samples, sample_regex)
+    try:
+        if not reader.metrics:
+            print(f"No metrics of {input_qc} match the selection.")
+            return
+        if not console.is_terminal:
+            for start, end in iter_pages(reader, console.width, samples_per_page):
+                console.print(get_page_table(reader, start, end))
+            if not reader.loaded:
+                print(f"No samples of {input_qc} match the selection.")
+            return
+
+        # Start index of each page that has been shown, to page back
+        page_starts = [0]
+        while True:
+            start = page_starts[-1]
+            end = get_page(reader, start, console.width, samples_per_page)
+            if end == start:
+                print(f"No samples of {input_qc} match the selection.")
+                return
+            with console.pager(styles=True):
+                console.print(get_page_table(reader, start, end))
+
+            has_next = reader.get_sample(end) is not None
+            choices = (["n"] if has_next else []) + (["p"] if len(page_starts) > 1 else []) + ["q"]
+            if choices == ["q"]:
+                return
+            total = f"{len(reader.loaded)}" if reader.exhausted else f"{len(reader.loaded)}+"
+            choice = Prompt.ask(
+                f"Samples {start + 1}-{end} of {total}. Next page (n), previous page (p) or quit (q)?",
+                choices=choices,
+                default=choices[0],
+            )
+            if choice == "n":
+                page_starts.append(end)
+            elif choice == "p":
+                page_starts.pop()
+            else:
+                return
+    finally:
+        reader.close()
@@ -0,0 +1,266 @@
+########################################################################
+#
+#   Authors:
+#       William Feng
+#       Harvard Medical School
+#       william_feng@gmail.com
+#
+#       Alexander Veit
+#       Harvard Medical School
+#       alexander_veit@hms.harvard.edu
+#
+#   Bulk reset of a workflow step for the unaligned BAMs of a folder,
+#       with batched cancellation of their jobs.
+#
+########################################################################
+
+from concurrent.futures import ThreadPoolExecutor
+from fnmatch import fnmatch
+from typing import Dict, List, Optional
+
+from rich.console import Console
+from rich.table import Table
+
+from src.executor_utils import is_local_job_id
+from src.file_utils import remove_files
+from src.logging_utils import add_to_log
+from src.slurm_utils import read_job_marker, get_active_job_ids, cancel_jobs
+from src.status_utils import get_sample_states
+from src.Pbmm2Workflow import (
+    Pbmm2Workflow,
+    EXT_ALIGNMENT_RUNNING,
+    EXT_QC_RUNNING,
+    EXT_CRAM_RUNNING,
+    EXT_MERGE_RUNNING,
+    STATE_WORKFLOW_COMPLETE,
+)
+
+WORKFLOW_STEPS = ["merge", "cram", "qc", "checks", "alignment"]
+# Number of files that are removed (or running markers that are read) in parallel
+RESET_WORKERS = 16
+# Number of files that are locked at once, each lock holds a file descriptor
+RESET_LOCK_BATCH_SIZE = 256
+RUNNING_MARKER_EXTENSIONS = [EXT_ALIGNMENT_RUNNING, EXT_QC_RUNNING, EXT_CRAM_RUNNING, EXT_MERGE_RUNNING]
+
+
+def is_running_marker(path: str) -> bool:
+    return any(path.endswith(f".{extension}") for extension in RUNNING_MARKER_EXTENSIONS)
+
+
+def read_job_ids(paths: List[str], workers: int = RESET_WORKERS) -> Dict[str, str]:
+    """Job IDs of the running markers among the given paths, by path of the marker. Markers that
+    don't exist or don't contain a job ID are omitted.
+    """
+
+    def read_job_id(path: str) -> Optional[str]:
+        try:
+            return read_job_marker(path).job_id
+        except (FileNotFoundError, ValueError):
+            return None
+
+    marker_paths = [path for path in paths if is_running_marker(path)]
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+        job_ids = list(executor.map(read_job_id, marker_paths))
+    return {path: job_id for path, job_id in zip(marker_paths, job_ids) if job_id}
+
+
+def get_in_flight_job_ids(job_ids: List[str]) -> List[str]:
+    """Slurm jobs among the given jobs that are still pending or running, from a single squeue
+    call. If the live job state is unknown, all Slurm jobs are returned. Local jobs are never
+    returned, they can't be cancelled.
+    """
+
+    slurm_job_ids = sorted({job_id for job_id in job_ids if not is_local_job_id(job_id)})
+    active_job_ids = get_active_job_ids(slurm_job_ids)
+    if active_job_ids is None:
+        print("Could not retrieve the job states from Slurm. Cancelling all jobs of the reset files.")
+        return slurm_job_ids
+    return [job_id for job_id in slurm_job_ids if job_id in active_job_ids]
+
+
+class ResetPlan:
+    """Files that are removed and jobs that are cancelled to reset a workflow step of the
+    unaligned BAMs of a folder, see get_reset_plan
+
+    Args:
+        folder (str): working directory
+        workflow_step (str): 'merge', 'cram', 'qc', 'checks' or 'alignment'
+    """
+
+    def __init__(self, folder: str, workflow_step: str):
+        self.folder = folder
+        self.workflow_step = workflow_step
+        # State of each file that is reset, by file name
+        self.states: Dict[str, str] = {}
+        # Existing files that are removed with their size, by file name of the unaligned BAM
+        self.files: Dict[str, Dict[str, int]] = {}
+        # Job ID of each running marker that is removed, by path of the marker
+        self.job_ids: Dict[str, str] = {}
+        # Jobs that are still pending or running and are cancelled
+        self.in_flight_job_ids: List[str] = []
+        # Reason each file that matched the filters is not reset, by file name
+        self.skipped: Dict[str, str] = {}
+
+    def get_file_names(self) -> List[str]:
+        return list(self.states)
+
+    def get_size(self, file_name: str) -> int:
+        return sum(self.files[file_name].values())
+
+    def get_reclaimed_bytes(self) -> int:
+        # Files of a merged sample are listed for each of its movies
+        sizes = {}
+        for files in self.files.values():
+            sizes.update(files)
+        return sum(sizes.values())
+
+    def get_in_flight_job_ids(self, file_name: str) -> List[str]:
+        return [
+            self.job_ids[path]
+            for path in self.files[file_name]
+            if path in self.job_ids and self.job_ids[path] in self.in_flight_job_ids
+        ]
+
+    def print(self):
+        table = Table(
+            title=f"Reset of workflow step '{self.workflow_step}' in {self.folder}", title_justify="left"
+        )
+        table.add_column("File")
+        table.add_column("State")
+        table.add_column("Jobs to cancel")
+        table.add_column("Files to remove", justify="right")
+        table.add_column("Size (GB)", justify="right")
+        for file_name, state in self.states.items():
+            table.add_row(
+                file_name,
+                state,
+                ", ".join(self.get_in_flight_job_ids(file_name)),
+                str(len(self.files[file_name])),
+                f"{self.get_size(file_name) / 1024**3:.2f}",
+            )
+        Console().print(table)
+        for file_name, reason in self.skipped.items():
+            print(f"Skipping {file_name}: {reason}.")
+        number_of_files = len({path for files in self.files.values() for path in files})
+        print(
+            f"{len(self.states)} files to reset, {len(self.in_flight_job_ids)} jobs to cancel, "
+            f"{number_of_files} files to remove, {self.get_reclaimed_bytes() / 1024**3:.2f} GB to reclaim."
+        )
+
+
+def get_reset_plan(
+    folder: str,
+    workflow_step: str,
+    state_filter: Optional[List[str]] = None,
+    globs: Optional[List[str]] = None,
+    workers: int = RESET_WORKERS,
+) -> ResetPlan:
+    """Plans the reset of a workflow step for the unaligned BAMs of a folder from one snapshot of
+    the folder, one sacct call (for the states) and one squeue call (for the jobs in flight).
+    Nothing is cancelled or removed. Files whose workflow is complete are skipped, like in
+    Pbmm2Workflow.reset, and so are files without any file of the step.
+
+    Args:
+        folder (str): working directory
+        workflow_step (str): 'merge', 'cram', 'qc', 'checks' or 'alignment'
+        state_filter (List[str]): only reset the files in these states
+        globs (List[str]): only reset the files whose name matches one of these globs
+        workers (int): number of threads that read the running markers
+    """
+
+    if workflow_step not in WORKFLOW_STEPS:
+        raise ValueError("workflow_step must be on of 'merge', 'cram', 'qc', 'checks', 'alignment'.")
+    workflow = Pbmm2Workflow(folder, read_only=True)
+    states = get_sample_states(folder, workflow)
+    plan = ResetPlan(folder, workflow_step)
+    for file_name, state in sorted(states.items()):
+        if state_filter and state not in state_filter:
+            continue
+        if globs and not any(fnmatch(file_name, glob) for glob in globs):
+            continue
+        if state == STATE_WORKFLOW_COMPLETE:
+            plan.skipped[file_name] = "the workflow is complete"
+            continue
+        if workflow_step == "merge" and not workflow.get_sample(file_name):
+            plan.skipped[file_name] = "it does not belong to a sample that is merged"
+            continue
+        files = {
+            path: workflow.get_file_size(path)
+            for path in workflow.get_reset_files(file_name, workflow_step)
+            if workflow.is_file(path)
+        }
+        # Nothing to reset, e.g. files whose alignment hasn't been started yet
+        if files:
+            plan.states[file_name] = state
+            plan.files[file_name] = files
+
+    paths = list(dict.fromkeys(path for files in plan.files.values() for path in files))
+    plan.job_ids = read_job_ids(paths, workers)
+    plan.in_flight_job_ids = get_in_flight_job_ids(list(plan.job_ids.values()))
+    return plan
+
+
+def reset_files(workflow: Pbmm2Workflow, plan: ResetPlan, file_names: List[str], workers: int):
+    """Resets the workflow step of the given files of a plan, which must be locked. Returns the
+    removed paths and the cancelled jobs.
+    """
+
+    paths = list(dict.fromkeys(
+        path for file_name in file_names for path in workflow.get_reset_files(file_name, plan.workflow_step)
+    ))
+    # The jobs are cancelled first, so that they don't recreate the removed files
+    job_ids = get_in_flight_job_ids(list(read_job_ids(paths, workers).values()))
+    if job_ids:
+        error = cancel_jobs(job_ids)
+        if error:
+            add_to_log(f"Error cancelling jobs {','.join(job_ids)}: {error}")
+            raise Exception(
+                f"Could not cancel the jobs of the files to reset. No file of {', '.join(file_names)} was removed. {error}"
+            )
+        add_to_log(f"Cancelled jobs {','.join(job_ids)} to reset workflow step '{plan.workflow_step}'.")
+    remove_files(paths, workers=workers)
+    for file_name in file_names:
+        add_to_log(
+            f"Resetting workflow step '{plan.workflow_step}' for {workflow.get_file_with_extension(file_name, 'bam')}."
+        )
+    return paths, job_ids
+
+
+def run_reset(plan: ResetPlan, workers: int = RESET_WORKERS):
+    """Resets the workflow step of the files of a plan. The files are reset in batches of
+    RESET_LOCK_BATCH_SIZE: the files of a batch are locked, all of their jobs that are still in
+    flight are cancelled with one scancel call, the files of the step are removed in parallel
+    and the locks are released. Files that are locked by another run of the workflow are
+    skipped. The files to remove are determined again once the files are locked, in case the
+    workflow was advanced since the plan was made.
+
+    Args:
+        plan (ResetPlan): plan of the reset, see get_reset_plan
+        workers (int): number of threads that remove files
+    """
+
+    workflow = Pbmm2Workflow(plan.folder, check_requirements=False)
+    all_file_names = plan.get_file_names()
+    file_names, removed_paths, job_ids = [], set(), []
+    for start in range(0, len(all_file_names), RESET_LOCK_BATCH_SIZE):
+        try:
+            batch_file_names = [
+                file_name
+                for file_name in all_file_names[start : start + RESET_LOCK_BATCH_SIZE]
+                if workflow.acquire_reset_locks(file_name)
+            ]
+            batch_paths, batch_job_ids = reset_files(workflow, plan, batch_file_names, workers)
+        finally:
+            workflow.release_locks()
+        file_names += batch_file_names
+        removed_paths.update(batch_paths)
+        job_ids += batch_job_ids
+
+    sizes = {}
+    for file_name in file_names:
+        sizes.update(plan.files[file_name])
+    reclaimed_bytes = sum(size for path, size in sizes.items() if path in removed_paths)
+    print(
+        f"Reset workflow step '{plan.workflow_step}' for {len(file_names)} files in {plan.folder}: "
+        f"{len(job_ids)} jobs cancelled, {reclaimed_bytes / 1024**3:.2f} GB reclaimed."
+    )
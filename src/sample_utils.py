@@ -0,0 +1,93 @@
+########################################################################
+#
+#   Authors:
+#       William Feng
+#       Harvard Medical School
+#       william_feng@gmail.com
+#
+#       Alexander Veit
+#       Harvard Medical School
+#       alexander_veit@hms.harvard.edu
+#
+#   Assignment of the movie BAMs in a working directory to samples,
+#       from a sample sheet or a file name pattern.
+#
+########################################################################
+
+import csv
+import re
+from typing import Dict, List, Optional
+from src.config_utils import MergeConfig
+
+# Header of the sample sheet, if it has one
+SAMPLE_SHEET_HEADER = ["file_name", "sample"]
+
+
+def read_sample_sheet(path: str) -> Dict[str, str]:
+    """Reads a sample sheet: tab-separated, with the file name of an unaligned BAM and the name
+    of its sample per line. Empty lines, lines starting with # and the header are skipped.
+
+    Args:
+        path (str): path of the sample sheet
+
+    Returns:
+        Dict[str, str]: sample name by file name
+    """
+
+    samples = {}
+    with open(path, newline="") as sample_sheet:
+        for line_number, row in enumerate(csv.reader(sample_sheet, delimiter="\t"), start=1):
+            if not row or row[0].startswith("#") or row == SAMPLE_SHEET_HEADER:
+                continue
+            if len(row) < 2 or not row[0] or not row[1]:
+                raise Exception(f"Invalid line {line_number} in sample sheet {path}: expected file name and sample.")
+            file_name, sample = row[0].strip(), row[1].strip()
+            if samples.get(file_name, sample) != sample:
+                raise Exception(f"{file_name} is assigned to more than one sample in sample sheet {path}.")
+            samples[file_name] = sample
+    return samples
+
+
+class SampleAssignment:
+    """Sample of each movie BAM according to the merge config. Movies that are not in the
+    sample sheet (or don't match the pattern) don't belong to a sample and are not merged.
+
+    Args:
+        merge_config (MergeConfig): merge configuration with the sample sheet or pattern
+    """
+
+    def __init__(self, merge_config: MergeConfig):
+        if bool(merge_config.sample_sheet) == bool(merge_config.sample_pattern):
+            raise Exception("Please set either sample_sheet or sample_pattern in the merge config.")
+        self.samples_by_file = (
+            read_sample_sheet(merge_config.sample_sheet) if merge_config.sample_sheet else None
+        )
+        self.pattern = re.compile(merge_config.sample_pattern) if merge_config.sample_pattern else None
+        if self.pattern and not self.pattern.groups:
+            raise Exception("The sample_pattern in the merge config needs a group that matches the sample name.")
+
+    def get_sample(self, file_name: str) -> Optional[str]:
+        if self.samples_by_file is not None:
+            return self.samples_by_file.get(file_name)
+        match = self.pattern.match(file_name)
+        if not match:
+            return None
+        return match.group("sample") if "sample" in self.pattern.groupindex else match.group(1)
+
+    def get_movies_by_sample(self, file_names: List[str]) -> Dict[str, List[str]]:
+        """File names of the movies of each sample. With a sample sheet, these include movies
+        that are not in the working directory (yet).
+
+        Args:
+            file_names (List[str]): file names of the unaligned BAMs in the working directory
+        """
+
+        if self.samples_by_file is not None:
+            assignments = self.samples_by_file.items()
+        else:
+            assignments = ((file_name, self.get_sample(file_name)) for file_name in file_names)
+        movies_by_sample: Dict[str, List[str]] = {}
+        for file_name, sample in assignments:
+            if sample:
+                movies_by_sample.setdefault(sample, []).append(file_name)
+        return {sample: sorted(movies) for sample, movies in movies_by_sample.items()}
@@ -0,0 +1,133 @@
+########################################################################
+#
+#   Authors:
+#       William Feng
+#       Harvard Medical School
+#       william_feng@gmail.com
+#
+#       Alexander Veit
+#       Harvard Medical School
+#       alexander_veit@hms.harvard.edu
+#
+#   Utilities to order job submissions of folder-wide runs and to
+#       estimate when a batch of jobs will be complete.
+#
+########################################################################
+
+import heapq
+from datetime import datetime, timedelta
+from typing import List, Optional
+from pydantic import BaseModel
+from rich.console import Console
+from rich.table import Table
+
+
+class ScheduledJob(BaseModel):
+    file_name: str
+    step: str
+    input_size: int
+    estimated_runtime: float  # seconds
+    held_back: bool = False
+    estimated_start: Optional[float] = None  # seconds from now
+    estimated_finish: Optional[float] = None  # seconds from now
+
+
+def estimate_runtime(input_size: int, gb_per_hour: float) -> float:
+    """Estimated runtime of a job in seconds, given the size of its input and the throughput
+    of the step
+
+    Args:
+        input_size (int): size of the input in bytes
+        gb_per_hour (float): how many GB of input the step processes per hour
+    """
+
+    return input_size / 1024**3 / gb_per_hour * 3600
+
+
+def order_largest_first(jobs: List[ScheduledJob]) -> List[ScheduledJob]:
+    """Orders jobs by decreasing input size. Starting the longest jobs first keeps a
+    large job from starting last and stretching the wall-clock time of the whole batch
+    (longest processing time first scheduling).
+    """
+
+    return sorted(jobs, key=lambda job: job.input_size, reverse=True)
+
+
+def hold_back_jobs(jobs: List[ScheduledJob], num_in_flight: int, max_in_flight: Optional[int]):
+    """Marks the jobs that would exceed the maximum number of in-flight jobs as held back.
+    Jobs are expected to be ordered by priority.
+
+    Args:
+        jobs (List[ScheduledJob]): jobs of a single step, ordered
+        num_in_flight (int): number of jobs of the step that are currently pending or running
+        max_in_flight (int): maximum number of in-flight jobs of the step. None means no limit
+    """
+
+    num_free_slots = len(jobs) if max_in_flight is None else max(max_in_flight - num_in_flight, 0)
+    for i, job in enumerate(jobs):
+        job.held_back = i >= num_free_slots
+
+
+def estimate_completion(
+    jobs: List[ScheduledJob], in_flight_remaining: List[float], max_in_flight: Optional[int]
+) -> float:
+    """Simulates running the ordered jobs on `max_in_flight` slots, where the in-flight jobs
+    occupy slots for their remaining runtime. Stores the estimated start and finish on each job
+    and returns the estimated time in seconds until all jobs are complete.
+
+    Args:
+        jobs (List[ScheduledJob]): jobs of a single step, ordered
+        in_flight_remaining (List[float]): estimated remaining runtimes of the in-flight jobs
+        max_in_flight (int): maximum number of in-flight jobs of the step. None means no limit
+    """
+
+    num_slots = max(
+        len(jobs) + len(in_flight_remaining) if max_in_flight is None else max_in_flight, 1
+    )
+    slots = sorted(in_flight_remaining)[:num_slots]
+    slots += [0.0] * (num_slots - len(slots))
+    heapq.heapify(slots)
+    completion = max(in_flight_remaining, default=0.0)
+    for job in jobs:
+        job.estimated_start = heapq.heappop(slots)
+        job.estimated_finish = job.estimated_start + job.estimated_runtime
+        heapq.heappush(slots, job.estimated_finish)
+        completion = max(completion, job.estimated_finish)
+    return completion
+
+
+def format_duration(seconds: float) -> str:
+    return str(timedelta(seconds=round(seconds)))
+
+
+def print_schedule(jobs: List[ScheduledJob], completion: float, num_in_flight: dict):
+    """Prints the planned submission order and the estimated completion time (dry run report)
+
+    Args:
+        jobs (List[ScheduledJob]): planned jobs in submission order
+        completion (float): estimated time in seconds until all jobs are complete
+        num_in_flight (dict): number of in-flight jobs per step
+    """
+
+    table = Table(title="Planned submissions")
+    for column in ["#", "File", "Step", "Input size (GB)", "Est. start", "Est. finish", "Action"]:
+        table.add_column(column)
+    for i, job in enumerate(jobs, start=1):
+        table.add_row(
+            str(i),
+            job.file_name,
+            job.step,
+            f"{job.input_size / 1024**3:.2f}",
+            f"+{format_duration(job.estimated_start)}",
+            f"+{format_duration(job.estimated_finish)}",
+            "held back" if job.held_back else "submit",
+        )
+
+    console = Console()
+    console.print(table)
+    for step, count in num_in_flight.items():
+        console.print(f"In-flight {step} jobs: {count}")
+    finish_time = datetime.now() + timedelta(seconds=completion)
+    console.print(
+        f"Estimated completion of all planned jobs: {finish_time:%Y-%m-%d %H:%M} (in {format_duration(completion)})"
+    )
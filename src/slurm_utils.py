@@ -0,0 +1,433 @@
+########################################################################
+#
+#   Authors:
+#       William Feng
+#       Harvard Medical School
+#       william_feng@gmail.com
+#
+#       Alexander Veit
+#       Harvard Medical School
+#       alexander_veit@hms.harvard.edu
+#
+#   Utilities to submit sbatch jobs concurrently, rate limited and
+#       with retries on transient Slurm controller errors.
+#
+########################################################################
+
+import asyncio
+import re
+import subprocess
+import json
+import threading
+import time
+from datetime import datetime, timezone
+from typing import Dict, List, Optional
+from pydantic import BaseModel
+from src.config_utils import SlurmConfig
+from src.file_utils import write_atomically
+from src.lock_utils import create_file_exclusively
+from src.profiling_utils import profiled
+
+SBATCH_JOB_ID_PATTERN = re.compile(r"Submitted batch job (\d+)")
+
+# Errors returned by sbatch when slurmctld is busy. Submissions failing with
+# one of these are retried, every other failure is reported immediately.
+TRANSIENT_SBATCH_ERRORS = [
+    "Socket timed out",
+    "Slurm temporarily unable",
+    "Unable to contact slurm controller",
+    "Resource temporarily unavailable",
+]
+# Maximum number of job IDs passed to one sacct, squeue or scancel call, to keep the command
+# line short for large projects
+JOB_IDS_PER_CALL = 1000
+# Interval in which a submission checks for a free sbatch slot, see SubmissionLimiter
+SUBMISSION_SLOT_POLL_SECONDS = 0.01
+
+# Terminal Slurm job states of jobs that did not complete successfully
+JOB_STATE_COMPLETED = "COMPLETED"
+# The job needs more resources than it had. Resubmitted with more memory/time
+RESOURCE_FAILURE_STATES = ["OUT_OF_MEMORY", "TIMEOUT"]
+# The job failed because of the cluster, not the job. Resubmitted with the same resources
+INFRASTRUCTURE_FAILURE_STATES = ["NODE_FAIL", "PREEMPTED", "BOOT_FAIL"]
+# The tool itself failed or the job was cancelled. Reported, never resubmitted
+TOOL_FAILURE_STATES = ["FAILED", "CANCELLED", "DEADLINE"]
+FAILURE_STATES = RESOURCE_FAILURE_STATES + INFRASTRUCTURE_FAILURE_STATES + TOOL_FAILURE_STATES
+
+
+class JobSubmission(BaseModel):
+    job_name: str
+    # Main input of the job, e.g. the BAM that is aligned
+    input_path: str
+    command: str
+    slurm_out: str
+    time: str
+    memory: str
+    threads: int
+    mail_user: str
+    # Path of the file that signals to the workflow that the job is running
+    marker_path: str
+    attempt: int = 1
+    # The running marker of the failed previous attempt is kept until this submission is
+    # confirmed, and only then replaced, see Pbmm2Workflow.handle_failed_job
+    replaces_marker: bool = False
+    job_id: Optional[str] = None
+    error: Optional[str] = None
+    # Exit code of a job that was run locally, see LocalExecutor
+    exit_code: Optional[int] = None
+
+    def get_sbatch_args(self, slurm_config: SlurmConfig) -> List[str]:
+        return [
+            "sbatch",
+            "-J", self.job_name,
+            "-p", slurm_config.partition,
+            "-A", slurm_config.account,
+            "-o", self.slurm_out,
+            "-t", self.time,
+            f"--mem={self.memory}",
+            "-c", str(self.threads),
+            "--mail-type=ALL",
+            f"--mail-user={self.mail_user}",
+            f"--wrap={self.command}",
+        ]
+
+
+class JobMarker(BaseModel):
+    """Content of the file that signals to the workflow that a job is running"""
+
+    job_id: Optional[str] = None
+    attempt: int = 1
+    time: Optional[str] = None
+    memory: Optional[str] = None
+    # Only set for jobs that were run locally, which have finished once the marker is written
+    exit_code: Optional[int] = None
+
+    @classmethod
+    def from_submission(cls, submission: JobSubmission):
+        return cls(
+            job_id=submission.job_id,
+            attempt=submission.attempt,
+            time=submission.time,
+            memory=submission.memory,
+            exit_code=submission.exit_code,
+        )
+
+
+def read_job_marker(path: str) -> JobMarker:
+    """Reads a running marker. Older markers are either empty or only contain the job ID.
+
+    Args:
+        path (str): path of the running marker
+    """
+
+    with open(path) as f:
+        content = f.read().strip()
+    if not content:
+        return JobMarker()
+    if not content.startswith("{"):
+        return JobMarker(job_id=content)
+    return JobMarker(**json.loads(content))
+
+
+def write_job_marker(path: str, marker: JobMarker, replace: bool = False):
+    """Atomically creates a running marker. Raises FileExistsError if the marker exists already,
+    i.e. if the step has been submitted by someone else.
+
+    Args:
+        path (str): path of the running marker
+        marker (JobMarker): content of the marker
+        replace (bool): atomically replace the marker of a failed previous attempt instead
+    """
+
+    if replace:
+        write_atomically(path, marker.model_dump_json())
+    else:
+        create_file_exclusively(path, marker.model_dump_json())
+
+
+class _RateLimiter:
+    """Spaces out consecutive calls so that at most `rate` calls per second are made. Can be
+    shared by the event loops of several threads.
+    """
+
+    def __init__(self, rate: float):
+        self.interval = 1.0 / rate if rate > 0 else 0.0
+        self.next_call = 0.0
+        self.lock = threading.Lock()
+
+    async def wait(self):
+        # The time slot is reserved under the lock, the wait for it happens outside of it
+        with self.lock:
+            now = time.monotonic()
+            call_time = max(now, self.next_call)
+            self.next_call = call_time + self.interval
+        if call_time > now:
+            await asyncio.sleep(call_time - now)
+
+
+class SubmissionLimiter:
+    """Limits the number of simultaneous sbatch calls and the submission rate, see
+    SubmissionConfig. One limiter is shared by all submissions of an executor, also if they are
+    made from several threads (e.g. by the folders of a batch run).
+    """
+
+    def __init__(self, slurm_config: SlurmConfig):
+        submission_config = slurm_config.submission_config
+        self.semaphore = threading.BoundedSemaphore(submission_config.max_concurrent_submissions)
+        self.rate_limiter = _RateLimiter(submission_config.submissions_per_second)
+
+    async def acquire(self):
+        # Polled, so that the event loop isn't blocked while other threads hold the slots
+        while not self.semaphore.acquire(blocking=False):
+            await asyncio.sleep(SUBMISSION_SLOT_POLL_SECONDS)
+        await self.rate_limiter.wait()
+
+    def release(self):
+        self.semaphore.release()
+
+
+def parse_job_id(sbatch_output: str) -> Optional[str]:
+    """Returns the job ID from the output of sbatch, e.g. "Submitted batch job 1234"
+
+    Args:
+        sbatch_output (str): stdout of the sbatch command
+    """
+
+    match = SBATCH_JOB_ID_PATTERN.search(sbatch_output)
+    return match.group(1) if match else None
+
+
+def is_transient_sbatch_error(sbatch_output: str) -> bool:
+    return any(error in sbatch_output for error in TRANSIENT_SBATCH_ERRORS)
+
+
+async def _submit_one(submission: JobSubmission, slurm_config: SlurmConfig, limiter: SubmissionLimiter):
+    submission_config = slurm_config.submission_config
+    args = submission.get_sbatch_args(slurm_config)
+    error = None
+
+    for attempt in range(submission_config.max_submission_retries + 1):
+        await limiter.acquire()
+        try:
+            process = await asyncio.create_subprocess_exec(
+                *args,
+                stdout=asyncio.subprocess.PIPE,
+                stderr=asyncio.subprocess.PIPE,
+            )
+            stdout, stderr = await process.communicate()
+        except OSError as e:
+            submission.error = f"Could not run sbatch: {str(e)}"
+            return submission
+        finally:
+            limiter.release()
+
+        stdout, stderr = stdout.decode(), stderr.decode()
+        if process.returncode == 0:
+            submission.job_id = parse_job_id(stdout)
+            if not submission.job_id:
+                submission.error = f"Could not parse job ID from sbatch output: {stdout.strip()}"
+            return submission
+
+        error = (stderr or stdout).strip()
+        if not is_transient_sbatch_error(error) or attempt == submission_config.max_submission_retries:
+            break
+        await asyncio.sleep(submission_config.retry_backoff_seconds * 2**attempt)
+
+    submission.error = f"sbatch exited with code {process.returncode}: {error}"
+    return submission
+
+
+async def _submit_all(submissions: List[JobSubmission], slurm_config: SlurmConfig, limiter: SubmissionLimiter):
+    return await asyncio.gather(*[_submit_one(s, slurm_config, limiter) for s in submissions])
+
+
+@profiled("submit_sbatch_jobs")
+def submit_sbatch_jobs(
+    submissions: List[JobSubmission], slurm_config: SlurmConfig, limiter: Optional[SubmissionLimiter] = None
+) -> List[JobSubmission]:
+    """Submits the sbatch jobs concurrently. The number of simultaneous sbatch calls and the
+    submission rate are limited by the submission config. Submissions that fail with a transient
+    error are retried with exponential backoff. The job ID (or the error) is stored on each
+    submission, failed submissions are not raised.
+
+    Args:
+        submissions (List[JobSubmission]): jobs to submit
+        slurm_config (SlurmConfig): Slurm configuration incl. the submission limits
+        limiter (SubmissionLimiter): limiter shared with other submissions, e.g. of the same
+            executor. Defaults to a limiter for these submissions only
+    """
+
+    if not submissions:
+        return []
+    limiter = limiter or SubmissionLimiter(slurm_config)
+    return list(asyncio.run(_submit_all(submissions, slurm_config, limiter)))
+
+
+def get_active_job_ids(job_ids: List[str]) -> Optional[set]:
+    """Returns the subset of the given job IDs that are still pending or running according to
+    squeue. Returns None if squeue is not available or fails, i.e. if the live job state is unknown.
+
+    Args:
+        job_ids (List[str]): Slurm job IDs to look up
+    """
+
+    active_job_ids = set()
+    for i in range(0, len(job_ids), JOB_IDS_PER_CALL):
+        chunk = job_ids[i:i + JOB_IDS_PER_CALL]
+        try:
+            result = subprocess.run(
+                ["squeue", "-h", "-o", "%i", "-j", ",".join(chunk)],
+                capture_output=True,
+                text=True,
+            )
+        except OSError:
+            return None
+        # squeue fails if none of the job IDs is known to the controller anymore
+        if result.returncode != 0:
+            if "Invalid job id" in result.stderr:
+                continue
+            return None
+        active_job_ids |= set(result.stdout.split()) & set(chunk)
+    return active_job_ids
+
+
+def cancel_jobs(job_ids: List[str]) -> Optional[str]:
+    """Cancels the given jobs with a single scancel call (one per JOB_IDS_PER_CALL jobs). Jobs
+    that have ended already are ignored by scancel.
+
+    Args:
+        job_ids (List[str]): Slurm job IDs to cancel
+
+    Returns:
+        Optional[str]: the error, if scancel could not be run or failed, otherwise None
+    """
+
+    for i in range(0, len(job_ids), JOB_IDS_PER_CALL):
+        try:
+            result = subprocess.run(
+                ["scancel", *job_ids[i:i + JOB_IDS_PER_CALL]],
+                capture_output=True,
+                text=True,
+            )
+        except OSError as e:
+            return f"Could not run scancel: {str(e)}"
+        if result.returncode != 0:
+            return f"scancel exited with code {result.returncode}: {(result.stderr or result.stdout).strip()}"
+    return None
+
+
+def get_job_states(job_ids: List[str]) -> Dict[str, str]:
+    """Returns the Slurm state of the given jobs according to sacct, e.g. "RUNNING" or
+    "OUT_OF_MEMORY". If a step of a job ran out of memory or time, that state is returned even
+    if the job allocation itself is reported as "FAILED". Jobs unknown to sacct are omitted.
+    sacct is called once per JOB_IDS_PER_CALL jobs.
+
+    Args:
+        job_ids (List[str]): Slurm job IDs to look up
+    """
+
+    output = []
+    for i in range(0, len(job_ids), JOB_IDS_PER_CALL):
+        try:
+            result = subprocess.run(
+                ["sacct", "-n", "-P", "-o", "JobID,State", "-j", ",".join(job_ids[i:i + JOB_IDS_PER_CALL])],
+                capture_output=True,
+                text=True,
+            )
+        except OSError:
+            return {}
+        if result.returncode == 0:
+            output += result.stdout.splitlines()
+
+    job_states = {}
+    step_failures = {}
+    for line in output:
+        if "|" not in line:
+            continue
+        job_id, state = line.split("|", 1)
+        # E.g. "CANCELLED by 12345"
+        state = state.split(" ")[0]
+        if "." in job_id:
+            if state in RESOURCE_FAILURE_STATES:
+                step_failures[job_id.split(".")[0]] = state
+        else:
+            job_states[job_id] = state
+    for job_id, state in step_failures.items():
+        if job_id in job_states:
+            job_states[job_id] = state
+    return job_states
+
+
+def parse_memory(memory: str) -> int:
+    """Converts a Slurm memory specification like "48G" to megabytes"""
+
+    units = {"K": 1 / 1024, "M": 1, "G": 1024, "T": 1024**2}
+    memory = memory.strip().upper()
+    if memory[-1] in units:
+        return int(float(memory[:-1]) * units[memory[-1]])
+    return int(memory)
+
+
+def format_memory(megabytes: int) -> str:
+    if megabytes % 1024 == 0:
+        return f"{megabytes // 1024}G"
+    return f"{megabytes}M"
+
+
+def parse_time(time: str) -> int:
+    """Converts a Slurm time specification like "0-06:00:00" or "04:00:00" to seconds"""
+
+    days = 0
+    if "-" in time:
+        days, time = time.split("-", 1)
+    parts = [int(p) for p in time.split(":")]
+    while len(parts) < 3:
+        parts.insert(0, 0)
+    hours, minutes, seconds = parts
+    return ((int(days) * 24 + hours) * 60 + minutes) * 60 + seconds
+
+
+def format_time(seconds: int) -> str:
+    days, seconds = divmod(int(seconds), 24 * 3600)
+    hours, seconds = divmod(seconds, 3600)
+    minutes, seconds = divmod(seconds, 60)
+    return f"{days}-{hours:02d}:{minutes:02d}:{seconds:02d}"
+
+
+def get_job_times(job_ids: List[str]) -> Dict[str, Dict[str, Optional[datetime]]]:
+    """Returns submit, start and end time (UTC) of the given jobs according to sacct. Times that
+    are not known (yet) are None. Jobs unknown to sacct are omitted.
+
+    Args:
+        job_ids (List[str]): Slurm job IDs to look up
+    """
+
+    def parse(value: str) -> Optional[datetime]:
+        try:
+            # sacct reports local time
+            return datetime.fromisoformat(value).astimezone(timezone.utc)
+        except ValueError:
+            return None
+
+    job_times = {}
+    for i in range(0, len(job_ids), JOB_IDS_PER_CALL):
+        try:
+            result = subprocess.run(
+                ["sacct", "-n", "-P", "-X", "-o", "JobID,Submit,Start,End", "-j", ",".join(job_ids[i:i + JOB_IDS_PER_CALL])],
+                capture_output=True,
+                text=True,
+            )
+        except OSError:
+            return job_times
+        if result.returncode != 0:
+            continue
+        for line in result.stdout.splitlines():
+            fields = line.split("|")
+            if len(fields) != 4:
+                continue
+            job_times[fields[0]] = {
+                "submit": parse(fields[1]),
+                "start": parse(fields[2]),
+                "end": parse(fields[3]),
+            }
+    return job_times
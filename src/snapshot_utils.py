@@ -0,0 +1,71 @@
+########################################################################
+#
+#   Authors:
+#       William Feng
+#       Harvard Medical School
+#       william_feng@gmail.com
+#
+#       Alexander Veit
+#       Harvard Medical School
+#       alexander_veit@hms.harvard.edu
+#
+#   Snapshot of the files in a working directory, so that the state of
+#       all samples can be determined without a stat call per file.
+#
+########################################################################
+
+import os
+import time
+from typing import Dict, List, Optional, Tuple
+from src.traversal_utils import iter_files
+
+# Subfolders of the working directory that are part of the snapshot
+SNAPSHOT_SUBFOLDERS = ["qc", "qc_merged"]
+
+
+class FolderSnapshot:
+    """Files of a working directory (and its qc/ and qc_merged/ folders), listed with a single scandir per
+    folder, see iter_files. Sizes and mtimes are only retrieved (and then kept) for the files that need them.
+    Only meant for read-only use, e.g. status reports and metrics: the snapshot does not change
+    when files are created or removed afterwards.
+    """
+
+    def __init__(self, folder: str):
+        self.folder = folder
+        self.created = time.time()
+        self.files = set()
+        # (size, mtime) of the files that have been looked at, by path
+        self.stats: Dict[str, Tuple[int, float]] = {}
+        # The folder and its subfolders are listed in parallel
+        self.files.update(
+            iter_files(folder, max_depth=1, include_folders=SNAPSHOT_SUBFOLDERS, pruned_folders=None)
+        )
+
+    def is_file(self, path: str) -> bool:
+        return path in self.files
+
+    def get_stat(self, path: str) -> Tuple[int, float]:
+        """(size, mtime) of a file in the snapshot. Raises FileNotFoundError like os.stat"""
+
+        if path not in self.files:
+            raise FileNotFoundError(path)
+        if path not in self.stats:
+            stat = os.stat(path)
+            self.stats[path] = (stat.st_size, stat.st_mtime)
+        return self.stats[path]
+
+    def get_size(self, path: str) -> int:
+        return self.get_stat(path)[0]
+
+    def get_mtime(self, path: str) -> float:
+        return self.get_stat(path)[1]
+
+    def get_file_names(self, suffix: Optional[str] = None) -> List[str]:
+        """Names of the files directly in the folder, optionally only those ending with suffix"""
+
+        prefix = f"{self.folder}/"
+        return sorted(
+            path[len(prefix):]
+            for path in self.files
+            if "/" not in path[len(prefix):] and (suffix is None or path.endswith(suffix))
+        )
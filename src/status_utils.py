@@ -0,0 +1,254 @@
+########################################################################
+#
+#   Authors:
+#       William Feng
+#       Harvard Medical School
+#       william_feng@gmail.com
+#
+#       Alexander Veit
+#       Harvard Medical School
+#       alexander_veit@hms.harvard.edu
+#
+#   Read-only status of working directories, based on cached state
+#       snapshots.
+#
+########################################################################
+
+import hashlib
+import json
+import os
+import time
+from datetime import datetime
+from typing import Dict, List, Optional
+
+from rich.console import Console, Group
+from rich.live import Live
+from rich.table import Table
+
+from src.config_utils import Config
+from src.file_utils import write_atomically
+from src.snapshot_utils import SNAPSHOT_SUBFOLDERS
+from src.Pbmm2Workflow import (
+    Pbmm2Workflow,
+    STATE_PENDING,
+    STATE_ALIGNMENT_RUNNING,
+    STATE_ALIGNMENT_FAILED,
+    STATE_ALIGNMENT_COMPLETE,
+    STATE_CHECKS_COMPLETE,
+    STATE_QC_RUNNING,
+    STATE_QC_FAILED,
+    STATE_QC_COMPLETE,
+    STATE_QC_PARSED,
+    STATE_CRAM_RUNNING,
+    STATE_CRAM_FAILED,
+    STATE_CRAM_COMPLETE,
+    STATE_MERGE_RUNNING,
+    STATE_MERGE_FAILED,
+    STATE_MERGE_COMPLETE,
+    STATE_WORKFLOW_COMPLETE,
+)
+
+# State of files whose state can't be determined, e.g. because the pbmm2 log contains errors
+STATE_ERROR = "error"
+STATES = [
+    STATE_PENDING,
+    STATE_ALIGNMENT_RUNNING,
+    STATE_ALIGNMENT_FAILED,
+    STATE_ALIGNMENT_COMPLETE,
+    STATE_CHECKS_COMPLETE,
+    STATE_QC_RUNNING,
+    STATE_QC_FAILED,
+    STATE_QC_COMPLETE,
+    STATE_QC_PARSED,
+    STATE_CRAM_RUNNING,
+    STATE_CRAM_FAILED,
+    STATE_CRAM_COMPLETE,
+    STATE_MERGE_RUNNING,
+    STATE_MERGE_FAILED,
+    STATE_MERGE_COMPLETE,
+    STATE_WORKFLOW_COMPLETE,
+    STATE_ERROR,
+]
+
+DEFAULT_CACHE_DIR = "~/.cache/o2-processing-utils/status"
+
+
+def get_sample_states(folder: str, workflow: Optional[Pbmm2Workflow] = None) -> Dict[str, str]:
+    """Determines the state of each unaligned BAM in the folder from one snapshot of the folder
+    and one sacct call for the running jobs. Nothing is submitted or changed.
+
+    Args:
+        folder (str): working directory
+        workflow (Pbmm2Workflow): read-only workflow of the folder, which takes the snapshot.
+            Created if not given
+
+    Returns:
+        Dict[str, str]: state by file name
+    """
+
+    workflow = workflow or Pbmm2Workflow(folder, read_only=True)
+    workflow.take_snapshot()
+    file_names = workflow.get_unaligned_bams()
+    workflow.prefetch_job_states(file_names)
+    states = {}
+    for file_name in file_names:
+        try:
+            states[file_name] = workflow.get_state(file_name)
+        except Exception:
+            states[file_name] = STATE_ERROR
+    return states
+
+
+def count_states(states: Dict[str, str]) -> Dict[str, int]:
+    counts = {state: 0 for state in STATES}
+    for state in states.values():
+        counts[state] = counts.get(state, 0) + 1
+    return counts
+
+
+def get_cache_path(config: Config, folder: str) -> str:
+    cache_dir = os.path.expanduser(config.status_config.cache_dir or DEFAULT_CACHE_DIR)
+    return f"{cache_dir}/{hashlib.sha1(folder.encode()).hexdigest()}.json"
+
+
+def get_folder_mtimes(folder: str) -> List[Optional[float]]:
+    """mtimes of the folder and its QC folders. They change whenever a file is added, removed
+    or renamed, i.e. with every step of the workflow.
+    """
+
+    mtimes = []
+    for path in [folder] + [f"{folder}/{subfolder}" for subfolder in SNAPSHOT_SUBFOLDERS]:
+        try:
+            mtimes.append(os.stat(path).st_mtime)
+        except FileNotFoundError:
+            mtimes.append(None)
+    return mtimes
+
+
+def get_status(config: Config, folder: str, refresh: bool = False) -> dict:
+    """Returns the state snapshot of a folder. A cached snapshot is used if it's younger than
+    ttl_seconds (status config) and no file was added or removed in the folder since then.
+    Job states can change without any file changes, so they are at most ttl_seconds old.
+
+    Args:
+        config (Config): workflow configuration
+        folder (str): working directory
+        refresh (bool): ignore the cached snapshot
+
+    Returns:
+        dict: folder, created (timestamp) and states (state by file name)
+    """
+
+    folder = os.path.abspath(folder.rstrip("/"))
+    cache_path = get_cache_path(config, folder)
+    # Taken before the states are determined, so that changes in between invalidate the snapshot
+    folder_mtimes = get_folder_mtimes(folder)
+    if not refresh:
+        try:
+            with open(cache_path) as cache_file:
+                status = json.load(cache_file)
+            if (
+                status["folder_mtimes"] == folder_mtimes
+                and 0 <= time.time() - status["created"] < config.status_config.ttl_seconds
+            ):
+                return status
+        except (OSError, ValueError, KeyError):
+            pass
+
+    status = {
+        "folder": folder,
+        "created": time.time(),
+        "folder_mtimes": folder_mtimes,
+        "states": get_sample_states(folder),
+    }
+    try:
+        os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+        write_atomically(cache_path, json.dumps(status))
+    except OSError as e:
+        # The status can still be shown, it's just not cached
+        print(f"Could not cache the status of {folder}: {str(e)}")
+    return status
+
+
+def filter_states(states: Dict[str, str], state_filter: Optional[List[str]]) -> Dict[str, str]:
+    if not state_filter:
+        return states
+    return {file_name: state for file_name, state in states.items() if state in state_filter}
+
+
+def get_status_json(statuses: List[dict], state_filter: Optional[List[str]]) -> str:
+    return json.dumps(
+        [
+            {
+                "folder": status["folder"],
+                "snapshot_time": datetime.fromtimestamp(status["created"]).isoformat(timespec="seconds"),
+                "counts": count_states(status["states"]),
+                "samples": [
+                    {"file_name": file_name, "state": state}
+                    for file_name, state in sorted(filter_states(status["states"], state_filter).items())
+                ],
+            }
+            for status in statuses
+        ],
+        indent=2,
+    )
+
+
+def get_status_tables(statuses: List[dict], state_filter: Optional[List[str]]) -> Group:
+    tables = []
+    for status in statuses:
+        snapshot_time = datetime.fromtimestamp(status["created"]).strftime("%Y-%m-%d %H:%M:%S")
+        table = Table(title=f"{status['folder']} (snapshot of {snapshot_time})")
+        table.add_column("File")
+        table.add_column("State")
+        for file_name, state in sorted(filter_states(status["states"], state_filter).items()):
+            table.add_row(file_name, state)
+        tables.append(table)
+
+    counts_table = Table(title="Samples per state")
+    counts_table.add_column("State")
+    for status in statuses:
+        counts_table.add_column(status["folder"], justify="right")
+    all_counts = [count_states(status["states"]) for status in statuses]
+    for state in STATES:
+        counts_table.add_row(state, *[str(counts[state]) for counts in all_counts])
+    counts_table.add_row("total", *[str(len(status["states"])) for status in statuses], style="bold")
+    tables.append(counts_table)
+    return Group(*tables)
+
+
+def print_status(
+    config: Config,
+    folders: List[str],
+    state_filter: Optional[List[str]] = None,
+    as_json: bool = False,
+    live: bool = False,
+    refresh: bool = False,
+):
+    """Prints the state of each sample and the number of samples per state of the given folders.
+
+    Args:
+        config (Config): workflow configuration
+        folders (List[str]): working directories
+        state_filter (List[str]): only list the samples in these states (counts are not affected)
+        as_json (bool): print JSON instead of tables
+        live (bool): keep refreshing the tables every refresh_seconds (status config)
+        refresh (bool): ignore cached snapshots (only for the first refresh in live mode)
+    """
+
+    statuses = [get_status(config, folder, refresh=refresh) for folder in folders]
+    if as_json:
+        print(get_status_json(statuses, state_filter))
+        return
+    if not live:
+        Console().print(get_status_tables(statuses, state_filter))
+        return
+
+    with Live(get_status_tables(statuses, state_filter), auto_refresh=False) as live_display:
+        try:
+            while True:
+                time.sleep(config.status_config.refresh_seconds)
+                statuses = [get_status(config, folder) for folder in folders]
+                live_display.update(get_status_tables(statuses, state_filter), refresh=True)
+        except KeyboardInterrupt:
+            pass
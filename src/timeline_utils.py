@@ -0,0 +1,326 @@
+########################################################################
+#
+#   Authors:
+#       William Feng
+#       Harvard Medical School
+#       william_feng@gmail.com
+#
+#       Alexander Veit
+#       Harvard Medical School
+#       alexander_veit@hms.harvard.edu
+#
+#   Utilities to reconstruct per-sample timelines from the master log
+#       and to report where time is spent in the workflow.
+#
+########################################################################
+
+import csv
+import os
+import re
+from datetime import datetime, timezone
+from typing import Dict, Iterator, List, Optional, Tuple
+from pydantic import BaseModel
+from rich.console import Console
+from rich.table import Table
+from src.config_utils import Config
+from src.slurm_utils import get_job_times
+from src.executor_utils import is_local_job_id
+
+LOG_TIME_FORMAT = "%Y-%m-%d, %H:%M:%S %Z"
+
+STEP_ALIGNMENT = "alignment"
+STEP_CHECKS = "checks"
+STEP_QC = "qc"
+STEP_CRAM = "cram"
+STEP_MERGE = "merge"
+
+# Input size buckets (upper bounds in GB) the durations are additionally grouped by
+SIZE_BUCKETS_GB = [5, 20, 50]
+
+PERCENTILES = [50, 90, 99]
+
+SUBMITTING_PATTERN = re.compile(
+    r"^Submitting (?:sbatch )?job to run (pbmm2|samtools stats|o2p-bam-stats|samtools view|samtools merge) on (.+?)\. time="
+)
+SUBMITTED_PATTERN = re.compile(r"^Submitted \w+ job (\S+) \((\S+)\)\. Signal file: (.+)$")
+CHECKS_PATTERN = re.compile(r"^Running checks on (.+?)\.$")
+PARSING_PATTERN = re.compile(r"^Parsing QC outputs for (.+?) and storing \.qc file$")
+CRAM_VERIFIED_PATTERN = re.compile(r"^Verified CRAM .+? against the QC of (.+?): ")
+MERGE_VERIFIED_PATTERN = re.compile(r"^Verified merged BAM .+? against the QC of (.+?): ")
+
+JOB_NAME_STEPS = {
+    "o2p_align_pbmm2": STEP_ALIGNMENT,
+    "o2p_qc_samtools_stats": STEP_QC,
+    "o2p_qc_bam_stats": STEP_QC,
+    "o2p_cram_samtools": STEP_CRAM,
+    "o2p_merge_samtools": STEP_MERGE,
+}
+SUBMITTING_STEPS = {
+    "pbmm2": STEP_ALIGNMENT,
+    "samtools stats": STEP_QC,
+    "o2p-bam-stats": STEP_QC,
+    "samtools view": STEP_CRAM,
+    "samtools merge": STEP_MERGE,
+}
+# Suffixes of paths in the log that are replaced by ".bam" to get the unaligned BAM
+PATH_SUFFIXES = [
+    ".aligned_sorted.qc_running",
+    ".aligned_sorted.cram_running",
+    ".merge_running",
+    ".alignment_running",
+    ".aligned_sorted.bam",
+]
+
+
+class StepTiming(BaseModel):
+    sample: str
+    step: str
+    input_size: Optional[int] = None
+    job_id: Optional[str] = None
+    submitted: Optional[datetime] = None
+    started: Optional[datetime] = None
+    ended: Optional[datetime] = None
+    # Next action of the workflow on the sample after the step
+    next_action: Optional[datetime] = None
+
+    @property
+    def queue_wait(self) -> Optional[float]:
+        if self.submitted and self.started:
+            return (self.started - self.submitted).total_seconds()
+        return None
+
+    @property
+    def run_time(self) -> Optional[float]:
+        if self.started and self.ended:
+            return (self.ended - self.started).total_seconds()
+        return None
+
+    @property
+    def human_gap(self) -> Optional[float]:
+        """Time between the end of the step and the next run of the workflow on the sample"""
+
+        # The checks run within the workflow, they end right away
+        end = self.submitted if self.step == STEP_CHECKS else self.ended
+        if end and self.next_action:
+            return max((self.next_action - end).total_seconds(), 0.0)
+        return None
+
+    @property
+    def turnaround(self) -> Optional[float]:
+        if self.submitted and self.next_action:
+            return (self.next_action - self.submitted).total_seconds()
+        return None
+
+
+METRICS = ["queue_wait", "run_time", "human_gap", "turnaround"]
+
+
+def parse_log_line(line: str) -> Optional[Tuple[datetime, str]]:
+    """Returns (time, message) of a line of the master log, None if it's not a log entry"""
+
+    time, _, message = line.rstrip("\n").partition("\t")
+    try:
+        return datetime.strptime(time, LOG_TIME_FORMAT).replace(tzinfo=timezone.utc), message
+    except ValueError:
+        return None
+
+
+def read_log(log_path: str) -> Iterator[Tuple[datetime, str]]:
+    """Streams the (time, message) entries of the master log"""
+
+    with open(log_path) as log_file:
+        for line in log_file:
+            entry = parse_log_line(line)
+            if entry:
+                yield entry
+
+
+def get_sample_path(path: str) -> str:
+    for suffix in PATH_SUFFIXES:
+        if path.endswith(suffix):
+            return path[: -len(suffix)] + ".bam"
+    return path
+
+
+class TimelineBuilder:
+    """Reconstructs when each step of each sample was submitted and when the workflow next
+    acted on the sample, from the log entries in log order. For log entries that only contain
+    a file name (older logs), the sample is looked up by its file name.
+    """
+
+    def __init__(self):
+        self.timings: Dict[Tuple[str, str], StepTiming] = {}
+        self.samples_by_name: Dict[str, str] = {}
+
+    def get_timing(self, sample: str, step: str) -> StepTiming:
+        if "/" not in sample:
+            sample = self.samples_by_name.get(sample, sample)
+        self.samples_by_name[os.path.basename(sample)] = sample
+        if (sample, step) not in self.timings:
+            self.timings[(sample, step)] = StepTiming(sample=sample, step=step)
+        return self.timings[(sample, step)]
+
+    def add_entry(self, time: datetime, message: str):
+        match = SUBMITTING_PATTERN.match(message)
+        if match:
+            step = SUBMITTING_STEPS[match.group(1)]
+            timing = self.get_timing(get_sample_path(match.group(2)), step)
+            # A resubmission starts the step over
+            timing.submitted, timing.job_id, timing.next_action = time, None, None
+            if step == STEP_QC:
+                self.get_timing(timing.sample, STEP_CHECKS).next_action = time
+            return
+        match = SUBMITTED_PATTERN.match(message)
+        if match and match.group(2) in JOB_NAME_STEPS:
+            timing = self.get_timing(get_sample_path(match.group(3)), JOB_NAME_STEPS[match.group(2)])
+            timing.job_id = match.group(1)
+            return
+        match = CHECKS_PATTERN.match(message)
+        if match:
+            sample = get_sample_path(match.group(1))
+            self.get_timing(sample, STEP_ALIGNMENT).next_action = time
+            self.get_timing(sample, STEP_CHECKS).submitted = time
+            return
+        match = PARSING_PATTERN.match(message)
+        if match:
+            self.get_timing(get_sample_path(match.group(1)), STEP_QC).next_action = time
+            return
+        match = CRAM_VERIFIED_PATTERN.match(message)
+        if match:
+            self.get_timing(get_sample_path(match.group(1)), STEP_CRAM).next_action = time
+            return
+        match = MERGE_VERIFIED_PATTERN.match(message)
+        if match:
+            self.get_timing(get_sample_path(match.group(1)), STEP_MERGE).next_action = time
+
+
+def build_timelines(log_path: str, path_filter: Optional[str] = None) -> List[StepTiming]:
+    """Reconstructs the timelines of all samples in the master log, see TimelineBuilder
+
+    Args:
+        log_path (str): path of the master log
+        path_filter (str): only include samples whose path contains this string
+    """
+
+    builder = TimelineBuilder()
+    for time, message in read_log(log_path):
+        builder.add_entry(time, message)
+
+    result = [t for t in builder.timings.values() if not path_filter or path_filter in t.sample]
+    for timing in result:
+        try:
+            timing.input_size = os.path.getsize(timing.sample)
+        except OSError:
+            pass
+    return result
+
+
+def add_job_times(timings: List[StepTiming]):
+    """Adds start and end of the Slurm jobs of the steps, retrieved with sacct"""
+
+    job_ids = [t.job_id for t in timings if t.job_id and not is_local_job_id(t.job_id)]
+    job_times = get_job_times(job_ids)
+    for timing in timings:
+        if timing.job_id in job_times:
+            times = job_times[timing.job_id]
+            timing.started, timing.ended = times["start"], times["end"]
+
+
+def percentile(values: List[float], q: float) -> float:
+    """Percentile with linear interpolation between the closest ranks"""
+
+    values = sorted(values)
+    position = (len(values) - 1) * q / 100
+    lower = int(position)
+    upper = min(lower + 1, len(values) - 1)
+    return values[lower] + (values[upper] - values[lower]) * (position - lower)
+
+
+def get_size_bucket(input_size: Optional[int]) -> str:
+    if input_size is None:
+        return "unknown"
+    size_gb = input_size / 1024**3
+    lower = 0
+    for upper in SIZE_BUCKETS_GB:
+        if size_gb < upper:
+            return f"{lower}-{upper} GB"
+        lower = upper
+    return f">{lower} GB"
+
+
+def summarize(timings: List[StepTiming], by_size: bool) -> List[dict]:
+    """Returns n and the percentiles of each metric, grouped by step (and input size bucket)"""
+
+    groups: Dict[Tuple[str, str], List[StepTiming]] = {}
+    for timing in timings:
+        bucket = get_size_bucket(timing.input_size) if by_size else ""
+        groups.setdefault((timing.step, bucket), []).append(timing)
+
+    step_order = [STEP_ALIGNMENT, STEP_CHECKS, STEP_QC, STEP_CRAM, STEP_MERGE]
+    rows = []
+    for (step, bucket), group in sorted(groups.items(), key=lambda g: (step_order.index(g[0][0]), g[0][1])):
+        for metric in METRICS:
+            values = [getattr(t, metric) for t in group if getattr(t, metric) is not None]
+            if not values:
+                continue
+            row = {"step": step, "size": bucket, "metric": metric, "n": len(values)}
+            for q in PERCENTILES:
+                row[f"p{q}"] = percentile(values, q)
+            rows.append(row)
+    return rows
+
+
+def format_duration(seconds: float) -> str:
+    hours, seconds = divmod(int(seconds), 3600)
+    minutes, seconds = divmod(seconds, 60)
+    return f"{hours}:{minutes:02d}:{seconds:02d}"
+
+
+def print_summary(rows: List[dict], title: str, by_size: bool):
+    table = Table(title=title)
+    columns = ["Step"] + (["Input size"] if by_size else []) + ["Metric", "n"]
+    columns += [f"p{q}" for q in PERCENTILES]
+    for column in columns:
+        table.add_column(column)
+    for row in rows:
+        values = [row["step"]] + ([row["size"]] if by_size else []) + [row["metric"], str(row["n"])]
+        values += [format_duration(row[f"p{q}"]) for q in PERCENTILES]
+        table.add_row(*values)
+    Console().print(table)
+
+
+def write_timelines_csv(timings: List[StepTiming], csv_path: str):
+    with open(csv_path, "w", newline="") as outfile:
+        csvwriter = csv.writer(outfile)
+        csvwriter.writerow(
+            ["sample", "step", "input_size", "job_id", "submitted", "started", "ended", "next_action"]
+            + METRICS
+        )
+        for t in sorted(timings, key=lambda t: (t.sample, t.step)):
+            times = [t.submitted, t.started, t.ended, t.next_action]
+            csvwriter.writerow(
+                [t.sample, t.step, t.input_size, t.job_id]
+                + [time.isoformat() if time else "" for time in times]
+                + [getattr(t, metric) if getattr(t, metric) is not None else "" for metric in METRICS]
+            )
+
+
+def print_timeline_report(config: Config, path_filter: Optional[str] = None, csv_path: Optional[str] = None):
+    """Reconstructs the per-sample timelines from the master log and prints p50/p90/p99 of
+    queue wait, run time, human gap (time until the workflow is run again after a step ended)
+    and turnaround by step and by input size.
+
+    Args:
+        config (Config): workflow configuration, incl. the path of the master log
+        path_filter (str): only include samples whose path contains this string
+        csv_path (str): optional path of a CSV file the per-sample timelines are written to
+    """
+
+    timings = build_timelines(config.log_path, path_filter)
+    add_job_times(timings)
+    print(f"Reconstructed {len(timings)} step timelines of {len({t.sample for t in timings})} samples.")
+    print_summary(summarize(timings, by_size=False), "Durations by step (h:mm:ss)", by_size=False)
+    print_summary(summarize(timings, by_size=True), "Durations by step and input size (h:mm:ss)", by_size=True)
+    if csv_path:
+        write_timelines_csv(timings, csv_path)
+        print(f"Per-sample timelines written to {csv_path}.")
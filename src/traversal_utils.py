@@ -0,0 +1,119 @@
+########################################################################
+#
+#   Authors:
+#       William Feng
+#       Harvard Medical School
+#       william_feng@gmail.com
+#
+#       Alexander Veit
+#       Harvard Medical School
+#       alexander_veit@hms.harvard.edu
+#
+#   Pruned, parallel traversal of folder trees, which lists the folders
+#       with os.scandir in a pool of threads.
+#
+########################################################################
+
+import os
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from fnmatch import fnmatch
+from typing import Iterator, List, Optional, Tuple
+
+from src.logging_utils import add_to_log
+
+# Folders that only hold outputs or temporary files (e.g. of other tools) and are not searched
+PRUNED_FOLDERS = ["tmp", "scratch", ".snapshot", "__pycache__"]
+# Number of folders that are listed in parallel. Listings mostly wait for the (network) file system
+TRAVERSAL_WORKERS = 8
+
+
+def matches_any(name: str, relative_path: str, patterns: Optional[List[str]]) -> bool:
+    return any(fnmatch(name, pattern) or fnmatch(relative_path, pattern) for pattern in patterns or [])
+
+
+def scan_folder(path: str) -> Tuple[List[str], List[str]]:
+    """Names of the files and of the subfolders of a folder, from a single scandir. Symlinks to
+    folders are not followed. A folder that disappeared is empty. A folder that can't be listed
+    (e.g. without read permission) is reported and skipped, so that the rest of the tree is
+    still traversed.
+    """
+
+    files, folders = [], []
+    try:
+        with os.scandir(path) as entries:
+            for entry in entries:
+                # Uses the file type from the directory listing, no stat on most file systems
+                if entry.is_dir(follow_symlinks=False):
+                    folders.append(entry.name)
+                elif entry.is_file():
+                    files.append(entry.name)
+    except FileNotFoundError:
+        pass
+    except OSError as e:
+        message = f"Skipping folder {path}, it can't be listed: {e}"
+        print(message)
+        try:
+            add_to_log(message)
+        except Exception:
+            # No config to find the log with, e.g. when only QC files are summarized
+            pass
+    return files, folders
+
+
+def iter_files(
+    root: str,
+    include: Optional[List[str]] = None,
+    exclude: Optional[List[str]] = None,
+    max_depth: Optional[int] = None,
+    include_folders: Optional[List[str]] = None,
+    pruned_folders: Optional[List[str]] = PRUNED_FOLDERS,
+    workers: int = TRAVERSAL_WORKERS,
+) -> Iterator[str]:
+    """Yields the paths of the files in a folder tree. The folders are listed in a pool of
+    threads and the files of each folder are yielded as soon as it has been listed, so that the
+    caller can process them while the rest of the tree is still traversed. The order of the
+    files is not defined.
+
+    Globs are matched against the names and the paths relative to root.
+
+    Args:
+        root (str): folder to start from
+        include (List[str]): only yield files that match one of these globs, e.g. "*.qc"
+        exclude (List[str]): skip files and folders that match one of these globs
+        max_depth (int): depth of the deepest folders that are listed. 0 only lists root.
+            None means no limit
+        include_folders (List[str]): only descend into subfolders that match one of these globs
+        pruned_folders (List[str]): don't descend into subfolders that match one of these globs,
+            see PRUNED_FOLDERS. The root itself is always listed
+        workers (int): number of threads that list folders
+    """
+
+    root = root.rstrip("/") or "/"
+
+    def get_relative_path(folder: str, name: str) -> str:
+        return f"{folder}/{name}"[len(root) + 1:]
+
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+        # Folder and its depth, by the future of its listing
+        pending = {executor.submit(scan_folder, root): (root, 0)}
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                folder, depth = pending.pop(future)
+                files, folders = future.result()
+                if max_depth is None or depth < max_depth:
+                    for name in folders:
+                        relative_path = get_relative_path(folder, name)
+                        if include_folders is not None and not matches_any(name, relative_path, include_folders):
+                            continue
+                        if matches_any(name, relative_path, pruned_folders) or matches_any(name, relative_path, exclude):
+                            continue
+                        path = f"{folder}/{name}"
+                        pending[executor.submit(scan_folder, path)] = (path, depth + 1)
+                for name in files:
+                    relative_path = get_relative_path(folder, name)
+                    if include is not None and not matches_any(name, relative_path, include):
+                        continue
+                    if matches_any(name, relative_path, exclude):
+                        continue
+                    yield f"{folder}/{name}"
@@ -0,0 +1,217 @@
+########################################################################
+#
+#   Authors:
+#       William Feng
+#       Harvard Medical School
+#       william_feng@gmail.com
+#
+#       Alexander Veit
+#       Harvard Medical School
+#       alexander_veit@hms.harvard.edu
+#
+#   Utilities to watch folders for new unaligned BAMs and to start the
+#       workflow as soon as their transfer is complete.
+#
+########################################################################
+
+import ctypes
+import ctypes.util
+import os
+import select
+import struct
+import time
+from typing import Callable, Dict, List, Optional, Tuple
+
+# File systems on which inotify does not see changes made by other hosts
+NETWORK_FILE_SYSTEMS = ["nfs", "nfs4", "lustre", "gpfs", "cifs", "smb3", "beegfs", "panfs"]
+
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+INOTIFY_EVENT_HEADER = struct.Struct("iIII")
+
+
+def get_file_system_type(path: str) -> Optional[str]:
+    """Returns the type of the file system the path is on, according to /proc/mounts"""
+
+    path = os.path.realpath(path)
+    file_system_type, mount_point_length = None, -1
+    try:
+        with open("/proc/mounts") as mounts:
+            for line in mounts:
+                fields = line.split()
+                if len(fields) < 3:
+                    continue
+                mount_point = fields[1]
+                is_parent = path == mount_point or path.startswith(mount_point.rstrip("/") + "/")
+                if is_parent and len(mount_point) > mount_point_length:
+                    file_system_type, mount_point_length = fields[2], len(mount_point)
+    except OSError:
+        return None
+    return file_system_type
+
+
+def is_network_file_system(path: str) -> bool:
+    file_system_type = get_file_system_type(path) or ""
+    return file_system_type in NETWORK_FILE_SYSTEMS or file_system_type.startswith("fuse")
+
+
+def is_unaligned_bam(file_name: str, aligned_extension: str) -> bool:
+    """Unaligned BAMs are *.bam files that are not workflow outputs. Hidden files are
+    skipped, since rsync transfers into a hidden temporary file.
+    """
+
+    return (
+        file_name.endswith(".bam")
+        and aligned_extension not in file_name
+        and not file_name.startswith(".")
+    )
+
+
+class _Inotify:
+    """Minimal inotify wrapper based on ctypes (watches folders, not recursively)"""
+
+    def __init__(self, folders: List[str]):
+        self.libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        self.fd = self.libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self.folders = {}
+        for folder in folders:
+            wd = self.libc.inotify_add_watch(
+                self.fd,
+                os.fsencode(folder),
+                IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE | IN_MODIFY,
+            )
+            if wd < 0:
+                raise OSError(ctypes.get_errno(), f"inotify_add_watch failed for {folder}")
+            self.folders[wd] = folder
+
+    def read_events(self, timeout: float) -> List[Tuple[str, str]]:
+        """Waits up to timeout seconds and returns (folder, file name) of the changed files"""
+
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        if not readable:
+            return []
+        try:
+            buffer = os.read(self.fd, 64 * 1024)
+        except BlockingIOError:
+            return []
+        events, offset = [], 0
+        while offset < len(buffer):
+            wd, _, _, name_length = INOTIFY_EVENT_HEADER.unpack_from(buffer, offset)
+            offset += INOTIFY_EVENT_HEADER.size
+            name = buffer[offset:offset + name_length].rstrip(b"\0").decode(errors="replace")
+            offset += name_length
+            if wd in self.folders and name:
+                events.append((self.folders[wd], name))
+        return events
+
+    def close(self):
+        os.close(self.fd)
+
+
+class FolderWatcher:
+    """Watches folders for new unaligned BAMs and calls `on_stable_file(folder, file_name)` once
+    the size and mtime of a new file have not changed for `stability_window` seconds, i.e. once
+    its transfer is complete. New files are detected with inotify. On network file systems,
+    where inotify misses changes made by other hosts, the folders are listed periodically instead.
+    """
+
+    def __init__(
+        self,
+        folders: List[str],
+        aligned_extension: str,
+        on_stable_file: Callable[[str, str], None],
+        stability_window: float,
+        poll_interval: float,
+        use_inotify: Optional[bool] = None,
+    ):
+        self.folders = folders
+        self.aligned_extension = aligned_extension
+        self.on_stable_file = on_stable_file
+        self.stability_window = stability_window
+        self.poll_interval = poll_interval
+        if use_inotify is None:
+            use_inotify = not any(is_network_file_system(folder) for folder in folders)
+        self.inotify = _Inotify(folders) if use_inotify else None
+        self.known_files = {folder: set() for folder in folders}
+        # (size, mtime, time since when size and mtime are unchanged) of the new files, by path
+        self.candidates: Dict[Tuple[str, str], Tuple[int, float, float]] = {}
+
+    def add_existing_files(self, is_new: Callable[[str, str], bool]):
+        """Registers the files that are already in the folders. Files for which is_new returns
+        True are treated like newly arrived files, all others are ignored.
+        """
+
+        for folder in self.folders:
+            for file_name in self.list_unaligned_bams(folder):
+                self.known_files[folder].add(file_name)
+                if is_new(folder, file_name):
+                    self.add_candidate(folder, file_name)
+
+    def list_unaligned_bams(self, folder: str) -> List[str]:
+        with os.scandir(folder) as entries:
+            return [
+                entry.name
+                for entry in entries
+                if is_unaligned_bam(entry.name, self.aligned_extension) and entry.is_file()
+            ]
+
+    def add_candidate(self, folder: str, file_name: str):
+        if (folder, file_name) not in self.candidates:
+            print(f"New file {folder}/{file_name}. Waiting until its transfer is complete.")
+            self.candidates[(folder, file_name)] = (-1, -1.0, time.time())
+
+    def detect_new_files(self):
+        if self.inotify:
+            deadline = time.time() + self.poll_interval
+            while time.time() < deadline:
+                # The deadline may have passed since the loop condition was checked
+                for folder, file_name in self.inotify.read_events(max(0.0, deadline - time.time())):
+                    if is_unaligned_bam(file_name, self.aligned_extension):
+                        self.known_files[folder].add(file_name)
+                        self.add_candidate(folder, file_name)
+            return
+
+        time.sleep(self.poll_interval)
+        for folder in self.folders:
+            file_names = set(self.list_unaligned_bams(folder))
+            for file_name in file_names - self.known_files[folder]:
+                self.add_candidate(folder, file_name)
+            self.known_files[folder] = file_names
+
+    def check_candidates(self):
+        """Starts the files whose size and mtime are stable for the stability window"""
+
+        now = time.time()
+        for (folder, file_name), (size, mtime, stable_since) in list(self.candidates.items()):
+            try:
+                stat = os.stat(f"{folder}/{file_name}")
+            except FileNotFoundError:
+                # E.g. renamed or deleted again
+                del self.candidates[(folder, file_name)]
+                continue
+            if (stat.st_size, stat.st_mtime) != (size, mtime):
+                self.candidates[(folder, file_name)] = (stat.st_size, stat.st_mtime, now)
+            elif now - stable_since >= self.stability_window:
+                del self.candidates[(folder, file_name)]
+                self.on_stable_file(folder, file_name)
+
+    def watch(self, max_cycles: Optional[int] = None):
+        """Watches the folders until interrupted or for max_cycles cycles of poll_interval seconds"""
+
+        mode = "inotify" if self.inotify else f"polling every {self.poll_interval}s"
+        print(f"Watching {', '.join(self.folders)} ({mode}).")
+        cycle = 0
+        try:
+            while max_cycles is None or cycle < max_cycles:
+                self.detect_new_files()
+                self.check_candidates()
+                cycle += 1
+        finally:
+            if self.inotify:
+                self.inotify.close()
@@ -0,0 +1,176 @@
+########################################################################
+#
+#   Authors:
+#       William Feng
+#       Harvard Medical School
+#       william_feng@gmail.com
+#
+#       Alexander Veit
+#       Harvard Medical School
+#       alexander_veit@hms.harvard.edu
+#
+#   Fixtures of the benchmarks: fake cluster tools on PATH, a benchmark
+#       config and counting of file system operations and spawns.
+#
+########################################################################
+
+import json
+import os
+import sys
+import threading
+from pathlib import Path
+from typing import Dict
+
+import pytest
+
+from fakes import create_fake_tools, create_config, get_stats_text
+
+# Sizes of the synthetic inputs, can be reduced for quick runs
+NUM_SAMPLES = int(os.getenv("O2P_BENCHMARK_SAMPLES", 2000))
+NUM_QC_FILES = int(os.getenv("O2P_BENCHMARK_QC_FILES", 10000))
+NUM_LOG_LINES = int(os.getenv("O2P_BENCHMARK_LOG_LINES", 2000000))
+NUM_STATS_LINES = int(os.getenv("O2P_BENCHMARK_STATS_LINES", 200000))
+NUM_SUMMARY_SAMPLES = int(os.getenv("O2P_BENCHMARK_SUMMARY_SAMPLES", 50000))
+
+# Audit events that are counted (see https://docs.python.org/3/library/audit_events.html)
+COUNTED_EVENT_PREFIXES = ["open", "os.", "shutil.", "subprocess.Popen"]
+# os.stat does not raise audit events (also used by os.path.isfile/getsize), it's wrapped instead
+STAT_EVENT = "os.stat"
+
+
+class OperationCounter:
+    """Counts the file system operations and subprocess spawns of the benchmarked calls, based on
+    audit hooks and a wrapper of os.stat. Counts are averaged over the benchmarked calls.
+    """
+
+    active = None
+
+    def __init__(self):
+        self.counts: Dict[str, int] = {}
+        self.num_calls = 0
+        self.lock = threading.Lock()
+
+    def add(self, event: str):
+        with self.lock:
+            self.counts[event] = self.counts.get(event, 0) + 1
+
+    def count(self, func):
+        """Wraps func, so that its operations are counted whenever it's called"""
+
+        def wrapper(*args, **kwargs):
+            OperationCounter.active = self
+            try:
+                return func(*args, **kwargs)
+            finally:
+                OperationCounter.active = None
+                self.num_calls += 1
+
+        return wrapper
+
+    def get_counts_per_call(self) -> Dict[str, float]:
+        return {
+            event: round(count / max(self.num_calls, 1), 1)
+            for event, count in sorted(self.counts.items())
+        }
+
+
+def _audit_hook(event: str, args):
+    counter = OperationCounter.active
+    if counter is not None and any(event.startswith(prefix) for prefix in COUNTED_EVENT_PREFIXES):
+        counter.add(event)
+
+
+sys.addaudithook(_audit_hook)
+_os_stat = os.stat
+
+
+def _counted_stat(*args, **kwargs):
+    counter = OperationCounter.active
+    if counter is not None:
+        counter.add(STAT_EVENT)
+    return _os_stat(*args, **kwargs)
+
+
+def pytest_addoption(parser):
+    group = parser.getgroup("o2p benchmarks")
+    group.addoption(
+        "--counts-baseline",
+        default=".benchmarks/operation_counts.json",
+        help="JSON file with the baseline operation counts per benchmark.",
+    )
+    group.addoption(
+        "--save-counts-baseline",
+        action="store_true",
+        help="Store the operation counts of this run as the new baseline.",
+    )
+    group.addoption(
+        "--counts-tolerance",
+        type=float,
+        default=0.1,
+        help="Relative increase of an operation count over the baseline that fails a benchmark.",
+    )
+
+
+@pytest.fixture(scope="session")
+def counts_baseline(request):
+    """Operation counts per benchmark. Loaded from the baseline file, and written back at the
+    end of the session if --save-counts-baseline is given.
+    """
+
+    path = Path(request.config.getoption("--counts-baseline"))
+    baseline = json.loads(path.read_text()) if path.is_file() else {}
+    current = {}
+    yield baseline, current
+    if request.config.getoption("--save-counts-baseline"):
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_text(json.dumps({**baseline, **current}, indent=2, sort_keys=True) + "\n")
+
+
+@pytest.fixture
+def operation_counter(request, benchmark, counts_baseline, monkeypatch):
+    """Counts the operations of the benchmarked calls (wrap the target with counter.count).
+    The counts are added to the benchmark JSON (extra_info) and compared with the baseline.
+    """
+
+    monkeypatch.setattr(os, "stat", _counted_stat)
+    counter = OperationCounter()
+    yield counter
+
+    counts = counter.get_counts_per_call()
+    benchmark.extra_info["operations_per_call"] = counts
+    baseline, current = counts_baseline
+    current[request.node.name] = counts
+    tolerance = request.config.getoption("--counts-tolerance")
+    regressions = [
+        f"{event}: {count} (baseline {baseline[request.node.name][event]})"
+        for event, count in counts.items()
+        if event in baseline.get(request.node.name, {})
+        and count > baseline[request.node.name][event] * (1 + tolerance) + 1
+    ]
+    if regressions and not request.config.getoption("--save-counts-baseline"):
+        pytest.fail("Operation counts increased over the baseline:\n" + "\n".join(regressions))
+
+
+@pytest.fixture(scope="session")
+def benchmark_env(tmp_path_factory):
+    """Fake cluster tools on PATH and a benchmark config in O2_PROCESSING_CONFIG"""
+
+    root = tmp_path_factory.mktemp("o2p_benchmark_env")
+    create_fake_tools(root / "bin")
+    stats_path = root / "stats.txt"
+    stats_path.write_text(get_stats_text(NUM_STATS_LINES))
+    config_path = create_config(root / "config.json", root / "master_log.log")
+
+    environ = {
+        "PATH": f"{root / 'bin'}{os.pathsep}{os.environ.get('PATH', '')}",
+        "O2_PROCESSING_CONFIG": str(config_path),
+        "O2P_BENCHMARK_STATS": str(stats_path),
+    }
+    previous = {name: os.environ.get(name) for name in environ}
+    os.environ.update(environ)
+    yield {"root": root, "config": config_path, "log": root / "master_log.log", "stats": stats_path}
+    for name, value in previous.items():
+        if value is None:
+            os.environ.pop(name, None)
+        else:
+            os.environ[name] = value
@@ -0,0 +1,70 @@
+########################################################################
+#
+#   Authors:
+#       William Feng
+#       Harvard Medical School
+#       william_feng@gmail.com
+#
+#       Alexander Veit
+#       Harvard Medical School
+#       alexander_veit@hms.harvard.edu
+#
+#   Synthetic QC files, summary QC files and logs for the benchmarks.
+#       Fake cluster tools and project folders are in test/fakes.py.
+#
+########################################################################
+
+import random
+from pathlib import Path
+
+NUM_QC_METRICS = 100
+
+
+def create_qc_files(folder: Path, num_files: int) -> Path:
+    """Creates num_files parsed .qc files with NUM_QC_METRICS metrics each"""
+
+    folder.mkdir(parents=True, exist_ok=True)
+    header = "\t".join(f"samtools stats: metric {i}" for i in range(NUM_QC_METRICS))
+    rng = random.Random(0)
+    for i in range(num_files):
+        values = "\t".join(str(rng.randint(0, 10**9)) for _ in range(NUM_QC_METRICS))
+        (folder / f"sample_{i:06d}.aligned_sorted.qc").write_text(f"{header}\n{values}\n")
+    return folder
+
+
+def create_summary_file(path: Path, num_samples: int) -> Path:
+    """Creates a summary QC file with num_samples samples and NUM_QC_METRICS metrics. Every
+    1000th sample is an outlier in the first metric.
+    """
+
+    rng = random.Random(0)
+    with open(path, "w") as summary_file:
+        summary_file.write("File name\t" + "\t".join(f"samtools stats: metric {i}" for i in range(NUM_QC_METRICS)) + "\n")
+        for i in range(num_samples):
+            values = [rng.gauss(10**6, 10**5) for _ in range(NUM_QC_METRICS)]
+            if i % 1000 == 0:
+                values[0] *= 10
+            summary_file.write(f"sample_{i:06d}.aligned_sorted.qc\t" + "\t".join(f"{value:.6g}" for value in values) + "\n")
+    return path
+
+
+def create_log(path: Path, num_lines: int, folder: str = "/n/data1/project", needle_every: int = 200000) -> Path:
+    """Creates a master log with num_lines entries. Every needle_every-th entry mentions
+    'needle_sample', so that searches for it have few hits.
+    """
+
+    messages = [
+        "Submitting job to run pbmm2 on {folder}/sample_{i}.bam. time=0-06:00:00, mem=48G, threads=32",
+        "Submitted slurm job {i} (o2p_align_pbmm2). Signal file: {folder}/sample_{i}.alignment_running",
+        "Running checks on {folder}/sample_{i}.bam.",
+        "Submitting job to run samtools stats on {folder}/sample_{i}.aligned_sorted.bam. time=00-04:00:00, mem=4G, threads=2",
+        "Parsing QC outputs for {folder}/sample_{i}.bam and storing .qc file",
+        "Cleaning up temporary files for file sample_{i}.bam.",
+    ]
+    with open(path, "w") as log_file:
+        for i in range(num_lines):
+            message = messages[i % len(messages)].format(folder=folder, i=i)
+            if i % needle_every == 0:
+                message += " needle_sample"
+            log_file.write(f"2026-01-01, 00:00:00 UTC\t{message}\n")
+    return path
@@ -0,0 +1,102 @@
+########################################################################
+#
+#   Authors:
+#       William Feng
+#       Harvard Medical School
+#       william_feng@gmail.com
+#
+#       Alexander Veit
+#       Harvard Medical School
+#       alexander_veit@hms.harvard.edu
+#
+#   Benchmarks of the hot paths on synthetic project folders, run with
+#       fake cluster tools. See `make benchmark`.
+#
+########################################################################
+
+import itertools
+import shutil
+
+import pytest
+
+from conftest import NUM_SAMPLES, NUM_QC_FILES, NUM_LOG_LINES, NUM_SUMMARY_SAMPLES
+from fakes import create_project_folder
+from synthetic_data import create_qc_files, create_log, create_summary_file
+from src.Pbmm2Workflow import Pbmm2Workflow
+from src.qc_utils import create_summary_qc_file, parse_samtools_stats
+from src.qc_gate_utils import load_summary_matrix, apply_qc_gate
+from src.config_utils import QCGateConfig
+from src.logging_utils import search_log
+
+
+@pytest.fixture(scope="module")
+def project_template(benchmark_env):
+    """Project folder with NUM_SAMPLES samples in all workflow states. It's copied for each
+    benchmark round, since the workflow advances the samples.
+    """
+
+    folder = benchmark_env["root"] / "project_template"
+    create_project_folder(folder, NUM_SAMPLES)
+    return folder
+
+
+@pytest.fixture
+def project_folders(project_template, tmp_path):
+    """Returns a function that creates a fresh copy of the project folder"""
+
+    counter = itertools.count()
+
+    def create():
+        folder = tmp_path / f"project_{next(counter)}"
+        shutil.copytree(project_template, folder)
+        return str(folder)
+
+    return create
+
+
+def test_resume_workflow_all(benchmark, project_folders, operation_counter):
+    def setup():
+        return (Pbmm2Workflow(project_folders()),), {}
+
+    benchmark.pedantic(
+        operation_counter.count(lambda workflow: workflow.resume_workflow_all()),
+        setup=setup,
+        rounds=3,
+    )
+
+
+def test_resume_workflow_all_dry_run(benchmark, project_folders, operation_counter):
+    workflow = Pbmm2Workflow(project_folders())
+    benchmark.pedantic(
+        operation_counter.count(lambda: workflow.resume_workflow_all(dry_run=True)), rounds=3
+    )
+
+
+def test_create_summary_qc_file(benchmark, benchmark_env, operation_counter):
+    qc_folder = create_qc_files(benchmark_env["root"] / "qc_files", NUM_QC_FILES)
+    summary_path = benchmark_env["root"] / "summary.qc"
+    benchmark.pedantic(
+        operation_counter.count(create_summary_qc_file), args=(str(qc_folder), str(summary_path)), rounds=3
+    )
+
+
+def test_parse_samtools_stats(benchmark, benchmark_env, operation_counter):
+    metrics = benchmark(operation_counter.count(parse_samtools_stats), str(benchmark_env["stats"]))
+    assert "samtools stats: raw total sequences" in metrics
+
+
+def test_qc_gate(benchmark, benchmark_env, operation_counter):
+    summary_path = create_summary_file(benchmark_env["root"] / "summary_gate.qc", NUM_SUMMARY_SAMPLES)
+    gate_config = QCGateConfig(thresholds=[{"metric": "samtools stats: metric 1", "min": 5 * 10**5}])
+
+    def run_gate():
+        return apply_qc_gate(*load_summary_matrix(str(summary_path)), gate_config)
+
+    result = benchmark.pedantic(operation_counter.count(run_gate), rounds=3)
+    # Sample 0 is an outlier in the first metric
+    assert result.flagged[0]
+
+
+def test_search_log(benchmark, benchmark_env, operation_counter):
+    create_log(benchmark_env["log"], NUM_LOG_LINES)
+    benchmark.pedantic(operation_counter.count(search_log), args=("needle_sample",), rounds=3)
@@ -0,0 +1,39 @@
+########################################################################
+#
+#   Authors:
+#       William Feng
+#       Harvard Medical School
+#       william_feng@gmail.com
+#
+#       Alexander Veit
+#       Harvard Medical School
+#       alexander_veit@hms.harvard.edu
+#
+#   Fixtures of the unit tests: fake cluster tools on PATH and a test
+#       config in O2_PROCESSING_CONFIG.
+#
+########################################################################
+
+import os
+
+import pytest
+
+from fakes import create_fake_tools, create_config, get_stats_text
+
+
+@pytest.fixture
+def workflow_env(tmp_path, monkeypatch):
+    """Fake sbatch/squeue/sacct/scancel/pbmm2/samtools on PATH and a config in
+    O2_PROCESSING_CONFIG. The fake tools can be replaced by writing to root/bin.
+    """
+
+    root = tmp_path / "o2p_env"
+    create_fake_tools(root / "bin")
+    stats_path = root / "stats.txt"
+    stats_path.write_text(get_stats_text(100))
+    config_path = create_config(root / "config.json", root / "master_log.log")
+
+    monkeypatch.setenv("PATH", f"{root / 'bin'}{os.pathsep}{os.environ.get('PATH', '')}")
+    monkeypatch.setenv("O2_PROCESSING_CONFIG", str(config_path))
+    monkeypatch.setenv("O2P_BENCHMARK_STATS", str(stats_path))
+    return {"root": root, "bin": root / "bin", "config": config_path, "log": root / "master_log.log"}
@@ -0,0 +1,178 @@
+########################################################################
+#
+#   Authors:
+#       William Feng
+#       Harvard Medical School
+#       william_feng@gmail.com
+#
+#       Alexander Veit
+#       Harvard Medical School
+#       alexander_veit@hms.harvard.edu
+#
+#   Fake cluster tools, test configs and stub project folders, shared by
+#       the unit tests and the benchmarks.
+#
+########################################################################
+
+import json
+import os
+import random
+from pathlib import Path
+from typing import Dict, List
+
+# Workflow states of the samples in a synthetic project folder, assigned round robin
+SAMPLE_STATES = [
+    "pending",
+    "alignment_running",
+    "alignment_complete",
+    "checks_complete",
+    "qc_running",
+    "qc_complete",
+    "complete",
+]
+
+FAKE_TOOLS = {
+    "sbatch": """#!/bin/bash
+echo "Submitted batch job $((RANDOM * 32768 + RANDOM))"
+""",
+    # No job is known, i.e. all running markers belong to jobs that are gone
+    "squeue": """#!/bin/bash
+exit 0
+""",
+    "sacct": """#!/bin/bash
+exit 0
+""",
+    "scancel": """#!/bin/bash
+exit 0
+""",
+    "pbmm2": """#!/bin/bash
+if [ "$1" == "--version" ]; then echo "pbmm2 1.13.1"; fi
+""",
+    "samtools": """#!/bin/bash
+case "$1" in
+    --version) echo "samtools 1.19" ;;
+    quickcheck) exit 0 ;;
+    stats) cat "$O2P_BENCHMARK_STATS" ;;
+esac
+""",
+}
+
+
+def create_fake_tools(bin_dir: Path):
+    """Creates fake sbatch/squeue/sacct/scancel/pbmm2/samtools executables that return
+    immediately with plausible output
+    """
+
+    bin_dir.mkdir(parents=True, exist_ok=True)
+    for name, script in FAKE_TOOLS.items():
+        path = bin_dir / name
+        path.write_text(script)
+        path.chmod(0o755)
+
+
+def create_config(path: Path, log_path: Path) -> Path:
+    config = {
+        "reference_sequence_path": str(path.parent / "reference.fa"),
+        "log_path": str(log_path),
+        "slurm_config": {
+            "allocated_time": "0-06:00:00",
+            "allocated_memory": "48G",
+            "allocated_threads": 32,
+            "mail_user": "",
+            # Don't let the rate limiter dominate the benchmarks
+            "submission_config": {"max_concurrent_submissions": 16, "submissions_per_second": 10000.0},
+        },
+    }
+    path.write_text(json.dumps(config))
+    return path
+
+
+def update_config(path: Path, **sections):
+    """Replaces top-level sections of a test config, e.g. cram_config={"enabled": True}"""
+
+    config = json.loads(path.read_text())
+    config.update(sections)
+    path.write_text(json.dumps(config))
+
+
+def get_stats_text(num_lines: int) -> str:
+    """samtools stats output with the usual SN section followed by num_lines of other sections"""
+
+    sn_fields = [
+        "raw total sequences", "filtered sequences", "sequences", "is sorted", "1st fragments",
+        "last fragments", "reads mapped", "reads mapped and paired", "reads unmapped",
+        "reads properly paired", "reads paired", "reads duplicated", "reads MQ0", "reads QC failed",
+        "non-primary alignments", "supplementary alignments", "total length", "total first fragment length",
+        "total last fragment length", "bases mapped", "bases mapped (cigar)", "bases trimmed",
+        "bases duplicated", "mismatches", "error rate", "average length", "average first fragment length",
+        "average last fragment length", "maximum length", "maximum first fragment length",
+        "maximum last fragment length", "average quality", "insert size average",
+        "insert size standard deviation", "inward oriented pairs", "outward oriented pairs",
+        "pairs with other orientation", "pairs on different chromosomes", "percentage of properly paired reads (%)",
+    ]
+    rng = random.Random(0)
+    lines = ["# This file was produced by samtools stats (1.19+htslib-1.19)", "# CHK, Checksum\tCHK\t1\t2\t3"]
+    lines += [f"SN\t{field}:\t{rng.randint(0, 10**9)}" for field in sn_fields]
+    sections = ["FFQ", "LFQ", "GCF", "GCL", "GCC", "RL", "COV", "GCD", "ID", "IC"]
+    for i in range(num_lines):
+        section = sections[i % len(sections)]
+        lines.append(f"{section}\t{i}\t" + "\t".join(str(rng.randint(0, 1000)) for _ in range(8)))
+    return "\n".join(lines) + "\n"
+
+
+def create_fake_tool(workflow_env, name: str, script: str):
+    """Replaces a fake tool by a script that logs the job IDs (-j) of each call"""
+
+    calls = workflow_env["root"] / f"{name}_calls"
+    tool = workflow_env["bin"] / name
+    tool.write_text(f"""#!/bin/bash
+while [ "$1" != "-j" ]; do shift; done
+JOB_IDS="$2"
+echo "$JOB_IDS" >> {calls}
+{script}
+""")
+    tool.chmod(0o755)
+    return calls
+
+
+def create_project_folder(folder: Path, num_samples: int) -> Dict[str, List[str]]:
+    """Creates a project folder with num_samples stub unaligned BAMs, spread evenly over the
+    workflow states. Returns the file names per state.
+    """
+
+    (folder / "qc").mkdir(parents=True, exist_ok=True)
+    samples: Dict[str, List[str]] = {state: [] for state in SAMPLE_STATES}
+    marker = json.dumps({"job_id": "1", "attempt": 1, "time": "0-06:00:00", "memory": "48G"})
+    for i in range(num_samples):
+        state = SAMPLE_STATES[i % len(SAMPLE_STATES)]
+        name = f"m{i:06d}"
+        samples[state].append(f"{name}.bam")
+
+        def touch(extension: str, content: str = ""):
+            (folder / f"{name}.{extension}").write_text(content)
+
+        touch("bam", "x" * (1024 + i))
+        if state == "pending":
+            continue
+        if state == "complete":
+            (folder / "qc" / f"{name}.aligned_sorted.qc").write_text("a\tb\n1\t2\n")
+            continue
+        touch("alignment_running", marker)
+        if state == "alignment_running":
+            continue
+        touch("aligned_sorted.bam", "x" * (1024 + i))
+        touch("align_slurm_out")
+        if state == "alignment_complete":
+            continue
+        touch("aligned_sorted.checks_complete")
+        if state == "checks_complete":
+            continue
+        touch("aligned_sorted.qc_running", marker)
+        touch("aligned_sorted.qc_slurm_out")
+        if state == "qc_running":
+            continue
+        touch("aligned_sorted.stats.txt", "SN\traw total sequences:\t10\nSN\treads mapped:\t9\n")
+        # Record count of the stub unaligned BAM, which the read counts are reconciled with
+        bam_stat = os.stat(folder / f"{name}.bam")
+        touch("record_count", json.dumps({"size": bam_stat.st_size, "mtime": bam_stat.st_mtime, "records": 10}))
+    return samples
@@ -0,0 +1,229 @@
+########################################################################
+#
+#   Authors:
+#       William Feng
+#       Harvard Medical School
+#       william_feng@gmail.com
+#
+#       Alexander Veit
+#       Harvard Medical School
+#       alexander_veit@hms.harvard.edu
+#
+#   Tests of the built-in BAM metrics engine, with small BAMs that are
+#       written by the tests.
+#
+########################################################################
+
+import os
+import random
+import struct
+import zlib
+
+import pytest
+
+from src.bam_stats_utils import (
+    BGZF_EOF,
+    BAM_MAGIC,
+    PBI_HEADER,
+    PBI_MAGIC,
+    FLAG_UNMAPPED,
+    FLAG_SECONDARY,
+    FLAG_QC_FAILED,
+    FLAG_SUPPLEMENTARY,
+    CIGAR_SOFT_CLIP,
+    count_primary_records,
+    get_bam_stats,
+    get_record_count,
+    quickcheck,
+    read_pbi_record_count,
+)
+from src.constants import SAMTOOLS_STATS
+
+REFERENCES = [(b"chr1", 10**6), (b"chr2", 10**6)]
+CIGAR_MATCH = 0
+
+
+def compress_block(data: bytes) -> bytes:
+    """One BGZF block with the given uncompressed data"""
+
+    compressor = zlib.compressobj(6, zlib.DEFLATED, -15)
+    compressed = compressor.compress(data) + compressor.flush()
+    header = struct.pack("<4sIBBHBBHH", b"\x1f\x8b\x08\x04", 0, 0, 0xFF, 6, 66, 67, 2, len(compressed) + 25)
+    return header + compressed + struct.pack("<II", zlib.crc32(data), len(data))
+
+
+def encode_record(name: str, flag: int, l_seq: int, mapq: int, soft_clip: int, mismatches: int) -> bytes:
+    read_name = name.encode() + b"\x00"
+    if flag & FLAG_UNMAPPED:
+        ref_id, pos, cigar = -1, -1, []
+    else:
+        ref_id, pos = 0, 100
+        cigar = [soft_clip << 4 | CIGAR_SOFT_CLIP] if soft_clip else []
+        cigar.append((l_seq - soft_clip) << 4 | CIGAR_MATCH)
+    rng = random.Random(name)
+    sequence = bytes(rng.getrandbits(8) for _ in range((l_seq + 1) // 2))
+    qualities = bytes(rng.randint(0, 60) for _ in range(l_seq))
+    aux = b"NMi" + struct.pack("<i", mismatches) + b"RGZmovie\x00"
+    body = struct.pack(
+        "<iiBBHHHiiii", ref_id, pos, len(read_name), mapq, 4680, len(cigar), flag, l_seq, -1, -1, 0
+    )
+    body += read_name + b"".join(struct.pack("<I", op) for op in cigar) + sequence + qualities + aux
+    return struct.pack("<i", len(body)) + body
+
+
+def write_bam(path, records, block_size: int = 997, eof: bool = True) -> bytes:
+    """Writes a BAM whose uncompressed data is split into blocks of block_size bytes, so that
+    records cross block boundaries. Returns the uncompressed data.
+    """
+
+    text = b"@HD\tVN:1.6\tSO:unknown\n"
+    header = BAM_MAGIC + struct.pack("<i", len(text)) + text + struct.pack("<i", len(REFERENCES))
+    for name, length in REFERENCES:
+        header += struct.pack("<i", len(name) + 1) + name + b"\x00" + struct.pack("<i", length)
+    data = header + b"".join(encode_record(**record) for record in records)
+    blocks = [compress_block(data[i:i + block_size]) for i in range(0, len(data), block_size)]
+    with open(path, "wb") as bam_file:
+        bam_file.write(b"".join(blocks) + (BGZF_EOF if eof else b""))
+    return data
+
+
+def get_records(num_records: int, seed: int = 0):
+    rng = random.Random(seed)
+    flags = [0, 0, 0, FLAG_UNMAPPED, FLAG_SECONDARY, FLAG_SUPPLEMENTARY, FLAG_QC_FAILED, 16]
+    return [
+        {
+            "name": f"m64011_190830_220126/{i}/ccs",
+            "flag": flags[i % len(flags)],
+            "l_seq": rng.randint(50, 400),
+            "mapq": 0 if i % 11 == 0 else 60,
+            "soft_clip": rng.choice([0, 0, 5, 20]),
+            "mismatches": rng.randint(0, 5),
+        }
+        for i in range(num_records)
+    ]
+
+
+def get_expected_stats(records) -> dict:
+    """Metrics of the records by hand, following the samtools stats definitions"""
+
+    primary = [r for r in records if not r["flag"] & (FLAG_SECONDARY | FLAG_SUPPLEMENTARY)]
+    mapped = [r for r in primary if not r["flag"] & FLAG_UNMAPPED]
+    bases_mapped_cigar = sum(r["l_seq"] - r["soft_clip"] for r in mapped)
+    mismatches = sum(r["mismatches"] for r in mapped)
+    total_length = sum(r["l_seq"] for r in primary)
+    values = {
+        "raw total sequences": len(primary),
+        "reads mapped": len(mapped),
+        "reads unmapped": len(primary) - len(mapped),
+        "reads MQ0": sum(1 for r in mapped if r["mapq"] == 0),
+        "reads QC failed": sum(1 for r in primary if r["flag"] & FLAG_QC_FAILED),
+        "non-primary alignments": sum(1 for r in records if r["flag"] & FLAG_SECONDARY),
+        "supplementary alignments": sum(1 for r in records if r["flag"] & FLAG_SUPPLEMENTARY),
+        "total length": total_length,
+        "bases mapped": sum(r["l_seq"] for r in mapped),
+        "bases mapped (cigar)": bases_mapped_cigar,
+        "mismatches": mismatches,
+        "maximum length": max(r["l_seq"] for r in primary),
+        "sequences": len(primary),
+        "filtered sequences": 0,
+        "average length": round(total_length / len(primary)),
+        "error rate": f"{mismatches / bases_mapped_cigar:e}",
+    }
+    return {f"{SAMTOOLS_STATS}: {name}": str(value) for name, value in values.items()}
+
+
+@pytest.fixture
+def bam(tmp_path):
+    records = get_records(400)
+    path = tmp_path / "movie.bam"
+    write_bam(path, records)
+    return str(path), records
+
+
+@pytest.mark.parametrize("workers", [1, 2, 3, 8])
+def test_get_bam_stats_exact(bam, workers):
+    path, records = bam
+
+    assert get_bam_stats(path, fraction=1.0, workers=workers) == get_expected_stats(records)
+
+
+@pytest.mark.parametrize("workers", [1, 3])
+def test_count_primary_records(bam, workers):
+    path, records = bam
+
+    assert count_primary_records(path, workers=workers) == int(
+        get_expected_stats(records)[f"{SAMTOOLS_STATS}: raw total sequences"]
+    )
+
+
+def test_records_larger_than_a_block(tmp_path):
+    # Each record spans several blocks, and ranges start in the middle of records
+    records = get_records(40)
+    for record in records:
+        record["l_seq"] = 3000
+    path = tmp_path / "long_reads.bam"
+    write_bam(path, records, block_size=500)
+
+    for workers in [1, 4]:
+        assert get_bam_stats(str(path), workers=workers) == get_expected_stats(records)
+
+
+def test_truncated_bam(tmp_path):
+    path = tmp_path / "truncated.bam"
+    data = write_bam(path, get_records(100), block_size=100000)
+    # The single data block is cut within the last record
+    (tmp_path / "truncated.bam").write_bytes(compress_block(data[:-10]))
+
+    with pytest.raises(Exception, match="is truncated"):
+        get_bam_stats(str(path), workers=1)
+
+
+def test_quickcheck(bam, tmp_path):
+    path, records = bam
+    quickcheck(path)
+
+    without_eof = tmp_path / "without_eof.bam"
+    write_bam(without_eof, records, eof=False)
+    with pytest.raises(Exception, match="missing the BGZF end-of-file marker"):
+        quickcheck(str(without_eof))
+
+    not_a_bam = tmp_path / "not_a_bam.bam"
+    not_a_bam.write_bytes(compress_block(b"not a BAM") + BGZF_EOF)
+    with pytest.raises(Exception, match="is not a BAM file"):
+        quickcheck(str(not_a_bam))
+
+
+def write_pbi(path, num_reads: int):
+    header = PBI_HEADER.pack(PBI_MAGIC, 0x040000, 0, num_reads) + b"\x00" * 18
+    with open(path, "wb") as pbi_file:
+        pbi_file.write(compress_block(header) + BGZF_EOF)
+
+
+def test_read_pbi_record_count(tmp_path):
+    write_pbi(tmp_path / "movie.bam.pbi", 123456)
+
+    assert read_pbi_record_count(str(tmp_path / "movie.bam.pbi")) == 123456
+
+    (tmp_path / "invalid.pbi").write_bytes(compress_block(b"BAI\x01" + b"\x00" * 32))
+    with pytest.raises(Exception, match="is not a PacBio BAM index"):
+        read_pbi_record_count(str(tmp_path / "invalid.pbi"))
+
+
+def test_get_record_count_sources(bam):
+    path, records = bam
+    num_primary = int(get_expected_stats(records)[f"{SAMTOOLS_STATS}: raw total sequences"])
+
+    assert get_record_count(path, compute=False) is None
+    assert get_record_count(path, workers=2) == (num_primary, "bgzf")
+    assert get_record_count(path, compute=False) == (num_primary, "sidecar")
+
+    # An index that is not older than the BAM takes precedence
+    write_pbi(f"{path}.pbi", 42)
+    assert get_record_count(path) == (42, "pbi")
+    bam_mtime = os.stat(path).st_mtime
+    os.utime(f"{path}.pbi", (bam_mtime - 10, bam_mtime - 10))
+    assert get_record_count(path) == (num_primary, "sidecar")
+
+    # The sidecar is outdated once the BAM changes
+    os.utime(path, (bam_mtime + 10, bam_mtime + 10))
+    assert get_record_count(path, compute=False) is None
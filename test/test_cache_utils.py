@@ -0,0 +1,135 @@
+########################################################################
+#
+#   Authors:
+#       William Feng
+#       Harvard Medical School
+#       william_feng@gmail.com
+#
+#       Alexander Veit
+#       Harvard Medical School
+#       alexander_veit@hms.harvard.edu
+#
+#   Tests of the alignment cache and its interaction with the workflow.
+#
+########################################################################
+
+import json
+from pathlib import Path
+
+import pytest
+
+from fakes import create_project_folder
+from src.cache_utils import add_to_cache, get_cache_entry_dir
+from src.config_utils import load_config
+from src.Pbmm2Workflow import (
+    Pbmm2Workflow,
+    ACTION_PARSE_QC,
+    ACTION_RESTORE_FROM_CACHE,
+    ACTION_SUBMIT_ALIGNMENT,
+    ACTION_VERIFY_CRAM,
+    EXT_ALIGNED_SORTED,
+    EXT_CRAM,
+    EXT_CRAM_INDEXED,
+    EXT_CRAM_RECORD_COUNT,
+    EXT_CRAM_RUNNING,
+    EXT_QC,
+    QC_METRIC_PRIMARY_RECORDS,
+    STATE_QC_COMPLETE,
+    STATE_WORKFLOW_COMPLETE,
+)
+
+
+def update_config(workflow_env, **sections):
+    config = json.loads(workflow_env["config"].read_text())
+    config.update(sections)
+    workflow_env["config"].write_text(json.dumps(config))
+
+
+@pytest.fixture
+def cache_env(workflow_env, tmp_path):
+    (workflow_env["root"] / "reference.fa").write_text(">chr1\nACGT\n")
+    update_config(workflow_env, cache_config={"cache_dir": str(tmp_path / "cache")})
+    return workflow_env
+
+
+def add_cached_alignment(folder, file_name: str):
+    """Adds a cache entry for an unaligned BAM, as if it had been aligned in another folder"""
+
+    workflow = Pbmm2Workflow(str(folder), check_requirements=False)
+    sources = {}
+    for name, path in workflow.get_alignment_cache_files(file_name).items():
+        source = folder / f"cached.{name}"
+        source.write_text(name)
+        sources[name] = str(source)
+    add_to_cache(load_config().cache_config, workflow.get_alignment_cache_key(file_name), sources, file_name)
+    for source in sources.values():
+        Path(source).unlink()
+
+
+def test_cache_hits_are_not_planned(cache_env, tmp_path):
+    update_config(cache_env, scheduling_config={"max_in_flight_alignment": 1})
+    folder = tmp_path / "project"
+    folder.mkdir()
+    for i in range(3):
+        (folder / f"m{i}.bam").write_text("x" * (1000 * (i + 1)))
+    # The two largest files are cache hits, they must not take the only alignment slot
+    add_cached_alignment(folder, "m1.bam")
+    add_cached_alignment(folder, "m2.bam")
+
+    workflow = Pbmm2Workflow(str(folder), check_requirements=False)
+    states = {file_name: workflow.get_state(file_name) for file_name in workflow.get_unaligned_bams()}
+    jobs = workflow.plan_submissions(states)
+    assert [(job.file_name, job.held_back) for job in jobs] == [("m0.bam", False)]
+
+    results = {result.file: result.action for result in workflow.resume_workflow_all()}
+    assert results == {
+        f"{folder}/m0.bam": ACTION_SUBMIT_ALIGNMENT,
+        f"{folder}/m1.bam": ACTION_RESTORE_FROM_CACHE,
+        f"{folder}/m2.bam": ACTION_RESTORE_FROM_CACHE,
+    }
+    assert (folder / f"m1.{EXT_ALIGNED_SORTED}").read_text() == EXT_ALIGNED_SORTED
+
+
+def test_cram_is_cached_instead_of_aligned_bam(cache_env, tmp_path):
+    update_config(cache_env, cram_config={"enabled": True})
+    folder = tmp_path / "project"
+    (folder / "qc").mkdir(parents=True)
+    (folder / "m0.bam").write_text("x" * 1000)
+    (folder / "qc" / f"m0.{EXT_QC}").write_text(f"{QC_METRIC_PRIMARY_RECORDS}\n10\n")
+    for extension, content in [
+        (EXT_ALIGNED_SORTED, "bam"),
+        (EXT_CRAM, "cram"),
+        (EXT_CRAM_INDEXED, "crai"),
+        (EXT_CRAM_RECORD_COUNT, "10"),
+        (EXT_CRAM_RUNNING, json.dumps({"job_id": "1"})),
+    ]:
+        (folder / f"m0.{extension}").write_text(content)
+
+    workflow = Pbmm2Workflow(str(folder), check_requirements=False)
+    assert workflow.resume_workflow_single("m0.bam") == ACTION_VERIFY_CRAM
+    entry_dir = Path(get_cache_entry_dir(load_config().cache_config, workflow.get_alignment_cache_key("m0.bam")))
+    assert sorted(path.name for path in entry_dir.iterdir()) == sorted(["entry.json", EXT_CRAM, EXT_CRAM_INDEXED, EXT_QC])
+
+    # The same movie in another folder is restored as a verified CRAM
+    other_folder = tmp_path / "other_project"
+    other_folder.mkdir()
+    (other_folder / "m0.bam").write_text("x" * 1000)
+    other_workflow = Pbmm2Workflow(str(other_folder), check_requirements=False)
+    assert other_workflow.resume_workflow_single("m0.bam") == ACTION_RESTORE_FROM_CACHE
+    assert other_workflow.get_state("m0.bam") == STATE_WORKFLOW_COMPLETE
+    assert not (other_folder / f"m0.{EXT_ALIGNED_SORTED}").exists()
+
+
+@pytest.mark.parametrize("merge", [False, True])
+def test_movies_of_merged_samples_are_not_cached(cache_env, tmp_path, merge):
+    if merge:
+        update_config(cache_env, merge_config={"enabled": True, "sample_pattern": r"^(m)\d+"})
+    folder = tmp_path / "project"
+    samples = create_project_folder(folder, 7)
+    file_name = samples[STATE_QC_COMPLETE][0]
+    workflow = Pbmm2Workflow(str(folder), check_requirements=False)
+
+    assert workflow.run_next_step(file_name) == ACTION_PARSE_QC
+
+    # The aligned movie BAM is removed after the merge, the cache must not keep it
+    assert workflow.is_alignment_cached(file_name) != merge
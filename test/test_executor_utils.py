@@ -0,0 +1,120 @@
+########################################################################
+#
+#   Authors:
+#       William Feng
+#       Harvard Medical School
+#       william_feng@gmail.com
+#
+#       Alexander Veit
+#       Harvard Medical School
+#       alexander_veit@hms.harvard.edu
+#
+#   Tests of the local executor and the states of local jobs.
+#
+########################################################################
+
+import os
+
+from src.config_utils import load_config
+from src.executor_utils import (
+    LocalExecutor,
+    LOCAL_FAILURE_STATE,
+    get_executor,
+    get_local_job_state,
+    is_local_job_id,
+)
+from src.slurm_utils import JobSubmission, JobMarker, read_job_marker
+from src.Pbmm2Workflow import (
+    Pbmm2Workflow,
+    EXT_ALIGNMENT_RUNNING,
+    EXT_ALIGNMENT_SLURM_OUT,
+    STATE_ALIGNMENT_FAILED,
+    STATE_ALIGNMENT_RUNNING,
+)
+
+
+def get_submission(folder, command: str, name: str = "m0") -> JobSubmission:
+    return JobSubmission(
+        job_name=f"job_{name}",
+        input_path=str(folder / f"{name}.bam"),
+        command=command,
+        slurm_out=str(folder / f"{name}.{EXT_ALIGNMENT_SLURM_OUT}"),
+        time="0-01:00:00",
+        memory="1G",
+        threads=1,
+        mail_user="",
+        marker_path=str(folder / f"{name}.{EXT_ALIGNMENT_RUNNING}"),
+    )
+
+
+def test_local_executor_records_exit_code(workflow_env, tmp_path):
+    executor = LocalExecutor(load_config())
+    succeeded, failed = executor.submit(
+        [get_submission(tmp_path, "echo done", "m0"), get_submission(tmp_path, "echo failed; exit 3", "m1")]
+    )
+
+    assert is_local_job_id(succeeded.job_id) and succeeded.exit_code == 0
+    assert is_local_job_id(failed.job_id) and failed.exit_code == 3
+    assert (tmp_path / f"m1.{EXT_ALIGNMENT_SLURM_OUT}").read_text() == "failed\n"
+    assert JobMarker.from_submission(failed).exit_code == 3
+
+
+def test_local_executor_pins_cpus(workflow_env, tmp_path):
+    executor = LocalExecutor(load_config())
+    cpus = executor.get_cpu_slots()[0]
+    command = "python -c 'import os; print(sorted(os.sched_getaffinity(0)))'"
+    executor.submit([get_submission(tmp_path, command)])
+
+    assert (tmp_path / f"m0.{EXT_ALIGNMENT_SLURM_OUT}").read_text() == f"{sorted(cpus)}\n"
+
+
+def test_get_local_job_state():
+    assert get_local_job_state(None) is None
+    assert get_local_job_state(0) is None
+    assert get_local_job_state(1) == LOCAL_FAILURE_STATE
+    # Killed by a signal
+    assert get_local_job_state(-9) == LOCAL_FAILURE_STATE
+
+
+def test_failed_local_job_is_not_running_forever(workflow_env, tmp_path):
+    (tmp_path / "m0.bam").write_text("x")
+    (tmp_path / "m1.bam").write_text("x")
+    workflow = Pbmm2Workflow(str(tmp_path), executor_name="local", check_requirements=False)
+    workflow.submit_job(get_submission(tmp_path, "exit 1", "m0"))
+    # Markers written before exit codes were stored
+    (tmp_path / f"m1.{EXT_ALIGNMENT_RUNNING}").write_text(JobMarker(job_id="local-1").model_dump_json())
+
+    assert read_job_marker(str(tmp_path / f"m0.{EXT_ALIGNMENT_RUNNING}")).exit_code == 1
+    assert workflow.get_state("m0") == STATE_ALIGNMENT_FAILED
+    assert workflow.get_failed_job_state("m0", EXT_ALIGNMENT_RUNNING) == LOCAL_FAILURE_STATE
+    assert workflow.get_state("m1") == STATE_ALIGNMENT_RUNNING
+    assert os.path.isfile(tmp_path / f"m0.{EXT_ALIGNMENT_SLURM_OUT}")
+
+
+def test_advance_shares_one_executor(workflow_env, tmp_path, monkeypatch):
+    executors = []
+
+    def counted_get_executor(config, executor_name=None):
+        executors.append(get_executor(config, executor_name))
+        return executors[-1]
+
+    monkeypatch.setattr("src.Pbmm2Workflow.get_executor", counted_get_executor)
+    used_executors = []
+    resume_workflow_batch = Pbmm2Workflow.resume_workflow_batch
+
+    def record_executor(self, *args, **kwargs):
+        used_executors.append(self.executor)
+        return resume_workflow_batch(self, *args, **kwargs)
+
+    monkeypatch.setattr(Pbmm2Workflow, "resume_workflow_batch", record_executor)
+    folders = [tmp_path / f"project_{i}" for i in range(3)]
+    for folder in folders:
+        folder.mkdir()
+        (folder / "m0.bam").write_text("x")
+
+    results = Pbmm2Workflow.advance([str(folder) for folder in folders], workers=3)
+
+    assert [result.error for result in results] == [None] * 3
+    assert all(result.job_id for result in results)
+    assert len(executors) == 1
+    assert used_executors == executors * 3
@@ -0,0 +1,65 @@
+########################################################################
+#
+#   Authors:
+#       William Feng
+#       Harvard Medical School
+#       william_feng@gmail.com
+#
+#       Alexander Veit
+#       Harvard Medical School
+#       alexander_veit@hms.harvard.edu
+#
+#   Tests of the file locks of batch runs and bulk resets.
+#
+########################################################################
+
+import resource
+
+import pytest
+
+from fakes import create_project_folder
+from src.Pbmm2Workflow import Pbmm2Workflow, MAX_HELD_LOCKS, EXT_LOCK
+from src.reset_utils import get_reset_plan, run_reset, RESET_LOCK_BATCH_SIZE
+
+# Soft limit of open file descriptors during the tests, below the number of samples
+FD_LIMIT = 2 * max(MAX_HELD_LOCKS, RESET_LOCK_BATCH_SIZE)
+NUM_SAMPLES = 2 * FD_LIMIT
+
+
+@pytest.fixture
+def fd_limit():
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if hard != resource.RLIM_INFINITY and hard < FD_LIMIT:
+        pytest.skip(f"The hard limit of open files ({hard}) is below {FD_LIMIT}.")
+    resource.setrlimit(resource.RLIMIT_NOFILE, (FD_LIMIT, hard))
+    yield FD_LIMIT
+    resource.setrlimit(resource.RLIMIT_NOFILE, (soft, hard))
+
+
+def test_resume_workflow_all_more_samples_than_fd_limit(workflow_env, tmp_path, fd_limit):
+    folder = tmp_path / "project"
+    samples = create_project_folder(folder, NUM_SAMPLES)
+
+    results = Pbmm2Workflow(str(folder), check_requirements=False).resume_workflow_all()
+
+    assert len(results) == NUM_SAMPLES
+    assert [result for result in results if result.error] == []
+    # All jobs of the pending samples were submitted
+    assert all(result.job_id for result in results if result.file.endswith(tuple(samples["pending"])))
+    assert list(folder.glob(f"*.{EXT_LOCK}")) == []
+
+
+def test_run_reset_more_samples_than_fd_limit(workflow_env, tmp_path, fd_limit):
+    folder = tmp_path / "project"
+    samples = create_project_folder(folder, NUM_SAMPLES)
+
+    plan = get_reset_plan(str(folder), "alignment")
+    run_reset(plan)
+
+    # Only the unaligned BAMs are left of the samples whose workflow is not complete
+    for file_name in plan.get_file_names():
+        assert (folder / file_name).is_file()
+        assert not (folder / file_name.replace(".bam", ".alignment_running")).exists()
+        assert not (folder / file_name.replace(".bam", ".aligned_sorted.bam")).exists()
+    assert len(plan.get_file_names()) == NUM_SAMPLES - len(samples["pending"]) - len(samples["complete"])
+    assert list(folder.glob(f"*.{EXT_LOCK}")) == []
@@ -0,0 +1,116 @@
+########################################################################
+#
+#   Authors:
+#       William Feng
+#       Harvard Medical School
+#       william_feng@gmail.com
+#
+#       Alexander Veit
+#       Harvard Medical School
+#       alexander_veit@hms.harvard.edu
+#
+#   Tests of the Prometheus metrics export and its saved log state.
+#
+########################################################################
+
+import os
+
+import pytest
+
+from src.config_utils import load_config
+from src.metrics_utils import MetricsExporter, get_metrics_state_path
+
+
+def get_log_lines(folder, sample: str, job_id: str, failed: bool = False):
+    lines = [
+        ("00:00:00", f"Submitting job to run pbmm2 on {folder}/{sample}.bam. time=0-06:00:00, mem=48G, threads=32"),
+        ("00:00:01", f"Submitted slurm job {job_id} (o2p_align_pbmm2). Signal file: {folder}/{sample}.alignment_running"),
+    ]
+    if failed:
+        lines.append(("01:00:00", f"The alignment job {job_id} for file {sample}.bam failed with state OUT_OF_MEMORY"))
+    else:
+        lines.append(("01:00:00", f"Running checks on {folder}/{sample}.bam."))
+    return "".join(f"2026-01-01, {time} UTC\t{message}\n" for time, message in lines)
+
+
+def get_metric(metrics: str, name: str) -> float:
+    values = [line.rsplit(" ", 1)[1] for line in metrics.splitlines() if line.startswith(name + " ") or line.startswith(name + "{")]
+    assert len(values) == 1, name
+    return float(values[0])
+
+
+@pytest.fixture
+def metrics_env(workflow_env, tmp_path, monkeypatch):
+    # The status snapshots and the metrics state are saved in the default cache dir
+    monkeypatch.setenv("HOME", str(tmp_path / "home"))
+    folder = tmp_path / "project"
+    folder.mkdir()
+    (folder / "s0.bam").write_text("x")
+    return {**workflow_env, "folder": folder, "textfile": tmp_path / "o2p.prom"}
+
+
+def export(metrics_env) -> str:
+    config = load_config()
+    exporter = MetricsExporter(config, [str(metrics_env["folder"])], state_path=get_metrics_state_path(config))
+    exporter.export(str(metrics_env["textfile"]))
+    return metrics_env["textfile"].read_text()
+
+
+def test_export_continues_from_saved_state(metrics_env, monkeypatch):
+    folder, log = metrics_env["folder"], metrics_env["log"]
+    submitted = f'o2p_jobs_submitted_total{{folder="{folder}",step="alignment"}}'
+    failed = f'o2p_jobs_failed_total{{folder="{folder}",step="alignment",state="OUT_OF_MEMORY"}}'
+    turnaround = f'o2p_step_turnaround_seconds_count{{folder="{folder}",step="alignment"}}'
+    log.write_text(get_log_lines(folder, "s0", "100"))
+
+    metrics = export(metrics_env)
+    assert get_metric(metrics, submitted) == 1
+    assert get_metric(metrics, turnaround) == 1
+    assert os.path.isfile(get_metrics_state_path(load_config()))
+
+    with open(log, "a") as log_file:
+        log_file.write(get_log_lines(folder, "s1", "101", failed=True))
+    add_log_entry = MetricsExporter.add_log_entry
+    messages = []
+
+    def record_entry(self, time, message):
+        messages.append(message)
+        return add_log_entry(self, time, message)
+
+    monkeypatch.setattr(MetricsExporter, "add_log_entry", record_entry)
+    metrics = export(metrics_env)
+
+    # Only the new entries were read, the counters of the previous run were kept
+    assert len(messages) == 3 and all("s1" in message for message in messages)
+    assert get_metric(metrics, submitted) == 2
+    assert get_metric(metrics, failed) == 1
+    assert get_metric(metrics, turnaround) == 1
+
+
+def test_rotated_log_is_read_from_the_start(metrics_env):
+    folder, log = metrics_env["folder"], metrics_env["log"]
+    submitted = f'o2p_jobs_submitted_total{{folder="{folder}",step="alignment"}}'
+    log.write_text(get_log_lines(folder, "s0", "100"))
+    assert get_metric(export(metrics_env), submitted) == 1
+
+    # A new log that is already longer than the previous one. Its entries up to the saved offset
+    # don't count any jobs
+    rotated = log.with_name("rotated.log")
+    filler = "2026-01-02, 00:00:00 UTC\tStarting the workflow."
+    filler += "." * (log.stat().st_size - len(filler) - 1) + "\n"
+    rotated.write_text(filler + get_log_lines(folder, "s1", "101"))
+    os.replace(rotated, log)
+
+    assert get_metric(export(metrics_env), submitted) == 1
+
+
+def test_invalid_state_is_ignored(metrics_env):
+    folder, log = metrics_env["folder"], metrics_env["log"]
+    submitted = f'o2p_jobs_submitted_total{{folder="{folder}",step="alignment"}}'
+    log.write_text(get_log_lines(folder, "s0", "100"))
+    state_path = get_metrics_state_path(load_config())
+    os.makedirs(os.path.dirname(state_path))
+    with open(state_path, "w") as state_file:
+        state_file.write("{")
+
+    assert get_metric(export(metrics_env), submitted) == 1
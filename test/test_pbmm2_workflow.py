@@ -0,0 +1,428 @@
+########################################################################
+#
+#   Authors:
+#       William Feng
+#       Harvard Medical School
+#       william_feng@gmail.com
+#
+#       Alexander Veit
+#       Harvard Medical School
+#       alexander_veit@hms.harvard.edu
+#
+#   Tests of single steps of the pbmm2 workflow.
+#
+########################################################################
+
+import json
+import os
+
+import pytest
+from pydantic import ValidationError
+
+from fakes import create_fake_tool, create_project_folder, update_config
+from src.config_utils import Config
+from src.constants import SAMTOOLS_STATS
+from src.lock_utils import SampleLock
+from src.qc_utils import create_summary_qc_file, store_qc_metrics
+from src.reset_utils import get_reset_plan, run_reset
+from src.slurm_utils import JobMarker, TOOL_FAILURE_STATES, read_job_marker
+from src.Pbmm2Workflow import (
+    Pbmm2Workflow,
+    ACTION_HOLD_BACK,
+    ACTION_NOT_RETRIED,
+    ACTION_RETRY,
+    ACTION_SUBMIT_ALIGNMENT,
+    ACTION_SUBMIT_CRAM,
+    ACTION_VERIFY_CRAM,
+    ACTION_VERIFY_MERGE,
+    ACTION_WAIT,
+    EXT_ALIGNMENT_RUNNING,
+    EXT_ALIGNED_SORTED,
+    EXT_ALIGNED_SORTED_INDEXED,
+    EXT_CRAM,
+    EXT_CRAM_INDEXED,
+    EXT_CRAM_RECORD_COUNT,
+    EXT_CRAM_RUNNING,
+    EXT_LOCK,
+    EXT_MERGED,
+    EXT_MERGED_INDEXED,
+    EXT_MERGE_RECORD_COUNT,
+    EXT_MERGE_RUNNING,
+    EXT_QC,
+    QC_METRIC_PRIMARY_RECORDS,
+    STATE_ALIGNMENT_FAILED,
+    STATE_CRAM_COMPLETE,
+    STATE_CRAM_FAILED,
+    STATE_CRAM_RUNNING,
+    STATE_MERGE_COMPLETE,
+    STATE_QC_COMPLETE,
+    STATE_QC_PARSED,
+    STATE_WORKFLOW_COMPLETE,
+    STEP_ALIGNMENT,
+)
+
+
+@pytest.fixture
+def qc_complete_file(workflow_env, tmp_path):
+    """File name of a sample whose QC job is complete, with read count reconciliation enabled.
+    The aligned BAM has 10 primary records.
+    """
+
+    update_config(workflow_env["config"], qc_config={"reconcile_read_counts": True})
+    folder = tmp_path / "project"
+    samples = create_project_folder(folder, 7)
+    file_name = samples[STATE_QC_COMPLETE][0]
+    return folder, file_name
+
+
+def write_record_count(folder, file_name: str, records: int):
+    bam_stat = os.stat(folder / file_name)
+    (folder / file_name.replace(".bam", ".record_count")).write_text(
+        json.dumps({"size": bam_stat.st_size, "mtime": bam_stat.st_mtime, "records": records})
+    )
+
+
+def test_qc_is_parsed_if_read_counts_match(qc_complete_file):
+    folder, file_name = qc_complete_file
+    Pbmm2Workflow(str(folder), check_requirements=False).run_next_step(file_name)
+
+    assert (folder / "qc" / file_name.replace(".bam", f".{EXT_QC}")).is_file()
+
+
+def test_qc_is_blocked_if_read_counts_differ(qc_complete_file):
+    folder, file_name = qc_complete_file
+    write_record_count(folder, file_name, 11)
+
+    with pytest.raises(Exception, match="Read count reconciliation failed"):
+        Pbmm2Workflow(str(folder), check_requirements=False).run_next_step(file_name)
+    assert not (folder / "qc" / file_name.replace(".bam", f".{EXT_QC}")).exists()
+
+
+def test_reconciliation_is_skipped_without_record_count(qc_complete_file, workflow_env):
+    folder, file_name = qc_complete_file
+    os.remove(folder / file_name.replace(".bam", ".record_count"))
+
+    Pbmm2Workflow(str(folder), check_requirements=False).run_next_step(file_name)
+
+    # The unaligned BAM (a stub, not a BGZF file) was not read
+    assert (folder / "qc" / file_name.replace(".bam", f".{EXT_QC}")).is_file()
+    assert not (folder / file_name.replace(".bam", ".record_count")).exists()
+    assert "Skipping the read count reconciliation" in workflow_env["log"].read_text()
+
+
+def test_reset_qc_removes_parsed_qc_file(workflow_env, tmp_path):
+    folder = tmp_path / "project"
+    samples = create_project_folder(folder, 7)
+    file_name = samples["complete"][0]
+    workflow = Pbmm2Workflow(str(folder), check_requirements=False)
+    qc_file = workflow.get_qc_file(file_name)
+
+    assert qc_file in workflow.get_reset_files(file_name, "qc")
+    workflow.reset_qc(file_name)
+    assert not os.path.exists(qc_file)
+
+
+@pytest.fixture
+def merged_sample(workflow_env, tmp_path):
+    """Sample HG002 with two movies whose merge job is complete. The merged BAM has the
+    300 records of the movies.
+    """
+
+    update_config(workflow_env["config"], merge_config={"enabled": True, "sample_pattern": r"^(.+?)_m\d+"})
+    folder = tmp_path / "project"
+    (folder / "qc").mkdir(parents=True)
+    movies = ["HG002_m0.bam", "HG002_m1.bam"]
+    for i, movie in enumerate(movies):
+        name = movie.replace(".bam", "")
+        for extension in ["bam", EXT_ALIGNED_SORTED, EXT_ALIGNED_SORTED_INDEXED]:
+            (folder / f"{name}.{extension}").write_text("x")
+        store_qc_metrics(
+            {
+                f"{SAMTOOLS_STATS}: raw total sequences": str(100 * (i + 1)),
+                f"{SAMTOOLS_STATS}: non-primary alignments": "0",
+                f"{SAMTOOLS_STATS}: supplementary alignments": "0",
+            },
+            str(folder / "qc" / f"{name}.{EXT_QC}"),
+        )
+    for extension in [EXT_MERGED, EXT_MERGED_INDEXED]:
+        (folder / f"HG002.{extension}").write_text("x")
+    (folder / f"HG002.{EXT_MERGE_RECORD_COUNT}").write_text("300\n")
+    (folder / f"HG002.{EXT_MERGE_RUNNING}").write_text(JobMarker(job_id="100").model_dump_json())
+    return folder, movies
+
+
+def test_merged_qc_is_kept_apart_from_movie_qc(merged_sample, tmp_path):
+    folder, movies = merged_sample
+    workflow = Pbmm2Workflow(str(folder), check_requirements=False)
+
+    assert workflow.get_state(movies[0]) == STATE_MERGE_COMPLETE
+    assert workflow.run_next_step(movies[0]) == ACTION_VERIFY_MERGE
+
+    assert not (folder / f"HG002_m0.{EXT_ALIGNED_SORTED}").exists()
+    assert (folder / "qc_merged" / "HG002.merged.aligned_sorted.qc").is_file()
+    # The summary of the qc folder only has the movies
+    summary = tmp_path / "summary.qc"
+    create_summary_qc_file(str(folder / "qc"), str(summary))
+    rows = [line.split("\t")[0] for line in summary.read_text().splitlines()[1:]]
+    assert rows == [f"HG002_m0.{EXT_QC}", f"HG002_m1.{EXT_QC}"]
+    assert Pbmm2Workflow(str(folder), check_requirements=False).is_workflow_complete(movies[1])
+
+
+def test_reset_of_movie_waits_for_sample_lock(merged_sample):
+    folder, movies = merged_sample
+    workflow = Pbmm2Workflow(str(folder), check_requirements=False)
+    sample_lock = SampleLock(str(folder / f"HG002.{EXT_LOCK}"), 3600)
+    assert sample_lock.acquire()
+
+    try:
+        workflow.reset(movies[0], "merge")
+        assert (folder / f"HG002.{EXT_MERGE_RUNNING}").is_file()
+        run_reset(get_reset_plan(str(folder), "qc"))
+        assert (folder / "qc" / f"HG002_m0.{EXT_QC}").is_file()
+        assert (folder / f"HG002.{EXT_MERGE_RUNNING}").is_file()
+        # The lock of the movie was not kept
+        assert not (folder / f"HG002_m0.{EXT_LOCK}").exists()
+    finally:
+        sample_lock.release()
+
+    workflow.reset(movies[0], "merge")
+    assert not (folder / f"HG002.{EXT_MERGE_RUNNING}").exists()
+    assert not (folder / f"HG002.{EXT_MERGED}").exists()
+    assert list(folder.glob(f"*.{EXT_LOCK}")) == []
+
+
+def test_cram_and_merge_are_rejected(workflow_env):
+    config = json.loads(workflow_env["config"].read_text())
+
+    with pytest.raises(ValidationError, match="can't be combined with merging movies"):
+        Config(**config, cram_config={"enabled": True}, merge_config={"enabled": True, "sample_pattern": "(.+)"})
+
+
+@pytest.fixture
+def qc_parsed_file(workflow_env, tmp_path):
+    """Movie m0.bam with the CRAM conversion enabled, whose QC has been parsed. The aligned BAM
+    has 10 primary records.
+    """
+
+    update_config(workflow_env["config"], cram_config={"enabled": True})
+    folder = tmp_path / "project"
+    folder.mkdir()
+    for extension in ["bam", EXT_ALIGNED_SORTED, EXT_ALIGNED_SORTED_INDEXED]:
+        (folder / f"m0.{extension}").write_text("x")
+    store_qc_metrics({QC_METRIC_PRIMARY_RECORDS: "10"}, str(folder / "qc" / f"m0.{EXT_QC}"))
+    return folder, "m0.bam"
+
+
+def complete_cram_job(folder, records: int = 10):
+    for extension in [EXT_CRAM, EXT_CRAM_INDEXED]:
+        (folder / f"m0.{extension}").write_text("x")
+    (folder / f"m0.{EXT_CRAM_RECORD_COUNT}").write_text(f"{records}\n")
+
+
+def test_cram_state_transitions(qc_parsed_file):
+    folder, file_name = qc_parsed_file
+    workflow = Pbmm2Workflow(str(folder), check_requirements=False)
+
+    assert workflow.get_state(file_name) == STATE_QC_PARSED
+    assert workflow.run_next_step(file_name) == ACTION_SUBMIT_CRAM
+    assert workflow.get_state(file_name) == STATE_CRAM_RUNNING
+
+    # The record count is written last, the CRAM isn't complete before
+    complete_cram_job(folder)
+    (folder / f"m0.{EXT_CRAM_RECORD_COUNT}").write_text("")
+    assert workflow.get_state(file_name) == STATE_CRAM_RUNNING
+    complete_cram_job(folder)
+    assert workflow.get_state(file_name) == STATE_CRAM_COMPLETE
+
+    assert workflow.run_next_step(file_name) == ACTION_VERIFY_CRAM
+    assert workflow.get_state(file_name) == STATE_WORKFLOW_COMPLETE
+    assert sorted(path.name for path in folder.iterdir()) == sorted(["m0.bam", f"m0.{EXT_CRAM}", f"m0.{EXT_CRAM_INDEXED}", "qc"])
+
+
+@pytest.mark.parametrize(
+    "records,index,error",
+    [
+        (11, True, "11 primary records, but 10 according to samtools stats"),
+        (10, False, "the index is missing"),
+    ],
+)
+def test_verify_cram_keeps_aligned_bam(qc_parsed_file, records, index, error):
+    folder, file_name = qc_parsed_file
+    (folder / f"m0.{EXT_CRAM_RUNNING}").write_text(JobMarker(job_id="100").model_dump_json())
+    complete_cram_job(folder, records)
+    if not index:
+        (folder / f"m0.{EXT_CRAM_INDEXED}").unlink()
+    workflow = Pbmm2Workflow(str(folder), check_requirements=False)
+
+    with pytest.raises(Exception, match=error):
+        workflow.verify_cram(file_name)
+    assert (folder / f"m0.{EXT_ALIGNED_SORTED}").is_file()
+    assert workflow.get_state(file_name) == STATE_CRAM_COMPLETE
+
+
+def test_failed_cram_job_is_retried(qc_parsed_file, workflow_env):
+    folder, file_name = qc_parsed_file
+    create_fake_tool(workflow_env, "sacct", 'for JOB_ID in ${JOB_IDS//,/ }; do echo "$JOB_ID|NODE_FAIL"; done')
+    (folder / f"m0.{EXT_CRAM_RUNNING}").write_text(JobMarker(job_id="100", time="0-12:00:00", memory="8G").model_dump_json())
+    workflow = Pbmm2Workflow(str(folder), check_requirements=False)
+
+    assert workflow.get_state(file_name) == STATE_CRAM_FAILED
+    assert workflow.run_next_step(file_name) == ACTION_RETRY
+    assert read_job_marker(str(folder / f"m0.{EXT_CRAM_RUNNING}")).attempt == 2
+
+
+@pytest.fixture
+def failed_jobs(workflow_env, tmp_path):
+    """Adds samples whose alignment job failed with a given Slurm state (according to a fake
+    sacct). Returns the project folder and the function that adds a sample.
+    """
+
+    update_config(
+        workflow_env["config"],
+        slurm_config={
+            **json.loads(workflow_env["config"].read_text())["slurm_config"],
+            "retry_config": {"max_attempts": 3, "max_memory": "64G", "max_time": "0-10:00:00"},
+        },
+    )
+    job_states = workflow_env["root"] / "job_states"
+    job_states.write_text("")
+    create_fake_tool(workflow_env, "sacct", f"""
+for JOB_ID in ${{JOB_IDS//,/ }}; do grep "^$JOB_ID|" {job_states}; done
+exit 0
+""")
+    folder = tmp_path / "project"
+    folder.mkdir()
+
+    def add_failed_job(name: str, job_state: str, attempt: int = 1, time: str = "0-06:00:00", memory: str = "16G", size: int = 1024):
+        job_id = str(100 + len(job_states.read_text().splitlines()))
+        with open(job_states, "a") as f:
+            f.write(f"{job_id}|{job_state}\n")
+        (folder / f"{name}.bam").write_text("x" * size)
+        (folder / f"{name}.{EXT_ALIGNED_SORTED}").write_text("partial")
+        (folder / f"{name}.{EXT_ALIGNMENT_RUNNING}").write_text(
+            JobMarker(job_id=job_id, attempt=attempt, time=time, memory=memory).model_dump_json()
+        )
+        return f"{name}.bam"
+
+    return folder, add_failed_job
+
+
+@pytest.mark.parametrize(
+    "job_state,attempt,time,memory,expected_time,expected_memory,not_retried",
+    [
+        # Memory and time are scaled by 2, up to the ceilings of 64G and 10 hours
+        ("OUT_OF_MEMORY", 1, "0-06:00:00", "16G", "0-06:00:00", "32G", None),
+        ("OUT_OF_MEMORY", 2, "0-06:00:00", "48G", "0-06:00:00", "64G", None),
+        ("OUT_OF_MEMORY", 1, "0-06:00:00", "64G", "0-06:00:00", "64G", "Memory is already at the ceiling of 64G"),
+        ("TIMEOUT", 1, "0-03:00:00", "16G", "0-06:00:00", "16G", None),
+        ("TIMEOUT", 1, "0-06:00:00", "16G", "0-10:00:00", "16G", None),
+        ("TIMEOUT", 1, "0-10:00:00", "16G", "0-10:00:00", "16G", "Time is already at the ceiling of 0-10:00:00"),
+        # Failures of the cluster are retried with the same resources
+        ("NODE_FAIL", 1, "0-06:00:00", "16G", "0-06:00:00", "16G", None),
+        ("OUT_OF_MEMORY", 3, "0-06:00:00", "16G", "0-06:00:00", "16G", "Maximum number of attempts (3) reached"),
+    ]
+    + [(state, 1, "0-06:00:00", "16G", "0-06:00:00", "16G", "Tool errors are not retried") for state in TOOL_FAILURE_STATES],
+)
+def test_get_job_retry(failed_jobs, job_state, attempt, time, memory, expected_time, expected_memory, not_retried):
+    folder, add_failed_job = failed_jobs
+    file_name = add_failed_job("m0", job_state, attempt=attempt, time=time, memory=memory)
+    workflow = Pbmm2Workflow(str(folder), check_requirements=False)
+
+    retry = workflow.get_job_retry(file_name, STEP_ALIGNMENT)
+
+    assert (retry.job_state, retry.attempt) == (job_state, attempt)
+    assert (retry.time, retry.memory) == (expected_time, expected_memory)
+    assert retry.not_retried == not_retried
+
+
+def test_failed_job_is_resubmitted_with_escalated_resources(failed_jobs):
+    folder, add_failed_job = failed_jobs
+    file_name = add_failed_job("m0", "OUT_OF_MEMORY")
+    workflow = Pbmm2Workflow(str(folder), check_requirements=False)
+
+    assert workflow.get_state(file_name) == STATE_ALIGNMENT_FAILED
+    assert workflow.run_next_step(file_name) == ACTION_RETRY
+
+    marker = read_job_marker(str(folder / f"m0.{EXT_ALIGNMENT_RUNNING}"))
+    assert (marker.attempt, marker.memory, marker.time) == (2, "32G", "0-06:00:00")
+    assert marker.job_id != "100"
+    assert not (folder / f"m0.{EXT_ALIGNED_SORTED}").exists()
+
+
+def test_tool_failure_is_not_resubmitted(failed_jobs, workflow_env):
+    folder, add_failed_job = failed_jobs
+    file_name = add_failed_job("m0", "FAILED")
+    marker = (folder / f"m0.{EXT_ALIGNMENT_RUNNING}").read_text()
+
+    assert Pbmm2Workflow(str(folder), check_requirements=False).run_next_step(file_name) == ACTION_NOT_RETRIED
+    assert (folder / f"m0.{EXT_ALIGNMENT_RUNNING}").read_text() == marker
+    assert "Tool errors are not retried" in workflow_env["log"].read_text()
+
+
+def test_failed_resubmission_keeps_attempt_and_resources(failed_jobs, workflow_env):
+    folder, add_failed_job = failed_jobs
+    file_name = add_failed_job("m0", "OUT_OF_MEMORY", attempt=2, memory="32G")
+    sbatch = workflow_env["bin"] / "sbatch"
+    sbatch.write_text("#!/bin/bash\necho 'sbatch: error: Invalid account' >&2\nexit 1\n")
+    workflow = Pbmm2Workflow(str(folder), check_requirements=False)
+
+    with pytest.raises(Exception, match="Error submitting 1 job"):
+        workflow.run_next_step(file_name)
+
+    # The next run resubmits the same attempt with the same escalated resources
+    marker = read_job_marker(str(folder / f"m0.{EXT_ALIGNMENT_RUNNING}"))
+    assert (marker.job_id, marker.attempt, marker.memory) == ("100", 2, "32G")
+    assert workflow.get_state(file_name) == STATE_ALIGNMENT_FAILED
+    retry = workflow.get_job_retry(file_name, STEP_ALIGNMENT)
+    assert (retry.memory, retry.not_retried) == ("64G", None)
+
+
+def test_resubmissions_count_against_in_flight_cap(failed_jobs, workflow_env):
+    folder, add_failed_job = failed_jobs
+    update_config(workflow_env["config"], scheduling_config={"max_in_flight_alignment": 2})
+    retried = [add_failed_job(f"m{i}", "OUT_OF_MEMORY", size=1024 * (i + 1)) for i in range(4)]
+    not_retried = add_failed_job("m4", "FAILED")
+    (folder / "m5.bam").write_text("x")
+
+    results = {
+        os.path.basename(result.file): result
+        for result in Pbmm2Workflow(str(folder), check_requirements=False).resume_workflow_all()
+    }
+
+    # The two largest BAMs are resubmitted, the other resubmissions and the new alignment wait
+    assert [results[file_name].action for file_name in retried] == [ACTION_HOLD_BACK] * 2 + [ACTION_RETRY] * 2
+    assert results["m5.bam"].action == ACTION_HOLD_BACK
+    # Tool errors are reported and don't take a slot
+    assert results[not_retried].action == ACTION_NOT_RETRIED
+    assert all(result.error is None for result in results.values())
+
+
+def test_submissions_over_in_flight_cap_are_held_back(workflow_env, tmp_path, monkeypatch, capsys):
+    update_config(workflow_env["config"], scheduling_config={"max_in_flight_alignment": 2})
+    # All jobs are still pending or running
+    create_fake_tool(workflow_env, "squeue", 'echo "${JOB_IDS//,/ }"')
+    folder = tmp_path / "project"
+    folder.mkdir()
+    (folder / "m0.bam").write_text("x")
+    (folder / f"m0.{EXT_ALIGNMENT_RUNNING}").write_text(JobMarker(job_id="100").model_dump_json())
+    for name, size in [("m1", 3000), ("m2", 1000), ("m3", 2000)]:
+        (folder / f"{name}.bam").write_text("x" * size)
+    # The runtime of the in-flight job is estimated from the snapshot of the folder
+    monkeypatch.setattr(os.path, "getmtime", lambda path: pytest.fail(f"{path} was not taken from the snapshot"))
+    workflow = Pbmm2Workflow(str(folder), check_requirements=False)
+
+    assert workflow.resume_workflow_all(dry_run=True) == []
+    assert "In-flight alignment jobs: 1" in capsys.readouterr().out
+    assert not (folder / f"m1.{EXT_ALIGNMENT_RUNNING}").exists()
+
+    results = {os.path.basename(result.file): result.action for result in workflow.resume_workflow_all()}
+
+    # One free slot, taken by the largest BAM
+    assert results == {
+        "m0.bam": ACTION_WAIT,
+        "m1.bam": ACTION_SUBMIT_ALIGNMENT,
+        "m2.bam": ACTION_HOLD_BACK,
+        "m3.bam": ACTION_HOLD_BACK,
+    }
+    assert (folder / f"m1.{EXT_ALIGNMENT_RUNNING}").is_file()
+    assert not (folder / f"m3.{EXT_ALIGNMENT_RUNNING}").exists()
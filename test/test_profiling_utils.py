@@ -0,0 +1,97 @@
+########################################################################
+#
+#   Authors:
+#       William Feng
+#       Harvard Medical School
+#       william_feng@gmail.com
+#
+#       Alexander Veit
+#       Harvard Medical School
+#       alexander_veit@hms.harvard.edu
+#
+#   Tests of the opt-in instrumentation of o2p commands.
+#
+########################################################################
+
+import json
+import subprocess
+
+import pytest
+
+from src import profiling_utils
+from src.constants import O2P_PROFILE
+from src.profiling_utils import SUBPROCESS_RUN, _Profiler, _instrument_subprocess_run, init_profiling, profiled
+
+
+@profiled("test_operation")
+def operation(value: int) -> int:
+    if value < 0:
+        raise ValueError("negative")
+    return value * 2
+
+
+@pytest.fixture
+def instrumented_run(monkeypatch):
+    """Instruments subprocess.run for the test only (enable_profiling does it for good)"""
+
+    monkeypatch.setattr(subprocess, "run", subprocess.run)
+    monkeypatch.setattr(profiling_utils, "_profiler", None)
+    _instrument_subprocess_run()
+
+
+def enable(monkeypatch, output_path=None) -> _Profiler:
+    profiler = _Profiler(output_path)
+    monkeypatch.setattr(profiling_utils, "_profiler", profiler)
+    return profiler
+
+
+def test_profiled_calls_are_recorded(monkeypatch):
+    profiler = enable(monkeypatch)
+
+    assert operation(1) == 2
+    assert operation(2) == 4
+    with pytest.raises(ValueError):
+        operation(-1)
+
+    calls, total, maximum = profiler.stats["test_operation"]
+    # Failed calls are recorded as well
+    assert calls == 3
+    assert 0 <= maximum <= total
+
+
+def test_subprocess_runs_are_recorded_by_program(monkeypatch, instrumented_run):
+    profiler = enable(monkeypatch)
+
+    subprocess.run(["true"], check=True)
+    subprocess.run("echo 1 > /dev/null", shell=True, check=True)
+    subprocess.check_output(["echo", "1"])
+
+    assert profiler.stats[f"{SUBPROCESS_RUN}: true"][0] == 1
+    assert profiler.stats[f"{SUBPROCESS_RUN}: echo"][0] == 2
+
+
+def test_nothing_is_recorded_unless_enabled(monkeypatch, instrumented_run):
+    monkeypatch.delenv(O2P_PROFILE, raising=False)
+    init_profiling(profile=False)
+    assert not profiling_utils.is_profiling_enabled()
+
+    monkeypatch.setenv(O2P_PROFILE, "0")
+    init_profiling(profile=False)
+    assert not profiling_utils.is_profiling_enabled()
+
+    # The instrumented functions still work
+    assert operation(1) == 2
+    assert subprocess.run(["echo", "1"], capture_output=True, text=True).stdout == "1\n"
+
+
+def test_chrome_trace(monkeypatch, tmp_path):
+    trace_path = tmp_path / "trace.json"
+    profiler = enable(monkeypatch, str(trace_path))
+
+    operation(1)
+    operation(2)
+    profiler.write_output()
+
+    events = json.loads(trace_path.read_text())["traceEvents"]
+    assert [event["name"] for event in events] == ["test_operation", "test_operation"]
+    assert all(event["ph"] == "X" and event["dur"] >= 0 for event in events)
@@ -0,0 +1,164 @@
+########################################################################
+#
+#   Authors:
+#       William Feng
+#       Harvard Medical School
+#       william_feng@gmail.com
+#
+#       Alexander Veit
+#       Harvard Medical School
+#       alexander_veit@hms.harvard.edu
+#
+#   Tests of the robust z-scores, threshold rules and outlier flags of
+#       the QC gate.
+#
+########################################################################
+
+import numpy as np
+import pytest
+
+from src.config_utils import QCGateConfig
+from src.qc_gate_utils import (
+    MAD_SCALE,
+    MEAN_ABSOLUTE_DEVIATION_SCALE,
+    QC_GATE_FAIL,
+    QC_GATE_FLAGGED,
+    QC_GATE_PASS,
+    apply_qc_gate,
+    get_robust_z_scores,
+    load_summary_matrix,
+    run_qc_gate,
+)
+from src.qc_viewer_utils import SAMPLE_COLUMN
+
+
+def test_get_robust_z_scores():
+    matrix = np.array(
+        [
+            [1.0, 5.0, 7.0, 1.0],
+            [2.0, 5.0, 7.0, 2.0],
+            [3.0, 5.0, 7.0, np.nan],
+            [4.0, 5.0, 7.0, 4.0],
+            [100.0, 9.0, 7.0, 100.0],
+        ]
+    )
+
+    z_scores = get_robust_z_scores(matrix)
+
+    # Median 3, MAD 1
+    np.testing.assert_allclose(z_scores[:, 0], (matrix[:, 0] - 3) / MAD_SCALE)
+    # MAD 0: mean absolute deviation 4 / 5 instead
+    np.testing.assert_allclose(z_scores[:, 1], [0, 0, 0, 0, 4 / (0.8 * MEAN_ABSOLUTE_DEVIATION_SCALE)])
+    # No deviation at all
+    np.testing.assert_array_equal(z_scores[:, 2], np.zeros(5))
+    # NaN values are ignored: median 3, MAD 1.5. Their z-score is 0
+    np.testing.assert_allclose(z_scores[:, 3], [-2 / (1.5 * MAD_SCALE), -1 / (1.5 * MAD_SCALE), 0, 1 / (1.5 * MAD_SCALE), 97 / (1.5 * MAD_SCALE)])
+
+
+def test_threshold_reasons():
+    samples = ["s0.qc", "s1.qc", "s2.qc", "s3.qc"]
+    metrics = ["reads mapped", "error rate"]
+    matrix = np.array([[100.0, 0.01], [5.0, 0.01], [100.0, 0.5], [np.nan, 0.01]])
+    gate_config = QCGateConfig(
+        thresholds=[{"metric": "reads mapped", "min": 10}, {"metric": "error rate", "max": 0.1}]
+    )
+
+    result = apply_qc_gate(samples, metrics, matrix, gate_config)
+
+    assert [result.get_result(i) for i in range(4)] == [QC_GATE_PASS, QC_GATE_FAIL, QC_GATE_FAIL, QC_GATE_FAIL]
+    assert result.reasons == [
+        [],
+        ["reads mapped = 5 < 10"],
+        ["error rate = 0.5 > 0.1"],
+        ["reads mapped is missing"],
+    ]
+
+
+def test_unknown_threshold_metric():
+    gate_config = QCGateConfig(thresholds=[{"metric": "reads unknown", "min": 1}])
+
+    with pytest.raises(Exception, match="reads unknown"):
+        apply_qc_gate(["s0.qc"], ["reads mapped"], np.array([[1.0]]), gate_config)
+
+
+def get_outlier_matrix(num_samples: int = 20) -> np.ndarray:
+    # Metric 0 varies and has an outlier in the last sample. Metric 1 is the same in all samples
+    # but one, whose z-score is large because of the MAD of 0
+    matrix = np.column_stack([np.arange(num_samples, dtype=float), np.full(num_samples, 50.0)])
+    matrix[-1, 0] = 1000
+    matrix[0, 1] = 51
+    return matrix
+
+
+def test_outliers_are_flagged():
+    samples = [f"s{i}.qc" for i in range(20)]
+    result = apply_qc_gate(samples, ["metric 0", "metric 1"], get_outlier_matrix(), QCGateConfig())
+
+    assert not result.failed.any()
+    assert result.get_result(0) == QC_GATE_FLAGGED
+    assert result.get_result(19) == QC_GATE_FLAGGED
+    assert result.get_reported_indices() == [0, 19]
+    assert result.reasons[0][0].startswith("metric 1 = 51 is an outlier")
+    assert result.reasons[19][0].startswith("metric 0 = 1000 is an outlier")
+
+
+def test_outliers_of_selected_metrics_and_failures():
+    samples = [f"s{i}.qc" for i in range(20)]
+    gate_config = QCGateConfig(outlier_metrics=["metric 0"], fail_on_outliers=True)
+
+    result = apply_qc_gate(samples, ["metric 0", "metric 1"], get_outlier_matrix(), gate_config)
+
+    assert result.get_failed_indices() == [19]
+    assert not result.flagged.any()
+    assert result.get_result(0) == QC_GATE_PASS
+
+
+def test_no_outliers_below_min_samples():
+    samples = [f"s{i}.qc" for i in range(20)]
+    result = apply_qc_gate(samples, ["metric 0", "metric 1"], get_outlier_matrix(), QCGateConfig(min_samples_for_outliers=21))
+
+    assert result.get_reported_indices() == []
+
+
+def test_failure_takes_precedence_over_flag():
+    samples = [f"s{i}.qc" for i in range(20)]
+    gate_config = QCGateConfig(thresholds=[{"metric": "metric 0", "max": 500}])
+
+    result = apply_qc_gate(samples, ["metric 0", "metric 1"], get_outlier_matrix(), gate_config)
+
+    assert result.get_result(19) == QC_GATE_FAIL
+    assert result.get_failed_indices() == [19]
+    assert np.flatnonzero(result.flagged).tolist() == [0]
+    assert result.reasons[19][0] == "metric 0 = 1000 > 500"
+    assert "is an outlier" in result.reasons[19][1]
+
+
+def test_run_qc_gate_writes_results(tmp_path, capsys):
+    matrix = get_outlier_matrix()
+    summary_path = tmp_path / "summary.qc"
+    lines = [f"{SAMPLE_COLUMN}\tmetric 0\tmetric 1"]
+    lines += [f"s{i}.qc\t{row[0]:g}\t{row[1]:g}" for i, row in enumerate(matrix)]
+    summary_path.write_text("\n".join(lines) + "\n")
+    gate_config = QCGateConfig(thresholds=[{"metric": "metric 0", "min": 1}])
+
+    result = run_qc_gate(str(summary_path), gate_config, output_path=str(tmp_path / "gate.tsv"))
+
+    assert result.get_failed_indices() == [0]
+    assert "19 of 20 samples passed the QC gate, 1 of them flagged as outliers." in capsys.readouterr().out
+    rows = [line.split("\t") for line in (tmp_path / "gate.tsv").read_text().splitlines()]
+    assert [row[1] for row in rows[1:]] == [QC_GATE_FAIL] + [QC_GATE_PASS] * 18 + [QC_GATE_FLAGGED]
+
+
+def test_metrics_missing_in_the_first_sample(tmp_path):
+    summary_path = tmp_path / "summary.qc"
+    summary_path.write_text(
+        f"{SAMPLE_COLUMN}\taverage quality\terror rate\tversion\n"
+        "s0.qc\t\t0.02\t\n"
+        "s1.qc\t30.5\t0.01\t1.13.0\n"
+    )
+
+    samples, metrics, matrix = load_summary_matrix(str(summary_path))
+
+    # Metrics are numeric if their first value is, whichever sample it's in
+    assert (samples, metrics) == (["s0.qc", "s1.qc"], ["average quality", "error rate"])
+    np.testing.assert_array_equal(matrix, [[np.nan, 0.02], [30.5, 0.01]])
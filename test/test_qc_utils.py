@@ -0,0 +1,62 @@
+########################################################################
+#
+#   Authors:
+#       William Feng
+#       Harvard Medical School
+#       william_feng@gmail.com
+#
+#       Alexander Veit
+#       Harvard Medical School
+#       alexander_veit@hms.harvard.edu
+#
+#   Tests of the parsed .qc files and the summary QC file.
+#
+########################################################################
+
+from src.constants import SAMTOOLS_STATS
+from src.qc_utils import create_summary_qc_file, store_qc_metrics
+
+SAMTOOLS_METRICS = {
+    f"{SAMTOOLS_STATS}: average quality": "30.5",
+    f"{SAMTOOLS_STATS}: error rate": "1.000000e-02",
+    f"{SAMTOOLS_STATS}: raw total sequences": "100",
+}
+# The native engine doesn't compute all samtools stats metrics
+NATIVE_METRICS = {
+    f"{SAMTOOLS_STATS}: error rate": "2.000000e-02",
+    f"{SAMTOOLS_STATS}: raw total sequences": "200",
+}
+
+
+def read_summary(path):
+    return [line.split("\t") for line in path.read_text().splitlines()]
+
+
+def test_summary_of_identical_headers(tmp_path):
+    store_qc_metrics(SAMTOOLS_METRICS, str(tmp_path / "qc" / "s1.aligned_sorted.qc"))
+    store_qc_metrics(SAMTOOLS_METRICS, str(tmp_path / "qc" / "s0.aligned_sorted.qc"))
+
+    create_summary_qc_file(str(tmp_path / "qc"), str(tmp_path / "summary.qc"))
+
+    assert read_summary(tmp_path / "summary.qc") == [
+        ["File name", *SAMTOOLS_METRICS],
+        ["s0.aligned_sorted.qc", *SAMTOOLS_METRICS.values()],
+        ["s1.aligned_sorted.qc", *SAMTOOLS_METRICS.values()],
+    ]
+
+
+def test_summary_of_both_qc_engines(tmp_path, capsys):
+    store_qc_metrics(NATIVE_METRICS, str(tmp_path / "qc" / "s0.aligned_sorted.qc"))
+    store_qc_metrics(SAMTOOLS_METRICS, str(tmp_path / "qc" / "s1.aligned_sorted.qc"))
+    store_qc_metrics({**NATIVE_METRICS, "pbmm2: version": "1.13.0"}, str(tmp_path / "qc" / "s2.aligned_sorted.qc"))
+
+    create_summary_qc_file(str(tmp_path / "qc"), str(tmp_path / "summary.qc"))
+
+    # The union of the metrics, sorted like the metrics of a .qc file
+    assert read_summary(tmp_path / "summary.qc") == [
+        ["File name", "pbmm2: version", *SAMTOOLS_METRICS],
+        ["s0.aligned_sorted.qc", "", "", "2.000000e-02", "200"],
+        ["s1.aligned_sorted.qc", "", "30.5", "1.000000e-02", "100"],
+        ["s2.aligned_sorted.qc", "1.13.0", "", "2.000000e-02", "200"],
+    ]
+    assert "3 different sets of metrics" in capsys.readouterr().out
@@ -0,0 +1,110 @@
+########################################################################
+#
+#   Authors:
+#       William Feng
+#       Harvard Medical School
+#       william_feng@gmail.com
+#
+#       Alexander Veit
+#       Harvard Medical School
+#       alexander_veit@hms.harvard.edu
+#
+#   Tests of the lazy reader and the pages of the transposed QC viewer.
+#
+########################################################################
+
+import pytest
+
+from src.qc_viewer_utils import COLUMN_PADDING, SAMPLE_COLUMN, QCFileReader, get_page, iter_pages
+
+METRICS = ["metric a", "metric bb", "version"]
+# Sample names and values are at most 5 characters wide
+SAMPLES = [(f"s{i}.qc", [str(i), str(10 * i), "1.13"]) for i in range(5)]
+# Width of the metric names and of each sample column
+METRIC_COLUMN_WIDTH = len("metric bb") + COLUMN_PADDING
+SAMPLE_COLUMN_WIDTH = len("s0.qc") + COLUMN_PADDING
+
+
+@pytest.fixture
+def summary_qc(tmp_path):
+    path = tmp_path / "summary.qc"
+    lines = ["\t".join([SAMPLE_COLUMN, *METRICS])] + ["\t".join([name, *values]) for name, values in SAMPLES]
+    path.write_text("\n".join(lines) + "\n")
+    return str(path)
+
+
+def read_all(reader: QCFileReader):
+    samples = []
+    while reader.get_sample(len(samples)):
+        samples.append(reader.loaded[len(samples)])
+    return samples
+
+
+def test_all_metrics_and_samples(summary_qc):
+    reader = QCFileReader(summary_qc)
+
+    assert reader.metrics == METRICS
+    assert read_all(reader) == SAMPLES
+    assert reader.exhausted
+
+
+def test_metric_selection(summary_qc):
+    reader = QCFileReader(summary_qc, metrics=["version", "metric a"])
+
+    assert reader.metrics == ["version", "metric a"]
+    assert reader.get_sample(1) == ("s1.qc", ["1.13", "1"])
+
+    reader = QCFileReader(summary_qc, metric_regex="^metric")
+    assert reader.metrics == ["metric a", "metric bb"]
+    assert reader.get_sample(0) == ("s0.qc", ["0", "0"])
+
+    # The regular expression filters the selected metrics
+    assert QCFileReader(summary_qc, metrics=["version", "metric bb"], metric_regex="b+").metrics == ["metric bb"]
+
+    with pytest.raises(Exception, match="Metrics not found in .*: unknown"):
+        QCFileReader(summary_qc, metrics=["metric a", "unknown"])
+
+
+def test_sample_selection(summary_qc):
+    reader = QCFileReader(summary_qc, samples=["s3.qc", "s1.qc", "s9.qc"])
+    assert [name for name, _ in read_all(reader)] == ["s1.qc", "s3.qc"]
+
+    reader = QCFileReader(summary_qc, sample_regex=r"s[2-4]")
+    assert [name for name, _ in read_all(reader)] == ["s2.qc", "s3.qc", "s4.qc"]
+
+    reader = QCFileReader(summary_qc, samples=["s3.qc", "s4.qc"], sample_regex=r"4")
+    assert [name for name, _ in read_all(reader)] == ["s4.qc"]
+
+
+def test_parsed_qc_file_of_one_sample(tmp_path):
+    path = tmp_path / "m0.aligned_sorted.qc"
+    path.write_text("metric a\tmetric bb\n1\t2\n")
+
+    reader = QCFileReader(str(path))
+
+    assert reader.metrics == ["metric a", "metric bb"]
+    assert read_all(reader) == [("m0.aligned_sorted.qc", ["1", "2"])]
+
+
+def test_rows_are_read_lazily(summary_qc):
+    reader = QCFileReader(summary_qc)
+    assert reader.loaded == []
+
+    assert get_page(reader, 0, width=1000, max_samples=2) == 2
+
+    # Only the header and the rows of the page were read
+    assert reader.rows.line_num == 3
+    assert len(reader.loaded) == 2
+    assert not reader.exhausted
+    reader.close()
+
+
+def test_pages_split_by_width(summary_qc):
+    width = METRIC_COLUMN_WIDTH + 2 * SAMPLE_COLUMN_WIDTH
+
+    assert list(iter_pages(QCFileReader(summary_qc), width)) == [(0, 2), (2, 4), (4, 5)]
+    assert list(iter_pages(QCFileReader(summary_qc), width - 1)) == [(i, i + 1) for i in range(5)]
+    # A page has at least one sample, even if it doesn't fit
+    assert list(iter_pages(QCFileReader(summary_qc), 1)) == [(i, i + 1) for i in range(5)]
+    assert list(iter_pages(QCFileReader(summary_qc), 1000, max_samples=3)) == [(0, 3), (3, 5)]
+    assert list(iter_pages(QCFileReader(summary_qc, sample_regex="none"), 1000)) == []
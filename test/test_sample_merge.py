@@ -0,0 +1,173 @@
+########################################################################
+#
+#   Authors:
+#       William Feng
+#       Harvard Medical School
+#       william_feng@gmail.com
+#
+#       Alexander Veit
+#       Harvard Medical School
+#       alexander_veit@hms.harvard.edu
+#
+#   Tests of the per-sample merge: assignment of movies to samples and
+#       the merged samtools stats.
+#
+########################################################################
+
+import pytest
+
+from src.config_utils import MergeConfig
+from src.constants import SAMTOOLS_STATS
+from src.qc_utils import merge_samtools_stats
+from src.sample_utils import SampleAssignment, read_sample_sheet
+
+
+def get_stats(**values) -> dict:
+    return {f"{SAMTOOLS_STATS}: {name.replace('_', ' ')}": str(value) for name, value in values.items()}
+
+
+MOVIE_STATS = [
+    {
+        **get_stats(
+            sequences=100,
+            raw_total_sequences=100,
+            total_length=1000,
+            maximum_length=30,
+            average_length=10,
+            average_quality=20.0,
+            reads_properly_paired=40,
+            insert_size_average=100,
+            insert_size_standard_deviation=10,
+            mismatches=9,
+            error_rate="1.000000e-02",
+        ),
+        f"{SAMTOOLS_STATS}: is sorted": "1",
+        f"{SAMTOOLS_STATS}: bases mapped (cigar)": "900",
+        f"{SAMTOOLS_STATS}: percentage of properly paired reads (%)": "40.0",
+        "pbmm2: version": "1.13.0",
+        "movie": "m0",
+    },
+    {
+        **get_stats(
+            sequences=300,
+            raw_total_sequences=300,
+            total_length=6100,
+            maximum_length=50,
+            average_length=20,
+            average_quality=30.0,
+            reads_properly_paired=60,
+            insert_size_average=200,
+            insert_size_standard_deviation=20,
+            mismatches=51,
+            error_rate="2.428571e-02",
+        ),
+        f"{SAMTOOLS_STATS}: is sorted": "0",
+        f"{SAMTOOLS_STATS}: bases mapped (cigar)": "2100",
+        f"{SAMTOOLS_STATS}: percentage of properly paired reads (%)": "20.0",
+        "pbmm2: version": "1.13.0",
+        "movie": "m1",
+    },
+]
+
+
+def test_merge_samtools_stats():
+    merged = merge_samtools_stats(MOVIE_STATS)
+
+    assert merged == {
+        **get_stats(
+            sequences=400,
+            raw_total_sequences=400,
+            total_length=7100,
+            maximum_length=50,
+            # 7100 / 400
+            average_length=18,
+            # (1000 * 20 + 6100 * 30) / 7100
+            average_quality=28.6,
+            reads_properly_paired=100,
+            # (40 * 100 + 60 * 200) / 100
+            insert_size_average=160,
+            # sqrt((40 * (10² + 60²) + 60 * (20² + 40²)) / 100) = sqrt(2680)
+            insert_size_standard_deviation=51.8,
+            mismatches=60,
+            # 60 / 3000
+            error_rate="2.000000e-02",
+        ),
+        f"{SAMTOOLS_STATS}: is sorted": "0",
+        f"{SAMTOOLS_STATS}: bases mapped (cigar)": "3000",
+        # 100 / 400
+        f"{SAMTOOLS_STATS}: percentage of properly paired reads (%)": "25",
+        # Metrics of other tools are only kept if all movies agree
+        "pbmm2: version": "1.13.0",
+    }
+
+
+def test_merge_samtools_stats_of_one_movie():
+    merged = merge_samtools_stats(MOVIE_STATS[:1])
+
+    assert merged[f"{SAMTOOLS_STATS}: average length"] == "10"
+    assert merged[f"{SAMTOOLS_STATS}: insert size standard deviation"] == "10"
+    assert merged[f"{SAMTOOLS_STATS}: error rate"] == "1.000000e-02"
+    assert merged["movie"] == "m0"
+
+
+def test_merge_samtools_stats_without_mapped_bases():
+    stats = [get_stats(sequences=0, reads_properly_paired=0, insert_size_average=0, insert_size_standard_deviation=0, error_rate=0)] * 2
+
+    merged = merge_samtools_stats(stats)
+
+    assert merged[f"{SAMTOOLS_STATS}: error rate"] == "0.000000e+00"
+    assert merged[f"{SAMTOOLS_STATS}: insert size average"] == "0"
+    assert merged[f"{SAMTOOLS_STATS}: insert size standard deviation"] == "0"
+
+
+def test_read_sample_sheet(tmp_path):
+    sample_sheet = tmp_path / "samples.tsv"
+    sample_sheet.write_text("file_name\tsample\n# comment\n\nm0.bam\tHG002\nm1.bam\t HG002 \nm2.bam\tHG003\nm0.bam\tHG002\n")
+
+    assert read_sample_sheet(str(sample_sheet)) == {"m0.bam": "HG002", "m1.bam": "HG002", "m2.bam": "HG003"}
+
+    sample_sheet.write_text("m0.bam\tHG002\nm0.bam\tHG003\n")
+    with pytest.raises(Exception, match="assigned to more than one sample"):
+        read_sample_sheet(str(sample_sheet))
+
+    sample_sheet.write_text("m0.bam\tHG002\nm1.bam\n")
+    with pytest.raises(Exception, match="Invalid line 2"):
+        read_sample_sheet(str(sample_sheet))
+
+
+def test_sample_assignment_from_sample_sheet(tmp_path):
+    sample_sheet = tmp_path / "samples.tsv"
+    sample_sheet.write_text("m1.bam\tHG002\nm0.bam\tHG002\nm2.bam\tHG003\n")
+    assignment = SampleAssignment(MergeConfig(sample_sheet=str(sample_sheet)))
+
+    assert assignment.get_sample("m0.bam") == "HG002"
+    assert assignment.get_sample("m9.bam") is None
+    # Movies of the sample sheet that are not in the working directory (yet) are included
+    assert assignment.get_movies_by_sample(["m0.bam", "m9.bam"]) == {
+        "HG002": ["m0.bam", "m1.bam"],
+        "HG003": ["m2.bam"],
+    }
+
+
+def test_sample_assignment_from_pattern():
+    file_names = ["HG002_m64011.bam", "HG002_m64012.bam", "HG003_m64013.bam", "other.bam"]
+
+    assignment = SampleAssignment(MergeConfig(sample_pattern=r"^(.+?)_m\d+"))
+    assert assignment.get_sample("other.bam") is None
+    assert assignment.get_movies_by_sample(file_names) == {
+        "HG002": ["HG002_m64011.bam", "HG002_m64012.bam"],
+        "HG003": ["HG003_m64013.bam"],
+    }
+
+    # The group "sample" takes precedence over the first group
+    assignment = SampleAssignment(MergeConfig(sample_pattern=r"^(HG)(?P<sample>\d+)_"))
+    assert assignment.get_sample("HG002_m64011.bam") == "002"
+
+
+def test_sample_assignment_config_errors(tmp_path):
+    with pytest.raises(Exception, match="either sample_sheet or sample_pattern"):
+        SampleAssignment(MergeConfig())
+    with pytest.raises(Exception, match="either sample_sheet or sample_pattern"):
+        SampleAssignment(MergeConfig(sample_sheet=str(tmp_path / "samples.tsv"), sample_pattern="(.+)"))
+    with pytest.raises(Exception, match="needs a group"):
+        SampleAssignment(MergeConfig(sample_pattern=r"^HG\d+_"))
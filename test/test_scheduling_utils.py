@@ -0,0 +1,87 @@
+########################################################################
+#
+#   Authors:
+#       William Feng
+#       Harvard Medical School
+#       william_feng@gmail.com
+#
+#       Alexander Veit
+#       Harvard Medical School
+#       alexander_veit@hms.harvard.edu
+#
+#   Tests of the submission order, the in-flight caps and the completion
+#       estimate of batch runs.
+#
+########################################################################
+
+import pytest
+
+from src.scheduling_utils import (
+    ScheduledJob,
+    estimate_completion,
+    estimate_runtime,
+    hold_back_jobs,
+    order_largest_first,
+)
+
+GB = 1024**3
+
+
+def get_jobs(*runtimes: float):
+    """Jobs with the given runtimes in hours, whose input size is their runtime in GB"""
+
+    return [
+        ScheduledJob(file_name=f"m{i}.bam", step="alignment", input_size=int(runtime * GB), estimated_runtime=runtime * 3600)
+        for i, runtime in enumerate(runtimes)
+    ]
+
+
+def test_estimate_runtime():
+    assert estimate_runtime(30 * GB, gb_per_hour=10.0) == 3 * 3600
+
+
+def test_order_largest_first():
+    jobs = get_jobs(1, 3, 2, 3)
+
+    ordered = order_largest_first(jobs)
+
+    # Stable for equal sizes
+    assert [job.file_name for job in ordered] == ["m1.bam", "m3.bam", "m2.bam", "m0.bam"]
+
+
+@pytest.mark.parametrize(
+    "num_in_flight,max_in_flight,held_back",
+    [
+        (0, None, [False, False, False]),
+        (5, None, [False, False, False]),
+        (0, 2, [False, False, True]),
+        (1, 2, [False, True, True]),
+        # More jobs in flight than the cap, e.g. after the cap was lowered
+        (3, 2, [True, True, True]),
+        (0, 0, [True, True, True]),
+    ],
+)
+def test_hold_back_jobs(num_in_flight, max_in_flight, held_back):
+    jobs = get_jobs(3, 2, 1)
+
+    hold_back_jobs(jobs, num_in_flight, max_in_flight)
+
+    assert [job.held_back for job in jobs] == held_back
+
+
+def test_estimate_completion():
+    jobs = get_jobs(3, 2, 1, 1)
+
+    # Two slots, one of them busy for another hour with an in-flight job
+    completion = estimate_completion(jobs, [3600.0], max_in_flight=2)
+
+    assert [(job.estimated_start / 3600, job.estimated_finish / 3600) for job in jobs] == [(0, 3), (1, 3), (3, 4), (3, 4)]
+    assert completion == 4 * 3600
+
+
+def test_estimate_completion_without_limit():
+    jobs = get_jobs(3, 2)
+
+    assert estimate_completion(jobs, [5 * 3600.0], max_in_flight=None) == 5 * 3600
+    assert [job.estimated_start for job in jobs] == [0, 0]
+    assert estimate_completion([], [], max_in_flight=None) == 0
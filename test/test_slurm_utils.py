@@ -0,0 +1,216 @@
+########################################################################
+#
+#   Authors:
+#       William Feng
+#       Harvard Medical School
+#       william_feng@gmail.com
+#
+#       Alexander Veit
+#       Harvard Medical School
+#       alexander_veit@hms.harvard.edu
+#
+#   Tests of the sbatch submissions and the Slurm job states.
+#
+########################################################################
+
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from fakes import create_fake_tool
+from src.config_utils import SlurmConfig
+from src.slurm_utils import (
+    JOB_IDS_PER_CALL,
+    JobSubmission,
+    SubmissionLimiter,
+    get_active_job_ids,
+    get_job_states,
+    parse_job_id,
+    read_job_marker,
+    submit_sbatch_jobs,
+)
+from src.Pbmm2Workflow import Pbmm2Workflow
+
+TRANSIENT_ERROR = "sbatch: error: Batch job submission failed: Socket timed out on send/recv operation"
+PERMANENT_ERROR = "sbatch: error: Batch job submission failed: Invalid account or account/partition combination specified"
+
+
+def get_submission(folder, name: str) -> JobSubmission:
+    return JobSubmission(
+        job_name=f"job_{name}",
+        input_path=str(folder / f"{name}.bam"),
+        command="true",
+        slurm_out=str(folder / f"{name}.align_slurm_out"),
+        time="0-01:00:00",
+        memory="1G",
+        threads=1,
+        mail_user="",
+        marker_path=str(folder / f"{name}.alignment_running"),
+    )
+
+
+def get_slurm_config(**submission_config) -> SlurmConfig:
+    return SlurmConfig(
+        allocated_time="0-01:00:00",
+        allocated_memory="1G",
+        allocated_threads=1,
+        mail_user="",
+        submission_config=submission_config,
+    )
+
+
+def create_fake_sbatch(workflow_env, failures: int, error: str = TRANSIENT_ERROR, output: str = None):
+    """Replaces the fake sbatch by one that fails `failures` times with the given error before it
+    succeeds. Every call is appended to the returned file.
+    """
+
+    calls = workflow_env["root"] / "sbatch_calls"
+    output = output or "Submitted batch job $((1000 + CALLS))"
+    sbatch = workflow_env["bin"] / "sbatch"
+    sbatch.write_text(f"""#!/bin/bash
+echo "$@" >> {calls}
+CALLS=$(wc -l < {calls})
+if [ "$CALLS" -le {failures} ]; then echo "{error}" >&2; exit 1; fi
+echo "{output}"
+""")
+    sbatch.chmod(0o755)
+    return calls
+
+
+def count_calls(calls) -> int:
+    return len(calls.read_text().splitlines()) if calls.exists() else 0
+
+
+def test_parse_job_id():
+    assert parse_job_id("Submitted batch job 1234\n") == "1234"
+    assert parse_job_id("sbatch: warning: ...\nSubmitted batch job 42") == "42"
+    assert parse_job_id("Submitted batch job") is None
+
+
+def test_submit_sbatch_jobs_parses_job_id(workflow_env, tmp_path):
+    calls = create_fake_sbatch(workflow_env, failures=0)
+    slurm_config = get_slurm_config()
+    submission, = submit_sbatch_jobs([get_submission(tmp_path, "m0")], slurm_config)
+
+    assert submission.job_id == "1001"
+    assert submission.error is None
+    # The sbatch arguments end with the wrapped command
+    assert calls.read_text().startswith("-J job_m0 -p park -A park_contrib")
+
+
+def test_submit_sbatch_jobs_reports_unparsable_output(workflow_env, tmp_path):
+    create_fake_sbatch(workflow_env, failures=0, output="Something unexpected")
+    submission, = submit_sbatch_jobs([get_submission(tmp_path, "m0")], get_slurm_config())
+
+    assert submission.job_id is None
+    assert "Could not parse job ID" in submission.error
+
+
+def test_submit_sbatch_jobs_retries_transient_errors(workflow_env, tmp_path):
+    calls = create_fake_sbatch(workflow_env, failures=2)
+    slurm_config = get_slurm_config(max_submission_retries=3, retry_backoff_seconds=0.01)
+    submission, = submit_sbatch_jobs([get_submission(tmp_path, "m0")], slurm_config)
+
+    assert submission.job_id == "1003"
+    assert count_calls(calls) == 3
+
+
+def test_submit_sbatch_jobs_does_not_retry_permanent_errors(workflow_env, tmp_path):
+    calls = create_fake_sbatch(workflow_env, failures=1, error=PERMANENT_ERROR)
+    slurm_config = get_slurm_config(max_submission_retries=3, retry_backoff_seconds=0.01)
+    submission, = submit_sbatch_jobs([get_submission(tmp_path, "m0")], slurm_config)
+
+    assert submission.job_id is None
+    assert submission.error == f"sbatch exited with code 1: {PERMANENT_ERROR}"
+    assert count_calls(calls) == 1
+
+
+def test_submit_sbatch_jobs_gives_up_without_final_backoff(workflow_env, tmp_path):
+    calls = create_fake_sbatch(workflow_env, failures=10)
+    slurm_config = get_slurm_config(max_submission_retries=2, retry_backoff_seconds=0.2)
+
+    start = time.monotonic()
+    submission, = submit_sbatch_jobs([get_submission(tmp_path, "m0")], slurm_config)
+    elapsed = time.monotonic() - start
+
+    assert submission.job_id is None
+    assert TRANSIENT_ERROR in submission.error
+    assert count_calls(calls) == 3
+    # Backoffs of 0.2s and 0.4s between the attempts, none after the last one (0.8s)
+    assert 0.6 <= elapsed < 1.2
+
+
+def test_submit_sbatch_jobs_respects_rate_limit(workflow_env, tmp_path):
+    calls = create_fake_sbatch(workflow_env, failures=0)
+    slurm_config = get_slurm_config(max_concurrent_submissions=8, submissions_per_second=20.0)
+
+    start = time.monotonic()
+    submissions = submit_sbatch_jobs([get_submission(tmp_path, f"m{i}") for i in range(6)], slurm_config)
+    elapsed = time.monotonic() - start
+
+    assert sorted(submission.job_id for submission in submissions) == [str(1001 + i) for i in range(6)]
+    assert count_calls(calls) == 6
+    assert elapsed >= 5 / 20
+
+
+@pytest.mark.parametrize("failures,submitted", [(0, True), (1, False)])
+def test_marker_is_only_written_after_confirmed_submission(workflow_env, tmp_path, failures, submitted):
+    create_fake_sbatch(workflow_env, failures=failures, error=PERMANENT_ERROR)
+    (tmp_path / "m0.bam").write_text("x")
+    workflow = Pbmm2Workflow(str(tmp_path), executor_name="slurm", check_requirements=False)
+    submission = get_submission(tmp_path, "m0")
+
+    if submitted:
+        workflow.submit_job(submission)
+        assert read_job_marker(submission.marker_path).job_id == "1001"
+    else:
+        with pytest.raises(Exception, match="Error submitting 1 job"):
+            workflow.submit_job(submission)
+        assert not (tmp_path / "m0.alignment_running").exists()
+
+
+def test_submission_limiter_is_shared_by_threads(workflow_env, tmp_path):
+    slurm_config = get_slurm_config(max_concurrent_submissions=4, submissions_per_second=20.0)
+    limiter = SubmissionLimiter(slurm_config)
+    batches = [[get_submission(tmp_path, f"m{i}_{j}") for j in range(5)] for i in range(2)]
+
+    start = time.monotonic()
+    with ThreadPoolExecutor(max_workers=2) as pool:
+        results = list(pool.map(lambda batch: submit_sbatch_jobs(batch, slurm_config, limiter), batches))
+    elapsed = time.monotonic() - start
+
+    assert all(submission.job_id for batch in results for submission in batch)
+    # 10 submissions at 20 per second, also though they were made from two event loops
+    assert elapsed >= 9 / 20
+
+
+def test_get_job_states_chunks_job_ids(workflow_env):
+    # Every job failed, the jobs divisible by 7 because a step ran out of memory
+    calls = create_fake_tool(workflow_env, "sacct", """
+for JOB_ID in ${JOB_IDS//,/ }; do
+    echo "$JOB_ID|FAILED"
+    if [ $((JOB_ID % 7)) -eq 0 ]; then echo "$JOB_ID.batch|OUT_OF_MEMORY"; fi
+done
+""")
+    job_ids = [str(i) for i in range(1, 2 * JOB_IDS_PER_CALL + 2)]
+
+    job_states = get_job_states(job_ids)
+
+    assert [len(line.split(",")) for line in calls.read_text().splitlines()] == [JOB_IDS_PER_CALL, JOB_IDS_PER_CALL, 1]
+    assert job_states == {job_id: "OUT_OF_MEMORY" if int(job_id) % 7 == 0 else "FAILED" for job_id in job_ids}
+
+
+def test_get_active_job_ids_chunks_job_ids(workflow_env):
+    # Only the even jobs are known to the controller, the first chunk has none of them
+    calls = create_fake_tool(workflow_env, "squeue", """
+ACTIVE=0
+for JOB_ID in ${JOB_IDS//,/ }; do
+    if [ $((JOB_ID % 2)) -eq 0 ] && [ "$JOB_ID" -gt 10000 ]; then echo "$JOB_ID"; ACTIVE=1; fi
+done
+if [ $ACTIVE -eq 0 ]; then echo "slurm_load_jobs error: Invalid job id specified" >&2; exit 1; fi
+""")
+    job_ids = [str(i) for i in range(1, JOB_IDS_PER_CALL + 1)] + [str(10001 + i) for i in range(10)]
+
+    assert get_active_job_ids(job_ids) == {str(10001 + i) for i in range(10) if (10001 + i) % 2 == 0}
+    assert len(calls.read_text().splitlines()) == 2
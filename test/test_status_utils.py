@@ -0,0 +1,122 @@
+########################################################################
+#
+#   Authors:
+#       William Feng
+#       Harvard Medical School
+#       william_feng@gmail.com
+#
+#       Alexander Veit
+#       Harvard Medical School
+#       alexander_veit@hms.harvard.edu
+#
+#   Tests of the cached state snapshots of o2p-status.
+#
+########################################################################
+
+import json
+import os
+from datetime import datetime
+from types import SimpleNamespace
+
+import pytest
+
+from fakes import create_project_folder, update_config
+from src import snapshot_utils, status_utils
+from src.config_utils import load_config
+from src.Pbmm2Workflow import STATE_PENDING, STATE_WORKFLOW_COMPLETE
+from src.status_utils import get_cache_path, get_status, get_status_json
+
+TTL_SECONDS = 60
+
+
+@pytest.fixture
+def status_env(workflow_env, tmp_path, monkeypatch):
+    """Project folder with one sample per state, a fake clock (status_env["now"]) and a counter
+    of the folder listings (status_env["listings"])
+    """
+
+    update_config(workflow_env["config"], status_config={"cache_dir": str(tmp_path / "cache"), "ttl_seconds": TTL_SECONDS})
+    folder = tmp_path / "project"
+    samples = create_project_folder(folder, 7)
+    env = {"folder": str(folder), "samples": samples, "now": 1000.0, "listings": 0}
+    monkeypatch.setattr(status_utils, "time", SimpleNamespace(time=lambda: env["now"]))
+    iter_files = snapshot_utils.iter_files
+
+    def count_listing(folder, **kwargs):
+        env["listings"] += 1
+        return iter_files(folder, **kwargs)
+
+    monkeypatch.setattr(snapshot_utils, "iter_files", count_listing)
+    return env
+
+
+def test_status_is_cached_within_ttl(status_env):
+    config = load_config()
+    status = get_status(config, status_env["folder"])
+
+    assert status_env["listings"] == 1
+    assert status["created"] == 1000.0
+    assert status["states"][status_env["samples"]["pending"][0]] == STATE_PENDING
+    assert os.path.isfile(get_cache_path(config, status_env["folder"]))
+
+    status_env["now"] += TTL_SECONDS - 1
+    assert get_status(config, status_env["folder"]) == status
+    assert status_env["listings"] == 1
+
+    # Expired
+    status_env["now"] += 1
+    assert get_status(config, status_env["folder"])["created"] == 1000.0 + TTL_SECONDS
+    assert status_env["listings"] == 2
+
+
+def test_refresh_ignores_cached_status(status_env):
+    config = load_config()
+    get_status(config, status_env["folder"])
+
+    assert get_status(config, status_env["folder"], refresh=True)["created"] == 1000.0
+    assert status_env["listings"] == 2
+
+
+@pytest.mark.parametrize("subfolder", ["", "qc", "qc_merged"])
+def test_new_file_invalidates_cached_status(status_env, subfolder):
+    config = load_config()
+    get_status(config, status_env["folder"])
+    mtimes = status_utils.get_folder_mtimes(status_env["folder"])
+
+    folder = os.path.join(status_env["folder"], subfolder)
+    os.makedirs(folder, exist_ok=True)
+    with open(f"{folder}/new.bam", "w") as new_file:
+        new_file.write("x")
+    # Make sure the change is visible even with a coarse mtime resolution
+    os.utime(folder, (mtimes[0] + 10, mtimes[0] + 10))
+
+    status = get_status(config, status_env["folder"])
+    assert status_env["listings"] == 2
+    assert ("new.bam" in status["states"]) == (subfolder == "")
+
+
+def test_invalid_cache_file_is_ignored(status_env):
+    config = load_config()
+    cache_path = get_cache_path(config, status_env["folder"])
+    os.makedirs(os.path.dirname(cache_path))
+    with open(cache_path, "w") as cache_file:
+        cache_file.write("{")
+
+    assert len(get_status(config, status_env["folder"])["states"]) == 7
+    assert status_env["listings"] == 1
+
+
+def test_get_status_json(status_env):
+    status = get_status(load_config(), status_env["folder"])
+
+    report = json.loads(get_status_json([status], [STATE_WORKFLOW_COMPLETE]))
+
+    assert len(report) == 1
+    assert report[0]["folder"] == status_env["folder"]
+    assert report[0]["snapshot_time"] == datetime.fromtimestamp(1000.0).isoformat(timespec="seconds")
+    # Counts of all states, samples only of the filtered states
+    assert sum(report[0]["counts"].values()) == 7
+    assert report[0]["counts"][STATE_PENDING] == 1
+    assert report[0]["samples"] == [
+        {"file_name": file_name, "state": STATE_WORKFLOW_COMPLETE} for file_name in status_env["samples"]["complete"]
+    ]
@@ -0,0 +1,144 @@
+########################################################################
+#
+#   Authors:
+#       William Feng
+#       Harvard Medical School
+#       william_feng@gmail.com
+#
+#       Alexander Veit
+#       Harvard Medical School
+#       alexander_veit@hms.harvard.edu
+#
+#   Tests of the per-sample timelines reconstructed from the master log.
+#
+########################################################################
+
+import pytest
+
+from src.timeline_utils import (
+    STEP_ALIGNMENT,
+    STEP_CHECKS,
+    STEP_QC,
+    STEP_CRAM,
+    STEP_MERGE,
+    build_timelines,
+    summarize,
+)
+
+
+def get_log(folder) -> str:
+    """Log of movie s0 through all steps incl. the CRAM conversion, of movie s1 whose alignment
+    was resubmitted and of the merge of sample HG002
+    """
+
+    resources = "time=0-06:00:00, mem=48G, threads=32"
+    entries = [
+        ("00:00:00", f"Submitting job to run pbmm2 on {folder}/s0.bam. {resources}"),
+        ("00:00:01", f"Submitted slurm job 100 (o2p_align_pbmm2). Signal file: {folder}/s0.alignment_running"),
+        ("00:00:00", f"Submitting job to run pbmm2 on {folder}/s1.bam. {resources}"),
+        ("00:00:01", f"Submitted slurm job 101 (o2p_align_pbmm2). Signal file: {folder}/s1.alignment_running"),
+        ("01:00:00", f"Submitting job to run pbmm2 on {folder}/s1.bam. {resources}"),
+        ("01:00:01", f"Submitted slurm job 102 (o2p_align_pbmm2). Signal file: {folder}/s1.alignment_running"),
+        ("01:30:00", f"Running checks on {folder}/s1.bam."),
+        ("02:00:00", f"Running checks on {folder}/s0.bam."),
+        ("02:10:00", f"Submitting job to run samtools stats on {folder}/s0.aligned_sorted.bam. {resources}"),
+        ("02:10:01", f"Submitted slurm job 103 (o2p_qc_samtools_stats). Signal file: {folder}/s0.aligned_sorted.qc_running"),
+        ("03:10:00", f"Parsing QC outputs for {folder}/s0.bam and storing .qc file"),
+        ("03:20:00", f"Submitting job to run samtools view on {folder}/s0.aligned_sorted.bam. {resources}"),
+        ("03:20:01", f"Submitted slurm job 104 (o2p_cram_samtools). Signal file: {folder}/s0.aligned_sorted.cram_running"),
+        (
+            "05:20:00",
+            f"Verified CRAM {folder}/s0.aligned_sorted.cram against the QC of {folder}/s0.bam: 10 primary records. "
+            "Removing the aligned BAM.",
+        ),
+        ("06:00:00", f"Submitting job to run samtools merge on {folder}/HG002.bam. {resources}"),
+        ("06:00:01", f"Submitted slurm job 105 (o2p_merge_samtools). Signal file: {folder}/HG002.merge_running"),
+        (
+            "07:00:00",
+            f"Verified merged BAM {folder}/HG002.merged.aligned_sorted.bam against the QC of {folder}/HG002.bam: "
+            "300 records from 2 movies. Removing the aligned movie BAMs.",
+        ),
+    ]
+    lines = [f"2026-01-01, {time} UTC\t{message}" for time, message in entries]
+    # Output of other tools in the log is skipped
+    lines.insert(2, "[INFO] pbmm2 align output")
+    return "\n".join(lines) + "\n"
+
+
+@pytest.fixture
+def timelines(tmp_path):
+    folder = tmp_path / "project"
+    folder.mkdir()
+    (folder / "s0.bam").write_text("x" * 100)
+    (folder / "s1.bam").write_text("x" * 100)
+    log = tmp_path / "o2p.log"
+    log.write_text(get_log(folder))
+    return folder, build_timelines(str(log))
+
+
+def test_build_timelines(timelines):
+    folder, timings = timelines
+    by_step = {(timing.sample.rsplit("/", 1)[1], timing.step): timing for timing in timings}
+
+    assert sorted(by_step) == sorted(
+        [
+            ("s0.bam", STEP_ALIGNMENT),
+            ("s0.bam", STEP_CHECKS),
+            ("s0.bam", STEP_QC),
+            ("s0.bam", STEP_CRAM),
+            ("s1.bam", STEP_ALIGNMENT),
+            ("s1.bam", STEP_CHECKS),
+            ("HG002.bam", STEP_MERGE),
+        ]
+    )
+    assert by_step[("s0.bam", STEP_ALIGNMENT)].sample == f"{folder}/s0.bam"
+    assert by_step[("s0.bam", STEP_ALIGNMENT)].input_size == 100
+    assert by_step[("HG002.bam", STEP_MERGE)].input_size is None
+    assert [by_step[("s0.bam", step)].job_id for step in [STEP_ALIGNMENT, STEP_QC, STEP_CRAM]] == ["100", "103", "104"]
+    # The resubmission starts the step over
+    assert by_step[("s1.bam", STEP_ALIGNMENT)].job_id == "102"
+    assert by_step[("s1.bam", STEP_ALIGNMENT)].turnaround == 30 * 60
+    assert by_step[("s0.bam", STEP_ALIGNMENT)].turnaround == 2 * 3600
+    # The checks end when they are run, the QC job is submitted 10 minutes later
+    assert by_step[("s0.bam", STEP_CHECKS)].human_gap == 10 * 60
+    assert by_step[("s0.bam", STEP_QC)].turnaround == 3600
+    assert by_step[("s0.bam", STEP_CRAM)].turnaround == 2 * 3600
+    assert by_step[("HG002.bam", STEP_MERGE)].turnaround == 3600
+    # The checks of s1 were never followed by a QC submission
+    assert by_step[("s1.bam", STEP_CHECKS)].next_action is None
+    # Without the job times from sacct
+    assert all(timing.queue_wait is None and timing.run_time is None for timing in timings)
+
+
+def test_build_timelines_with_path_filter(timelines, tmp_path):
+    timings = build_timelines(str(tmp_path / "o2p.log"), path_filter="/s1.bam")
+
+    assert sorted(timing.step for timing in timings) == [STEP_ALIGNMENT, STEP_CHECKS]
+
+
+def test_summarize(timelines):
+    _, timings = timelines
+
+    rows = summarize(timings, by_size=False)
+
+    assert [(row["step"], row["metric"], row["n"]) for row in rows] == [
+        (STEP_ALIGNMENT, "turnaround", 2),
+        (STEP_CHECKS, "human_gap", 1),
+        (STEP_CHECKS, "turnaround", 1),
+        (STEP_QC, "turnaround", 1),
+        (STEP_CRAM, "turnaround", 1),
+        (STEP_MERGE, "turnaround", 1),
+    ]
+    # 30 minutes and 2 hours
+    assert rows[0]["p50"] == 75 * 60
+    assert rows[0]["p90"] == pytest.approx(30 * 60 + 0.9 * 90 * 60)
+    assert rows[0]["p99"] == pytest.approx(30 * 60 + 0.99 * 90 * 60)
+
+    rows = summarize(timings, by_size=True)
+    assert {(row["step"], row["size"]) for row in rows} == {
+        (STEP_ALIGNMENT, "0-5 GB"),
+        (STEP_CHECKS, "0-5 GB"),
+        (STEP_QC, "0-5 GB"),
+        (STEP_CRAM, "0-5 GB"),
+        (STEP_MERGE, "unknown"),
+    }
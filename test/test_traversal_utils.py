@@ -0,0 +1,68 @@
+########################################################################
+#
+#   Authors:
+#       William Feng
+#       Harvard Medical School
+#       william_feng@gmail.com
+#
+#       Alexander Veit
+#       Harvard Medical School
+#       alexander_veit@hms.harvard.edu
+#
+#   Tests of the folder traversal.
+#
+########################################################################
+
+import os
+
+import pytest
+
+from src.traversal_utils import iter_files, scan_folder
+
+
+@pytest.fixture
+def folder_tree(tmp_path):
+    for path in ["a.qc", "run1/b.qc", "run1/c.txt", "run1/tmp/d.qc", "run2/deep/e.qc"]:
+        (tmp_path / path).parent.mkdir(parents=True, exist_ok=True)
+        (tmp_path / path).write_text("")
+    return tmp_path
+
+
+def get_relative_paths(root, paths):
+    return sorted(os.path.relpath(path, root) for path in paths)
+
+
+def test_iter_files(folder_tree):
+    paths = iter_files(str(folder_tree), include=["*.qc"])
+
+    assert get_relative_paths(folder_tree, paths) == ["a.qc", "run1/b.qc", "run2/deep/e.qc"]
+
+
+def test_iter_files_max_depth_and_exclude(folder_tree):
+    paths = iter_files(str(folder_tree), include=["*.qc"], max_depth=1, exclude=["run1"])
+
+    assert get_relative_paths(folder_tree, paths) == ["a.qc"]
+
+
+@pytest.mark.skipif(os.geteuid() == 0, reason="Permissions are not enforced for root.")
+def test_unreadable_folder_is_skipped(workflow_env, folder_tree, capsys):
+    unreadable = folder_tree / "run1"
+    unreadable.chmod(0)
+    try:
+        paths = list(iter_files(str(folder_tree), include=["*.qc"]))
+    finally:
+        unreadable.chmod(0o755)
+
+    assert get_relative_paths(folder_tree, paths) == ["a.qc", "run2/deep/e.qc"]
+    assert f"Skipping folder {unreadable}" in capsys.readouterr().out
+    assert f"Skipping folder {unreadable}" in workflow_env["log"].read_text()
+
+
+def test_scan_folder_reports_os_errors(workflow_env, tmp_path, capsys):
+    # Listing a file fails with NotADirectoryError, like listing a folder without permission
+    (tmp_path / "file").write_text("")
+
+    assert scan_folder(str(tmp_path / "file")) == ([], [])
+    assert scan_folder(str(tmp_path / "missing")) == ([], [])
+    assert f"Skipping folder {tmp_path / 'file'}" in capsys.readouterr().out
+    assert f"Skipping folder {tmp_path / 'file'}" in workflow_env["log"].read_text()
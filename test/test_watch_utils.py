@@ -0,0 +1,122 @@
+########################################################################
+#
+#   Authors:
+#       William Feng
+#       Harvard Medical School
+#       william_feng@gmail.com
+#
+#       Alexander Veit
+#       Harvard Medical School
+#       alexander_veit@hms.harvard.edu
+#
+#   Tests of the folder watcher that starts the workflow for newly
+#       transferred unaligned BAMs.
+#
+########################################################################
+
+import time
+from types import SimpleNamespace
+
+import pytest
+
+from src import watch_utils
+from src.watch_utils import FolderWatcher
+
+STABILITY_WINDOW = 0.2
+
+
+def create_watcher(folder, use_inotify: bool) -> FolderWatcher:
+    """Watcher of a folder. The stable files are collected in watcher.started"""
+
+    started = []
+    watcher = FolderWatcher(
+        [str(folder)],
+        "aligned_sorted.bam",
+        lambda folder, file_name: started.append(file_name),
+        stability_window=STABILITY_WINDOW,
+        poll_interval=0.01,
+        use_inotify=use_inotify,
+    )
+    watcher.started = started
+    return watcher
+
+
+@pytest.fixture(params=[True, False], ids=["inotify", "polling"])
+def use_inotify(request):
+    return request.param
+
+
+@pytest.fixture
+def watcher(tmp_path, use_inotify):
+    folder_watcher = create_watcher(tmp_path, use_inotify)
+    yield folder_watcher
+    if folder_watcher.inotify:
+        folder_watcher.inotify.close()
+
+
+def test_file_is_started_once_stable(watcher, tmp_path):
+    bam = tmp_path / "m0.bam"
+    bam.write_text("x")
+    (tmp_path / "m0.aligned_sorted.bam").write_text("x")
+    (tmp_path / ".m1.bam.partial").write_text("x")
+    watcher.detect_new_files()
+    assert list(watcher.candidates) == [(str(tmp_path), "m0.bam")]
+
+    watcher.check_candidates()
+    # Still growing
+    with open(bam, "a") as bam_file:
+        bam_file.write("x")
+    watcher.check_candidates()
+    assert watcher.started == []
+
+    time.sleep(STABILITY_WINDOW)
+    watcher.check_candidates()
+    assert watcher.started == ["m0.bam"]
+    assert watcher.candidates == {}
+
+    # A file is only started once
+    watcher.detect_new_files()
+    watcher.check_candidates()
+    assert watcher.started == ["m0.bam"]
+
+
+def test_file_that_disappears_is_dropped(watcher, tmp_path):
+    (tmp_path / "m0.bam").write_text("x")
+    watcher.detect_new_files()
+    watcher.check_candidates()
+
+    (tmp_path / "m0.bam").unlink()
+    time.sleep(STABILITY_WINDOW)
+    watcher.check_candidates()
+
+    assert watcher.candidates == {}
+    assert watcher.started == []
+
+
+def test_existing_files(tmp_path, use_inotify):
+    for name in ["m0.bam", "m1.bam"]:
+        (tmp_path / name).write_text("x")
+    watcher = create_watcher(tmp_path, use_inotify)
+
+    watcher.add_existing_files(lambda folder, file_name: file_name == "m1.bam")
+
+    assert list(watcher.candidates) == [(str(tmp_path), "m1.bam")]
+    # Files that are already known are not detected as new
+    watcher.detect_new_files()
+    assert list(watcher.candidates) == [(str(tmp_path), "m1.bam")]
+    if watcher.inotify:
+        watcher.inotify.close()
+
+
+def test_inotify_timeout_is_not_negative(tmp_path, monkeypatch):
+    watcher = FolderWatcher([str(tmp_path)], "aligned_sorted.bam", None, STABILITY_WINDOW, 1.0, use_inotify=True)
+    timeouts = []
+    monkeypatch.setattr(watcher.inotify, "read_events", lambda timeout: timeouts.append(timeout) or [])
+    # The deadline (1.0) passes between the loop condition (0.9) and the timeout (1.5)
+    clock = iter([0.0, 0.9, 1.5, 2.0])
+    monkeypatch.setattr(watch_utils, "time", SimpleNamespace(time=lambda: next(clock)))
+
+    watcher.detect_new_files()
+    watcher.inotify.close()
+
+    assert timeouts == [0.0]